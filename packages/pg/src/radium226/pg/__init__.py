@@ -1,6 +1,9 @@
 from .postgresql import PostgreSQL
+from .pool import PostgreSQLPool, Database
 
 
 __all__ = [
     "PostgreSQL",
+    "PostgreSQLPool",
+    "Database",
 ]
\ No newline at end of file
@@ -0,0 +1,137 @@
+import fcntl
+from contextlib import ExitStack, closing, contextmanager
+from dataclasses import dataclass
+from os import cpu_count, getpid, kill
+from pathlib import Path
+from signal import SIGINT
+from typing import Iterator
+from uuid import uuid4
+
+import psycopg2
+
+from .postgresql import PostgreSQL
+
+
+@dataclass(frozen=True, slots=True)
+class Database():
+    """A database of its own, created for a test in one of the instances of the pool."""
+
+    host: str
+    port: int
+    name: str
+    # The data directory of the instance, where its certificates are
+    folder_path: Path
+    ssl: bool
+
+    @contextmanager
+    def connect(self):
+        with closing(psycopg2.connect(
+            dbname=self.name,
+            user="postgres",
+            host=self.host,
+            port=self.port,
+            sslmode="require" if self.ssl else "disable",
+        )) as connection:
+            yield connection
+
+
+class PostgreSQLPool():
+    """Running PostgreSQL instances, shared by the processes given the same folder (like the pytest-xdist workers).
+
+    An instance is leased by locking its lock file, and is started by the first process leasing it. The instances then
+    keep running until the last process using the pool leaves it, which is told by a lock file that every process
+    holds a shared lock on.
+    """
+
+    _folder_path: Path
+    _size: int
+    _ssl: bool
+
+    _exit_stack: ExitStack
+
+    def __init__(self, folder_path: Path, size: int | None = None, ssl: bool = False):
+        self._folder_path = folder_path
+        self._size = size or cpu_count() or 1
+        self._ssl = ssl
+        self._exit_stack = ExitStack()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _instance_folder_path(self, index: int) -> Path:
+        return self._folder_path / f"instance-{index}"
+
+    def __enter__(self):
+        self._folder_path.mkdir(parents=True, exist_ok=True)
+        self._lock_file = self._exit_stack.enter_context(( self._folder_path / "pool.lock" ).open("a"))
+        fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+        return self
+
+    def _lock_instance(self, exit_stack: ExitStack) -> int:
+        lock_files = [exit_stack.enter_context(( self._folder_path / f"instance-{index}.lock" ).open("a")) for index in range(self._size)]
+
+        # The processes start from different instances, so that they do not all try the same ones first
+        offset = getpid() % self._size
+        indices = [(offset + index) % self._size for index in range(self._size)]
+        for index in indices:
+            try:
+                fcntl.flock(lock_files[index], fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return index
+            except BlockingIOError:
+                pass
+
+        # All the instances are leased, so we wait for ours
+        fcntl.flock(lock_files[offset], fcntl.LOCK_EX)
+        return offset
+
+    @contextmanager
+    def lease(self) -> Iterator[PostgreSQL]:
+        """Leases an instance, which no other process uses until it is given back."""
+
+        with ExitStack() as exit_stack:
+            folder_path = self._instance_folder_path(self._lock_instance(exit_stack))
+            if ( pg := PostgreSQL.running(folder_path, ssl=self._ssl) ) is None:
+                pg = PostgreSQL(ssl=self._ssl, folder_path=folder_path).__enter__()
+                pg.detach()
+            yield pg
+
+    @contextmanager
+    def database(self, template: str = "template1") -> Iterator[Database]:
+        """Creates a database for the time of the block, in a leased instance."""
+
+        with self.lease() as pg:
+            name = f"test_{uuid4().hex}"
+            with pg.connect() as connection:
+                connection.autocommit = True
+                with closing(connection.cursor()) as cursor:
+                    cursor.execute(f'CREATE DATABASE "{name}" TEMPLATE "{template}"')
+            try:
+                yield Database(pg.host, pg.port, name, pg.folder_path, self._ssl)
+            finally:
+                with pg.connect() as connection:
+                    connection.autocommit = True
+                    with closing(connection.cursor()) as cursor:
+                        # The connections that the test left open do not keep the database around
+                        cursor.execute(f'DROP DATABASE "{name}" WITH (FORCE)')
+
+    def _stop_instances(self):
+        for index in range(self._size):
+            try:
+                lines = ( self._instance_folder_path(index) / "postmaster.pid" ).read_text().splitlines()
+                # A fast shutdown, which does not wait for the clients to leave
+                kill(int(lines[0]), SIGINT)
+            except (FileNotFoundError, IndexError, ValueError, ProcessLookupError):
+                pass
+
+    def __exit__(self, type, value, traceback):
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Other processes are still using the instances
+            pass
+        else:
+            self._stop_instances()
+        self._exit_stack.close()
+        return False
@@ -1,27 +1,40 @@
 from pathlib import Path
-from subprocess import Popen, run
+from subprocess import Popen, run, CalledProcessError
 from contextlib import ExitStack, closing, contextmanager
 from signal import SIGTERM
 from temppathlib import TemporaryDirectory
 import psycopg2
-from os import chmod
-from shutil import copy2 as copy
+from os import chmod, environ, kill
+from shutil import copy2 as copy, copytree
 from textwrap import dedent
+from hashlib import sha256
+from time import sleep, monotonic
+import socket
 
 from .random_port import random_port
-from .retry import retry
+
+
+STARTUP_TIMEOUT = 30.0
+
+
+def _cache_folder_path() -> Path:
+    if cache_folder_path := environ.get("RADIUM226_PG_CACHE_DIR"):
+        return Path(cache_folder_path)
+    return Path(environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "radium226-pg"
 
 
 class PostgreSQL():
 
     _folder_path: Path
     _port: int | None
+    _process: Popen | None
     _exit_stack: ExitStack
 
 
     def __init__(self, ssl: bool = False, folder_path: Path | None = None):
         self._exit_stack = ExitStack()
         self._port = None
+        self._process = None
         self._ssl = ssl
 
         if folder_path is None:
@@ -32,9 +45,7 @@ class PostgreSQL():
     def __enter__(self):
         self._folder_path.mkdir(parents=True, exist_ok=True)
         if not ( self._folder_path / "PG_VERSION" ).exists():
-            self._init_database()
-            if self._ssl:
-                self._generate_ssl_certificates()
+            self._clone_template(self._template_folder_path())
 
         port = self._start_instance()
         self._port = port
@@ -42,23 +53,79 @@ class PostgreSQL():
         return self
 
 
-    def _generate_ssl_certificates(self):
+    @classmethod
+    def running(cls, folder_path: Path, ssl: bool = False) -> "PostgreSQL | None":
+        """The instance which is already running in the folder (maybe started by another process), if any."""
+
+        try:
+            lines = ( folder_path / "postmaster.pid" ).read_text().splitlines()
+            process_id, port = int(lines[0]), int(lines[3])
+            kill(process_id, 0)
+        except (FileNotFoundError, IndexError, ValueError, ProcessLookupError):
+            return None
+
+        pg = cls(ssl=ssl, folder_path=folder_path)
+        pg._port = port
+        return pg if pg._is_ready() else None
+
+
+    def detach(self):
+        """Leaves the instance running once the `with` block is over, for other processes to use it."""
+        self._exit_stack.pop_all()
+
+
+    def _template_folder_path(self) -> Path:
+        """The cluster initialized once per PostgreSQL version (and SSL setting), which the instances are copies of."""
+
+        version = run(["initdb", "--version"], check=True, capture_output=True, text=True).stdout.strip()
+        key = sha256(f"{version} ssl={self._ssl}".encode()).hexdigest()[:16]
+        cache_folder_path = _cache_folder_path()
+        template_folder_path = cache_folder_path / f"template-{key}"
+        if ( template_folder_path / "PG_VERSION" ).exists():
+            return template_folder_path
+
+        cache_folder_path.mkdir(parents=True, exist_ok=True)
+        with TemporaryDirectory(base_tmp_dir=cache_folder_path, prefix="initdb-") as temporary_directory:
+            folder_path = temporary_directory.path / "data"
+            self._init_database(folder_path)
+            if self._ssl:
+                self._generate_ssl_certificates(folder_path)
+            try:
+                # The template only shows up once complete, and another process may have been faster
+                folder_path.rename(template_folder_path)
+            except OSError:
+                if not ( template_folder_path / "PG_VERSION" ).exists():
+                    raise
+        return template_folder_path
+
+
+    def _clone_template(self, template_folder_path: Path):
+        try:
+            # Where the filesystem supports it (like Btrfs or XFS), the files are shared until they are written to
+            run(["cp", "-a", "--reflink=auto", f"{template_folder_path}/.", f"{self._folder_path}"], check=True, capture_output=True)
+        except (CalledProcessError, FileNotFoundError):
+            copytree(template_folder_path, self._folder_path, dirs_exist_ok=True)
+        # PostgreSQL refuses to start if others can access the data directory
+        chmod(self._folder_path, 0o700)
+
+
+    def _generate_ssl_certificates(self, folder_path: Path):
         command = [
             "openssl",
             "req",
             "-nodes",
             "-new",
             "-x509",
-            "-keyout", f"{self._folder_path}/server.key",
-            "-out", f"{self._folder_path}/server.crt",
+            "-keyout", f"{folder_path}/server.key",
+            "-out", f"{folder_path}/server.crt",
             "-subj", "/C=US/ST=Test/L=Test/O=Test/CN=localhost",
         ]
         run(command, check=True)
 
-        chmod(f"{self._folder_path}/server.key", 0o400)
-        copy(f"{self._folder_path}/server.crt", f"{self._folder_path}/root.crt")
+        chmod(f"{folder_path}/server.key", 0o400)
+        copy(f"{folder_path}/server.crt", f"{folder_path}/root.crt")
 
-        with ( self._folder_path / "postgresql.conf" ).open("a") as file:
+        with ( folder_path / "postgresql.conf" ).open("a") as file:
             file.write(dedent("""\
                 ssl = on
                 ssl_ca_file = 'root.crt'
@@ -70,11 +137,13 @@ class PostgreSQL():
             """))
         
 
-    def _init_database(self):
+    def _init_database(self, folder_path: Path):
         command = [
             "initdb",
-            "-D", f"{self._folder_path}",
+            "-D", f"{folder_path}",
             "-U", "postgres",
+            # The clusters are thrown away, so there is no point in waiting for the disk
+            "--no-sync",
         ]
         run(command, check=True)
 
@@ -89,7 +158,7 @@ class PostgreSQL():
             "-c", f"listen_addresses=localhost",
         ]
 
-        process = Popen(command)
+        process = self._process = Popen(command)
         def stop_process():
             process.send_signal(SIGTERM)
             process.wait()
@@ -121,15 +190,33 @@ class PostgreSQL():
         return "localhost"
 
 
-    @retry(times=5, wait=1)
+    def _is_ready(self) -> bool:
+        # Like pg_ctl, we rely on the status that the postmaster writes in its PID file, and then on its socket
+        try:
+            lines = ( self._folder_path / "postmaster.pid" ).read_text().splitlines()
+        except FileNotFoundError:
+            return False
+        if len(lines) < 8 or lines[7].strip() != "ready":
+            return False
+
+        with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as unix_socket:
+            try:
+                unix_socket.connect(f"{self._folder_path.absolute()}/.s.PGSQL.{self.port}")
+            except OSError:
+                return False
+        return True
+
+
     def _wait_for_instance(self):
-        command = [
-            "pg_isready",
-            "-h", "localhost",
-            "-p", f"{self.port}",
-            "-U", "postgres",
-        ]
-        run(command, check=True)
+        deadline = monotonic() + STARTUP_TIMEOUT
+        wait = 0.005
+        while not self._is_ready():
+            if ( return_code := self._process.poll() ) is not None:
+                raise Exception(f"PostgreSQL exited with code {return_code}! ")
+            if monotonic() > deadline:
+                raise TimeoutError("PostgreSQL is not ready! ")
+            sleep(wait)
+            wait = min(wait * 2, 0.1)
 
 
     def __exit__(self, type, value, traceback):
@@ -1,4 +1,4 @@
-from radium226.pg import PostgreSQL
+from radium226.pg import PostgreSQL, PostgreSQLPool
 from contextlib import closing
 from time import sleep
 
@@ -11,4 +11,31 @@ def test_postgresql(ssl) -> None:
         with pg.connect() as connection:
             with closing(connection.cursor()) as cursor:
                 cursor.execute("SELECT 1")
-                assert cursor.fetchone() == (1,)
\ No newline at end of file
+                assert cursor.fetchone() == (1,)
+
+
+def test_postgresql_from_template(tmp_path, monkeypatch) -> None:
+    monkeypatch.setenv("RADIUM226_PG_CACHE_DIR", str(tmp_path))
+    with PostgreSQL() as first_pg, PostgreSQL() as second_pg:
+        # Both instances are copies of the same template, which is initialized only once
+        assert len(list(tmp_path.glob("template-*"))) == 1
+        assert first_pg.folder_path != second_pg.folder_path
+        for pg in [first_pg, second_pg]:
+            with pg.connect() as connection, closing(connection.cursor()) as cursor:
+                cursor.execute("SELECT 1")
+                assert cursor.fetchone() == (1,)
+
+
+def test_postgresql_pool(tmp_path) -> None:
+    with PostgreSQLPool(tmp_path, size=2) as postgresql_pool:
+        with postgresql_pool.database() as first_database, postgresql_pool.database() as second_database:
+            # Each database is in its own instance, as long as there are enough of them
+            assert first_database.port != second_database.port
+            for database in [first_database, second_database]:
+                with database.connect() as connection, closing(connection.cursor()) as cursor:
+                    cursor.execute("SELECT current_database()")
+                    assert cursor.fetchone() == (database.name,)
+
+        # The instance keeps running for the next lease
+        with postgresql_pool.database() as database:
+            assert database.port in (first_database.port, second_database.port)
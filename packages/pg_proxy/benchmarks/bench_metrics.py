@@ -0,0 +1,86 @@
+import struct
+from time import perf_counter, perf_counter_ns
+
+from radium226.pg_proxy.metrics import Metrics, Histogram
+from radium226.pg_proxy.wire import WireEventHandler
+
+
+DURATION_IN_SECONDS = 2.0
+
+CHUNK_SIZE = 4096
+
+QUERY_COUNT = 64
+
+
+def message(type: bytes, payload: bytes) -> bytes:
+    return type + struct.pack("!i", len(payload) + 4) + payload
+
+
+def frontend_stream() -> bytes:
+    return b"".join([
+        message(b"Q", b"SELECT * FROM users WHERE id = 42\x00"),
+        message(b"B", b"\x00\x00\x00\x00\x00\x01\x00\x00\x00\x0242\x00\x00"),
+        message(b"E", b"\x00\x00\x00\x00\x00"),
+        message(b"S", b""),
+    ] * QUERY_COUNT)
+
+
+def backend_stream() -> bytes:
+    data_row = message(b"D", b"\x00\x02\x00\x00\x00\x0242\x00\x00\x00\x0bHello World")
+    return b"".join([
+        *[data_row] * 10,
+        message(b"C", b"SELECT 10\x00"),
+        message(b"Z", b"I"),
+    ] * 2 * QUERY_COUNT)
+
+
+class _EventHandler(WireEventHandler):
+
+    def on_message_sent(self, frame: memoryview):
+        # The query analysis is left out, as only the cost of the metrics is measured
+        pass
+
+
+def chunks(stream: bytes) -> list[memoryview]:
+    return [memoryview(stream)[offset:offset + CHUNK_SIZE] for offset in range(0, len(stream), CHUNK_SIZE)]
+
+
+def bench_event_handler(name: str, metrics: Metrics | None) -> float:
+    frontend_chunks, backend_chunks = chunks(frontend_stream()), chunks(backend_stream())
+    message_count_per_round = 4 * QUERY_COUNT + 12 * 2 * QUERY_COUNT
+
+    event_handler = _EventHandler(metrics=metrics)
+    # The framers are past the startup phase
+    event_handler.on_chunk_sent(memoryview(struct.pack("!i", 9) + struct.pack("!i", 196608) + b"\x00"))
+
+    message_count = 0
+    begin = perf_counter()
+    while (elapsed := perf_counter() - begin) < DURATION_IN_SECONDS:
+        for chunk in frontend_chunks:
+            event_handler.on_chunk_sent(chunk)
+        for chunk in backend_chunks:
+            event_handler.on_chunk_received(chunk)
+        message_count += message_count_per_round
+
+    print(f"{name}: {message_count / elapsed:,.0f} messages/s")
+    return elapsed / message_count
+
+
+def bench_histogram():
+    histogram = Histogram("duration_seconds", "Duration")
+    record_count = 1_000_000
+    begin = perf_counter_ns()
+    for value in range(record_count):
+        histogram.record(value)
+    print(f"record: {(perf_counter_ns() - begin) / record_count:,.0f} ns")
+
+
+def main():
+    bench_histogram()
+    without_metrics = bench_event_handler("without metrics", None)
+    with_metrics = bench_event_handler("with metrics", Metrics())
+    print(f"overhead: {(with_metrics - without_metrics) * 1e9:,.0f} ns/message")
+
+
+if __name__ == "__main__":
+    main()
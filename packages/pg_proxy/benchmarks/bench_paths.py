@@ -0,0 +1,300 @@
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+from contextlib import ExitStack, closing, contextmanager, redirect_stdout
+from dataclasses import dataclass, asdict
+from enum import StrEnum, auto
+from multiprocessing import get_context
+from pathlib import Path
+from random import Random
+from threading import Thread, Barrier
+from time import perf_counter, perf_counter_ns, process_time
+from typing import Callable, Iterator
+
+import psycopg2
+from click import command, option, Choice
+
+from radium226.pg import PostgreSQL
+from radium226.pg.random_port import random_port
+from radium226.socket_forwarder import SocketForwarder, HostAndPort
+from radium226.pg_proxy import PostgreSQLProxy, PoolMode
+from radium226.pg_proxy.framing import Framer, FramerState
+from radium226.pg_proxy.metrics import Histogram
+from radium226.pg_proxy.wire import ClientCommand, encode_message, encode_startup_message
+
+
+DURATION_IN_SECONDS = 10.0
+
+CLIENT_COUNT = 8
+
+ROW_COUNT = 100_000
+
+
+class Target(StrEnum):
+
+    # The clients connect to PostgreSQL itself
+    DIRECT = auto()
+    # Through a SocketForwarder which does not look at the bytes
+    FORWARDER = auto()
+    # Through a PostgreSQLProxy which frames the messages and analyzes the queries
+    PROXY = auto()
+    # Through a PostgreSQLProxy which pools the backends
+    POOLER = auto()
+
+
+class Workload(StrEnum):
+
+    TINY = auto()
+    LARGE = auto()
+    COPY = auto()
+    EXTENDED = auto()
+
+
+DEFAULT_MIX = "tiny=8,large=1,copy=1,extended=4"
+
+
+class _Sink():
+
+    def write(self, data):
+        pass
+
+
+class ExtendedQueryClient():
+    """Runs a prepared statement with the extended query protocol, which psycopg2 does not speak."""
+
+    def __init__(self, port: int):
+        self._socket = socket.create_connection(("localhost", port))
+        self._framer = Framer(FramerState.MESSAGES)
+        self._socket.sendall(encode_startup_message({"user": "postgres", "database": "postgres"}))
+        self._read_until_ready()
+
+        self._socket.sendall(
+            encode_message(ClientCommand.PARSE, b"statement\x00SELECT $1::int + 1\x00\x00\x01\x00\x00\x00\x17")
+            + encode_message(ClientCommand.SYNC)
+        )
+        self._read_until_ready()
+
+    def _read_until_ready(self):
+        while True:
+            data = self._socket.recv(65536)
+            if not data:
+                raise ConnectionResetError("The server closed the connection")
+            for frame in self._framer.feed(data):
+                if frame[0:1] == b"E":
+                    raise RuntimeError(bytes(frame))
+                if frame[0:1] == b"Z":
+                    return
+
+    def execute(self, value: int):
+        parameter = str(value).encode()
+        self._socket.sendall(b"".join([
+            encode_message(ClientCommand.BIND, b"\x00statement\x00\x00\x00\x00\x01" + struct.pack("!i", len(parameter)) + parameter + b"\x00\x00"),
+            encode_message(ClientCommand.EXECUTE, b"\x00\x00\x00\x00\x00"),
+            encode_message(ClientCommand.SYNC),
+        ]))
+        self._read_until_ready()
+
+    def close(self):
+        with closing(self._socket):
+            self._socket.sendall(encode_message(ClientCommand.TERMINATE))
+
+
+class Client():
+    """One of the concurrent clients, with a connection for each kind of protocol."""
+
+    def __init__(self, port: int):
+        self._connection = psycopg2.connect(dbname="postgres", user="postgres", host="localhost", port=port, sslmode="disable")
+        self._connection.autocommit = True
+        self._cursor = self._connection.cursor()
+        self._extended_query_client = ExtendedQueryClient(port)
+
+    def run(self, workload: Workload, value: int):
+        match workload:
+            case Workload.TINY:
+                self._cursor.execute("SELECT 1")
+                self._cursor.fetchall()
+            case Workload.LARGE:
+                self._cursor.execute(f"SELECT generate_series(1, {ROW_COUNT})")
+                self._cursor.fetchall()
+            case Workload.COPY:
+                self._cursor.copy_expert(f"COPY (SELECT generate_series(1, {ROW_COUNT})) TO STDOUT", _Sink())
+            case Workload.EXTENDED:
+                self._extended_query_client.execute(value)
+
+    def close(self):
+        self._extended_query_client.close()
+        self._cursor.close()
+        self._connection.close()
+
+
+@dataclass(frozen=True, slots=True)
+class Result():
+
+    target: str
+    workload: str
+    request_count: int
+    throughput: float
+    p50_ms: float
+    p99_ms: float
+    p999_ms: float
+    # The CPU time of the benchmark process (the clients), and of the process in between (if any)
+    client_cpu_per_request_us: float
+    proxy_cpu_per_request_us: float
+
+
+def parse_mix(mix: str) -> list[tuple[Workload, int]]:
+    weights = []
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        weights.append((Workload(name.strip()), int(weight or 1)))
+    return weights
+
+
+def _serve(target: Target, remote_port: int, local_port: int, ready, stop):
+    local_host_and_port, remote_host_and_port = HostAndPort("localhost", local_port), HostAndPort("localhost", remote_port)
+    # The proxy prints every query, which would slow it down for nothing
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull), ExitStack() as exit_stack:
+        match target:
+            case Target.FORWARDER:
+                exit_stack.enter_context(SocketForwarder(local_host_and_port, remote_host_and_port))
+            case Target.PROXY:
+                exit_stack.enter_context(PostgreSQLProxy("localhost", remote_port, local_port=local_port))
+            case Target.POOLER:
+                exit_stack.enter_context(PostgreSQLProxy("localhost", remote_port, local_port=local_port, pool_mode=PoolMode.TRANSACTION))
+        ready.set()
+        stop.wait()
+
+
+@contextmanager
+def serving(target: Target, remote_port: int) -> Iterator[tuple[int, Callable[[], float]]]:
+    """Starts what is in between the clients and PostgreSQL in its own process, whose CPU time is known once it is over."""
+
+    if target == Target.DIRECT:
+        yield remote_port, lambda: 0.0
+        return
+
+    context = get_context("spawn")
+    ready, stop = context.Event(), context.Event()
+    local_port = random_port()
+    process = context.Process(target=_serve, args=(target, remote_port, local_port, ready, stop))
+
+    def children_cpu_time() -> float:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    cpu_time_before = children_cpu_time()
+    cpu_time = None
+    process.start()
+    try:
+        ready.wait()
+        # The CPU time of the process is only accounted for once it is joined
+        yield local_port, lambda: cpu_time
+    finally:
+        stop.set()
+        process.join()
+        cpu_time = children_cpu_time() - cpu_time_before
+
+
+def run_clients(port: int, client_count: int, duration: float, weights: list[tuple[Workload, int]]) -> tuple[dict[str, Histogram], float, float]:
+    workloads = [workload for workload, _ in weights]
+    histograms = {workload: Histogram(f"{workload}_duration", f"Duration of the {workload} requests") for workload in [*workloads, "all"]}
+    barrier = Barrier(client_count + 1)
+    errors = []
+
+    def run_client(index: int):
+        random = Random(index)
+        try:
+            client = Client(port)
+        except Exception as e:
+            errors.append(e)
+            barrier.wait()
+            return
+
+        with closing(client):
+            barrier.wait()
+            end = perf_counter() + duration
+            while perf_counter() < end:
+                workload, = random.choices(workloads, [weight for _, weight in weights])
+                begin = perf_counter_ns()
+                client.run(workload, random.randrange(1_000_000))
+                duration_in_us = (perf_counter_ns() - begin) // 1000
+                histograms[workload].record(duration_in_us)
+                histograms["all"].record(duration_in_us)
+
+    threads = [Thread(target=run_client, args=(index,)) for index in range(client_count)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    cpu_time_before, begin = process_time(), perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed, cpu_time = perf_counter() - begin, process_time() - cpu_time_before
+    if errors:
+        raise errors[0]
+    return histograms, elapsed, cpu_time
+
+
+def _results(target: Target, histograms: dict[str, Histogram], elapsed: float, client_cpu_time: float, proxy_cpu_time: float) -> list[Result]:
+    request_count = histograms["all"].count
+    results = []
+    # Each workload gets its latencies, while the CPU time can only be split evenly between the requests
+    for workload, histogram in histograms.items():
+        if (count := histogram.count) == 0:
+            continue
+
+        results.append(Result(
+            target=target,
+            workload=workload,
+            request_count=count,
+            throughput=count / elapsed,
+            p50_ms=histogram.percentile(50) / 1000,
+            p99_ms=histogram.percentile(99) / 1000,
+            p999_ms=histogram.percentile(99.9) / 1000,
+            client_cpu_per_request_us=client_cpu_time / request_count * 1e6,
+            proxy_cpu_per_request_us=proxy_cpu_time / request_count * 1e6,
+        ))
+    return results
+
+
+def _commit() -> str | None:
+    process = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent)
+    return process.stdout.strip() if process.returncode == 0 else None
+
+
+@command()
+@option("--target", "targets", type=Choice([target.value for target in Target]), multiple=True, default=[target.value for target in Target], show_default=True)
+@option("--clients", "client_count", type=int, default=CLIENT_COUNT, show_default=True, help="Number of concurrent clients")
+@option("--duration", type=float, default=DURATION_IN_SECONDS, show_default=True, help="Duration in seconds of each run")
+@option("--mix", default=DEFAULT_MIX, show_default=True, help="Weights of the workloads (tiny, large, copy and extended)")
+@option("--output", "output_path", type=Path, default=Path("bench_paths.json"), show_default=True, help="JSON file the results are written to")
+def main(targets: tuple[str, ...], client_count: int, duration: float, mix: str, output_path: Path):
+    weights = parse_mix(mix)
+    results = []
+    with PostgreSQL() as pg:
+        for target in map(Target, targets):
+            with serving(target, pg.port) as (port, proxy_cpu_time):
+                histograms, elapsed, client_cpu_time = run_clients(port, client_count, duration, weights)
+            target_results = _results(target, histograms, elapsed, client_cpu_time, proxy_cpu_time())
+            for result in target_results:
+                print(
+                    f"{result.target:>9} {result.workload:>8}: {result.throughput:>10,.0f} requests/s, "
+                    f"p50={result.p50_ms:.3f} ms p99={result.p99_ms:.3f} ms p999={result.p999_ms:.3f} ms, "
+                    f"cpu={result.client_cpu_per_request_us:,.0f} µs (clients) + {result.proxy_cpu_per_request_us:,.0f} µs (proxy) per request"
+                )
+            results += target_results
+
+    output_path.write_text(json.dumps({
+        "commit": _commit(),
+        "python": sys.version,
+        "parameters": {"client_count": client_count, "duration": duration, "mix": mix, "row_count": ROW_COUNT},
+        "results": [asdict(result) for result in results],
+    }, indent=2))
+    print(f"Results written to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
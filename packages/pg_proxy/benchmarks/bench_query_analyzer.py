@@ -0,0 +1,43 @@
+from random import Random
+from time import perf_counter
+
+from radium226.pg_proxy.query_analyzer import QueryAnalyzer, analyze
+
+
+DURATION_IN_SECONDS = 2.0
+
+STATEMENT_COUNT = 200
+
+
+def queries(count: int) -> list[str]:
+    random = Random(42)
+    # The same statement shapes come again and again, with different literals
+    return [
+        f"SELECT id, name FROM table_{random.randrange(STATEMENT_COUNT)} WHERE id = {random.randrange(1_000_000)} AND name = 'name-{index}'"
+        for index in range(count)
+    ]
+
+
+def bench(name: str, analyze) -> None:
+    query_list = queries(10_000)
+    query_count = 0
+    begin = perf_counter()
+    while (elapsed := perf_counter() - begin) < DURATION_IN_SECONDS:
+        for query in query_list[:1_000]:
+            analyze(query)
+            query_count += 1
+        query_list = query_list[1_000:] + query_list[:1_000]
+
+    print(f"{name}: {query_count / elapsed:,.0f} queries/s")
+
+
+def main():
+    bench("parse", analyze)
+
+    query_analyzer = QueryAnalyzer()
+    bench("cached", query_analyzer.analyze)
+    print(f"hits={query_analyzer.hit_count} misses={query_analyzer.miss_count}")
+
+
+if __name__ == "__main__":
+    main()
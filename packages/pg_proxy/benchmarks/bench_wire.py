@@ -0,0 +1,70 @@
+import struct
+from time import perf_counter
+
+from radium226.pg_proxy.framing import Framer
+from radium226.pg_proxy.wire import (
+    decode_frontend_message,
+    decode_backend_message,
+)
+
+
+DURATION_IN_SECONDS = 2.0
+
+CHUNK_SIZE = 4096
+
+
+def message(type: bytes, payload: bytes) -> bytes:
+    return type + struct.pack("!i", len(payload) + 4) + payload
+
+
+def frontend_stream() -> bytes:
+    return b"".join([
+        message(b"Q", b"SELECT * FROM information_schema.sql_features WHERE feature_id = '42'\x00"),
+        message(b"P", b"\x00SELECT * FROM users WHERE id = $1\x00\x00\x01\x00\x00\x00\x17"),
+        message(b"B", b"\x00\x00\x00\x00\x00\x01\x00\x00\x00\x0242\x00\x00"),
+        message(b"D", b"P\x00"),
+        message(b"E", b"\x00\x00\x00\x00\x00"),
+        message(b"S", b""),
+    ] * 64)
+
+
+def backend_stream() -> bytes:
+    row_description = message(b"T", b"\x00\x02" + b"".join(
+        name + b"\x00" + struct.pack("!ihihih", 0, 0, 23, 4, -1, 0)
+        for name in [b"id", b"name"]
+    ))
+    data_row = message(b"D", b"\x00\x02\x00\x00\x00\x0242\x00\x00\x00\x0bHello World")
+    return b"".join([
+        row_description,
+        *[data_row] * 100,
+        message(b"C", b"SELECT 100\x00"),
+        message(b"Z", b"I"),
+    ] * 8)
+
+
+def bench(name: str, stream: bytes, framer: Framer, decode) -> None:
+    chunks = [stream[offset:offset + CHUNK_SIZE] for offset in range(0, len(stream), CHUNK_SIZE)]
+    byte_count = 0
+    message_count = 0
+    begin = perf_counter()
+    while (elapsed := perf_counter() - begin) < DURATION_IN_SECONDS:
+        for chunk in chunks:
+            for frame in framer.feed(chunk):
+                decode(frame)
+                message_count += 1
+        byte_count += len(stream)
+
+    print(f"{name}: {message_count / elapsed:,.0f} messages/s, {byte_count / elapsed / 1024 / 1024:,.1f} MiB/s")
+
+
+def main():
+    frontend_framer, backend_framer = Framer.pair()
+    # Both framers are past the startup phase
+    list(frontend_framer.feed(struct.pack("!i", 9) + struct.pack("!i", 196608) + b"\x00"))
+
+    bench("frontend", frontend_stream(), frontend_framer, decode_frontend_message)
+    bench("backend", backend_stream(), backend_framer, decode_backend_message)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,13 @@
 from .postgresql_proxy import PostgreSQLProxy
+from .pool import PoolMode
+from .tls import SSLMode
+from .message_stream import MessageHandler, MessageStream
 
 
 __all__ = [
     "PostgreSQLProxy",
-]
\ No newline at end of file
+    "PoolMode",
+    "SSLMode",
+    "MessageHandler",
+    "MessageStream",
+]
@@ -0,0 +1,131 @@
+import hashlib
+import hmac
+import secrets
+from base64 import b64decode, b64encode
+
+from .wire import (
+    AUTHENTICATION_OK,
+    AUTHENTICATION_CLEARTEXT_PASSWORD,
+    AUTHENTICATION_MD5_PASSWORD,
+    AUTHENTICATION_SASL,
+    AUTHENTICATION_SASL_CONTINUE,
+    AUTHENTICATION_SASL_FINAL,
+    NULL_BYTE,
+)
+
+
+SCRAM_SHA_256 = "SCRAM-SHA-256"
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class PasswordRequiredError(AuthenticationError):
+    pass
+
+
+def md5_password(user: str, password: str, salt: bytes) -> bytes:
+    digest = hashlib.md5(password.encode() + user.encode()).hexdigest()
+    return b"md5" + hashlib.md5(digest.encode() + salt).hexdigest().encode()
+
+
+class ScramSha256Client():
+    """The client side of SCRAM-SHA-256 (RFC 5802 and RFC 7677), without channel binding."""
+
+    _password: str
+    _client_nonce: str
+
+    _client_first_message_bare: str
+    _server_signature: bytes | None
+
+    def __init__(self, password: str, client_nonce: str | None = None):
+        self._password = password
+        self._client_nonce = client_nonce or b64encode(secrets.token_bytes(18)).decode()
+        # The user name is taken from the StartupMessage by PostgreSQL
+        self._client_first_message_bare = f"n=,r={self._client_nonce}"
+        self._server_signature = None
+
+    def client_first_message(self) -> bytes:
+        return f"n,,{self._client_first_message_bare}".encode()
+
+    def client_final_message(self, server_first_message: bytes) -> bytes:
+        attributes = dict(attribute.split("=", 1) for attribute in server_first_message.decode().split(","))
+        nonce, salt, iteration_count = attributes["r"], b64decode(attributes["s"]), int(attributes["i"])
+        if not nonce.startswith(self._client_nonce):
+            raise AuthenticationError("The server nonce does not extend the client one")
+
+        client_final_message_without_proof = f"c=biws,r={nonce}"
+        auth_message = f"{self._client_first_message_bare},{server_first_message.decode()},{client_final_message_without_proof}".encode()
+
+        salted_password = hashlib.pbkdf2_hmac("sha256", self._password.encode(), salt, iteration_count)
+        client_key = hmac.digest(salted_password, b"Client Key", "sha256")
+        client_signature = hmac.digest(hashlib.sha256(client_key).digest(), auth_message, "sha256")
+        client_proof = bytes(a ^ b for a, b in zip(client_key, client_signature))
+
+        server_key = hmac.digest(salted_password, b"Server Key", "sha256")
+        self._server_signature = hmac.digest(server_key, auth_message, "sha256")
+
+        return f"{client_final_message_without_proof},p={b64encode(client_proof).decode()}".encode()
+
+    def verify_server_final_message(self, server_final_message: bytes) -> None:
+        attributes = dict(attribute.split("=", 1) for attribute in server_final_message.decode().split(","))
+        if "e" in attributes:
+            raise AuthenticationError(f"The server rejected the authentication: {attributes['e']}")
+        if not hmac.compare_digest(b64decode(attributes["v"]), self._server_signature):
+            raise AuthenticationError("The server signature is invalid")
+
+
+class Authenticator():
+    """Answers the authentication requests of a backend on behalf of a client whose password is known."""
+
+    _user: str
+    _password: str | None
+    _scram_client: ScramSha256Client | None
+
+    password_required: bool
+
+    def __init__(self, user: str, password: str | None):
+        self._user = user
+        self._password = password
+        self._scram_client = None
+
+        # Whether the backend asked for the password, or trusted us
+        self.password_required = False
+
+    def _require_password(self) -> str:
+        if self._password is None:
+            raise PasswordRequiredError(f"The backend requires a password for user {self._user}")
+        self.password_required = True
+        return self._password
+
+    def respond(self, code: int, data: bytes) -> bytes | None:
+        """Returns the payload of the PasswordMessage answering the request, or None if none is expected."""
+
+        match code:
+            case _ if code == AUTHENTICATION_OK:
+                return None
+
+            case _ if code == AUTHENTICATION_CLEARTEXT_PASSWORD:
+                return self._require_password().encode() + NULL_BYTE
+
+            case _ if code == AUTHENTICATION_MD5_PASSWORD:
+                return md5_password(self._user, self._require_password(), data[:4]) + NULL_BYTE
+
+            case _ if code == AUTHENTICATION_SASL:
+                mechanisms = data.rstrip(NULL_BYTE).split(NULL_BYTE)
+                if SCRAM_SHA_256.encode() not in mechanisms:
+                    raise AuthenticationError(f"No supported SASL mechanism in {mechanisms}")
+                self._scram_client = ScramSha256Client(self._require_password())
+                client_first_message = self._scram_client.client_first_message()
+                return SCRAM_SHA_256.encode() + NULL_BYTE + len(client_first_message).to_bytes(4, "big", signed=True) + client_first_message
+
+            case _ if code == AUTHENTICATION_SASL_CONTINUE:
+                return self._scram_client.client_final_message(data)
+
+            case _ if code == AUTHENTICATION_SASL_FINAL:
+                self._scram_client.verify_server_final_message(data)
+                return None
+
+            case _:
+                raise AuthenticationError(f"Unsupported authentication request: {code}")
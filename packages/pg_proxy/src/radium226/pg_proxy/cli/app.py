@@ -1,7 +1,124 @@
-from click import group, version_option
+from pathlib import Path
+
+from click import group, version_option, option, Choice, Path as PathType, BadParameter
+
+from radium226.socket_forwarder import Engine, OverflowPolicy, HostAndPort, Watermarks
+from radium226.socket_forwarder.flow_control import DEFAULT_MEMORY_BUDGET
+from radium226.socket_forwarder.admission import ADMISSION_TIMEOUT_IN_SECONDS
+
+from ..postgresql_proxy import PostgreSQLProxy
+from ..pool import PoolMode, DEFAULT_POOL_SIZE, DEFAULT_RESET_QUERY
+from ..result_cache import RESULT_CACHE_TTL
+from ..tls import SSLMode
+
+
+def parse_watermarks(value: str | None) -> Watermarks | None:
+    if value is None:
+        return None
+    high, low = value.split(":")
+    return Watermarks(high=int(high), low=int(low))
 
 
 @group()
 @version_option("1.0.0")
 def app():
-    print("Hello, World!")
\ No newline at end of file
+    pass
+
+
+@app.command()
+@option("--remote-host", default="localhost", show_default=True)
+@option("--remote-port", type=int, default=5432, show_default=True)
+@option("--local-host", default="localhost", show_default=True)
+@option("--local-port", type=int, default=5432, show_default=True)
+@option("--workers", "worker_count", type=int, default=1, show_default=True, help="Number of processes sharing the local port with SO_REUSEPORT")
+@option("--engine", type=Choice([engine.value for engine in Engine]), default=Engine.SELECTORS.value, show_default=True)
+@option("--dispatch-workers", "dispatch_worker_count", type=int, default=0, show_default=True, help="Number of threads inspecting the traffic off the forwarding loop (0 to inspect inline)")
+@option("--overflow-policy", type=Choice([overflow_policy.value for overflow_policy in OverflowPolicy]), default=OverflowPolicy.DROP.value, show_default=True)
+@option("--pool-mode", type=Choice([pool_mode.value for pool_mode in PoolMode]), default=None, help="Pool the backends instead of forwarding each client to its own one")
+@option("--pool-size", type=int, default=DEFAULT_POOL_SIZE, show_default=True, help="Maximum number of backends per user, database and startup parameters")
+@option("--reset-query", default=DEFAULT_RESET_QUERY, show_default=True, help="Query resetting a backend before another client gets it")
+@option("--result-cache-size", type=int, default=0, show_default=True, help="Size in bytes of the cache of read-only query results (0 to disable, requires --pool-mode and a single worker)")
+@option("--result-cache-ttl", type=float, default=RESULT_CACHE_TTL, show_default=True, help="Time in seconds after which a cached result expires")
+@option("--ssl-certificate", "ssl_certificate_path", type=PathType(exists=True, dir_okay=False, path_type=Path), default=None, help="Certificate presented to the clients, to terminate their TLS connections (requires --pool-mode)")
+@option("--ssl-key", "ssl_key_path", type=PathType(exists=True, dir_okay=False, path_type=Path), default=None, help="Private key of the certificate, if it is not in the same file")
+@option("--allow-cleartext-password/--no-allow-cleartext-password", default=False, show_default=True, help="Ask the clients which did not start TLS for their password anyway, which then goes over the network in clear")
+@option("--upstream-ssl-mode", type=Choice([ssl_mode.value for ssl_mode in SSLMode]), default=SSLMode.DISABLE.value, show_default=True, help="Whether the connections to PostgreSQL are encrypted (requires --pool-mode)")
+@option("--upstream-ssl-root-certificate", "upstream_ssl_root_certificate_path", type=PathType(exists=True, dir_okay=False, path_type=Path), default=None, help="Certificate authorities trusted with --upstream-ssl-mode verify-full")
+@option("--replica", "replicas", multiple=True, help="Read replica (as host:port) the read-only queries are spread over (requires --pool-mode transaction)")
+@option("--health-check-interval", type=float, default=None, help="Interval in seconds between the health checks of PostgreSQL (and of the replicas), whose failures stop the routing to them")
+@option("--upstream-to-downstream-watermarks", default=None, help="Bytes (as high:low) of the answers of PostgreSQL buffered for a client before PostgreSQL stops being read")
+@option("--downstream-to-upstream-watermarks", default=None, help="Bytes (as high:low) of the queries of a client buffered for PostgreSQL before the client stops being read")
+@option("--memory-budget", type=int, default=None, help=f"Bytes buffered by all the connections of a worker before they are paused early (selectors and epoll engines only, {DEFAULT_MEMORY_BUDGET} by default)")
+@option("--metrics-port", type=int, default=None, help="Port serving the metrics in the Prometheus format on /metrics (single worker only)")
+@option("--handoff-path", type=PathType(dir_okay=False, path_type=Path), default=None, help="Unix socket through which a proxy started with the same path takes over the listening socket of this one, which then exits (single worker without --pool-mode only)")
+@option("--handoff-connections/--no-handoff-connections", default=False, show_default=True, help="Whether the live connections are taken over too, rather than served by the previous proxy until they are over (they are not inspected anymore)")
+@option("--max-upstream-connections", type=int, default=None, help="Maximum number of connections to PostgreSQL, above which the clients wait for one to close (single worker only)")
+@option("--max-upstream-connections-per-database", type=int, default=None, help="Maximum number of connections to PostgreSQL for each user and database (requires --pool-mode)")
+@option("--admission-timeout", type=float, default=ADMISSION_TIMEOUT_IN_SECONDS, show_default=True, help="Time in seconds a client waits for a connection to PostgreSQL before being turned away")
+def serve(
+    remote_host: str, 
+    remote_port: int, 
+    local_host: str, 
+    local_port: int, 
+    worker_count: int, 
+    engine: str, 
+    dispatch_worker_count: int, 
+    overflow_policy: str,
+    pool_mode: str | None,
+    pool_size: int,
+    reset_query: str,
+    result_cache_size: int,
+    result_cache_ttl: float,
+    ssl_certificate_path: Path | None,
+    ssl_key_path: Path | None,
+    allow_cleartext_password: bool,
+    upstream_ssl_mode: str,
+    upstream_ssl_root_certificate_path: Path | None,
+    replicas: tuple[str, ...],
+    health_check_interval: float | None,
+    upstream_to_downstream_watermarks: str | None,
+    downstream_to_upstream_watermarks: str | None,
+    memory_budget: int | None,
+    metrics_port: int | None,
+    handoff_path: Path | None,
+    handoff_connections: bool,
+    max_upstream_connections: int | None,
+    max_upstream_connections_per_database: int | None,
+    admission_timeout: float,
+):
+    if replicas and pool_mode != PoolMode.TRANSACTION:
+        raise BadParameter("The read replicas require --pool-mode transaction", param_hint="--replica")
+
+    with PostgreSQLProxy(
+        remote_host=remote_host,
+        remote_port=remote_port,
+        local_host=local_host,
+        local_port=local_port,
+        worker_count=worker_count,
+        engine=Engine(engine),
+        dispatch_worker_count=dispatch_worker_count,
+        overflow_policy=OverflowPolicy(overflow_policy),
+        pool_mode=PoolMode(pool_mode) if pool_mode else None,
+        pool_size=pool_size,
+        reset_query=reset_query or None,
+        result_cache_size=result_cache_size,
+        result_cache_ttl=result_cache_ttl,
+        ssl_certificate_path=ssl_certificate_path,
+        ssl_key_path=ssl_key_path,
+        allow_cleartext_password=allow_cleartext_password,
+        upstream_ssl_mode=SSLMode(upstream_ssl_mode),
+        upstream_ssl_root_certificate_path=upstream_ssl_root_certificate_path,
+        replicas=[HostAndPort.parse_address(replica).as_tuple() for replica in replicas],
+        health_check_interval=health_check_interval,
+        upstream_to_downstream_watermarks=parse_watermarks(upstream_to_downstream_watermarks),
+        downstream_to_upstream_watermarks=parse_watermarks(downstream_to_upstream_watermarks),
+        memory_budget=memory_budget,
+        metrics_port=metrics_port,
+        handoff_path=handoff_path,
+        handoff_connections=handoff_connections,
+        max_upstream_connections=max_upstream_connections,
+        max_upstream_connections_per_database=max_upstream_connections_per_database,
+        admission_timeout=admission_timeout,
+    ) as pg_proxy:
+        print(f"Proxy server listening on {pg_proxy.host}:{pg_proxy.port}! ")
+        pg_proxy.wait_for()
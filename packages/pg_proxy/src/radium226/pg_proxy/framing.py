@@ -0,0 +1,179 @@
+import struct
+from enum import StrEnum, auto
+from typing import Iterator
+
+
+CANCEL_REQUEST_CODE = 80877102
+SSL_REQUEST_CODE = 80877103
+GSSENC_REQUEST_CODE = 80877104
+
+UNTYPED_HEADER_LENGTH = 4
+TYPED_HEADER_LENGTH = 5
+
+MAX_STARTUP_MESSAGE_LENGTH = 10_000
+
+
+class FramingError(ValueError):
+    pass
+
+
+class FramerState(StrEnum):
+
+    # Frontend messages before the StartupMessage have no type byte
+    STARTUP = auto()
+    # The backend answers SSLRequest and GSSENCRequest with a single byte
+    ENCRYPTION_RESPONSE = auto()
+    MESSAGES = auto()
+    # Once TLS or GSSAPI encryption is negotiated, nothing can be framed anymore
+    ENCRYPTED = auto()
+
+
+class Framer():
+    """Splits one direction of a PostgreSQL connection into messages, whatever the chunks it is fed with.
+
+    Complete messages are yielded as memoryviews of the fed data, so the payload is only copied when a message spans
+    several chunks. The yielded memoryviews are only guaranteed to be valid until the next call to `feed`.
+
+    When `message_types` is given, only the messages of these types are yielded: the others are skipped from their
+    header on, so they are never copied whatever their size (and the untyped ones are not yielded either).
+    """
+
+    _state: FramerState
+    _pending: bytearray
+    _peer: "Framer | None"
+
+    # Whether the messages of each type byte are yielded, and what is left to skip of the current message
+    _wanted_types: bytes | None
+    _skipped_length: int
+
+    def __init__(self, state: FramerState, message_types: bytes | None = None):
+        self._state = state
+        self._pending = bytearray()
+        self._peer = None
+
+        self._wanted_types = bytes(type in message_types for type in range(256)) if message_types is not None else None
+        self._skipped_length = 0
+
+    @classmethod
+    def pair(cls,
+        frontend_message_types: bytes | None = None,
+        backend_message_types: bytes | None = None,
+    ) -> tuple["Framer", "Framer"]:
+        frontend_framer = cls(FramerState.STARTUP, frontend_message_types)
+        backend_framer = cls(FramerState.MESSAGES, backend_message_types)
+        frontend_framer._peer = backend_framer
+        backend_framer._peer = frontend_framer
+        return frontend_framer, backend_framer
+
+    @property
+    def state(self) -> FramerState:
+        return self._state
+
+    def _frame_length(self, data: memoryview | bytearray) -> int | None:
+        match self._state:
+            case FramerState.STARTUP:
+                if len(data) < UNTYPED_HEADER_LENGTH:
+                    return None
+                length, = struct.unpack_from("!i", data)
+                if not UNTYPED_HEADER_LENGTH + 4 <= length <= MAX_STARTUP_MESSAGE_LENGTH:
+                    raise FramingError(f"Invalid startup message length: {length}")
+                return length
+
+            case FramerState.ENCRYPTION_RESPONSE:
+                return 1 if len(data) >= 1 else None
+
+            case FramerState.MESSAGES:
+                if len(data) < TYPED_HEADER_LENGTH:
+                    return None
+                length, = struct.unpack_from("!i", data, 1)
+                if length < 4:
+                    raise FramingError(f"Invalid message length: {length}")
+                return 1 + length
+
+    def _header_length(self) -> int:
+        match self._state:
+            case FramerState.STARTUP:
+                return UNTYPED_HEADER_LENGTH
+            case FramerState.ENCRYPTION_RESPONSE:
+                return 1
+            case _:
+                return TYPED_HEADER_LENGTH
+
+    def _advance(self, frame: memoryview) -> None:
+        match self._state:
+            case FramerState.STARTUP:
+                code, = struct.unpack_from("!i", frame, 4)
+                if code in (SSL_REQUEST_CODE, GSSENC_REQUEST_CODE):
+                    self._peer._state = FramerState.ENCRYPTION_RESPONSE
+                elif code != CANCEL_REQUEST_CODE:
+                    self._state = FramerState.MESSAGES
+
+            case FramerState.ENCRYPTION_RESPONSE:
+                if frame[0] in b"SG":
+                    self._state = FramerState.ENCRYPTED
+                    self._peer._state = FramerState.ENCRYPTED
+                else:
+                    self._state = FramerState.MESSAGES
+
+    def _skips(self, data: memoryview | bytearray) -> bool:
+        # Only typed messages are skipped, as the untyped ones move the state of the framers along
+        return self._wanted_types is not None and self._state == FramerState.MESSAGES and not self._wanted_types[data[0]]
+
+    def _yields(self) -> bool:
+        return self._wanted_types is None or self._state == FramerState.MESSAGES
+
+    def feed(self, data: bytes | bytearray | memoryview) -> Iterator[memoryview]:
+        view = memoryview(data)
+        offset = 0
+
+        # We first complete the message which spanned the previous chunks, copying only what it lacks
+        while self._pending and self._state != FramerState.ENCRYPTED:
+            length = self._frame_length(self._pending)
+            if length is not None and self._skips(self._pending):
+                self._skipped_length = length - len(self._pending)
+                self._pending = bytearray()
+                break
+
+            if length is not None and len(self._pending) == length:
+                frame, self._pending = memoryview(self._pending), bytearray()
+                yields = self._yields()
+                self._advance(frame)
+                if yields:
+                    yield frame
+                continue
+
+            if offset == len(view):
+                break
+
+            missing = (length if length is not None else self._header_length()) - len(self._pending)
+            self._pending += view[offset:offset + missing]
+            offset += min(missing, len(view) - offset)
+
+        if self._pending:
+            return
+
+        while self._state != FramerState.ENCRYPTED:
+            if self._skipped_length > 0:
+                skipped_length = min(self._skipped_length, len(view) - offset)
+                self._skipped_length -= skipped_length
+                offset += skipped_length
+                if self._skipped_length > 0:
+                    return
+
+            length = self._frame_length(view[offset:])
+            if length is not None and self._skips(view[offset:]):
+                self._skipped_length = length
+                continue
+
+            if length is None or offset + length > len(view):
+                break
+
+            frame = view[offset:offset + length]
+            offset += length
+            yields = self._yields()
+            self._advance(frame)
+            if yields:
+                yield frame
+
+        if self._state != FramerState.ENCRYPTED:
+            self._pending += view[offset:]
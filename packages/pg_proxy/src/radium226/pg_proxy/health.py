@@ -0,0 +1,17 @@
+import socket
+
+from radium226.socket_forwarder import HealthCheck
+
+from .wire import encode_ssl_request
+
+
+def probe_postgresql(connection_socket: socket.socket):
+    """Checks that PostgreSQL answers an SSLRequest, which it does with a single byte and before any authentication."""
+
+    connection_socket.sendall(encode_ssl_request())
+    if connection_socket.recv(1) not in (b"S", b"N"):
+        raise ConnectionError("The upstream does not answer like PostgreSQL")
+
+
+def postgresql_health_check(interval: float) -> HealthCheck:
+    return HealthCheck(probe=probe_postgresql, interval=interval)
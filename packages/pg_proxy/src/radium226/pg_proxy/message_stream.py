@@ -0,0 +1,84 @@
+from typing import Protocol
+
+from radium226.socket_forwarder import StreamingEventHandler
+
+from .framing import Framer, FramingError
+
+
+class MessageHandler(Protocol):
+    """Is given the messages of a connection while they flow, as memoryviews which are only valid during the call."""
+
+    # The types of the messages the handler is given (like b"QP"), as the others are skipped without being framed (None
+    # for all of them)
+    frontend_message_types: bytes | None = None
+    backend_message_types: bytes | None = None
+
+    def for_connection(self) -> "MessageHandler":
+        # Handlers keeping per-connection state return a new instance here
+        return self
+
+    def on_frontend_message(self, message: memoryview):
+        ...
+
+    def on_backend_message(self, message: memoryview):
+        ...
+
+    def on_framing_error(self, error: FramingError):
+        # The stream cannot be framed anymore, so the handler is not given any other message of the connection
+        pass
+
+    def on_connection_closed(self):
+        pass
+
+
+class MessageStream(StreamingEventHandler):
+    """Frames both directions of a forwarded connection as the chunks are read, for a `MessageHandler`.
+
+    A handler only subscribed to `Q` and `P` then pays for the header of each `DataRow`, and never for its payload.
+    """
+
+    _message_handler: MessageHandler
+    _frontend_framer: Framer
+    _backend_framer: Framer
+    # Whether a framer failed, after which it would only see the stream out of sync
+    _failed: bool
+
+    def __init__(self, message_handler: MessageHandler):
+        self._message_handler = message_handler
+        self._frontend_framer, self._backend_framer = Framer.pair(
+            message_handler.frontend_message_types,
+            message_handler.backend_message_types,
+        )
+        self._failed = False
+
+    @property
+    def message_handler(self) -> MessageHandler:
+        return self._message_handler
+
+    def for_connection(self) -> "MessageStream":
+        return MessageStream(self._message_handler.for_connection())
+
+    def _fail(self, error: FramingError):
+        self._failed = True
+        self._message_handler.on_framing_error(error)
+
+    def on_chunk_sent(self, chunk: memoryview):
+        if self._failed:
+            return
+        try:
+            for message in self._frontend_framer.feed(chunk):
+                self._message_handler.on_frontend_message(message)
+        except FramingError as e:
+            self._fail(e)
+
+    def on_chunk_received(self, chunk: memoryview):
+        if self._failed:
+            return
+        try:
+            for message in self._backend_framer.feed(chunk):
+                self._message_handler.on_backend_message(message)
+        except FramingError as e:
+            self._fail(e)
+
+    def on_connection_closed(self):
+        self._message_handler.on_connection_closed()
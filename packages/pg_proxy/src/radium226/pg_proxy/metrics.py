@@ -0,0 +1,294 @@
+from contextlib import ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, local
+from typing import Callable
+
+from radium226.socket_forwarder import HostAndPort
+
+
+# The histograms keep 2^(PRECISION_BITS - 1) buckets per power of two, so a bucket is at most 1/8 wider than its values
+PRECISION_BITS = 4
+_HALF_BUCKET_COUNT = 1 << (PRECISION_BITS - 1)
+
+# Values are recorded in microseconds, up to 2^36 µs (about 19 hours), and the bigger ones go to the last bucket
+MAX_EXPONENT = 36
+BUCKET_COUNT = (MAX_EXPONENT - PRECISION_BITS + 1) * _HALF_BUCKET_COUNT + _HALF_BUCKET_COUNT
+
+
+def bucket_index(value: int) -> int:
+    # This is on the path of every query, where the builtin min() and max() are noticeably slower than comparisons
+    if value < 2 * _HALF_BUCKET_COUNT:
+        return value
+    exponent = value.bit_length() - PRECISION_BITS
+    index = exponent * _HALF_BUCKET_COUNT + (value >> exponent)
+    return index if index < BUCKET_COUNT else BUCKET_COUNT - 1
+
+
+def bucket_upper_bound(index: int) -> int:
+    """The smallest value which is above the bucket."""
+
+    if index < 2 * _HALF_BUCKET_COUNT:
+        return index + 1
+    exponent, offset = divmod(index, _HALF_BUCKET_COUNT)
+    return (offset + _HALF_BUCKET_COUNT + 1) << (exponent - 1)
+
+
+class _Shard(local):
+    """The values that one thread updates, which no other thread writes to."""
+
+    def __init__(self, size: int, shards: list[list[int]]):
+        self.values = [0] * size
+        # Appending to a list is atomic, and the shard is only read from then on
+        shards.append(self.values)
+
+
+class _Metric():
+    """A metric is written without locks: each thread updates its own shard, and the shards are summed when read."""
+
+    _shards: list[list[int]]
+    _shard: _Shard
+
+    name: str
+    help: str
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._shards = []
+        self._shard = _Shard(self._shard_size(), self._shards)
+
+    def _shard_size(self) -> int:
+        return 1
+
+    def __getstate__(self):
+        # Only the definition is sent to other processes, where the metric starts over
+        return {"name": self.name, "help": self.help}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _sum(self, index: int) -> int:
+        return sum(values[index] for values in list(self._shards))
+
+    def render(self) -> list[str]:
+        ...
+
+
+class Counter(_Metric):
+
+    _type = "counter"
+    # The value can be read from what already counts it (like the memory budget of the forwarder)
+    _function: Callable[[], int] | None = None
+
+    def inc(self, amount: int = 1):
+        self._shard.values[0] += amount
+
+    def set_function(self, function: Callable[[], int]):
+        self._function = function
+
+    @property
+    def value(self) -> int:
+        if function := self._function:
+            return function()
+        return self._sum(0)
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self._type}",
+            f"{self.name} {self.value}",
+        ]
+
+
+class Gauge(Counter):
+
+    _type = "gauge"
+
+    def dec(self, amount: int = 1):
+        self._shard.values[0] -= amount
+
+
+class Histogram(_Metric):
+    """Counts values in fixed log-linear buckets, like an HDR histogram, so recording one is an index computation.
+
+    The values are integers (microseconds for the durations), which are multiplied by `scale` when rendered (to get
+    seconds).
+    """
+
+    _scale: float
+
+    def __init__(self, name: str, help: str, scale: float = 1.0):
+        super().__init__(name, help)
+        self._scale = scale
+
+    def __getstate__(self):
+        return {"name": self.name, "help": self.help, "scale": self._scale}
+
+    def _shard_size(self) -> int:
+        # The buckets, then the sum of the values
+        return BUCKET_COUNT + 1
+
+    def record(self, value: int):
+        values = self._shard.values
+        values[bucket_index(value)] += 1
+        values[BUCKET_COUNT] += value
+
+    def bucket_counts(self) -> list[int]:
+        return [sum(counts) for counts in zip(*list(self._shards))][:BUCKET_COUNT]
+
+    @property
+    def count(self) -> int:
+        return sum(self.bucket_counts())
+
+    @property
+    def sum(self) -> int:
+        return self._sum(BUCKET_COUNT)
+
+    def percentile(self, percentile: float) -> int:
+        """The upper bound of the bucket holding the value below which `percentile` percents of the values are."""
+
+        bucket_counts = self.bucket_counts()
+        threshold = sum(bucket_counts) * percentile / 100
+        cumulative_count = 0
+        for index, bucket_count in enumerate(bucket_counts):
+            cumulative_count += bucket_count
+            if bucket_count and cumulative_count >= threshold:
+                return bucket_upper_bound(index)
+        return 0
+
+    def render(self) -> list[str]:
+        bucket_counts = self.bucket_counts()
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        # The fine buckets are merged at every power of two, which is enough for Prometheus to compute quantiles
+        cumulative_count = 0
+        for index, bucket_count in enumerate(bucket_counts):
+            cumulative_count += bucket_count
+            if index >= 2 * _HALF_BUCKET_COUNT - 1 and index % _HALF_BUCKET_COUNT == _HALF_BUCKET_COUNT - 1 and index < BUCKET_COUNT - 1:
+                lines.append(f'{self.name}_bucket{{le="{bucket_upper_bound(index) * self._scale:g}"}} {cumulative_count}')
+        lines += [
+            f'{self.name}_bucket{{le="+Inf"}} {cumulative_count}',
+            f"{self.name}_sum {self.sum * self._scale:g}",
+            f"{self.name}_count {cumulative_count}",
+        ]
+        return lines
+
+
+class Metrics():
+    """The metrics of the proxy, shared by all the connections of a process."""
+
+    query_duration: Histogram
+    connection_count: Counter
+    live_connection_count: Gauge
+    # What the clients sent to PostgreSQL, and what PostgreSQL sent back to them
+    bytes_sent: Counter
+    bytes_received: Counter
+    connection_bytes_sent: Histogram
+    connection_bytes_received: Histogram
+    # The messages which could not be inspected, and the connections which are not inspected anymore because of them
+    inspection_errors: Counter
+    # The reads which went to the primary, as the replica they were meant for could not be used
+    replica_fallbacks: Counter
+    # What the forwarder holds for the connections whose reader is slower than their writer
+    buffered_bytes: Gauge
+    buffer_budget_bytes: Gauge
+    buffer_budget_pauses: Counter
+    # The connections to PostgreSQL, when they are capped, and the clients waiting for one
+    upstream_connections: Gauge
+    admission_waiting_clients: Gauge
+    admission_wait_duration: Histogram
+    admission_timeouts: Counter
+
+    def __init__(self):
+        self.query_duration = Histogram("pg_proxy_query_duration_seconds", "Time from a Query or an Execute to the matching ReadyForQuery", scale=1e-6)
+        self.connection_count = Counter("pg_proxy_connections_total", "Number of client connections")
+        self.live_connection_count = Gauge("pg_proxy_connections", "Number of live client connections")
+        self.bytes_sent = Counter("pg_proxy_sent_bytes_total", "Bytes sent by the clients")
+        self.bytes_received = Counter("pg_proxy_received_bytes_total", "Bytes received by the clients")
+        self.connection_bytes_sent = Histogram("pg_proxy_connection_sent_bytes", "Bytes sent by a client over its connection")
+        self.connection_bytes_received = Histogram("pg_proxy_connection_received_bytes", "Bytes received by a client over its connection")
+        self.inspection_errors = Counter("pg_proxy_inspection_errors_total", "Number of messages which could not be inspected")
+        self.replica_fallbacks = Counter("pg_proxy_replica_fallbacks_total", "Number of reads which went to the primary because a replica could not be used")
+        self.buffered_bytes = Gauge("pg_proxy_buffered_bytes", "Bytes buffered between the clients and PostgreSQL")
+        self.buffer_budget_bytes = Gauge("pg_proxy_buffer_budget_bytes", "Bytes that can be buffered before the connections are paused early")
+        self.buffer_budget_pauses = Counter("pg_proxy_buffer_budget_pauses_total", "Number of times a connection was paused because of the buffer budget")
+        self.upstream_connections = Gauge("pg_proxy_upstream_connections", "Number of connections to PostgreSQL counted against the cap")
+        self.admission_waiting_clients = Gauge("pg_proxy_admission_waiting_clients", "Number of clients waiting for a connection to PostgreSQL")
+        self.admission_wait_duration = Histogram("pg_proxy_admission_wait_seconds", "Time a client waited for a connection to PostgreSQL", scale=1e-6)
+        self.admission_timeouts = Counter("pg_proxy_admission_timeouts_total", "Number of clients turned away after waiting for a connection to PostgreSQL")
+
+    def __iter__(self):
+        return iter([
+            self.query_duration,
+            self.connection_count,
+            self.live_connection_count,
+            self.bytes_sent,
+            self.bytes_received,
+            self.connection_bytes_sent,
+            self.connection_bytes_received,
+            self.inspection_errors,
+            self.replica_fallbacks,
+            self.buffered_bytes,
+            self.buffer_budget_bytes,
+            self.buffer_budget_pauses,
+            self.upstream_connections,
+            self.admission_waiting_clients,
+            self.admission_wait_duration,
+            self.admission_timeouts,
+        ])
+
+    def render(self) -> str:
+        return "".join(line + "\n" for metric in self for line in metric.render())
+
+
+class MetricsServer():
+    """Serves the metrics in the Prometheus text format, on /metrics."""
+
+    _host_and_port: HostAndPort
+    _metrics: Metrics
+
+    _server: ThreadingHTTPServer | None
+    _thread: Thread | None
+
+    def __init__(self, host_and_port: HostAndPort, metrics: Metrics):
+        self._host_and_port = host_and_port
+        self._metrics = metrics
+        self._server = None
+        self._thread = None
+        self._exit_stack = ExitStack()
+
+    def __enter__(self):
+        metrics = self._metrics
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would flood the output
+                pass
+
+        ThreadingHTTPServer.allow_reuse_address = True
+        self._server = ThreadingHTTPServer(self._host_and_port.as_tuple(), Handler)
+        self._exit_stack.callback(self._server.server_close)
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self._exit_stack.callback(self._thread.join)
+        self._exit_stack.callback(self._server.shutdown)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._exit_stack.close()
+        return False
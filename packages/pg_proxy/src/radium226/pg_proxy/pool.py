@@ -0,0 +1,442 @@
+import asyncio
+import hmac
+from collections import deque
+from dataclasses import dataclass
+from enum import StrEnum, auto
+
+from radium226.socket_forwarder import HostAndPort, CircuitBreaker, AsyncioAdmission
+
+from .authentication import Authenticator, PasswordRequiredError
+from .framing import Framer, FramerState
+from .tls import SSLMode, UpstreamSSLContext
+from .wire import (
+    ServerResponse,
+    Authentication,
+    BackendKeyData,
+    ErrorResponse,
+    ParameterStatus,
+    ReadyForQuery,
+    decode_backend_message,
+    encode_startup_message,
+    encode_ssl_request,
+    encode_password_message,
+    encode_query,
+    encode_terminate,
+)
+
+
+DEFAULT_POOL_SIZE = 20
+
+DEFAULT_RESET_QUERY = "DISCARD ALL"
+
+READ_SIZE = 64 * 1024
+
+# Without it, a connection to an unreachable host waits for the TCP timeouts of the OS (minutes)
+CONNECT_TIMEOUT_IN_SECONDS = 5.0
+
+
+class PoolMode(StrEnum):
+
+    # A client holds a backend from its first query to its disconnection
+    SESSION = auto()
+    # A client holds a backend from its first query to the end of the transaction
+    TRANSACTION = auto()
+
+
+class BackendError(Exception):
+    """The backend refused the connection, with an ErrorResponse which can be relayed to the client."""
+
+    frame: bytes
+
+    def __init__(self, frame: bytes):
+        self.frame = frame
+        super().__init__(decode_backend_message(memoryview(frame)).fields.get("M"))
+
+
+@dataclass(frozen=True, slots=True)
+class PoolKey():
+
+    user: str
+    database: str
+    # The other startup parameters (like client_encoding), as backends started with other ones are not interchangeable
+    parameters: tuple[tuple[str, str], ...]
+
+    @property
+    def admission_key(self) -> tuple[str, str]:
+        # The cap of the admission control is per user and database, whatever the other startup parameters
+        return (self.user, self.database)
+
+    @classmethod
+    def from_startup_parameters(cls, parameters: dict[str, str]) -> "PoolKey":
+        user = parameters.get("user", "")
+        return cls(
+            user=user,
+            database=parameters.get("database", user),
+            parameters=tuple(sorted((name, value) for name, value in parameters.items() if name not in ("user", "database"))),
+        )
+
+    def startup_parameters(self) -> dict[str, str]:
+        return {"user": self.user, "database": self.database, **dict(self.parameters)}
+
+
+class Backend():
+    """An authenticated connection to PostgreSQL, read message by message."""
+
+    _reader: asyncio.StreamReader
+    _writer: asyncio.StreamWriter
+    _framer: Framer
+    _frames: deque[memoryview]
+
+    key: PoolKey
+    # The server the backend is connected to, which cancel requests must go to
+    remote_host_and_port: HostAndPort
+    parameters: dict[str, str]
+    process_id: int
+    secret_key: int
+    # The transaction status of the last ReadyForQuery: I (idle), T (in a transaction) or E (in a failed transaction)
+    status: bytes
+    # The names of the statements prepared by the `PreparedStatementTracker` of the clients, from the least to the most
+    # recently used (the values are unused)
+    prepared_statements: dict[str, None]
+
+    def __init__(self, key: PoolKey, remote_host_and_port: HostAndPort, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._framer = Framer(FramerState.MESSAGES)
+        self._frames = deque()
+
+        self.key = key
+        self.remote_host_and_port = remote_host_and_port
+        self.parameters = {}
+        self.process_id = 0
+        self.secret_key = 0
+        self.status = b"I"
+        self.prepared_statements = {}
+
+    @classmethod
+    async def connect(cls,
+        remote_host_and_port: HostAndPort,
+        key: PoolKey,
+        authenticator: Authenticator,
+        ssl_context: UpstreamSSLContext | None = None,
+    ) -> "Backend":
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(*remote_host_and_port.as_tuple()),
+            CONNECT_TIMEOUT_IN_SECONDS,
+        )
+        backend = cls(key, remote_host_and_port, reader, writer)
+        try:
+            if ssl_context is not None:
+                await backend._start_tls(ssl_context, remote_host_and_port.host)
+            await backend._start(authenticator)
+        except BaseException:
+            backend.close()
+            raise
+
+        if (ssl_object := writer.get_extra_info("ssl_object")) is not None:
+            # The ticket came with the answer to the startup message, and the next backends can resume the session
+            ssl_context.remember_session(ssl_object)
+        return backend
+
+    async def _start_tls(self, ssl_context: UpstreamSSLContext, host: str):
+        self.write(encode_ssl_request())
+        await self.drain()
+        match await self._reader.read(1):
+            case b"S":
+                await self._writer.start_tls(ssl_context, server_hostname=host)
+            case b"N" if ssl_context.ssl_mode == SSLMode.PREFER:
+                pass
+            case b"N":
+                raise ConnectionRefusedError("PostgreSQL does not accept TLS connections")
+            case _:
+                raise ConnectionResetError("The backend closed the connection")
+
+    async def _start(self, authenticator: Authenticator):
+        self.write(encode_startup_message(self.key.startup_parameters()))
+        await self.drain()
+        while True:
+            frame = await self.read_frame()
+            match decode_backend_message(frame):
+                case Authentication(code=code, data=data):
+                    if (response := authenticator.respond(code, bytes(data))) is not None:
+                        self.write(encode_password_message(response))
+                        await self.drain()
+                case ParameterStatus(name=name, value=value):
+                    self.parameters[name] = value
+                case BackendKeyData(process_id=process_id, secret_key=secret_key):
+                    self.process_id, self.secret_key = process_id, secret_key
+                case ErrorResponse():
+                    raise BackendError(bytes(frame))
+                case ReadyForQuery(status=status):
+                    self.status = status
+                    return
+
+    async def read_frames(self) -> list[memoryview]:
+        """Returns the messages which are already received, waiting for some if there are none."""
+
+        while not self._frames:
+            data = await self._reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionResetError("The backend closed the connection")
+            # The frames are views of `data`, which is never reused, so they stay valid
+            self._frames.extend(self._framer.feed(data))
+
+        frames = list(self._frames)
+        self._frames.clear()
+        return frames
+
+    async def read_frame(self) -> memoryview:
+        if not self._frames:
+            self._frames.extend(await self.read_frames())
+        return self._frames.popleft()
+
+    def unread(self, frames: list[memoryview]):
+        self._frames.extendleft(reversed(frames))
+
+    def write(self, data: bytes):
+        self._writer.write(data)
+
+    def writelines(self, frames: list[bytes | memoryview]):
+        self._writer.writelines(frames)
+
+    async def drain(self):
+        await self._writer.drain()
+
+    async def reset(self, reset_query: str) -> bool:
+        """Runs the reset query and tells if the backend can be reused by another client."""
+
+        if self.status != b"I":
+            return False
+
+        try:
+            self.write(encode_query(reset_query))
+            await self.drain()
+            failed = False
+            while (frame := await self.read_frame())[0] != ServerResponse.READY_FOR_QUERY[0]:
+                failed |= frame[0] == ServerResponse.ERROR_RESPONSE[0]
+            self.status = bytes(frame[5:6])
+        except ConnectionError:
+            return False
+
+        if any(statement in reset_query.upper() for statement in ("DISCARD ALL", "DEALLOCATE ALL")):
+            self.prepared_statements.clear()
+        return not failed and self.status == b"I"
+
+    @property
+    def closed(self) -> bool:
+        return self._writer.is_closing() or self._reader.at_eof()
+
+    def close(self):
+        if not self._writer.is_closing():
+            self._writer.write(encode_terminate())
+            self._writer.close()
+
+
+class BackendPool():
+    """The backends of one (user, database, startup parameters) key.
+
+    Idle backends are reused in LIFO order, so that the most recently used (and warmest) one is reused first, and
+    clients waiting for a backend are served in FIFO order.
+    """
+
+    _remote_host_and_port: HostAndPort
+    _key: PoolKey
+    _max_size: int
+    _ssl_context: UpstreamSSLContext | None
+    _circuit_breaker: CircuitBreaker | None
+    # Shared by all the pools, as it caps their backends together (and per user and database)
+    _admission: AsyncioAdmission | None
+
+    _idle_backends: deque[Backend]
+    _waiters: deque[asyncio.Future]
+    _size: int
+
+    # The password that the backends were authenticated with, which the clients must then give
+    _password: str | None
+    _password_required: bool | None
+
+    parameters: dict[str, str]
+    # The queries sent to the backends of the pool and not answered yet, updated by the client sessions
+    outstanding_count: int
+
+    def __init__(self,
+        remote_host_and_port: HostAndPort,
+        key: PoolKey,
+        max_size: int = DEFAULT_POOL_SIZE,
+        ssl_context: UpstreamSSLContext | None = None,
+        circuit_breaker: CircuitBreaker | None = None,
+        admission: AsyncioAdmission | None = None,
+    ):
+        self._remote_host_and_port = remote_host_and_port
+        self._key = key
+        self._max_size = max_size
+        self._ssl_context = ssl_context
+        self._circuit_breaker = circuit_breaker
+        self._admission = admission
+
+        self._idle_backends = deque()
+        self._waiters = deque()
+        self._size = 0
+
+        self._password = None
+        self._password_required = None
+
+        self.parameters = {}
+        self.outstanding_count = 0
+
+    @property
+    def key(self) -> PoolKey:
+        return self._key
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle_backends)
+
+    @property
+    def available(self) -> bool:
+        """False while the circuit of the server is open, as new connections would fail anyway."""
+        return self._circuit_breaker is None or self._circuit_breaker.allows()
+
+    def record_failure(self):
+        # The failures to connect are recorded by themselves, but not the other ones (like a refused authentication)
+        if circuit_breaker := self._circuit_breaker:
+            circuit_breaker.record_failure()
+
+    @property
+    def password_required(self) -> bool | None:
+        """None until a first backend is connected, as we do not know yet if PostgreSQL trusts the proxy."""
+        return self._password_required
+
+    async def authenticate(self, password: str | None) -> None:
+        """Checks the password of a client against the backends, connecting a new one if it cannot be compared.
+
+        Without a password, `PasswordRequiredError` is raised if PostgreSQL does not trust the proxy.
+        """
+
+        if self._password_required is False:
+            return
+        if self._password_required:
+            if password is None:
+                raise PasswordRequiredError(f"A password is required for user {self._key.user}")
+            # The strings can only be compared as such when they are ASCII
+            if hmac.compare_digest(password.encode(), self._password.encode()):
+                return
+
+        # The password may have changed since the backends were authenticated, or the pool is still empty
+        self._size += 1
+        try:
+            authenticator = Authenticator(self._key.user, password)
+            backend = await self._connect(authenticator)
+        except BaseException:
+            self._size -= 1
+            self._wake_up_waiter()
+            raise
+
+        self._password, self._password_required = password, authenticator.password_required
+        self.parameters = dict(backend.parameters)
+        self.release(backend)
+
+    async def acquire(self) -> Backend:
+        while True:
+            while self._idle_backends:
+                backend = self._idle_backends.pop()
+                if not backend.closed:
+                    return backend
+                self._forget_backend()
+
+            if self._size < self._max_size:
+                self._size += 1
+                try:
+                    authenticator = Authenticator(self._key.user, self._password)
+                    return await self._connect(authenticator)
+                except BaseException:
+                    self._size -= 1
+                    self._wake_up_waiter()
+                    raise
+
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                if (backend := await waiter) is not None:
+                    return backend
+            except asyncio.CancelledError:
+                # The backend may have been handed over in the meantime, and must not be lost
+                if waiter.done() and (backend := waiter.result()) is not None:
+                    self.release(backend)
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    async def _connect(self, authenticator: Authenticator) -> Backend:
+        if not self.available:
+            # The client is told right away, rather than once the connection timed out
+            raise ConnectionRefusedError(f"The server {self._remote_host_and_port.host}:{self._remote_host_and_port.port} is unavailable")
+
+        # Over the cap, the client waits for another backend to be closed (or raises `AdmissionTimeoutError`)
+        if admission := self._admission:
+            await admission.admit(self._key.admission_key)
+        try:
+            backend = await Backend.connect(self._remote_host_and_port, self._key, authenticator, self._ssl_context)
+        except BaseException as e:
+            if admission:
+                admission.release(self._key.admission_key)
+            if isinstance(e, OSError) and (circuit_breaker := self._circuit_breaker):
+                circuit_breaker.record_failure()
+            raise
+
+        if circuit_breaker := self._circuit_breaker:
+            circuit_breaker.record_success()
+        return backend
+
+    def _wake_up_waiter(self, backend: Backend | None = None) -> bool:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # A None result tells the waiter to try again, as there is room for a new backend
+                waiter.set_result(backend)
+                return True
+        return False
+
+    def release(self, backend: Backend):
+        if backend.closed or backend.status != b"I":
+            self.discard(backend)
+            return
+
+        if not self._wake_up_waiter(backend):
+            self._idle_backends.append(backend)
+
+    def _forget_backend(self):
+        self._size -= 1
+        # Its place goes to the clients waiting for one, in this pool or in another one
+        if admission := self._admission:
+            admission.release(self._key.admission_key)
+
+    def discard(self, backend: Backend):
+        backend.close()
+        self._forget_backend()
+        self._wake_up_waiter()
+
+    async def reset_and_release(self, backend: Backend, reset_query: str | None):
+        if reset_query and not await backend.reset(reset_query):
+            self.discard(backend)
+        else:
+            self.release(backend)
+
+    def close_idle_backend(self) -> bool:
+        """Closes the least recently used idle backend, if there is one, to make room for another pool."""
+
+        if not self._idle_backends:
+            return False
+        self._idle_backends.popleft().close()
+        self._forget_backend()
+        return True
+
+    def close(self):
+        while self._idle_backends:
+            self._idle_backends.pop().close()
+            self._forget_backend()
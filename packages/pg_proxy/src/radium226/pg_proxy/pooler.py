@@ -0,0 +1,786 @@
+import asyncio
+import secrets
+import socket
+import ssl
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from itertools import count
+from pathlib import Path
+from threading import Thread, Event
+from typing import Callable
+
+from radium226.socket_forwarder import (
+    HostAndPort,
+    HealthCheck,
+    HealthChecker,
+    Watermarks,
+    AdmissionControl,
+    AsyncioAdmission,
+    AdmissionTimeoutError,
+)
+
+from .authentication import AuthenticationError, PasswordRequiredError
+from .framing import Framer, FramingError
+from .prepared_statements import PreparedStatementTracker, DEFAULT_MAX_PREPARED_STATEMENTS
+from .query_analyzer import QueryAnalyzer, StatementKind
+from .result_cache import ResultCache, RESULT_CACHE_TTL
+from .metrics import Metrics
+from .tls import SSLMode, UpstreamSSLContext, create_server_ssl_context, create_upstream_ssl_context
+from .pool import (
+    PoolMode,
+    PoolKey,
+    Backend,
+    BackendPool,
+    BackendError,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_RESET_QUERY,
+    READ_SIZE,
+)
+from .wire import (
+    ClientCommand,
+    ServerResponse,
+    StartupMessage,
+    SSLRequest,
+    GSSENCRequest,
+    CancelRequest,
+    PasswordMessage,
+    AUTHENTICATION_OK,
+    AUTHENTICATION_CLEARTEXT_PASSWORD,
+    decode_frontend_message,
+    decode_backend_message,
+    encode_authentication,
+    encode_parameter_status,
+    encode_backend_key_data,
+    encode_ready_for_query,
+    encode_cancel_request,
+    encode_error,
+    QueryTimer,
+)
+
+
+# Each of these messages is answered by a ReadyForQuery
+_SYNCHRONIZING_COMMANDS = frozenset([ClientCommand.QUERY[0], ClientCommand.SYNC[0], ClientCommand.FUNCTION_CALL[0]])
+
+# The statements that the replicas can run, if they are read-only
+_READ_ONLY_KINDS = frozenset([StatementKind.SELECT, StatementKind.SHOW])
+
+# The extended query protocol messages, which leave the backend busy until the next Sync
+_EXTENDED_QUERY_COMMANDS = frozenset(command[0] for command in [
+    ClientCommand.PARSE,
+    ClientCommand.BIND,
+    ClientCommand.DESCRIBE,
+    ClientCommand.EXECUTE,
+    ClientCommand.CLOSE,
+    ClientCommand.FLUSH,
+])
+
+
+@dataclass(slots=True)
+class _Recording():
+    """The answer to a query, which goes to the result cache if it ends well."""
+
+    key: tuple[PoolKey, tuple[tuple[str, str], ...], str]
+    tables: tuple[str, ...]
+    generation: int
+    frames: list[memoryview] = field(default_factory=list)
+    failed: bool = False
+
+
+class ClientSession():
+    """A client connected to the pooler, which is lent a backend when it has something to run."""
+
+    _pooler: "Pooler"
+    _reader: asyncio.StreamReader
+    _writer: asyncio.StreamWriter
+    _framer: Framer
+
+    _pool: BackendPool | None
+    _password: str | None
+    # Whether the client started TLS, without which its password would go over the network in clear
+    _encrypted: bool
+    _backend: Backend | None
+    # The pool of the backend, which is the one of a replica for the reads that go to one
+    _backend_pool: BackendPool | None
+    _relay_task: asyncio.Task | None
+    _prepared_statement_tracker: PreparedStatementTracker | None
+
+    # The ReadyForQuery that the backend still owes us, and whether an extended query is waiting for its Sync
+    _pending_ready_count: int
+    _in_extended_query: bool
+
+    _recording: _Recording | None
+    # The settings that the results depend on, as the backend reported them, and whether the session may have changed
+    # the ones which are not reported (like search_path, before PostgreSQL 18)
+    _parameters: tuple[tuple[str, str], ...]
+    _caches_results: bool
+    # The tables written by the current transaction, which are invalidated again once it is over
+    _written_tables: set[str]
+    _written_tables_by_statement: dict[str, tuple[str, ...]]
+
+    # Whether the reads go to the replicas, and the prepared statements which can
+    _splits_reads: bool
+    _read_only_statements: set[str]
+
+    _query_timer: QueryTimer
+    _bytes_sent: int
+    _bytes_received: int
+
+    process_id: int
+    secret_key: int
+
+    def __init__(self, pooler: "Pooler", process_id: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._pooler = pooler
+        self._reader = reader
+        self._writer = writer
+        self._framer, _ = Framer.pair()
+
+        self._pool = None
+        self._password = None
+        self._encrypted = False
+        self._backend = None
+        self._backend_pool = None
+        self._relay_task = None
+        # In session mode, the client keeps its prepared statements as it keeps its backend
+        self._prepared_statement_tracker = PreparedStatementTracker(pooler.max_prepared_statements) if pooler.pool_mode == PoolMode.TRANSACTION and pooler.track_prepared_statements else None
+
+        self._pending_ready_count = 0
+        self._in_extended_query = False
+
+        self._recording = None
+        self._parameters = ()
+        self._caches_results = True
+        self._written_tables = set()
+        self._written_tables_by_statement = {}
+
+        # In session mode, the client keeps its backend from its first query on, whatever the next ones are
+        self._splits_reads = pooler.pool_mode == PoolMode.TRANSACTION and pooler.has_replicas
+        self._read_only_statements = set()
+
+        self._query_timer = QueryTimer(pooler.metrics.query_duration)
+        self._bytes_sent = 0
+        self._bytes_received = 0
+
+        self.process_id = process_id
+        self.secret_key = secrets.randbits(31)
+
+    @property
+    def backend(self) -> Backend | None:
+        return self._backend
+
+    async def _read_frames(self) -> list[memoryview]:
+        while True:
+            data = await self._reader.read(READ_SIZE)
+            if not data:
+                return []
+            self._bytes_sent += len(data)
+            self._pooler.metrics.bytes_sent.inc(len(data))
+            if frames := list(self._framer.feed(data)):
+                return frames
+
+    async def _read_frame(self) -> memoryview | None:
+        frames = await self._read_frames()
+        if len(frames) > 1:
+            raise FramingError("The client sent messages before being answered")
+        return frames[0] if frames else None
+
+    def _write(self, data: bytes):
+        self._bytes_received += len(data)
+        self._pooler.metrics.bytes_received.inc(len(data))
+        self._writer.write(data)
+
+    def _writelines(self, frames: list[bytes | memoryview]):
+        # The frames are not joined into a copy: the transport sends them together with a single `sendmsg`
+        size = sum(len(frame) for frame in frames)
+        self._bytes_received += size
+        self._pooler.metrics.bytes_received.inc(size)
+        self._writer.writelines(frames)
+
+    async def run(self):
+        metrics = self._pooler.metrics
+        metrics.connection_count.inc()
+        metrics.live_connection_count.inc()
+        try:
+            if (startup_message := await self._start()) is None:
+                return
+            # After `_start()`, as the transport is another one once TLS is started
+            if watermarks := self._pooler.upstream_to_downstream_watermarks:
+                self._writer.transport.set_write_buffer_limits(high=watermarks.high, low=watermarks.low)
+
+            key = PoolKey.from_startup_parameters(startup_message.parameters)
+            self._pool = self._pooler.pool_for(key)
+            await self._authenticate()
+            await self._serve()
+
+        except BackendError as e:
+            self._write(e.frame)
+        except AdmissionTimeoutError as e:
+            self._write(encode_error(str(e), code="53300"))
+        except (AuthenticationError, OSError) as e:
+            self._write(encode_error(str(e)))
+        except (ConnectionError, FramingError):
+            pass
+
+        finally:
+            self._detach_backend(session_ended=True)
+            self._writer.close()
+            metrics.live_connection_count.dec()
+            metrics.connection_bytes_sent.record(self._bytes_sent)
+            metrics.connection_bytes_received.record(self._bytes_received)
+
+    async def _start(self) -> StartupMessage | None:
+        while (frame := await self._read_frame()) is not None:
+            match decode_frontend_message(frame):
+                case SSLRequest() if (ssl_context := self._pooler.ssl_context) is not None:
+                    # The TLS connection ends here, so the proxy sees the messages of the client
+                    self._write(b"S")
+                    await self._writer.drain()
+                    await self._writer.start_tls(ssl_context)
+                    self._encrypted = True
+                case SSLRequest() | GSSENCRequest():
+                    # The client then goes on unencrypted (or gives up)
+                    self._write(b"N")
+                case CancelRequest(process_id=process_id, secret_key=secret_key):
+                    await self._pooler.cancel(process_id, secret_key)
+                    return None
+                case StartupMessage() as startup_message:
+                    return startup_message
+        return None
+
+    async def _read_password(self) -> str:
+        # The password is checked against the one of the pooled backends (and the next backends are authenticated with
+        # it), so we need it in clear, which only TLS makes safe
+        if not self._encrypted and not self._pooler.allow_cleartext_password:
+            raise AuthenticationError("The password cannot be sent in clear, the connection must use TLS (sslmode=require)")
+        self._write(encode_authentication(AUTHENTICATION_CLEARTEXT_PASSWORD))
+        if (frame := await self._read_frame()) is None:
+            raise ConnectionResetError("The client left during the authentication")
+        match decode_frontend_message(frame):
+            case PasswordMessage(data=data):
+                return bytes(data).rstrip(b"\x00").decode()
+            case _:
+                raise AuthenticationError("A password was expected")
+
+    async def _authenticate(self):
+        try:
+            # If PostgreSQL trusts the proxy, the client is not asked for anything either
+            await self._pool.authenticate(None)
+        except PasswordRequiredError:
+            self._password = await self._read_password()
+            await self._pool.authenticate(self._password)
+
+        self._write(b"".join([
+            encode_authentication(AUTHENTICATION_OK),
+            *(encode_parameter_status(name, value) for name, value in self._pool.parameters.items()),
+            # The client gets its own key, as it does not keep the same backend
+            encode_backend_key_data(self.process_id, self.secret_key),
+            encode_ready_for_query(b"I"),
+        ]))
+        self._parameters = tuple(sorted(self._pool.parameters.items()))
+        await self._writer.drain()
+
+    async def _serve(self):
+        while frames := await self._read_frames():
+            outgoing_frames = []
+            for frame in frames:
+                type = frame[0]
+                if type == ClientCommand.TERMINATE[0]:
+                    await self._flush(outgoing_frames)
+                    return
+
+                if self._pooler.result_cache is not None and self._answer_from_cache(frame, outgoing_frames):
+                    continue
+
+                # The queries answered by the cache are not timed, as they do not reach PostgreSQL
+                self._query_timer.on_frontend_message(type)
+
+                # A new query (or batch of extended query messages) is where the backend can change
+                read_only = self._splits_reads and self._is_read_only(frame) and not self._in_extended_query
+                if self._splits_reads and self._on_replica() and not self._in_extended_query and not read_only:
+                    # The replica is given back once it answered what it was sent, and the primary takes over
+                    await self._flush(outgoing_frames)
+                    outgoing_frames = []
+                    await self._relay_task
+
+                if self._backend is None:
+                    # Nothing can be buffered here, as the backend is only released between two chunks
+                    await self._attach_backend(read_only)
+
+                if type in _SYNCHRONIZING_COMMANDS:
+                    self._pending_ready_count += 1
+                    self._backend_pool.outstanding_count += 1
+                    self._in_extended_query = False
+                elif type in _EXTENDED_QUERY_COMMANDS:
+                    self._in_extended_query = True
+
+                if prepared_statement_tracker := self._prepared_statement_tracker:
+                    prepared_statement_tracker.rewrite(frame, self._backend, outgoing_frames)
+                    if synthesized_responses := prepared_statement_tracker.synthesized_responses():
+                        self._writelines(synthesized_responses)
+                else:
+                    outgoing_frames.append(frame)
+
+            await self._flush(outgoing_frames)
+
+    def _is_read_only(self, frame: memoryview) -> bool:
+        """Tells if the frame starts something that a replica can run, and keeps track of the read-only statements."""
+
+        match frame[0]:
+            case type if type == ClientCommand.QUERY[0]:
+                metadata = self._pooler.query_analyzer.analyze(decode_frontend_message(frame).query)
+                return metadata.read_only and metadata.kind in _READ_ONLY_KINDS
+
+            case type if type == ClientCommand.PARSE[0]:
+                parse = decode_frontend_message(frame)
+                metadata = self._pooler.query_analyzer.analyze(parse.query)
+                if read_only := metadata.read_only and metadata.kind in _READ_ONLY_KINDS:
+                    self._read_only_statements.add(parse.statement)
+                else:
+                    self._read_only_statements.discard(parse.statement)
+                return read_only
+
+            case type if type == ClientCommand.BIND[0]:
+                return decode_frontend_message(frame).statement in self._read_only_statements
+
+            case _:
+                return False
+
+    def _on_replica(self) -> bool:
+        return self._backend is not None and self._backend_pool is not self._pool
+
+    async def _replica_pool(self) -> BackendPool | None:
+        if (replica_pool := self._pooler.replica_pool_for(self._pool.key)) is None:
+            return None
+        try:
+            await replica_pool.authenticate(self._password)
+        except (AuthenticationError, BackendError, OSError) as e:
+            # The primary can run the reads too
+            self._on_replica_failed(replica_pool, e)
+            return None
+        return replica_pool
+
+    def _on_replica_failed(self, replica_pool: BackendPool, error: Exception):
+        self._pooler.metrics.replica_fallbacks.inc()
+        if not isinstance(error, OSError):
+            replica_pool.record_failure()
+
+    def _write_tables(self, tables: tuple[str, ...]):
+        self._pooler.result_cache.invalidate(tables)
+        self._written_tables.update(tables)
+
+    def _answer_from_cache(self, frame: memoryview, outgoing_frames: list[memoryview]) -> bool:
+        """Tells if the cache answered the frame, and keeps an eye on the writes which invalidate it."""
+
+        match frame[0]:
+            case type if type == ClientCommand.PARSE[0]:
+                parse = decode_frontend_message(frame)
+                metadata = self._pooler.query_analyzer.analyze(parse.query)
+                if metadata.read_only:
+                    self._written_tables_by_statement.pop(parse.statement, None)
+                else:
+                    self._written_tables_by_statement[parse.statement] = metadata.tables
+                return False
+
+            case type if type == ClientCommand.BIND[0]:
+                data = bytes(frame)
+                offset = data.index(0, 5) + 1
+                statement = data[offset:data.index(0, offset)].decode()
+                if tables := self._written_tables_by_statement.get(statement):
+                    self._write_tables(tables)
+                return False
+
+            case type if type != ClientCommand.QUERY[0]:
+                return False
+
+        query = decode_frontend_message(frame).query
+        metadata = self._pooler.query_analyzer.analyze(query)
+        if not metadata.read_only:
+            if metadata.tables:
+                self._write_tables(metadata.tables)
+            return False
+
+        # Only the queries that are alone in flight, outside of a transaction, and which read tables are cached
+        if (
+            metadata.kind != StatementKind.SELECT
+            or not self._caches_results
+            or not metadata.tables
+            or outgoing_frames
+            or self._pending_ready_count > 0
+            or self._in_extended_query
+            or (self._backend is not None and self._backend.status != b"I")
+        ):
+            return False
+
+        result_cache = self._pooler.result_cache
+        key = (self._pool.key, self._parameters, query)
+        if (response := result_cache.get(key)) is not None:
+            self._write(response)
+            return True
+
+        self._recording = _Recording(key, metadata.tables, result_cache.generation)
+        return False
+
+    def _record(self, frame: memoryview):
+        recording = self._recording
+        recording.frames.append(frame)
+        match frame[0]:
+            case type if type == ServerResponse.ERROR_RESPONSE[0]:
+                recording.failed = True
+            case type if type == ServerResponse.READY_FOR_QUERY[0]:
+                self._recording = None
+                if not recording.failed and frame[5:6] == b"I":
+                    self._pooler.result_cache.put(recording.key, recording.tables, b"".join(recording.frames), recording.generation)
+
+    def _watch_settings(self, frame: memoryview):
+        match frame[0]:
+            case type if type == ServerResponse.PARAMETER_STATUS[0]:
+                parameter_status = decode_backend_message(frame)
+                parameters = dict(self._parameters)
+                parameters[parameter_status.name] = parameter_status.value
+                self._parameters = tuple(sorted(parameters.items()))
+            case type if type == ServerResponse.COMMAND_COMPLETE[0]:
+                if bytes(frame[5:-1]).split(b" ")[0] in (b"SET", b"RESET", b"DISCARD"):
+                    self._caches_results = False
+
+    async def _flush(self, frames: list[memoryview]):
+        if frames and (backend := self._backend):
+            backend.writelines(frames)
+            await backend.drain()
+
+    async def _attach_backend(self, read_only: bool = False):
+        backend_pool = self._pool
+        if read_only and (replica_pool := await self._replica_pool()) is not None:
+            backend_pool = replica_pool
+
+        try:
+            self._backend = await backend_pool.acquire()
+        except (BackendError, OSError) as e:
+            if backend_pool is self._pool:
+                raise
+            self._on_replica_failed(backend_pool, e)
+            backend_pool = self._pool
+            self._backend = await backend_pool.acquire()
+
+        self._backend_pool = backend_pool
+        self._relay_task = asyncio.get_running_loop().create_task(self._relay(self._backend, backend_pool))
+
+    def _can_release_backend(self) -> bool:
+        return (
+            self._pooler.pool_mode == PoolMode.TRANSACTION
+            and self._pending_ready_count == 0
+            and not self._in_extended_query
+            and self._backend.status == b"I"
+        )
+
+    def _detach_backend(self, session_ended: bool = False):
+        if (backend := self._backend) is None:
+            return
+
+        backend_pool = self._backend_pool
+        self._backend = None
+        self._backend_pool = None
+        if self._relay_task is not None and self._relay_task is not asyncio.current_task():
+            self._relay_task.cancel()
+        self._relay_task = None
+
+        if self._pending_ready_count > 0 or self._in_extended_query:
+            # The client left in the middle of a query, so we do not know what the backend is up to
+            backend_pool.outstanding_count -= self._pending_ready_count
+            backend_pool.discard(backend)
+            return
+
+        reset_query = self._pooler.reset_query if session_ended or self._pooler.reset_query_always else None
+        if reset_query:
+            asyncio.get_running_loop().create_task(backend_pool.reset_and_release(backend, reset_query))
+        else:
+            backend_pool.release(backend)
+
+    async def _relay(self, backend: Backend, backend_pool: BackendPool):
+        try:
+            while True:
+                frames = await backend.read_frames()
+                incoming_frames = frames
+                if prepared_statement_tracker := self._prepared_statement_tracker:
+                    incoming_frames = []
+
+                for index, frame in enumerate(frames):
+                    self._query_timer.on_backend_message(frame[0])
+                    if prepared_statement_tracker:
+                        prepared_statement_tracker.route(frame, backend, incoming_frames)
+                    if self._recording is not None:
+                        self._record(frame)
+                    if self._pooler.result_cache is not None:
+                        self._watch_settings(frame)
+                    if frame[0] != ServerResponse.READY_FOR_QUERY[0]:
+                        continue
+
+                    backend.status = bytes(frame[5:6])
+                    self._pending_ready_count -= 1
+                    backend_pool.outstanding_count -= 1
+                    if self._written_tables and backend.status == b"I":
+                        # A reader may have cached what it read before the transaction was committed
+                        self._pooler.result_cache.invalidate(self._written_tables)
+                        self._written_tables.clear()
+                    if self._can_release_backend():
+                        # What follows is not an answer to this client (like a notice), so the next one gets it
+                        backend.unread(frames[index + 1:])
+                        self._writelines(incoming_frames if prepared_statement_tracker else frames[:index + 1])
+                        self._detach_backend()
+                        await self._writer.drain()
+                        return
+
+                self._writelines(incoming_frames)
+                await self._writer.drain()
+
+        except ConnectionError:
+            # Either the backend or the client is gone, and the session cannot go on in both cases
+            self._backend = None
+            self._backend_pool = None
+            backend_pool.outstanding_count -= self._pending_ready_count
+            backend_pool.discard(backend)
+            self._writer.close()
+
+
+class Pooler():
+    """Speaks the PostgreSQL protocol to the clients, and lends them backends taken from per-key pools."""
+
+    _local_host_and_port: HostAndPort
+    _remote_host_and_port: HostAndPort
+    _replica_host_and_ports: list[HostAndPort]
+    _pool_size: int
+    _reuse_port: bool
+
+    _pools: dict[PoolKey, BackendPool]
+    _replica_pools: dict[PoolKey, list[BackendPool]]
+    _health_checker: HealthChecker | None
+    # Caps the backends of all the pools together
+    _admission: AsyncioAdmission | None
+    _sessions: dict[tuple[int, int], ClientSession]
+    _process_ids: count
+
+    _loop: asyncio.AbstractEventLoop | None
+    _loop_thread: Thread | None
+    _stopped: asyncio.Future | None
+
+    pool_mode: PoolMode
+    reset_query: str | None
+    reset_query_always: bool
+    track_prepared_statements: bool
+    # How many of them each backend keeps prepared
+    max_prepared_statements: int
+    # Whether the clients are asked for their password without TLS
+    allow_cleartext_password: bool
+
+    query_analyzer: QueryAnalyzer
+    result_cache: ResultCache | None
+    metrics: Metrics
+
+    ssl_context: ssl.SSLContext | None
+    upstream_ssl_context: UpstreamSSLContext | None
+
+    # When the answers of the backends are buffered for a client, the relay waits for them to drain under `low`
+    upstream_to_downstream_watermarks: Watermarks | None
+
+    def __init__(self,
+        local_host_and_port: HostAndPort,
+        remote_host_and_port: HostAndPort,
+        pool_mode: PoolMode = PoolMode.TRANSACTION,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        reset_query: str | None = DEFAULT_RESET_QUERY,
+        reset_query_always: bool = False,
+        track_prepared_statements: bool = True,
+        max_prepared_statements: int = DEFAULT_MAX_PREPARED_STATEMENTS,
+        result_cache_size: int = 0,
+        result_cache_ttl: float = RESULT_CACHE_TTL,
+        ssl_certificate_path: Path | None = None,
+        ssl_key_path: Path | None = None,
+        upstream_ssl_mode: SSLMode = SSLMode.DISABLE,
+        upstream_ssl_root_certificate_path: Path | None = None,
+        metrics: Metrics | None = None,
+        replica_host_and_ports: list[HostAndPort] | None = None,
+        health_check: HealthCheck | None = None,
+        upstream_to_downstream_watermarks: Watermarks | None = None,
+        admission_control: AdmissionControl | None = None,
+        allow_cleartext_password: bool = False,
+        reuse_port: bool = False,
+    ):
+        self._local_host_and_port = local_host_and_port
+        self._remote_host_and_port = remote_host_and_port
+        self._replica_host_and_ports = replica_host_and_ports or []
+        self._pool_size = pool_size
+        self._reuse_port = reuse_port
+
+        self._pools = {}
+        self._replica_pools = {}
+        # The primary and the replicas share their circuit breakers between all the pools
+        self._health_checker = HealthChecker([remote_host_and_port, *self._replica_host_and_ports], health_check) if health_check else None
+        self._admission = AsyncioAdmission(admission_control, on_full=self._make_room) if admission_control else None
+        self._sessions = {}
+        self._process_ids = count(1)
+
+        self._loop = None
+        self._loop_thread = None
+        self._stopped = None
+        self._exit_stack = ExitStack()
+
+        self.pool_mode = pool_mode
+        self.reset_query = reset_query
+        # In transaction mode, the reset query only runs when the client leaves (like the session mode does)
+        self.reset_query_always = reset_query_always
+        self.track_prepared_statements = track_prepared_statements
+        self.max_prepared_statements = max_prepared_statements
+        self.allow_cleartext_password = allow_cleartext_password
+
+        self.query_analyzer = QueryAnalyzer()
+        # The answers of read-only queries are cached only if a size (in bytes) is given
+        self.result_cache = ResultCache(result_cache_size, result_cache_ttl) if result_cache_size > 0 else None
+        self.metrics = metrics or Metrics()
+
+        # The contexts are created here rather than given, as they cannot be sent to the worker processes
+        self.ssl_context = create_server_ssl_context(ssl_certificate_path, ssl_key_path) if ssl_certificate_path is not None else None
+        # All the backends share it, so that each one resumes the TLS session of the previous one
+        self.upstream_ssl_context = create_upstream_ssl_context(upstream_ssl_mode, upstream_ssl_root_certificate_path)
+
+        self.upstream_to_downstream_watermarks = upstream_to_downstream_watermarks
+
+    @property
+    def pools(self) -> dict[PoolKey, BackendPool]:
+        return self._pools
+
+    @property
+    def has_replicas(self) -> bool:
+        return bool(self._replica_host_and_ports)
+
+    @property
+    def health_checker(self) -> HealthChecker | None:
+        return self._health_checker
+
+    def _create_pool(self, remote_host_and_port: HostAndPort, key: PoolKey) -> BackendPool:
+        circuit_breaker = self._health_checker.circuit_breaker(remote_host_and_port) if self._health_checker else None
+        return BackendPool(remote_host_and_port, key, self._pool_size, self.upstream_ssl_context, circuit_breaker, self._admission)
+
+    def _all_pools(self) -> list[BackendPool]:
+        return [*self._pools.values(), *(replica_pool for replica_pools in self._replica_pools.values() for replica_pool in replica_pools)]
+
+    def _make_room(self, admission_key: tuple[str, str]):
+        # The idle backends of the other pools hold places that a waiting client needs, so one of the pool which has the
+        # most of them is closed
+        key_full = self._admission.admission_control.key_full(admission_key)
+        for pool in sorted(self._all_pools(), key=lambda pool: pool.idle_count, reverse=True):
+            if (not key_full or pool.key.admission_key == admission_key) and pool.close_idle_backend():
+                return
+
+    def pool_for(self, key: PoolKey) -> BackendPool:
+        if (pool := self._pools.get(key)) is None:
+            pool = self._pools[key] = self._create_pool(self._remote_host_and_port, key)
+        return pool
+
+    def replica_pool_for(self, key: PoolKey) -> BackendPool | None:
+        if (replica_pools := self._replica_pools.get(key)) is None:
+            replica_pools = self._replica_pools[key] = [
+                self._create_pool(replica_host_and_port, key)
+                for replica_host_and_port in self._replica_host_and_ports
+            ]
+        # The replica with the fewest queries in flight is the least busy one (or the fastest one)
+        return min(
+            (replica_pool for replica_pool in replica_pools if replica_pool.available),
+            key=lambda replica_pool: replica_pool.outstanding_count,
+            default=None,
+        )
+
+    async def cancel(self, process_id: int, secret_key: int):
+        session = self._sessions.get((process_id, secret_key))
+        if session is None or (backend := session.backend) is None:
+            return
+
+        _, writer = await asyncio.open_connection(*backend.remote_host_and_port.as_tuple())
+        writer.write(encode_cancel_request(backend.process_id, backend.secret_key))
+        await writer.drain()
+        writer.close()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = ClientSession(self, next(self._process_ids), reader, writer)
+        self._sessions[(session.process_id, session.secret_key)] = session
+        try:
+            await session.run()
+        finally:
+            del self._sessions[(session.process_id, session.secret_key)]
+
+    def _bind(self) -> socket.socket:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self._reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind(self._local_host_and_port.as_tuple())
+        server_socket.listen()
+        return server_socket
+
+    async def _serve(self, server_socket: socket.socket, started: Event):
+        self._stopped = self._loop.create_future()
+        server = await asyncio.start_server(self._handle_client, sock=server_socket)
+        started.set()
+        try:
+            await self._stopped
+        finally:
+            server.close()
+            if admission := self._admission:
+                # The clients still waiting are abandoned with their sessions
+                admission.admission_control.clear()
+                admission.close()
+            for pool in self._all_pools():
+                pool.close()
+
+    def _run(self, server_socket: socket.socket, started: Event):
+        try:
+            self._loop.run_until_complete(self._serve(server_socket, started))
+        finally:
+            # Like with the SocketForwarder, the live sessions are abandoned rather than awaited
+            if tasks := asyncio.all_tasks(self._loop):
+                for task in tasks:
+                    task.cancel()
+                self._loop.run_until_complete(asyncio.wait(tasks))
+            self._loop.close()
+
+    def __enter__(self):
+        if health_checker := self._health_checker:
+            self._exit_stack.enter_context(health_checker)
+        server_socket = self._bind()
+        self._loop = asyncio.new_event_loop()
+        started = Event()
+        self._loop_thread = Thread(target=self._run, args=(server_socket, started))
+        self._loop_thread.start()
+        self._exit_stack.callback(self._loop_thread.join)
+        started.wait()
+        return self
+
+    def stop(self, wait_for=True):
+        def set_stopped():
+            if not self._stopped.done():
+                self._stopped.set_result(None)
+
+        try:
+            self._loop.call_soon_threadsafe(set_stopped)
+        except RuntimeError:
+            # The loop is already closed
+            pass
+        if wait_for:
+            self.wait_for()
+
+    def __exit__(self, type, value, traceback):
+        self.stop(wait_for=False)
+        self._exit_stack.close()
+        return False
+
+    def wait_for(self):
+        self._loop_thread.join()
+
+
+def run_pooler_worker(
+    local_host_and_port: HostAndPort,
+    remote_host_and_port: HostAndPort,
+    ready: Callable[[], None],
+    **kwargs,
+):
+    # Each worker process has its own pools, so the pool size applies per worker
+    with Pooler(local_host_and_port, remote_host_and_port, reuse_port=True, **kwargs) as pooler:
+        ready()
+        pooler.wait_for()
@@ -3,12 +3,35 @@ import socketserver
 from contextlib import ExitStack
 from threading import Thread
 from io import BytesIO
+from functools import partial
+from pathlib import Path
 
-from radium226.socket_forwarder import SocketForwarder, HostAndPort
+from radium226.socket_forwarder.flow_control import DEFAULT_MEMORY_BUDGET
+from radium226.socket_forwarder.admission import ADMISSION_TIMEOUT_IN_SECONDS
+from radium226.socket_forwarder import (
+    SocketForwarder, 
+    HealthCheck,
+    HostAndPort,
+    Engine,
+    Supervisor,
+    DispatchingEventHandler,
+    OverflowPolicy,
+    Watermarks,
+    MemoryBudget,
+    AdmissionControl,
+    run_socket_forwarder_worker,
+)
 
 
 from .server import Server
 from .wire import WireEventHandler
+from .pool import PoolMode, DEFAULT_POOL_SIZE, DEFAULT_RESET_QUERY
+from .pooler import Pooler, run_pooler_worker
+from .result_cache import RESULT_CACHE_TTL
+from .tls import SSLMode
+from .metrics import Metrics, MetricsServer
+from .health import postgresql_health_check
+from .wire import encode_error
 
 class PostgreSQLProxy():
 
@@ -18,20 +41,161 @@ class PostgreSQLProxy():
     _local_host: str
     _local_port: int
 
+    _worker_count: int
+    _engine: Engine
+
+    _dispatch_worker_count: int
+    _overflow_policy: OverflowPolicy
+
+    _pool_mode: PoolMode | None
+    _pool_size: int
+    _reset_query: str | None
+    _result_cache_size: int
+    _result_cache_ttl: float
+
+    _ssl_certificate_path: Path | None
+    _ssl_key_path: Path | None
+    _allow_cleartext_password: bool
+    _upstream_ssl_mode: SSLMode
+    _upstream_ssl_root_certificate_path: Path | None
+
+    _replicas: list[tuple[str, int]]
+    _health_check: HealthCheck | None
+
+    _upstream_to_downstream_watermarks: Watermarks | None
+    _downstream_to_upstream_watermarks: Watermarks | None
+    _memory_budget: MemoryBudget
+
+    _metrics: Metrics
+    _metrics_port: int | None
+
+    _handoff_path: Path | None
+    _handoff_connections: bool
+
+    # Caps the connections to PostgreSQL, above which the clients wait for one to close
+    _admission_control: AdmissionControl | None
+
     _socket_forwarder: SocketForwarder | None = None
+    _supervisor: Supervisor | None = None
+    _pooler: Pooler | None = None
 
     def __init__(self, 
         remote_host: str, 
         remote_port: int, 
         local_host: str | None = None, 
-        local_port: int | None = None
+        local_port: int | None = None,
+        worker_count: int = 1,
+        engine: Engine = Engine.SELECTORS,
+        dispatch_worker_count: int = 0,
+        overflow_policy: OverflowPolicy = OverflowPolicy.DROP,
+        pool_mode: PoolMode | None = None,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        reset_query: str | None = DEFAULT_RESET_QUERY,
+        result_cache_size: int = 0,
+        result_cache_ttl: float = RESULT_CACHE_TTL,
+        ssl_certificate_path: Path | None = None,
+        ssl_key_path: Path | None = None,
+        allow_cleartext_password: bool = False,
+        upstream_ssl_mode: SSLMode = SSLMode.DISABLE,
+        upstream_ssl_root_certificate_path: Path | None = None,
+        replicas: list[tuple[str, int]] | None = None,
+        health_check_interval: float | None = None,
+        upstream_to_downstream_watermarks: Watermarks | None = None,
+        downstream_to_upstream_watermarks: Watermarks | None = None,
+        memory_budget: int | None = None,
+        metrics_port: int | None = None,
+        handoff_path: Path | None = None,
+        handoff_connections: bool = False,
+        max_upstream_connections: int | None = None,
+        max_upstream_connections_per_database: int | None = None,
+        admission_timeout: float = ADMISSION_TIMEOUT_IN_SECONDS,
     ):
         self._remote_host = remote_host
         self._remote_port = remote_port
 
         self._local_host = local_host or "localhost"
         self._local_port = local_port or 5432
-        
+
+        self._worker_count = worker_count
+        self._engine = engine
+
+        self._dispatch_worker_count = dispatch_worker_count
+        self._overflow_policy = overflow_policy
+
+        # Without a pool mode, the bytes are forwarded as they are, and each client gets its own backend
+        self._pool_mode = pool_mode
+        self._pool_size = pool_size
+        self._reset_query = reset_query
+        # The result cache needs the pooler, which is the one answering the clients by itself
+        if result_cache_size > 0 and pool_mode is None:
+            raise ValueError("The result cache requires a pool mode")
+        # Each worker would cache on its own, and keep serving what a write through another worker invalidated
+        if result_cache_size > 0 and worker_count > 1:
+            raise ValueError("The result cache requires a single worker")
+        self._result_cache_size = result_cache_size
+        self._result_cache_ttl = result_cache_ttl
+
+        # Without a pool mode, the TLS connections of the clients go through to PostgreSQL, which terminates them
+        if (ssl_certificate_path is not None or upstream_ssl_mode != SSLMode.DISABLE) and pool_mode is None:
+            raise ValueError("The TLS termination requires a pool mode")
+        self._ssl_certificate_path = ssl_certificate_path
+        self._ssl_key_path = ssl_key_path
+        # The pooler asks the clients for their password in clear, which is only safe over TLS otherwise
+        self._allow_cleartext_password = allow_cleartext_password
+        self._upstream_ssl_mode = upstream_ssl_mode
+        self._upstream_ssl_root_certificate_path = upstream_ssl_root_certificate_path
+
+        # The queries can only be routed by the pooler, which is the one choosing the backends, and between two
+        # transactions (a session keeps its backend until it is over)
+        if replicas and pool_mode != PoolMode.TRANSACTION:
+            raise ValueError("The read replicas require the transaction pool mode")
+        self._replicas = replicas or []
+
+        # Without health checks, a dead upstream is only noticed by the connections which fail on it
+        self._health_check = postgresql_health_check(health_check_interval) if health_check_interval else None
+
+        # The metrics live in the process which records them, so the worker processes would each have their own
+        if metrics_port is not None and worker_count > 1:
+            raise ValueError("The metrics endpoint requires a single worker")
+        self._metrics = Metrics()
+        self._metrics_port = metrics_port
+
+        # The watermarks bound what each connection buffers, and the budget what they all buffer together
+        if memory_budget is not None and (pool_mode is not None or engine in (Engine.ASYNCIO, Engine.UVLOOP)):
+            raise ValueError("The memory budget requires the selectors or the epoll engine, without a pool mode")
+        self._upstream_to_downstream_watermarks = upstream_to_downstream_watermarks
+        self._downstream_to_upstream_watermarks = downstream_to_upstream_watermarks
+        self._memory_budget = MemoryBudget(memory_budget if memory_budget is not None else DEFAULT_MEMORY_BUDGET)
+        self._metrics.buffered_bytes.set_function(lambda: self._memory_budget.used)
+        self._metrics.buffer_budget_bytes.set_function(lambda: self._memory_budget.limit)
+        self._metrics.buffer_budget_pauses.set_function(lambda: self._memory_budget.pause_count)
+
+        # The sessions of the pooler live in its process, and each worker would need a handoff of its own
+        if handoff_path is not None and (pool_mode is not None or worker_count > 1):
+            raise ValueError("The handoff requires a single worker without a pool mode")
+        self._handoff_path = handoff_path
+        self._handoff_connections = handoff_connections
+
+        # Without a pool mode, the user and the database of a connection are not known when it is forwarded
+        if max_upstream_connections_per_database is not None and pool_mode is None:
+            raise ValueError("The cap on the connections per user and database requires a pool mode")
+        # The workers would each count their own connections, and let through `worker_count` times the cap
+        if (max_upstream_connections is not None or max_upstream_connections_per_database is not None) and worker_count > 1:
+            raise ValueError("The cap on the connections to PostgreSQL requires a single worker")
+        self._admission_control = None
+        if max_upstream_connections is not None or max_upstream_connections_per_database is not None:
+            admission_control = self._admission_control = AdmissionControl(
+                max_upstream_connections,
+                max_upstream_connections_per_database,
+                admission_timeout,
+                # Only the forwarder sends it, as the pooler answers the clients by itself
+                rejection=encode_error("Too many clients are waiting for a connection to PostgreSQL", code="53300"),
+                on_admitted=lambda wait_time: self._metrics.admission_wait_duration.record(int(wait_time * 1e6)),
+            )
+            self._metrics.upstream_connections.set_function(lambda: admission_control.active_count)
+            self._metrics.admission_waiting_clients.set_function(lambda: admission_control.waiting_count)
+            self._metrics.admission_timeouts.set_function(lambda: admission_control.timeout_count)
+
         self._exit_stack = ExitStack()
 
 
@@ -45,26 +209,129 @@ class PostgreSQLProxy():
         return self._local_port
     
 
+    @property
+    def worker_count(self) -> int:
+        return self._worker_count
+
+
+    @property
+    def metrics(self) -> Metrics:
+        return self._metrics
+    
+
     def wait_for(self) -> None:
-        if server := self._server:
-            server.wait_for()
+        if supervisor := self._supervisor:
+            supervisor.wait_for()
+        elif socket_forwarder := self._socket_forwarder:
+            socket_forwarder.wait_for()
+        elif pooler := self._pooler:
+            pooler.wait_for()
         else:
             raise ValueError("The server is not running")
     
 
+    def _create_event_handler(self) -> WireEventHandler | DispatchingEventHandler:
+        # The traffic is inspected while it flows, and only the messages the inspection needs are framed
+        event_handler = WireEventHandler(metrics=self._metrics)
+        if self._dispatch_worker_count > 0:
+            # The inspection then runs off the forwarding loop, whose latency does not depend on it anymore
+            event_handler = DispatchingEventHandler(
+                event_handler,
+                worker_count=self._dispatch_worker_count,
+                overflow_policy=self._overflow_policy,
+            )
+        return event_handler
+    
+
+    def _start_pooler(self, local_host_and_port: HostAndPort, remote_host_and_port: HostAndPort):
+        pooler_kwargs = dict(
+            pool_mode=self._pool_mode,
+            pool_size=self._pool_size,
+            reset_query=self._reset_query,
+            result_cache_size=self._result_cache_size,
+            result_cache_ttl=self._result_cache_ttl,
+            ssl_certificate_path=self._ssl_certificate_path,
+            ssl_key_path=self._ssl_key_path,
+            allow_cleartext_password=self._allow_cleartext_password,
+            upstream_ssl_mode=self._upstream_ssl_mode,
+            upstream_ssl_root_certificate_path=self._upstream_ssl_root_certificate_path,
+            replica_host_and_ports=[HostAndPort.from_tuple(replica) for replica in self._replicas],
+            health_check=self._health_check,
+            # The pooler sends the queries as they come, so only the answers are buffered
+            upstream_to_downstream_watermarks=self._upstream_to_downstream_watermarks,
+            admission_control=self._admission_control,
+        )
+        if self._worker_count > 1:
+            self._supervisor = self._exit_stack.enter_context(
+                Supervisor(
+                    partial(run_pooler_worker, local_host_and_port, remote_host_and_port, **pooler_kwargs),
+                    self._worker_count,
+                )
+            )
+        else:
+            self._pooler = self._exit_stack.enter_context(
+                Pooler(local_host_and_port, remote_host_and_port, metrics=self._metrics, **pooler_kwargs)
+            )
+
+
     def __enter__(self):
-        self._socket_forwarder = self._exit_stack.enter_context(
-            SocketForwarder(
-                HostAndPort(self._local_host, self._local_port), 
+        if self._metrics_port is not None:
+            self._exit_stack.enter_context(MetricsServer(HostAndPort(self._local_host, self._metrics_port), self._metrics))
+
+        if self._pool_mode is not None:
+            self._start_pooler(
+                HostAndPort(self._local_host, self._local_port),
                 HostAndPort(self._remote_host, self._remote_port),
-                WireEventHandler()
             )
-        )
+            return self
+
+        event_handler = self._create_event_handler()
+        if isinstance(event_handler, DispatchingEventHandler):
+            self._exit_stack.callback(event_handler.close)
+
+        local_host_and_port = HostAndPort(self._local_host, self._local_port)
+        remote_host_and_port = HostAndPort(self._remote_host, self._remote_port)
+
+        # The transports of asyncio are only bound by their watermarks
+        memory_budget = self._memory_budget if self._engine not in (Engine.ASYNCIO, Engine.UVLOOP) else None
+
+        if self._worker_count > 1:
+            # Each worker binds the local address with SO_REUSEPORT and runs its own selector loop
+            self._supervisor = self._exit_stack.enter_context(
+                Supervisor(
+                    partial(
+                        run_socket_forwarder_worker, 
+                        local_host_and_port, 
+                        remote_host_and_port, 
+                        event_handler,
+                        engine=self._engine,
+                        health_check=self._health_check,
+                        upstream_to_downstream_watermarks=self._upstream_to_downstream_watermarks,
+                        downstream_to_upstream_watermarks=self._downstream_to_upstream_watermarks,
+                        memory_budget=memory_budget,
+                    ),
+                    self._worker_count,
+                )
+            )
+        else:
+            self._socket_forwarder = self._exit_stack.enter_context(
+                SocketForwarder(
+                    local_host_and_port, 
+                    remote_host_and_port,
+                    event_handler,
+                    engine=self._engine,
+                    health_check=self._health_check,
+                    upstream_to_downstream_watermarks=self._upstream_to_downstream_watermarks,
+                    downstream_to_upstream_watermarks=self._downstream_to_upstream_watermarks,
+                    memory_budget=memory_budget,
+                    handoff_path=self._handoff_path,
+                    handoff_connections=self._handoff_connections,
+                    admission_control=self._admission_control,
+                )
+            )
         return self
 
 
     def __exit__(self, type, value, traceback):
-        print("Proxy server stopped! ")
         self._exit_stack.close()
-        print("Proxy server stopped2! ")
         return False
\ No newline at end of file
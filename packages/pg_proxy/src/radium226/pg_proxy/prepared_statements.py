@@ -0,0 +1,275 @@
+import hashlib
+import re
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from .wire import (
+    ClientCommand,
+    ServerResponse,
+    NULL_BYTE,
+    encode_message,
+    encode_error,
+    encode_query,
+    decode_frontend_message,
+)
+
+if TYPE_CHECKING:
+    from .pool import Backend
+
+
+BACKEND_STATEMENT_PREFIX = "pgp_"
+
+# The statements prepared on each backend, above which the least recently used one is closed
+DEFAULT_MAX_PREPARED_STATEMENTS = 100
+
+# The backend messages which are not answers to anything, and are always forwarded
+_ASYNCHRONOUS_RESPONSES = frozenset(response[0] for response in [
+    ServerResponse.NOTICE_RESPONSE,
+    ServerResponse.NOTIFICATION_RESPONSE,
+    ServerResponse.PARAMETER_STATUS,
+])
+
+# The simple queries which deallocate prepared statements (which are the ones of the protocol too)
+_DEALLOCATE = re.compile(r'\s*(?:DEALLOCATE\s+(?:PREPARE\s+)?(?P<name>\w+|"(?:[^"]|"")+")|DISCARD\s+ALL)\s*;?\s*', re.IGNORECASE)
+
+_PARSE_COMPLETE = encode_message(ServerResponse.PARSE_COMPLETE)
+_CLOSE_COMPLETE = encode_message(ServerResponse.CLOSE_COMPLETE)
+
+
+@dataclass(frozen=True, slots=True)
+class PreparedStatement():
+
+    # The name that the backends know the statement by, which is the same for all the clients preparing it
+    backend_name: str
+    # The Parse message preparing it under that name
+    frame: bytes
+
+    @classmethod
+    def from_parse(cls, frame: memoryview, name_length: int) -> "PreparedStatement":
+        # The query and the parameter types, which make the statement what it is
+        definition = bytes(frame[5 + name_length + 1:])
+        backend_name = BACKEND_STATEMENT_PREFIX + hashlib.sha256(definition).hexdigest()[:32]
+        return cls(
+            backend_name=backend_name,
+            frame=encode_message(ClientCommand.PARSE, backend_name.encode() + NULL_BYTE + definition),
+        )
+
+
+@dataclass(slots=True)
+class _ResponseSlot():
+    """What the client expects in answer to one of its messages."""
+
+    # The types of the backend messages which end the answer
+    last_responses: bytes
+    # Whether the answer goes to the client, or was only for the proxy (like for a Parse it added)
+    forwarded: bool = True
+    # An answer that the proxy gives by itself, without asking the backend
+    synthesized: bytes | None = None
+    # Whether the slot is for a Sync (or for a simple query), which an error does not skip
+    synchronizing: bool = False
+    # The statement being prepared on the backend, which is not if the Parse fails
+    backend_name: str | None = None
+    # The statement being closed on the backend, which is not if the Close is skipped
+    closed_backend_name: str | None = None
+
+
+class PreparedStatementTracker():
+    """Lets a client use its named prepared statements on whatever backend it is lent.
+
+    The statements of the client are prepared on the backends under a name derived from their definition, so a
+    backend which already prepared it for any client can reuse it, and a backend lacking it is sent the Parse first.
+    The answers of the backend are then matched with the messages of the client, in order to hide the answers to the
+    messages that the proxy added, and to add the answers to the messages that it did not send.
+
+    Each backend keeps at most `max_prepared_statements` of them: the least recently used one is closed to make room
+    for the next one, and prepared again if it is used again.
+    """
+
+    _max_prepared_statements: int
+    _statements: dict[str, PreparedStatement]
+    _response_slots: deque[_ResponseSlot]
+    # The statements used since the last Sync, which are not closed to make room as their portals would go with them
+    _used_backend_names: set[str]
+    # Whether a message was refused, after which the next ones are skipped up to the Sync (as the backend would)
+    _failed: bool
+
+    def __init__(self, max_prepared_statements: int = DEFAULT_MAX_PREPARED_STATEMENTS):
+        self._max_prepared_statements = max_prepared_statements
+        self._statements = {}
+        self._response_slots = deque()
+        self._used_backend_names = set()
+        self._failed = False
+
+    def _close(self, backend_name: str, backend: "Backend", outgoing_frames: list, forwarded: bool):
+        del backend.prepared_statements[backend_name]
+        outgoing_frames.append(encode_message(ClientCommand.CLOSE, b"S" + backend_name.encode() + NULL_BYTE))
+        self._response_slots.append(_ResponseSlot(ServerResponse.CLOSE_COMPLETE, forwarded=forwarded, closed_backend_name=backend_name))
+
+    def _prepare(self, statement: PreparedStatement, backend: "Backend", outgoing_frames: list, forwarded: bool):
+        # The backend names are kept from the least to the most recently used
+        evictable_backend_names = [
+            backend_name
+            for backend_name in backend.prepared_statements
+            if backend_name not in self._used_backend_names
+        ]
+        for backend_name in evictable_backend_names[:max(len(backend.prepared_statements) - self._max_prepared_statements + 1, 0)]:
+            self._close(backend_name, backend, outgoing_frames, forwarded=False)
+
+        backend.prepared_statements[statement.backend_name] = None
+        self._used_backend_names.add(statement.backend_name)
+        outgoing_frames.append(statement.frame)
+        self._response_slots.append(_ResponseSlot(ServerResponse.PARSE_COMPLETE, forwarded=forwarded, backend_name=statement.backend_name))
+
+    def _use(self, statement: PreparedStatement, backend: "Backend", outgoing_frames: list):
+        if statement.backend_name in backend.prepared_statements:
+            # It becomes the most recently used one
+            del backend.prepared_statements[statement.backend_name]
+            backend.prepared_statements[statement.backend_name] = None
+            self._used_backend_names.add(statement.backend_name)
+        else:
+            self._prepare(statement, backend, outgoing_frames, forwarded=False)
+
+    def _deallocate(self, frame: memoryview, backend: "Backend", outgoing_frames: list) -> memoryview | bytes:
+        """Forgets the statements that a simple query deallocates, and returns the query to send instead."""
+
+        if not (match := _DEALLOCATE.fullmatch(decode_frontend_message(frame).query)):
+            return frame
+
+        name = match.group("name")
+        if name is None or name.upper() == "ALL":
+            # The backend loses the statements of the other clients too, which prepare them again
+            self._statements.clear()
+            backend.prepared_statements.clear()
+            return frame
+
+        name = name[1:-1].replace('""', '"') if name.startswith('"') else name.lower()
+        if not (statement := self._statements.pop(name, None)):
+            # A statement prepared with PREPARE, which the backend knows by the name that the client gave
+            return frame
+
+        if statement.backend_name not in backend.prepared_statements:
+            # The backend must know it, so that the client gets the answer it expects
+            self._prepare(statement, backend, outgoing_frames, forwarded=False)
+        del backend.prepared_statements[statement.backend_name]
+        return encode_query(f"DEALLOCATE {statement.backend_name}")
+
+    def _rename(self, frame: memoryview, offset: int, name_length: int, backend_name: str) -> bytes:
+        payload = bytes(frame[5:offset]) + backend_name.encode() + bytes(frame[offset + name_length:])
+        return encode_message(bytes(frame[0:1]), payload)
+
+    def rewrite(self, frame: memoryview, backend: "Backend", outgoing_frames: list):
+        """Appends to `outgoing_frames` what must be sent to the backend instead of the frame of the client."""
+
+        # The simple queries are not skipped, as the client waits for their ReadyForQuery (and the backend, which did
+        # not see the refused message, answers them)
+        if self._failed and frame[0] not in (ClientCommand.SYNC[0], ClientCommand.QUERY[0], ClientCommand.FUNCTION_CALL[0]):
+            return
+
+        match frame[0]:
+            case type if type == ClientCommand.PARSE[0]:
+                name_length = bytes(frame[5:]).index(0)
+                if name_length == 0:
+                    outgoing_frames.append(frame)
+                    self._response_slots.append(_ResponseSlot(ServerResponse.PARSE_COMPLETE))
+                    return
+
+                name = bytes(frame[5:5 + name_length]).decode()
+                if name in self._statements:
+                    # Like PostgreSQL, which would not know about it as the statement of the backend has another name
+                    error = encode_error(f"prepared statement \"{name}\" already exists", code="42P05", severity="ERROR")
+                    self._response_slots.append(_ResponseSlot(b"", synthesized=error))
+                    self._failed = True
+                    return
+
+                statement = self._statements[name] = PreparedStatement.from_parse(frame, name_length)
+                if statement.backend_name in backend.prepared_statements:
+                    self._use(statement, backend, outgoing_frames)
+                    self._response_slots.append(_ResponseSlot(b"", synthesized=_PARSE_COMPLETE))
+                else:
+                    self._prepare(statement, backend, outgoing_frames, forwarded=True)
+
+            case type if type == ClientCommand.BIND[0]:
+                data = bytes(frame)
+                offset = data.index(0, 5) + 1
+                name_length = data.index(0, offset) - offset
+                if statement := self._statements.get(data[offset:offset + name_length].decode()):
+                    self._use(statement, backend, outgoing_frames)
+                    frame = self._rename(frame, offset, name_length, statement.backend_name)
+                outgoing_frames.append(frame)
+                self._response_slots.append(_ResponseSlot(ServerResponse.BIND_COMPLETE))
+
+            case type if type == ClientCommand.DESCRIBE[0]:
+                name_length = len(frame) - 7
+                if frame[5] == ord("S") and (statement := self._statements.get(bytes(frame[6:-1]).decode())):
+                    self._use(statement, backend, outgoing_frames)
+                    frame = self._rename(frame, 6, name_length, statement.backend_name)
+                outgoing_frames.append(frame)
+                self._response_slots.append(_ResponseSlot(ServerResponse.ROW_DESCRIPTION + ServerResponse.NO_DATA))
+
+            case type if type == ClientCommand.CLOSE[0]:
+                if frame[5] == ord("S") and (statement := self._statements.pop(bytes(frame[6:-1]).decode(), None)):
+                    if statement.backend_name in backend.prepared_statements:
+                        # The other clients which use it on this backend prepare it again
+                        self._close(statement.backend_name, backend, outgoing_frames, forwarded=True)
+                    else:
+                        # The backends which prepared it close it once it is their least recently used one
+                        self._response_slots.append(_ResponseSlot(b"", synthesized=_CLOSE_COMPLETE))
+                else:
+                    outgoing_frames.append(frame)
+                    self._response_slots.append(_ResponseSlot(ServerResponse.CLOSE_COMPLETE))
+
+            case type if type == ClientCommand.EXECUTE[0]:
+                outgoing_frames.append(frame)
+                self._response_slots.append(_ResponseSlot(
+                    ServerResponse.COMMAND_COMPLETE + ServerResponse.EMPTY_QUERY_RESPONSE + ServerResponse.PORTAL_SUSPENDED
+                ))
+
+            case type if type in (ClientCommand.SYNC[0], ClientCommand.QUERY[0], ClientCommand.FUNCTION_CALL[0]):
+                if type == ClientCommand.QUERY[0]:
+                    frame = self._deallocate(frame, backend, outgoing_frames)
+                self._used_backend_names.clear()
+                self._failed = False
+                outgoing_frames.append(frame)
+                self._response_slots.append(_ResponseSlot(ServerResponse.READY_FOR_QUERY, synchronizing=True))
+
+            case _:
+                # Flush and the COPY messages, which are not answered by themselves
+                outgoing_frames.append(frame)
+
+    def synthesized_responses(self) -> list[bytes]:
+        """Pops the answers which come next and are not waiting for the backend."""
+
+        responses = []
+        while self._response_slots and (synthesized := self._response_slots[0].synthesized) is not None:
+            self._response_slots.popleft()
+            responses.append(synthesized)
+        return responses
+
+    def route(self, frame: memoryview, backend: "Backend", incoming_frames: list):
+        """Appends to `incoming_frames` what must be sent to the client for this frame of the backend."""
+
+        type = frame[0]
+        if type in _ASYNCHRONOUS_RESPONSES or not self._response_slots:
+            incoming_frames.append(frame)
+            return
+
+        response_slot = self._response_slots[0]
+        if type == ServerResponse.ERROR_RESPONSE[0] and not response_slot.synchronizing:
+            # The backend then ignores everything up to the next Sync, and so do we
+            incoming_frames.append(frame)
+            while self._response_slots and not self._response_slots[0].synchronizing:
+                skipped_response_slot = self._response_slots.popleft()
+                if (backend_name := skipped_response_slot.backend_name) is not None:
+                    # Neither the failed Parse nor the skipped ones prepared anything
+                    backend.prepared_statements.pop(backend_name, None)
+                if (backend_name := skipped_response_slot.closed_backend_name) is not None:
+                    # Nor did the skipped Close close anything
+                    backend.prepared_statements[backend_name] = None
+            return
+
+        if response_slot.forwarded:
+            incoming_frames.append(frame)
+        if type in response_slot.last_responses:
+            self._response_slots.popleft()
+            incoming_frames.extend(self.synthesized_responses())
@@ -0,0 +1,213 @@
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import StrEnum, auto
+from threading import Lock
+
+import sqlglot
+from sqlglot import exp
+
+
+QUERY_ANALYZER_MAX_SIZE = 1024
+
+
+class StatementKind(StrEnum):
+
+    SELECT = auto()
+    INSERT = auto()
+    UPDATE = auto()
+    DELETE = auto()
+    MERGE = auto()
+    COPY = auto()
+    DDL = auto()
+    TRANSACTION = auto()
+    SET = auto()
+    SHOW = auto()
+    OTHER = auto()
+    # The statement could not be parsed
+    UNKNOWN = auto()
+
+
+@dataclass(frozen=True, slots=True)
+class QueryMetadata():
+
+    tables: tuple[str, ...]
+    # The kind of the first statement, as a query can hold several of them
+    kind: StatementKind
+    # True when none of the statements can write anything (or take a row lock)
+    read_only: bool
+
+
+_FINGERPRINT_PATTERN = re.compile(
+    r"""
+        (?P<quoted_identifier>"(?:[^"]|"")*")
+      | (?P<escape_string>[eE]'(?:[^'\\]|''|\\.)*')
+      | (?P<string>'(?:[^']|'')*')
+      | (?P<dollar_string>\$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?\$(?P=tag)\$)
+      | (?P<parameter>\$\d+)
+      | (?P<identifier>[A-Za-z_][\w$]*)
+      | (?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+      | (?P<whitespace>(?:\s+|--[^\n]*|/\*.*?\*/)+)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+_LITERAL_LIST_PATTERN = re.compile(r"\?(?:\s*,\s*\?)+")
+
+_LITERAL_GROUPS = frozenset(["escape_string", "string", "dollar_string", "number"])
+
+
+def _replace_token(match: re.Match) -> str:
+    group = match.lastgroup
+    if group in _LITERAL_GROUPS:
+        return "?"
+    if group == "whitespace":
+        return " "
+    return match.group()
+
+
+def fingerprint(query: str) -> str:
+    """Strips the literals, comments and extra whitespace out of the query, so that its statement shape is left.
+
+    Lists of literals are collapsed too, so that `IN (1, 2)` and `IN (1, 2, 3)` share the same fingerprint.
+    """
+
+    stripped_query = _FINGERPRINT_PATTERN.sub(_replace_token, query)
+    return _LITERAL_LIST_PATTERN.sub("?", stripped_query).strip()
+
+
+_STATEMENT_KINDS: dict[type[exp.Expression], StatementKind] = {
+    exp.Select: StatementKind.SELECT,
+    exp.Union: StatementKind.SELECT,
+    exp.Intersect: StatementKind.SELECT,
+    exp.Except: StatementKind.SELECT,
+    exp.Values: StatementKind.SELECT,
+    exp.Insert: StatementKind.INSERT,
+    exp.Update: StatementKind.UPDATE,
+    exp.Delete: StatementKind.DELETE,
+    exp.Merge: StatementKind.MERGE,
+    exp.Copy: StatementKind.COPY,
+    exp.Create: StatementKind.DDL,
+    exp.Drop: StatementKind.DDL,
+    exp.Alter: StatementKind.DDL,
+    exp.TruncateTable: StatementKind.DDL,
+    exp.Transaction: StatementKind.TRANSACTION,
+    exp.Commit: StatementKind.TRANSACTION,
+    exp.Rollback: StatementKind.TRANSACTION,
+    exp.Set: StatementKind.SET,
+}
+
+_WRITING_EXPRESSIONS = (exp.Insert, exp.Update, exp.Delete, exp.Merge)
+
+# Functions which make an otherwise read-only SELECT write something
+_WRITING_FUNCTIONS = frozenset(["nextval", "setval", "pg_advisory_lock", "pg_advisory_xact_lock"])
+
+
+def _statement_kind(statement: exp.Expression) -> StatementKind:
+    if isinstance(statement, exp.Command):
+        return StatementKind.SHOW if statement.name.upper() == "SHOW" else StatementKind.OTHER
+    return _STATEMENT_KINDS.get(type(statement), StatementKind.OTHER)
+
+
+def _is_read_only(statement: exp.Expression) -> bool:
+    match _statement_kind(statement):
+        case StatementKind.SHOW:
+            return True
+
+        case StatementKind.SELECT:
+            # SELECT ... INTO creates a table, and data-modifying CTEs can hide in any SELECT
+            if any(select.args.get("into") or select.args.get("locks") for select in statement.find_all(exp.Select)):
+                return False
+            if next(statement.find_all(*_WRITING_EXPRESSIONS), None):
+                return False
+            return not any(
+                function.name.lower() in _WRITING_FUNCTIONS
+                for function in statement.find_all(exp.Anonymous)
+            )
+
+        case _:
+            return False
+
+
+def _table_names(statement: exp.Expression) -> list[str]:
+    cte_names = {cte.alias_or_name for cte in statement.find_all(exp.CTE)}
+    return [
+        ".".join(part.name for part in table.parts)
+        for table in statement.find_all(exp.Table)
+        if table.name and (table.db or table.name not in cte_names)
+    ]
+
+
+def analyze(query: str) -> QueryMetadata:
+    try:
+        statements = [statement for statement in sqlglot.parse(query, dialect="postgres") if statement is not None]
+    except sqlglot.errors.SqlglotError:
+        return QueryMetadata(tables=(), kind=StatementKind.UNKNOWN, read_only=False)
+
+    if not statements:
+        return QueryMetadata(tables=(), kind=StatementKind.OTHER, read_only=True)
+
+    return QueryMetadata(
+        tables=tuple(dict.fromkeys(table_name for statement in statements for table_name in _table_names(statement))),
+        kind=_statement_kind(statements[0]),
+        read_only=all(_is_read_only(statement) for statement in statements),
+    )
+
+
+class QueryAnalyzer():
+    """Analyzes queries with sqlglot, but only once per statement shape.
+
+    The metadata is kept in a LRU cache keyed by the fingerprint of the query, which is much cheaper to compute than
+    parsing it. A single analyzer can be shared between the handlers of all the connections (and their threads).
+    """
+
+    _max_size: int
+    _metadata_by_fingerprint: OrderedDict[str, QueryMetadata]
+    _lock: Lock
+
+    hit_count: int
+    miss_count: int
+
+    def __init__(self, max_size: int = QUERY_ANALYZER_MAX_SIZE):
+        self._max_size = max_size
+        self._metadata_by_fingerprint = OrderedDict()
+        self._lock = Lock()
+
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def __len__(self) -> int:
+        return len(self._metadata_by_fingerprint)
+
+    # The lock cannot be pickled, and the cache is worth nothing to another process
+    def __getstate__(self):
+        return {"_max_size": self._max_size}
+
+    def __setstate__(self, state):
+        self.__init__(max_size=state["_max_size"])
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    def analyze(self, query: str) -> QueryMetadata:
+        key = fingerprint(query)
+        with self._lock:
+            if (metadata := self._metadata_by_fingerprint.get(key)) is not None:
+                self._metadata_by_fingerprint.move_to_end(key)
+                self.hit_count += 1
+                return metadata
+            self.miss_count += 1
+
+        # We parse outside of the lock: at worst, two threads parse the same new statement shape
+        metadata = analyze(query)
+        with self._lock:
+            self._metadata_by_fingerprint[key] = metadata
+            self._metadata_by_fingerprint.move_to_end(key)
+            while len(self._metadata_by_fingerprint) > self._max_size:
+                self._metadata_by_fingerprint.popitem(last=False)
+        return metadata
+
+    def clear(self):
+        with self._lock:
+            self._metadata_by_fingerprint.clear()
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+from typing import Hashable
+
+
+RESULT_CACHE_TTL = 5.0
+
+# A single result cannot take more than this share of the cache
+MAX_ENTRY_SHARE = 16
+
+
+def _normalize_table(table: str) -> str:
+    # Without the schema (and the case), a write invalidates more than it needs to, but never less
+    return table.rsplit(".", 1)[-1].lower()
+
+
+@dataclass(frozen=True, slots=True)
+class _Entry():
+
+    response: bytes
+    tables: tuple[str, ...]
+    expires_at: float
+
+
+class ResultCache():
+    """Keeps the answers of read-only queries, to replay them to the clients sending the same queries again.
+
+    Entries are evicted in LRU order once the cache holds more than `max_size` bytes of answers, expire after `ttl`
+    seconds, and are invalidated by the writes to any of their tables which go through the proxy. Writes which do not
+    go through the proxy are only caught up with by the TTL.
+    """
+
+    _max_size: int
+    _ttl: float
+
+    _entries: OrderedDict[Hashable, _Entry]
+    _keys_by_table: dict[str, set[Hashable]]
+    _size: int
+
+    # Each invalidation is numbered, so that an answer recorded before the invalidation of one of its tables is not kept
+    _generation: int
+    _generation_by_table: dict[str, int]
+
+    hit_count: int
+    miss_count: int
+    invalidation_count: int
+
+    def __init__(self, max_size: int, ttl: float = RESULT_CACHE_TTL):
+        self._max_size = max_size
+        self._ttl = ttl
+
+        self._entries = OrderedDict()
+        self._keys_by_table = {}
+        self._size = 0
+
+        self._generation = 0
+        self._generation_by_table = {}
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.invalidation_count = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, key: Hashable) -> bytes | None:
+        if (entry := self._entries.get(key)) is None:
+            self.miss_count += 1
+            return None
+
+        if entry.expires_at < monotonic():
+            self._remove(key)
+            self.miss_count += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hit_count += 1
+        return entry.response
+
+    def put(self, key: Hashable, tables: tuple[str, ...], response: bytes, generation: int):
+        """Keeps the answer, unless one of its tables was invalidated since `generation` (when it started)."""
+
+        if len(response) > self._max_size // MAX_ENTRY_SHARE:
+            return
+        tables = tuple(_normalize_table(table) for table in tables)
+        if any(self._generation_by_table.get(table, 0) > generation for table in tables):
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(response, tables, monotonic() + self._ttl)
+        self._size += len(response)
+        for table in tables:
+            self._keys_by_table.setdefault(table, set()).add(key)
+
+        while self._size > self._max_size:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tables: set[str] | tuple[str, ...]):
+        self._generation += 1
+        for table in map(_normalize_table, tables):
+            self._generation_by_table[table] = self._generation
+            for key in self._keys_by_table.pop(table, set()):
+                if key in self._entries:
+                    self._remove(key)
+                    self.invalidation_count += 1
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key)
+        self._size -= len(entry.response)
+        for table in entry.tables:
+            if (keys := self._keys_by_table.get(table)) is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
@@ -4,6 +4,7 @@ from queue import Queue, Empty
 from enum import StrEnum, auto
 from functools import partial
 import socket
+from time import monotonic
 from selectors import (
     DefaultSelector,
     EVENT_READ,
@@ -13,6 +14,8 @@ from typing import Protocol, Generator
 
 from io import BytesIO
 
+from radium226.socket_forwarder import OutputQueue, Wakeup
+
 
 from time import sleep
 
@@ -21,7 +24,8 @@ from time import sleep
 class ServerCommand(StrEnum):
 
     BREAK = auto()
-    CONTINUE = auto()
+    # Stops accepting, and breaks the loop once every answer has been written
+    DRAIN = auto()
 
 
 class LoopThread(Thread):
@@ -68,107 +72,149 @@ class Server():
     _exit_stack: ExitStack
     
     _loop_thread: Thread
+    # Only looked at when the loop is woken up, which is the only thing `stop` does to the loop
     _command_queue: Queue
+    _wakeup: Wakeup
 
     _host: str
     _port: int
 
+    # Whether the answers are held back until a whole batch of them can leave in full TCP segments
+    _cork: bool
+
 
-    def __init__(self, host, port, handler: Handler):
+    def __init__(self, host, port, handler: Handler, cork: bool = False):
         self._stopper = None
         self._exit_stack = ExitStack()
         self._command_queue = Queue()
-        self._loop_thread = LoopThread(target=self._loop, args=(host, port,))
+        self._wakeup = Wakeup()
+        self._loop_thread = None
         self._host = host
         self._port = port
         self._handler = handler
+        self._cork = cork
+
 
+    def _bind(self) -> socket.socket:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self._host, self._port))
+        server_socket.listen()
+        return server_socket
 
-    def _loop(self, host, port):
+
+    def _loop(self, server_socket: socket.socket):
         selector = DefaultSelector()
 
         handler = self._handler
 
+        # The answers waiting to be written to each connection, to wait for when draining
+        output_queues: dict[socket.socket, OutputQueue] = {}
+
         def accept_connection(server_socket, mask):
             connection_socket, _ = server_socket.accept()
             connection_socket.setblocking(False)
+            output_queue = output_queues[connection_socket] = OutputQueue(connection_socket, cork=self._cork)
             selector.register(
                 connection_socket, 
                 EVENT_READ | EVENT_WRITE,
-                data=partial(handle_session, self, b""),
+                data=partial(handle_session, self, output_queue),
             )
 
+        def close_session(connection_socket):
+            del output_queues[connection_socket]
+            selector.unregister(connection_socket)
+            try:
+                connection_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection_socket.close()
 
-        def handle_session(server, output_bytes: bytes, connection_socket, mask):
+
+        def handle_session(server, output_queue: OutputQueue, connection_socket, mask):
             if mask & EVENT_READ:
-                print("Reading! ")
                 input_bytes = b""
                 while True:
                     try:
                         input_chunk = connection_socket.recv(int(MAX_INPUT_BYTES_LENGTH / 1024))
-                        print(f"input_chunk={input_chunk}")
+                        if not input_chunk:
+                            # The client is gone
+                            close_session(connection_socket)
+                            return
                         input_bytes += input_chunk
                         if len(input_bytes) > MAX_INPUT_BYTES_LENGTH:
-                            connection_socket.shutdown(socket.SHUT_RDWR)
-                            connection_socket.close()
-                            selector.unregister(connection_socket)
+                            close_session(connection_socket)
                             return 
 
                     except BlockingIOError:
                         break
 
                 if input_bytes.startswith(b"STOP"):
-                    connection_socket.shutdown(socket.SHUT_RDWR)
-                    connection_socket.close()
-                    selector.unregister(connection_socket)
+                    close_session(connection_socket)
                     server.stop(wait_for=False)
                     return
                 
                 input_buffer = BytesIO(input_bytes)
                 output_buffer = BytesIO()
 
-                print(f"input_buffer.getvalue()={input_buffer.getvalue()}")
                 handler.handle(input_buffer, output_buffer)
-                print(f"output_buffer.getvalue()={output_buffer.getvalue()}")
-                output_bytes += output_buffer.getvalue()
+                # The answer is queued as is, and written along with what is still waiting with a single syscall
+                output_queue.append(output_buffer.getbuffer())
                 new_mask = EVENT_WRITE
 
             if mask & EVENT_WRITE:
-
-                print("Writing! ")
-                n = connection_socket.send(output_bytes)
-                output_bytes = output_bytes[n:]
-                new_mask = EVENT_READ if len(output_bytes) == 0 else EVENT_WRITE
+                output_queue.flush()
+                new_mask = EVENT_READ if len(output_queue) == 0 else EVENT_WRITE
             
-            selector.modify(connection_socket, new_mask, data=partial(handle_session, server, output_bytes))
+            selector.modify(connection_socket, new_mask, data=partial(handle_session, server, output_queue))
 
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((host, port))
-        server_socket.listen()
         selector.register(
             server_socket, 
             EVENT_READ, 
             data=accept_connection,
         )
 
-        while True:
-            events = selector.select()
-            try:
-                command = self._command_queue.get_nowait()
-            except Empty:
-                command = ServerCommand.CONTINUE
-            
-            if command == ServerCommand.BREAK:
-                break
+        def on_wakeup(wakeup, mask):
+            nonlocal stopped, drain_deadline
+            wakeup.clear()
+            while True:
+                try:
+                    command, grace_period = self._command_queue.get_nowait()
+                except Empty:
+                    break
+                if command == ServerCommand.BREAK:
+                    stopped = True
+                    return
+                if drain_deadline is None:
+                    stop_accepting()
+                    drain_deadline = monotonic() + grace_period
+
+        def stop_accepting():
+            selector.unregister(server_socket)
+            # The connections still waiting in the backlog are refused, rather than left hanging
+            server_socket.close()
 
-            for key, mask in events:
-                callback = key.data
-                callback(key.fileobj, mask)
+        selector.register(self._wakeup, EVENT_READ, data=on_wakeup)
 
-        selector.unregister(server_socket)
-        server_socket.shutdown(socket.SHUT_RDWR)
-        server_socket.close()
+        stopped = False
+        # Set once draining, after which the loop breaks as soon as every answer has been written
+        drain_deadline: float | None = None
+        try:
+            while not stopped and (drain_deadline is None or (any(map(len, output_queues.values())) and monotonic() < drain_deadline)):
+                for key, mask in selector.select(None if drain_deadline is None else drain_deadline - monotonic()):
+                    # An earlier event of the batch may have closed this socket
+                    if stopped or key.fileobj.fileno() == -1:
+                        continue
+                    callback = key.data
+                    callback(key.fileobj, mask)
+        finally:
+            # The sessions left once stopped (or once the grace period is over) are cut
+            for connection_socket in list(output_queues):
+                close_session(connection_socket)
+            if drain_deadline is None:
+                stop_accepting()
+            selector.close()
+            self._wakeup.close()
 
 
     def wait_for(self):
@@ -176,6 +222,8 @@ class Server():
 
 
     def __enter__(self):
+        # Bound before returning, so that the connections can be made right away
+        self._loop_thread = LoopThread(target=self._loop, args=(self._bind(),))
         self._loop_thread.start()
         self._exit_stack.callback(self.stop)
         return self
@@ -184,19 +232,12 @@ class Server():
     def __exit__(self, type, value, traceback):
         self._exit_stack.close()
 
-    def _dummy_connect(self):
-        dummy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        dummy_socket.connect((self._host, self._port))
-        dummy_socket.shutdown(socket.SHUT_RDWR)
-        dummy_socket.close()
-        
-        
-    def stop(self, wait_for=True):
-        self._command_queue.put(ServerCommand.BREAK)
-        try:
-            self._dummy_connect()
-        except ConnectionRefusedError:
-            pass
+    def stop(self, wait_for=True, grace_period: float | None = None):
+        """Stops serving right away or, with a `grace_period` (in seconds), stops accepting and writes the answers
+        which are still waiting until then."""
+
+        self._command_queue.put((ServerCommand.BREAK, None) if grace_period is None else (ServerCommand.DRAIN, grace_period))
+        self._wakeup.wake()
 
         if wait_for:
             self.wait_for()
\ No newline at end of file
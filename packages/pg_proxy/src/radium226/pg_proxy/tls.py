@@ -0,0 +1,58 @@
+import ssl
+from enum import StrEnum, auto
+from pathlib import Path
+
+
+class SSLMode(StrEnum):
+    """Whether the proxy encrypts its connections to PostgreSQL, like the sslmode of libpq."""
+
+    DISABLE = auto()
+    # TLS is used if PostgreSQL accepts it
+    PREFER = auto()
+    # TLS is used, without checking the certificate of PostgreSQL
+    REQUIRE = auto()
+    # TLS is used, and the certificate of PostgreSQL must be valid for its host
+    VERIFY_FULL = "verify-full"
+
+
+def create_server_ssl_context(certificate_path: Path, key_path: Path | None = None) -> ssl.SSLContext:
+    """The context terminating the TLS connections of the clients, with the certificate the proxy presents to them."""
+
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(certificate_path, key_path)
+    return ssl_context
+
+
+class UpstreamSSLContext(ssl.SSLContext):
+    """A client context which resumes the last TLS session it was given, to spare PostgreSQL full handshakes.
+
+    asyncio does not let us pass the session when it wraps a connection, so the context does it by itself.
+    """
+
+    ssl_mode: SSLMode
+    session: ssl.SSLSession | None = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session or self.session)
+
+    def remember_session(self, ssl_object: ssl.SSLObject):
+        # With TLS 1.3, the session is only resumable once its ticket is received, after the handshake
+        if (session := ssl_object.session) is not None and session.has_ticket:
+            self.session = session
+
+
+def create_upstream_ssl_context(ssl_mode: SSLMode, root_certificate_path: Path | None = None) -> UpstreamSSLContext | None:
+    if ssl_mode == SSLMode.DISABLE:
+        return None
+
+    ssl_context = UpstreamSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.ssl_mode = ssl_mode
+    if ssl_mode == SSLMode.VERIFY_FULL:
+        if root_certificate_path is not None:
+            ssl_context.load_verify_locations(root_certificate_path)
+        else:
+            ssl_context.load_default_certs()
+    else:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
@@ -1,32 +1,23 @@
 import io
 import struct
-from sqlglot import parse_one, exp
+from collections import deque
+from dataclasses import dataclass
+from time import perf_counter_ns
+from typing import Callable
 
 
-from radium226.socket_forwarder import EventHandler
-
 from .server import (
     Server,
     Handler,
 )
-
-from construct import (
-    Enum, 
-    Bytes,
-    this,
-    Struct,
-    Int,
-    GreedyBytes,
-    Switch,
-    Pass,
-    PaddedString,
-    RawCopy,
-    Transformed,
-    Array,
-    RepeatUntil,
-    CString,
-    Const,
-    Select
+from .query_analyzer import QueryAnalyzer
+from .metrics import Metrics, Histogram
+from .message_stream import MessageStream
+from .framing import (
+    CANCEL_REQUEST_CODE,
+    SSL_REQUEST_CODE,
+    GSSENC_REQUEST_CODE,
+    FramingError,
 )
 
 from io import BufferedReader, BufferedWriter, BytesIO
@@ -41,11 +32,19 @@ class ServerResponse:
     BIND_COMPLETE = b"2"
     CLOSE_COMPLETE = b"3"
     COMMAND_COMPLETE = b"C"
+    COPY_BOTH_RESPONSE = b"W"
+    COPY_DATA = b"d"
+    COPY_DONE = b"c"
+    COPY_IN_RESPONSE = b"G"
+    COPY_OUT_RESPONSE = b"H"
     DATA_ROW = b"D"
     EMPTY_QUERY_RESPONSE = b"I"
     ERROR_RESPONSE = b"E"
+    FUNCTION_CALL_RESPONSE = b"V"
+    NEGOTIATE_PROTOCOL_VERSION = b"v"
     NO_DATA = b"n"
     NOTICE_RESPONSE = b"N"
+    NOTIFICATION_RESPONSE = b"A"
     PARAMETER_DESCRIPTION = b"t"
     PARAMETER_STATUS = b"S"
     PARSE_COMPLETE = b"1"
@@ -54,6 +53,570 @@ class ServerResponse:
     ROW_DESCRIPTION = b"T"
 
 
+class ClientCommand:
+    """Byte codes for client commands in the PG wire protocol."""
+
+    BIND = b"B"
+    CLOSE = b"C"
+    COPY_DATA = b"d"
+    COPY_DONE = b"c"
+    COPY_FAIL = b"f"
+    DESCRIBE = b"D"
+    EXECUTE = b"E"
+    FLUSH = b"H"
+    FUNCTION_CALL = b"F"
+    PARSE = b"P"
+    PASSWORD_MESSAGE = b"p"
+    QUERY = b"Q"
+    SYNC = b"S"
+    TERMINATE = b"X"
+
+
+# Frontend messages
+
+@dataclass(slots=True)
+class StartupMessage:
+    protocol_version: int
+    parameters: dict[str, str]
+
+
+@dataclass(slots=True)
+class SSLRequest:
+    pass
+
+
+@dataclass(slots=True)
+class GSSENCRequest:
+    pass
+
+
+@dataclass(slots=True)
+class CancelRequest:
+    process_id: int
+    secret_key: int
+
+
+@dataclass(slots=True)
+class Query:
+    query: str
+
+
+@dataclass(slots=True)
+class Parse:
+    statement: str
+    query: str
+    parameter_types: tuple[int, ...]
+
+
+@dataclass(slots=True)
+class Bind:
+    portal: str
+    statement: str
+    parameter_formats: tuple[int, ...]
+    parameters: list[memoryview | None]
+    result_formats: tuple[int, ...]
+
+
+@dataclass(slots=True)
+class Describe:
+    kind: bytes
+    name: str
+
+
+@dataclass(slots=True)
+class Execute:
+    portal: str
+    max_rows: int
+
+
+@dataclass(slots=True)
+class Close:
+    kind: bytes
+    name: str
+
+
+@dataclass(slots=True)
+class Sync:
+    pass
+
+
+@dataclass(slots=True)
+class Flush:
+    pass
+
+
+@dataclass(slots=True)
+class Terminate:
+    pass
+
+
+@dataclass(slots=True)
+class PasswordMessage:
+    # Also carries SASLInitialResponse, SASLResponse and GSSResponse, which can only be told apart from the context
+    data: memoryview
+
+
+@dataclass(slots=True)
+class CopyFail:
+    message: str
+
+
+@dataclass(slots=True)
+class FunctionCall:
+    payload: memoryview
+
+
+# Backend messages
+
+@dataclass(slots=True)
+class EncryptionResponse:
+    accepted: bool
+
+
+@dataclass(slots=True)
+class Authentication:
+    code: int
+    data: memoryview
+
+
+@dataclass(slots=True)
+class BackendKeyData:
+    process_id: int
+    secret_key: int
+
+
+@dataclass(slots=True)
+class BindComplete:
+    pass
+
+
+@dataclass(slots=True)
+class CloseComplete:
+    pass
+
+
+@dataclass(slots=True)
+class CommandComplete:
+    tag: str
+
+
+@dataclass(slots=True)
+class CopyResponse:
+    type: bytes
+    format: int
+    column_formats: tuple[int, ...]
+
+
+@dataclass(slots=True)
+class DataRow:
+    values: list[memoryview | None]
+
+
+@dataclass(slots=True)
+class EmptyQueryResponse:
+    pass
+
+
+@dataclass(slots=True)
+class ErrorResponse:
+    fields: dict[str, str]
+
+
+@dataclass(slots=True)
+class FunctionCallResponse:
+    value: memoryview | None
+
+
+@dataclass(slots=True)
+class NegotiateProtocolVersion:
+    minor_version: int
+    unrecognized_options: list[str]
+
+
+@dataclass(slots=True)
+class NoData:
+    pass
+
+
+@dataclass(slots=True)
+class NoticeResponse:
+    fields: dict[str, str]
+
+
+@dataclass(slots=True)
+class NotificationResponse:
+    process_id: int
+    channel: str
+    payload: str
+
+
+@dataclass(slots=True)
+class ParameterDescription:
+    parameter_types: tuple[int, ...]
+
+
+@dataclass(slots=True)
+class ParameterStatus:
+    name: str
+    value: str
+
+
+@dataclass(slots=True)
+class ParseComplete:
+    pass
+
+
+@dataclass(slots=True)
+class PortalSuspended:
+    pass
+
+
+@dataclass(slots=True)
+class ReadyForQuery:
+    status: bytes
+
+
+@dataclass(slots=True)
+class RowDescriptionField:
+    name: str
+    table_oid: int
+    column_number: int
+    type_oid: int
+    type_size: int
+    type_modifier: int
+    format: int
+
+
+@dataclass(slots=True)
+class RowDescription:
+    fields: list[RowDescriptionField]
+
+
+# Both directions
+
+@dataclass(slots=True)
+class CopyData:
+    data: memoryview
+
+
+@dataclass(slots=True)
+class CopyDone:
+    pass
+
+
+@dataclass(slots=True)
+class UnknownMessage:
+    type: bytes
+    payload: memoryview
+
+
+# Decoding: the frames are the memoryviews yielded by the `Framer`, header included
+
+_int16 = struct.Struct("!h")
+_int32 = struct.Struct("!i")
+_int32_pair = struct.Struct("!ii")
+_field = struct.Struct("!ihihih")
+
+
+def _read_cstring(data: bytes, offset: int) -> tuple[str, int]:
+    end = data.index(0, offset)
+    return data[offset:end].decode(), end + 1
+
+
+def _read_int16_array(frame: memoryview, offset: int) -> tuple[tuple[int, ...], int]:
+    count, = _int16.unpack_from(frame, offset)
+    offset += 2
+    return struct.unpack_from(f"!{count}h", frame, offset), offset + 2 * count
+
+
+def _read_values(frame: memoryview, offset: int) -> tuple[list[memoryview | None], int]:
+    count, = _int16.unpack_from(frame, offset)
+    offset += 2
+    values = []
+    for _ in range(count):
+        length, = _int32.unpack_from(frame, offset)
+        offset += 4
+        if length < 0:
+            values.append(None)
+        else:
+            values.append(frame[offset:offset + length])
+            offset += length
+    return values, offset
+
+
+def _read_fields(frame: memoryview) -> dict[str, str]:
+    data = bytes(frame)
+    fields = {}
+    offset = 5
+    while data[offset] != 0:
+        code = chr(data[offset])
+        fields[code], offset = _read_cstring(data, offset + 1)
+    return fields
+
+
+def _decode_untyped_message(frame: memoryview):
+    code, = _int32.unpack_from(frame, 4)
+    match code:
+        case 196608:
+            data = bytes(frame)
+            names_and_values = data[8:-2].decode().split("\x00") if len(data) > 9 else []
+            return StartupMessage(code, dict(zip(names_and_values[::2], names_and_values[1::2])))
+        case _ if code == SSL_REQUEST_CODE:
+            return SSLRequest()
+        case _ if code == GSSENC_REQUEST_CODE:
+            return GSSENCRequest()
+        case _ if code == CANCEL_REQUEST_CODE:
+            return CancelRequest(*_int32_pair.unpack_from(frame, 8))
+        case _:
+            # Another protocol version, which the backend will answer with NegotiateProtocolVersion or an error
+            return StartupMessage(code, {})
+
+
+def _decode_query(frame: memoryview):
+    return Query(bytes(frame[5:-1]).decode())
+
+
+def _decode_parse(frame: memoryview):
+    data = bytes(frame)
+    statement, offset = _read_cstring(data, 5)
+    query, offset = _read_cstring(data, offset)
+    count, = _int16.unpack_from(frame, offset)
+    return Parse(statement, query, struct.unpack_from(f"!{count}i", frame, offset + 2))
+
+
+def _decode_bind(frame: memoryview):
+    data = bytes(frame)
+    portal, offset = _read_cstring(data, 5)
+    statement, offset = _read_cstring(data, offset)
+    parameter_formats, offset = _read_int16_array(frame, offset)
+    parameters, offset = _read_values(frame, offset)
+    result_formats, _ = _read_int16_array(frame, offset)
+    return Bind(portal, statement, parameter_formats, parameters, result_formats)
+
+
+def _decode_describe(frame: memoryview):
+    return Describe(bytes(frame[5:6]), bytes(frame[6:-1]).decode())
+
+
+def _decode_execute(frame: memoryview):
+    data = bytes(frame)
+    portal, offset = _read_cstring(data, 5)
+    max_rows, = _int32.unpack_from(frame, offset)
+    return Execute(portal, max_rows)
+
+
+def _decode_close(frame: memoryview):
+    return Close(bytes(frame[5:6]), bytes(frame[6:-1]).decode())
+
+
+def _decode_authentication(frame: memoryview):
+    code, = _int32.unpack_from(frame, 5)
+    return Authentication(code, frame[9:])
+
+
+def _decode_backend_key_data(frame: memoryview):
+    return BackendKeyData(*_int32_pair.unpack_from(frame, 5))
+
+
+def _decode_command_complete(frame: memoryview):
+    return CommandComplete(bytes(frame[5:-1]).decode())
+
+
+def _decode_copy_response(frame: memoryview):
+    column_formats, _ = _read_int16_array(frame, 6)
+    return CopyResponse(bytes(frame[0:1]), frame[5], column_formats)
+
+
+def _decode_data_row(frame: memoryview):
+    values, _ = _read_values(frame, 5)
+    return DataRow(values)
+
+
+def _decode_function_call_response(frame: memoryview):
+    length, = _int32.unpack_from(frame, 5)
+    return FunctionCallResponse(None if length < 0 else frame[9:9 + length])
+
+
+def _decode_negotiate_protocol_version(frame: memoryview):
+    minor_version, count = _int32_pair.unpack_from(frame, 5)
+    data = bytes(frame)
+    options = []
+    offset = 13
+    for _ in range(count):
+        option, offset = _read_cstring(data, offset)
+        options.append(option)
+    return NegotiateProtocolVersion(minor_version, options)
+
+
+def _decode_notification_response(frame: memoryview):
+    process_id, = _int32.unpack_from(frame, 5)
+    data = bytes(frame)
+    channel, offset = _read_cstring(data, 9)
+    payload, _ = _read_cstring(data, offset)
+    return NotificationResponse(process_id, channel, payload)
+
+
+def _decode_parameter_description(frame: memoryview):
+    count, = _int16.unpack_from(frame, 5)
+    return ParameterDescription(struct.unpack_from(f"!{count}i", frame, 7))
+
+
+def _decode_parameter_status(frame: memoryview):
+    data = bytes(frame)
+    name, offset = _read_cstring(data, 5)
+    value, _ = _read_cstring(data, offset)
+    return ParameterStatus(name, value)
+
+
+def _decode_row_description(frame: memoryview):
+    count, = _int16.unpack_from(frame, 5)
+    data = bytes(frame)
+    fields = []
+    offset = 7
+    for _ in range(count):
+        name, offset = _read_cstring(data, offset)
+        fields.append(RowDescriptionField(name, *_field.unpack_from(frame, offset)))
+        offset += _field.size
+    return RowDescription(fields)
+
+
+def _decode_copy_data(frame: memoryview):
+    return CopyData(frame[5:])
+
+
+FRONTEND_DECODERS: dict[int, Callable[[memoryview], object]] = {
+    ClientCommand.BIND[0]: _decode_bind,
+    ClientCommand.CLOSE[0]: _decode_close,
+    ClientCommand.COPY_DATA[0]: _decode_copy_data,
+    ClientCommand.COPY_DONE[0]: lambda frame: CopyDone(),
+    ClientCommand.COPY_FAIL[0]: lambda frame: CopyFail(bytes(frame[5:-1]).decode()),
+    ClientCommand.DESCRIBE[0]: _decode_describe,
+    ClientCommand.EXECUTE[0]: _decode_execute,
+    ClientCommand.FLUSH[0]: lambda frame: Flush(),
+    ClientCommand.FUNCTION_CALL[0]: lambda frame: FunctionCall(frame[5:]),
+    ClientCommand.PARSE[0]: _decode_parse,
+    ClientCommand.PASSWORD_MESSAGE[0]: lambda frame: PasswordMessage(frame[5:]),
+    ClientCommand.QUERY[0]: _decode_query,
+    ClientCommand.SYNC[0]: lambda frame: Sync(),
+    ClientCommand.TERMINATE[0]: lambda frame: Terminate(),
+}
+
+
+BACKEND_DECODERS: dict[int, Callable[[memoryview], object]] = {
+    ServerResponse.AUTHENTICATION_REQUEST[0]: _decode_authentication,
+    ServerResponse.BACKEND_KEY_DATA[0]: _decode_backend_key_data,
+    ServerResponse.BIND_COMPLETE[0]: lambda frame: BindComplete(),
+    ServerResponse.CLOSE_COMPLETE[0]: lambda frame: CloseComplete(),
+    ServerResponse.COMMAND_COMPLETE[0]: _decode_command_complete,
+    ServerResponse.COPY_BOTH_RESPONSE[0]: _decode_copy_response,
+    ServerResponse.COPY_DATA[0]: _decode_copy_data,
+    ServerResponse.COPY_DONE[0]: lambda frame: CopyDone(),
+    ServerResponse.COPY_IN_RESPONSE[0]: _decode_copy_response,
+    ServerResponse.COPY_OUT_RESPONSE[0]: _decode_copy_response,
+    ServerResponse.DATA_ROW[0]: _decode_data_row,
+    ServerResponse.EMPTY_QUERY_RESPONSE[0]: lambda frame: EmptyQueryResponse(),
+    ServerResponse.ERROR_RESPONSE[0]: lambda frame: ErrorResponse(_read_fields(frame)),
+    ServerResponse.FUNCTION_CALL_RESPONSE[0]: _decode_function_call_response,
+    ServerResponse.NEGOTIATE_PROTOCOL_VERSION[0]: _decode_negotiate_protocol_version,
+    ServerResponse.NO_DATA[0]: lambda frame: NoData(),
+    ServerResponse.NOTICE_RESPONSE[0]: lambda frame: NoticeResponse(_read_fields(frame)),
+    ServerResponse.NOTIFICATION_RESPONSE[0]: _decode_notification_response,
+    ServerResponse.PARAMETER_DESCRIPTION[0]: _decode_parameter_description,
+    ServerResponse.PARAMETER_STATUS[0]: _decode_parameter_status,
+    ServerResponse.PARSE_COMPLETE[0]: lambda frame: ParseComplete(),
+    ServerResponse.PORTAL_SUSPENDED[0]: lambda frame: PortalSuspended(),
+    ServerResponse.READY_FOR_QUERY[0]: lambda frame: ReadyForQuery(bytes(frame[5:6])),
+    ServerResponse.ROW_DESCRIPTION[0]: _decode_row_description,
+}
+
+
+def decode_frontend_message(frame: memoryview):
+    type = frame[0]
+    # Message types are never null, while the length of an untyped message always starts with a null byte
+    if type == 0:
+        return _decode_untyped_message(frame)
+    if decoder := FRONTEND_DECODERS.get(type):
+        return decoder(frame)
+    return UnknownMessage(bytes(frame[0:1]), frame[5:])
+
+
+def decode_backend_message(frame: memoryview):
+    if len(frame) == 1:
+        return EncryptionResponse(frame[0] in b"SG")
+    if decoder := BACKEND_DECODERS.get(frame[0]):
+        return decoder(frame)
+    return UnknownMessage(bytes(frame[0:1]), frame[5:])
+
+
+# Encoding: only the messages that the proxy has to say by itself, to a client or to a backend
+
+PROTOCOL_VERSION = 196608
+
+AUTHENTICATION_OK = 0
+AUTHENTICATION_CLEARTEXT_PASSWORD = 3
+AUTHENTICATION_MD5_PASSWORD = 5
+AUTHENTICATION_SASL = 10
+AUTHENTICATION_SASL_CONTINUE = 11
+AUTHENTICATION_SASL_FINAL = 12
+
+
+def _cstring(value: str) -> bytes:
+    return value.encode() + NULL_BYTE
+
+
+def encode_message(type: bytes, payload: bytes = b"") -> bytes:
+    return type + _int32.pack(len(payload) + 4) + payload
+
+
+def encode_startup_message(parameters: dict[str, str]) -> bytes:
+    payload = _int32.pack(PROTOCOL_VERSION) + b"".join(_cstring(name) + _cstring(value) for name, value in parameters.items()) + NULL_BYTE
+    return _int32.pack(len(payload) + 4) + payload
+
+
+def encode_ssl_request() -> bytes:
+    return _int32.pack(8) + _int32.pack(SSL_REQUEST_CODE)
+
+
+def encode_cancel_request(process_id: int, secret_key: int) -> bytes:
+    return _int32.pack(16) + _int32.pack(CANCEL_REQUEST_CODE) + _int32_pair.pack(process_id, secret_key)
+
+
+def encode_query(query: str) -> bytes:
+    return encode_message(ClientCommand.QUERY, _cstring(query))
+
+
+def encode_password_message(data: bytes) -> bytes:
+    return encode_message(ClientCommand.PASSWORD_MESSAGE, data)
+
+
+def encode_terminate() -> bytes:
+    return encode_message(ClientCommand.TERMINATE)
+
+
+def encode_authentication(code: int, data: bytes = b"") -> bytes:
+    return encode_message(ServerResponse.AUTHENTICATION_REQUEST, _int32.pack(code) + data)
+
+
+def encode_parameter_status(name: str, value: str) -> bytes:
+    return encode_message(ServerResponse.PARAMETER_STATUS, _cstring(name) + _cstring(value))
+
+
+def encode_backend_key_data(process_id: int, secret_key: int) -> bytes:
+    return encode_message(ServerResponse.BACKEND_KEY_DATA, _int32_pair.pack(process_id, secret_key))
+
+
+def encode_ready_for_query(status: bytes) -> bytes:
+    return encode_message(ServerResponse.READY_FOR_QUERY, status)
+
+
+def encode_error_response(fields: dict[str, str]) -> bytes:
+    return encode_message(ServerResponse.ERROR_RESPONSE, b"".join(code.encode() + _cstring(value) for code, value in fields.items()) + NULL_BYTE)
+
+
+def encode_error(message: str, code: str = "08000", severity: str = "FATAL") -> bytes:
+    return encode_error_response({"S": severity, "V": severity, "C": code, "M": message})
+
+
 class BVBuffer(object):
     """A helper for reading and writing bytes in the format the PG wire protocol expects."""
 
@@ -147,155 +710,125 @@ class WireWriter():
         return self.stream.getvalue()
 
 
-class WireEventHandler(EventHandler):
-
-    def __init__(self):
-        pass
-
-    def on_data_received(self, data: bytes):
-        # print(f"Data received! data={data}")
-        return
-
-    def on_data_sent(self, data: bytes):
-        print(f"Data sent! data={data}")
-        
-        buffer = BytesIO(data)
-
-        ClientCommand = Enum(
-            Bytes(1),
-            bind=b"B",
-            close=b"C",
-            describe=b"D",
-            execute=b"E",
-            flush=b"H",
-            query=b"Q",
-            parse=b"P",
-            password_message=b"p",
-            sync=b"S",
-            terminate=b"X",
-        )
-
-        FirstMessageCode = Enum(
-            Int, 
-            ssl_request=80877103,
-            startup_message=196608,
-        )
-
-        MessageLength = Int
-
-        FirstMessage = Struct(
-            "message_length" / MessageLength,
-            "code" / FirstMessageCode,
-        )
+class QueryTimer():
+    """Times the queries of a connection, matching each ReadyForQuery with the message of the client that asked for it.
+
+    A simple query is timed from its Query, and an extended query from its first Execute up to the Sync.
+    """
+
+    _histogram: Histogram
+    # The start of each query which is waiting for its ReadyForQuery, or None if there is nothing to time (like a Sync
+    # which only follows a Parse)
+    _starts: deque[int | None]
+    _extended_query_start: int | None
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+        self._starts = deque()
+        self._extended_query_start = None
+
+    def on_frontend_message(self, type: int):
+        match type:
+            case _ if type == ClientCommand.QUERY[0]:
+                self._starts.append(perf_counter_ns())
+            case _ if type == ClientCommand.EXECUTE[0]:
+                if self._extended_query_start is None:
+                    self._extended_query_start = perf_counter_ns()
+            case _ if type == ClientCommand.SYNC[0]:
+                self._starts.append(self._extended_query_start)
+                self._extended_query_start = None
+            case _ if type == ClientCommand.FUNCTION_CALL[0]:
+                self._starts.append(None)
+
+    def on_backend_message(self, type: int):
+        if type == ServerResponse.READY_FOR_QUERY[0] and self._starts and (start := self._starts.popleft()) is not None:
+            self._histogram.record((perf_counter_ns() - start) // 1000)
+
+
+
+class WireEventHandler(MessageStream):
+    """Inspects the traffic of the connections as a `MessageStream` of its own messages, of which only the queries (and
+    what the metrics time) are framed."""
+
+    _query_analyzer: QueryAnalyzer
+
+    _metrics: Metrics | None
+    _query_timer: QueryTimer | None
+    _bytes_sent: int
+    _bytes_received: int
+
+    def __init__(self, query_analyzer: QueryAnalyzer | None = None, metrics: Metrics | None = None):
+        if metrics:
+            self.frontend_message_types = ClientCommand.QUERY + ClientCommand.EXECUTE + ClientCommand.SYNC + ClientCommand.FUNCTION_CALL
+            self.backend_message_types = ServerResponse.READY_FOR_QUERY
+        else:
+            self.frontend_message_types = ClientCommand.QUERY
+            self.backend_message_types = b""
+        super().__init__(self)
+        self._query_analyzer = query_analyzer or QueryAnalyzer()
+
+        self._metrics = metrics
+        self._query_timer = QueryTimer(metrics.query_duration) if metrics else None
+        self._bytes_sent = 0
+        self._bytes_received = 0
+
+    def for_connection(self) -> "WireEventHandler":
+        if metrics := self._metrics:
+            metrics.connection_count.inc()
+            metrics.live_connection_count.inc()
+        # The analyzer and the metrics are shared, as the same statements show up on every connection
+        return WireEventHandler(self._query_analyzer, self._metrics)
+
+    @property
+    def query_analyzer(self) -> QueryAnalyzer:
+        return self._query_analyzer
+
+    @property
+    def metrics(self) -> Metrics | None:
+        return self._metrics
+
+    def on_chunk_sent(self, chunk: memoryview):
+        self._bytes_sent += len(chunk)
+        if metrics := self._metrics:
+            metrics.bytes_sent.inc(len(chunk))
+        super().on_chunk_sent(chunk)
+
+    def on_chunk_received(self, chunk: memoryview):
+        self._bytes_received += len(chunk)
+        if metrics := self._metrics:
+            metrics.bytes_received.inc(len(chunk))
+        super().on_chunk_received(chunk)
+
+    def on_frontend_message(self, message: memoryview):
+        if query_timer := self._query_timer:
+            query_timer.on_frontend_message(message[0])
+        self.on_message_sent(message)
+
+    def on_backend_message(self, message: memoryview):
+        if query_timer := self._query_timer:
+            query_timer.on_backend_message(message[0])
+
+    def on_framing_error(self, error: FramingError):
+        if metrics := self._metrics:
+            metrics.inspection_errors.inc()
+
+    def on_connection_closed(self):
+        # It is its own message handler, so there is nobody else to tell
+        if metrics := self._metrics:
+            metrics.live_connection_count.dec()
+            metrics.connection_bytes_sent.record(self._bytes_sent)
+            metrics.connection_bytes_received.record(self._bytes_received)
+
+    def on_message_sent(self, frame: memoryview):
+        # Only simple queries are inspected: we do not need to decode anything else
+        if frame[0] != ClientCommand.QUERY[0]:
+            return
 
         try:
-            Message = Struct(
-                "client_command" / ClientCommand,
-                "content" / Switch(
-                    this.client_command,
-                    {
-                        ClientCommand.query: Struct(
-                            "message_length" / MessageLength,
-                            "query" / CString("utf8"),
-                        )
-                    },
-                )
-            )
-
-            message = Select(FirstMessage, Message).parse(data)
-            print(message)
-
-            match message.client_command:
-                case ClientCommand.query:
-                    query = message.content.query
-
-                    print(f"query={query}")
-                    for table in parse_one(query, dialect="postgres").find_all(exp.Table):
-                        print(f"table={table}")
-
-        except Exception as e:
-            print(repr(e))
-            
-
-        return 
-    
-        buffer = BytesIO(data)
-
-        print("Handling! ")
-
-        ClientCommand = Enum(
-            Bytes(1),
-            bind=b"B",
-            close=b"C",
-            describe=b"D",
-            execute=b"E",
-            flush=b"H",
-            query=b"Q",
-            parse=b"P",
-            password_message=b"p",
-            sync=b"S",
-            terminate=b"X",
-        )
-
-        
-        FirstMessageCode = Enum(
-            Int, 
-            ssl_request=80877103,
-            startup_message=196608,
-        )
-
-        MessageLength = Int
-
-        FirstMessage = Struct(
-            "message_length" / MessageLength,
-            "code" / FirstMessageCode,
-        )
-
-        SSLRequest = Pass
-
-        Parameters = RepeatUntil(
-            lambda value, list_containers, context: len(value) == 0,
-            CString("utf8"),
-        )
-
-        def StartupMessage(message_length: int):
-            return Struct(
-                "parameters" / Parameters
-            )
-
-        ServerResponseCode = Enum(
-            Bytes(1),
-            authentication_request=b"R",
-            backend_key_data=b"K",
-            bind_complete=b"2",
-            close_complete=b"3",
-            command_complete=b"C",
-            data_row=b"D",
-            empty_query_response=b"I",
-            error_response=b"E",
-            no_data=b"n",
-            notice_response=b"N",
-            parameter_description=b"t",
-            parameter_status=b"S",
-            parse_complete=b"1",
-            portal_suspended=b"s",
-            ready_for_query=b"Z",
-            row_description=b"T",
-        )
-
-        first_message = FirstMessage.parse_stream(buffer)
-        print(first_message)
-
-        match first_message.code:
-            case "ssl_request":
-                print("SSL request! ")
-                # SSLRequest.parse_stream(buffer)
-                
-            case "startup_message":
-                print("Startup message! ")
-                # payload = Bytes(first_message.message_length - FirstMessage.sizeof()).parse_stream(buffer)
-                # parameters = Parameters.parse_stream(BytesIO(payload))
-                # parameters = dict(list(zip(parameters[::2], parameters[1::2])))
-                # print(parameters)
-                
-        print("We are here! ")
\ No newline at end of file
+            message = decode_frontend_message(frame)
+            self._query_analyzer.analyze(message.query)
+
+        except Exception:
+            # Unlike a framing error, it only spoils this message, and the next ones are still inspected
+            if metrics := self._metrics:
+                metrics.inspection_errors.inc()
@@ -0,0 +1,303 @@
+import socket
+import socketserver
+import ssl
+import struct
+import tempfile
+from contextlib import closing
+from itertools import count
+from os import environ
+from pathlib import Path
+from subprocess import run
+from uuid import uuid4
+from threading import Thread, Lock
+
+from pytest import fixture
+
+from radium226.pg import PostgreSQLPool
+from radium226.pg.random_port import random_port
+from radium226.pg_proxy.framing import Framer, FramerState
+from radium226.pg_proxy.wire import (
+    StartupMessage,
+    SSLRequest,
+    PasswordMessage,
+    Query,
+    Parse,
+    Bind,
+    Describe,
+    Execute,
+    Close,
+    Sync,
+    Terminate,
+    ServerResponse,
+    AUTHENTICATION_OK,
+    AUTHENTICATION_CLEARTEXT_PASSWORD,
+    decode_frontend_message,
+    decode_backend_message,
+    encode_message,
+    encode_startup_message,
+    encode_ssl_request,
+    encode_query,
+    encode_password_message,
+    encode_terminate,
+    encode_authentication,
+    encode_parameter_status,
+    encode_backend_key_data,
+    encode_ready_for_query,
+    encode_error,
+)
+
+
+def _command_complete(tag: str) -> bytes:
+    return encode_message(ServerResponse.COMMAND_COMPLETE, tag.encode() + b"\x00")
+
+
+def _row(*values: str) -> bytes:
+    row_description = encode_message(ServerResponse.ROW_DESCRIPTION, struct.pack("!h", len(values)) + b"".join(
+        f"column{index}".encode() + b"\x00" + struct.pack("!ihihih", 0, 0, 25, -1, -1, 0)
+        for index in range(len(values))
+    ))
+    data_row = encode_message(ServerResponse.DATA_ROW, struct.pack("!h", len(values)) + b"".join(
+        struct.pack("!i", len(value.encode())) + value.encode()
+        for value in values
+    ))
+    return row_description + data_row + _command_complete("SELECT 1")
+
+
+class FakePostgreSQL():
+    """Just enough of a PostgreSQL backend to see what the proxy does with its connections.
+
+    `SELECT pg_backend_pid()` answers the process ID of the connection, and every query is recorded with it.
+    """
+
+    def __init__(self, password: str | None = None, ssl_context: ssl.SSLContext | None = None):
+        self._password = password
+        self._ssl_context = ssl_context
+        self._process_ids = count(1000)
+        self._lock = Lock()
+
+        self.port = random_port()
+        self.host = "localhost"
+        self.queries: list[tuple[int, str]] = []
+        self.parsed_statements: list[tuple[int, str]] = []
+        self.connection_count = 0
+        self.tls_connection_count = 0
+        self.resumed_tls_session_count = 0
+
+    def _serve_connection(self, connection_socket: socket.socket):
+        framer, _ = Framer.pair()
+        process_id = next(self._process_ids)
+        status = b"I"
+        statements = {}
+        # After an error, the extended query messages are ignored up to the next Sync
+        failed = False
+
+        def send(data: bytes):
+            connection_socket.sendall(data)
+
+        def run(query: str) -> bytes:
+            nonlocal status
+            with self._lock:
+                self.queries.append((process_id, query))
+            match query.upper():
+                case "BEGIN":
+                    status = b"T"
+                    return _command_complete("BEGIN")
+                case "COMMIT" | "ROLLBACK":
+                    status = b"I"
+                    return _command_complete(query.upper())
+                case _ if query.upper().startswith(("SET ", "RESET ")):
+                    return _command_complete(query.split()[0].upper())
+                case "SELECT PG_BACKEND_PID()":
+                    return _row(str(process_id))
+                case "SELECT 1/0":
+                    if status == b"T":
+                        status = b"E"
+                    return encode_error("division by zero", code="22012", severity="ERROR")
+                case _:
+                    return _command_complete("SELECT 0")
+
+        while data := connection_socket.recv(65536):
+            for frame in framer.feed(data):
+                message = decode_frontend_message(frame)
+                if failed and not isinstance(message, Sync):
+                    continue
+
+                match message:
+                    case SSLRequest() if self._ssl_context is not None:
+                        send(b"S")
+                        connection_socket = self._ssl_context.wrap_socket(connection_socket, server_side=True)
+                        with self._lock:
+                            self.tls_connection_count += 1
+                            self.resumed_tls_session_count += connection_socket.session_reused
+                    case SSLRequest():
+                        send(b"N")
+                    case StartupMessage():
+                        with self._lock:
+                            self.connection_count += 1
+                        if self._password is not None:
+                            send(encode_authentication(AUTHENTICATION_CLEARTEXT_PASSWORD))
+                        else:
+                            self._send_welcome(send, process_id)
+                    case PasswordMessage(data=data):
+                        if bytes(data).rstrip(b"\x00").decode() != self._password:
+                            send(encode_error("password authentication failed", code="28P01"))
+                            return
+                        self._send_welcome(send, process_id)
+                    case Query(query=query):
+                        send(run(query) + encode_ready_for_query(status))
+                    case Parse(statement=statement, query=query):
+                        if statement and statement in statements:
+                            send(encode_error(f"prepared statement \"{statement}\" already exists", code="42P05", severity="ERROR"))
+                            failed = True
+                            continue
+                        with self._lock:
+                            self.parsed_statements.append((process_id, statement))
+                        statements[statement] = query
+                        send(encode_message(b"1"))
+                    case Bind(statement=statement):
+                        if statement not in statements:
+                            send(encode_error(f"prepared statement \"{statement}\" does not exist", code="26000", severity="ERROR"))
+                            failed = True
+                            continue
+                        portal_query = statements[statement]
+                        send(encode_message(b"2"))
+                    case Describe():
+                        send(encode_message(b"n"))
+                    case Execute():
+                        send(run(portal_query))
+                    case Close(name=name):
+                        statements.pop(name, None)
+                        send(encode_message(b"3"))
+                    case Sync():
+                        failed = False
+                        send(encode_ready_for_query(status))
+                    case Terminate():
+                        return
+
+    def _send_welcome(self, send, process_id: int):
+        send(b"".join([
+            encode_authentication(AUTHENTICATION_OK),
+            encode_parameter_status("server_version", "17.0"),
+            encode_backend_key_data(process_id, 42),
+            encode_ready_for_query(b"I"),
+        ]))
+
+    def __enter__(self):
+        fake_postgresql = self
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def handle(self):
+                try:
+                    fake_postgresql._serve_connection(self.request)
+                except ConnectionError:
+                    pass
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        return False
+
+
+class Client():
+    """A blocking PostgreSQL client, which only understands what `FakePostgreSQL` answers."""
+
+    def __init__(self,
+        host: str,
+        port: int,
+        user: str = "postgres",
+        database: str = "postgres",
+        password: str | None = None,
+        ssl_context: ssl.SSLContext | None = None,
+    ):
+        self._socket = socket.create_connection((host, port))
+        if ssl_context is not None:
+            self._socket.sendall(encode_ssl_request())
+            if self._socket.recv(1) != b"S":
+                raise ConnectionRefusedError("The server does not accept TLS connections")
+            self._socket = ssl_context.wrap_socket(self._socket, server_hostname=host)
+        self._framer = Framer(FramerState.MESSAGES)
+        self._frames = []
+
+        self._socket.sendall(encode_startup_message({"user": user, "database": database}))
+        while True:
+            frame = self.read_frame()
+            match frame[0:1]:
+                case b"R" if struct.unpack_from("!i", frame, 5)[0] == AUTHENTICATION_CLEARTEXT_PASSWORD:
+                    self._socket.sendall(encode_password_message(password.encode() + b"\x00"))
+                case b"E":
+                    raise ConnectionRefusedError(decode_backend_message(memoryview(frame)).fields["M"])
+                case b"Z":
+                    break
+
+    def read_frame(self) -> bytes:
+        while not self._frames:
+            data = self._socket.recv(65536)
+            if not data:
+                raise ConnectionResetError("The server closed the connection")
+            self._frames.extend(bytes(frame) for frame in self._framer.feed(data))
+        return self._frames.pop(0)
+
+    def read_until_ready(self) -> list[bytes]:
+        frames = []
+        while (frame := self.read_frame())[0:1] != b"Z":
+            frames.append(frame)
+        return frames
+
+    def send(self, data: bytes):
+        self._socket.sendall(data)
+
+    def query(self, query: str) -> list[str]:
+        """Runs the query, and returns the values of the first column."""
+
+        self.send(encode_query(query))
+        values = []
+        for frame in self.read_until_ready():
+            match decode_backend_message(memoryview(frame)):
+                case message if frame[0:1] == b"D":
+                    values.append(bytes(message.values[0]).decode())
+                case message if frame[0:1] == b"E":
+                    raise RuntimeError(message.fields["M"])
+        return values
+
+    def backend_pid(self) -> int:
+        return int(self.query("SELECT pg_backend_pid()")[0])
+
+    def close(self):
+        with closing(self._socket):
+            self._socket.sendall(encode_terminate())
+
+
+@fixture(scope="session")
+def postgresql_pool() -> PostgreSQLPool:
+    # The pytest-xdist workers of a same run share the instances
+    run_id = environ.get("PYTEST_XDIST_TESTRUNUID") or uuid4().hex
+    with PostgreSQLPool(Path(tempfile.gettempdir()) / f"radium226-pg-pool-{run_id}", ssl=True) as postgresql_pool:
+        yield postgresql_pool
+
+
+@fixture(scope="session")
+def certificate_paths(tmp_path_factory) -> tuple[Path, Path]:
+    folder_path = tmp_path_factory.mktemp("certificates")
+    certificate_path, key_path = folder_path / "server.crt", folder_path / "server.key"
+    run([
+        "openssl", "req", "-nodes", "-new", "-x509",
+        "-keyout", f"{key_path}",
+        "-out", f"{certificate_path}",
+        "-subj", "/CN=localhost",
+    ], check=True, capture_output=True)
+    return certificate_path, key_path
+
+
+@fixture
+def fake_postgresql() -> FakePostgreSQL:
+    with FakePostgreSQL() as fake_postgresql:
+        yield fake_postgresql
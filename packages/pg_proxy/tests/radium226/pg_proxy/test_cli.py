@@ -0,0 +1,9 @@
+from click.testing import CliRunner
+
+from radium226.pg_proxy.cli.app import app
+
+
+def test_serve_with_replica_without_transaction_pooling() -> None:
+    result = CliRunner().invoke(app, ["serve", "--pool-mode", "session", "--replica", "localhost:5433"])
+    assert result.exit_code == 2
+    assert "--replica" in result.output
@@ -0,0 +1,92 @@
+import struct
+
+from pytest import raises
+
+from radium226.pg_proxy.framing import (
+    Framer,
+    FramerState,
+    FramingError,
+    SSL_REQUEST_CODE,
+)
+
+
+def startup_message(**parameters: str) -> bytes:
+    payload = struct.pack("!i", 196608)
+    for name, value in parameters.items():
+        payload += name.encode() + b"\x00" + value.encode() + b"\x00"
+    payload += b"\x00"
+    return struct.pack("!i", len(payload) + 4) + payload
+
+
+def message(type: bytes, payload: bytes) -> bytes:
+    return type + struct.pack("!i", len(payload) + 4) + payload
+
+
+def feed_in_chunks(framer: Framer, data: bytes, chunk_size: int) -> list[bytes]:
+    messages = []
+    for offset in range(0, len(data), chunk_size):
+        messages.extend(bytes(frame) for frame in framer.feed(data[offset:offset + chunk_size]))
+    return messages
+
+
+def test_framer_with_any_chunk_size() -> None:
+    expected_messages = [
+        startup_message(user="postgres", database="postgres"),
+        message(b"Q", b"SELECT 1\x00"),
+        message(b"Q", b"SELECT * FROM information_schema.sql_features\x00"),
+        message(b"X", b""),
+    ]
+    data = b"".join(expected_messages)
+
+    for chunk_size in [1, 2, 3, 5, 7, 64, len(data)]:
+        frontend_framer, _ = Framer.pair()
+        assert feed_in_chunks(frontend_framer, data, chunk_size) == expected_messages
+
+
+def test_framer_with_ssl_request() -> None:
+    frontend_framer, backend_framer = Framer.pair()
+
+    ssl_request = struct.pack("!ii", 8, SSL_REQUEST_CODE)
+    assert [bytes(frame) for frame in frontend_framer.feed(ssl_request)] == [ssl_request]
+    assert frontend_framer.state == FramerState.STARTUP
+    assert backend_framer.state == FramerState.ENCRYPTION_RESPONSE
+
+    assert [bytes(frame) for frame in backend_framer.feed(b"S\x16\x03\x01")] == [b"S"]
+    assert frontend_framer.state == FramerState.ENCRYPTED
+    assert backend_framer.state == FramerState.ENCRYPTED
+    assert list(frontend_framer.feed(b"\x16\x03\x01\x02\x00")) == []
+
+
+def test_framer_with_refused_ssl_request() -> None:
+    frontend_framer, backend_framer = Framer.pair()
+
+    list(frontend_framer.feed(struct.pack("!ii", 8, SSL_REQUEST_CODE)))
+    ready_for_query = message(b"Z", b"I")
+    assert [bytes(frame) for frame in backend_framer.feed(b"N")] == [b"N"]
+    assert [bytes(frame) for frame in frontend_framer.feed(startup_message(user="postgres"))] == [startup_message(user="postgres")]
+    assert [bytes(frame) for frame in backend_framer.feed(ready_for_query)] == [ready_for_query]
+
+
+def test_framer_with_invalid_length() -> None:
+    _, backend_framer = Framer.pair()
+    with raises(FramingError):
+        list(backend_framer.feed(b"Z\x00\x00\x00\x01"))
+
+
+def test_framer_with_message_types() -> None:
+    data_row = message(b"D", b"\x00\x01" + struct.pack("!i", 1000) + b"x" * 1000)
+    ready_for_query = message(b"Z", b"I")
+    data = message(b"T", b"\x00\x00") + data_row * 10 + message(b"C", b"SELECT 10\x00") + ready_for_query
+
+    for chunk_size in [1, 3, 5, 7, 64, len(data)]:
+        # The data rows are skipped without being copied, however they are split
+        _, backend_framer = Framer.pair(backend_message_types=b"CZ")
+        assert feed_in_chunks(backend_framer, data, chunk_size) == [message(b"C", b"SELECT 10\x00"), ready_for_query]
+        assert backend_framer._pending == b""
+
+
+def test_framer_with_message_types_before_startup() -> None:
+    frontend_framer, _ = Framer.pair(frontend_message_types=b"Q")
+    data = startup_message(user="postgres") + message(b"P", b"\x00SELECT 1\x00\x00\x00") + message(b"Q", b"SELECT 1\x00")
+    # The startup message is not yielded, but the messages after it are still framed
+    assert feed_in_chunks(frontend_framer, data, 4) == [message(b"Q", b"SELECT 1\x00")]
@@ -0,0 +1,42 @@
+from contextlib import closing
+
+from pytest import mark
+
+from radium226.pg.random_port import random_port
+from radium226.socket_forwarder import SocketForwarder, Engine, HostAndPort
+from radium226.pg_proxy.message_stream import MessageHandler, MessageStream
+from radium226.pg_proxy.wire import decode_frontend_message
+
+from .conftest import FakePostgreSQL, Client
+
+
+class QueryRecorder(MessageHandler):
+
+    frontend_message_types = b"Q"
+    backend_message_types = b"Z"
+
+    def __init__(self):
+        self.queries = []
+        self.statuses = []
+
+    def on_frontend_message(self, message: memoryview):
+        self.queries.append(decode_frontend_message(message).query)
+
+    def on_backend_message(self, message: memoryview):
+        self.statuses.append(bytes(message[5:6]))
+
+
+@mark.parametrize("engine", [Engine.SELECTORS, Engine.ASYNCIO])
+def test_message_stream(fake_postgresql: FakePostgreSQL, engine: Engine) -> None:
+    query_recorder = QueryRecorder()
+    local_host_and_port = HostAndPort("localhost", random_port())
+    remote_host_and_port = HostAndPort(fake_postgresql.host, fake_postgresql.port)
+    with SocketForwarder(local_host_and_port, remote_host_and_port, MessageStream(query_recorder), engine=engine) as socket_forwarder:
+        with closing(Client(local_host_and_port.host, local_host_and_port.port)) as client:
+            client.backend_pid()
+            client.query("BEGIN")
+        socket_forwarder.stop()
+
+    # Neither the startup message nor the rows and the other answers reach the handler
+    assert query_recorder.queries == ["SELECT pg_backend_pid()", "BEGIN"]
+    assert query_recorder.statuses == [b"I", b"I", b"T"]
@@ -0,0 +1,88 @@
+from contextlib import closing
+from threading import Thread
+from urllib.request import urlopen
+
+from radium226.pg.random_port import random_port
+from radium226.socket_forwarder.flow_control import DEFAULT_MEMORY_BUDGET
+from radium226.pg_proxy import PoolMode
+from radium226.pg_proxy.metrics import Histogram, Metrics, bucket_index, bucket_upper_bound
+from radium226.pg_proxy.wire import WireEventHandler, encode_startup_message, encode_query, encode_ready_for_query
+
+from .conftest import FakePostgreSQL
+from .test_pooler import pooled_proxy, connect
+
+
+def test_histogram() -> None:
+    for value in [0, 1, 15, 16, 17, 1000, 123_456_789]:
+        index = bucket_index(value)
+        assert bucket_upper_bound(index - 1) <= value < bucket_upper_bound(index) if index > 0 else value == 0
+        # A bucket is at most 1/8 wider than its values
+        assert bucket_upper_bound(index) - value <= max(value / 8, 1)
+
+    histogram = Histogram("duration_seconds", "Duration", scale=1e-6)
+    threads = [Thread(target=lambda: [histogram.record(value) for value in range(1, 1001)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert histogram.count == 4000
+    assert histogram.sum == 4 * 500_500
+    assert 500 <= histogram.percentile(50) <= 500 * 9 / 8
+    assert 990 <= histogram.percentile(99) <= 990 * 9 / 8
+
+    lines = histogram.render()
+    assert 'duration_seconds_bucket{le="0.001024"} 4000' in lines
+    assert 'duration_seconds_bucket{le="0.000512"} 2044' in lines
+    assert "duration_seconds_count 4000" in lines
+
+
+def test_wire_event_handler_metrics() -> None:
+    metrics = Metrics()
+    event_handler = WireEventHandler(metrics=metrics).for_connection()
+    event_handler.on_chunk_sent(memoryview(encode_startup_message({"user": "postgres"})))
+    event_handler.on_chunk_received(memoryview(encode_ready_for_query(b"I")))
+    assert metrics.live_connection_count.value == 1
+
+    event_handler.on_chunk_sent(memoryview(encode_query("SELECT 1") + encode_query("SELECT 2")))
+    event_handler.on_chunk_received(memoryview(encode_ready_for_query(b"I")))
+    assert metrics.query_duration.count == 1
+    event_handler.on_chunk_received(memoryview(encode_ready_for_query(b"I")))
+    assert metrics.query_duration.count == 2
+
+    event_handler.on_connection_closed()
+    assert metrics.live_connection_count.value == 0
+    assert metrics.connection_count.value == 1
+    assert metrics.bytes_received.value == 3 * len(encode_ready_for_query(b"I"))
+    assert metrics.connection_bytes_sent.sum == metrics.bytes_sent.value
+
+
+def test_wire_event_handler_framing_error() -> None:
+    metrics = Metrics()
+    event_handler = WireEventHandler(metrics=metrics).for_connection()
+    event_handler.on_chunk_sent(memoryview(encode_startup_message({"user": "postgres"})))
+    # A message cannot be shorter than its length
+    event_handler.on_chunk_sent(memoryview(b"Q\x00\x00\x00\x01"))
+    assert metrics.inspection_errors.value == 1
+
+    # The stream is out of sync from then on, so it is not inspected anymore
+    event_handler.on_chunk_sent(memoryview(b"Q\x00\x00\x00\x01" + encode_query("SELECT 1")))
+    event_handler.on_chunk_received(memoryview(encode_ready_for_query(b"I")))
+    assert metrics.inspection_errors.value == 1
+    assert metrics.query_duration.count == 0
+
+
+def test_metrics_endpoint(fake_postgresql: FakePostgreSQL) -> None:
+    metrics_port = random_port()
+    with pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, metrics_port=metrics_port) as pg_proxy:
+        with closing(connect(pg_proxy)) as client:
+            for _ in range(3):
+                client.query("SELECT 1")
+
+            with urlopen(f"http://localhost:{metrics_port}/metrics") as response:
+                lines = response.read().decode().splitlines()
+
+    assert "pg_proxy_query_duration_seconds_count 3" in lines
+    assert "pg_proxy_connections 1" in lines
+    assert "pg_proxy_connections_total 1" in lines
+    assert f"pg_proxy_buffer_budget_bytes {DEFAULT_MEMORY_BUDGET}" in lines
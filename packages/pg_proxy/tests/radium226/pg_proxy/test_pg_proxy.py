@@ -1,28 +1,31 @@
 from pytest import fixture
 
-from radium226.pg import PostgreSQL
-from radium226.pg_proxy import PostgreSQLProxy
+from radium226.pg import PostgreSQLPool, Database
+from radium226.pg.random_port import random_port
+from radium226.pg_proxy import PostgreSQLProxy, PoolMode, SSLMode
 
 from contextlib import closing
 import psycopg2
 
 
 @fixture
-def pg() -> PostgreSQL:
-    with PostgreSQL(ssl=True) as pg:
+def pg(postgresql_pool: PostgreSQLPool) -> Database:
+    with postgresql_pool.database() as pg:
         yield pg
 
 
 @fixture
-def pg_proxy(pg: PostgreSQL) -> PostgreSQLProxy:
+def pg_proxy(pg: Database) -> PostgreSQLProxy:
     with PostgreSQLProxy(
         remote_host=pg.host,
         remote_port=pg.port,
+        # PostgreSQL itself may listen on the default port
+        local_port=random_port(),
     ) as pg_proxy:
         yield pg_proxy
 
 
-def test_pg_proxy(pg_proxy: PostgreSQLProxy) -> None:
+def test_pg_proxy(pg: Database, pg_proxy: PostgreSQLProxy) -> None:
     print(f"pg_proxy={pg_proxy}")
     host = pg_proxy.host
     print(f"host={host}")
@@ -31,7 +34,7 @@ def test_pg_proxy(pg_proxy: PostgreSQLProxy) -> None:
     print(f"port={port}")
 
     with closing(psycopg2.connect(
-        dbname="postgres",
+        dbname=pg.name,
         user="postgres",
         host=host,
         port=port,
@@ -42,3 +45,31 @@ def test_pg_proxy(pg_proxy: PostgreSQLProxy) -> None:
             print(result)
             pass
             # assert result == (index,)
+
+
+def test_pg_proxy_with_transaction_pooling(pg: Database) -> None:
+    with PostgreSQLProxy(
+        remote_host=pg.host,
+        remote_port=pg.port,
+        local_port=random_port(),
+        pool_mode=PoolMode.TRANSACTION,
+        # The proxy presents the certificate of PostgreSQL, and opens its own TLS connections to it
+        ssl_certificate_path=pg.folder_path / "server.crt",
+        ssl_key_path=pg.folder_path / "server.key",
+        upstream_ssl_mode=SSLMode.REQUIRE,
+    ) as pg_proxy:
+        backend_pids = []
+        for _ in range(2):
+            with closing(psycopg2.connect(
+                dbname=pg.name,
+                user="postgres",
+                host=pg_proxy.host,
+                port=pg_proxy.port,
+                sslmode="require",
+            )) as connection, closing(connection.cursor()) as cursor:
+                cursor.execute("SELECT pg_backend_pid()")
+                backend_pid, = cursor.fetchone()
+                connection.commit()
+                backend_pids.append(backend_pid)
+
+        assert backend_pids[0] == backend_pids[1]
@@ -0,0 +1,265 @@
+from contextlib import closing
+from time import sleep
+
+from pytest import fixture, raises
+
+from radium226.pg.random_port import random_port
+from radium226.pg_proxy import PostgreSQLProxy, PoolMode
+from radium226.pg_proxy.wire import encode_message
+
+from .conftest import FakePostgreSQL, Client
+
+
+def pooled_proxy(fake_postgresql: FakePostgreSQL, pool_mode: PoolMode, **kwargs) -> PostgreSQLProxy:
+    return PostgreSQLProxy(
+        remote_host=fake_postgresql.host,
+        remote_port=fake_postgresql.port,
+        local_port=random_port(),
+        pool_mode=pool_mode,
+        **kwargs,
+    )
+
+
+def connect(pg_proxy: PostgreSQLProxy, **kwargs) -> Client:
+    return Client(pg_proxy.host, pg_proxy.port, **kwargs)
+
+
+def test_transaction_pooling(fake_postgresql: FakePostgreSQL) -> None:
+    with pooled_proxy(fake_postgresql, PoolMode.TRANSACTION) as pg_proxy:
+        with closing(connect(pg_proxy)) as client:
+            backend_pid = client.backend_pid()
+        with closing(connect(pg_proxy)) as first_client, closing(connect(pg_proxy)) as second_client:
+            # Clients outside of a transaction share the same backend
+            assert first_client.backend_pid() == second_client.backend_pid() == backend_pid
+
+            first_client.query("BEGIN")
+            # The backend is held by the first client until the end of its transaction
+            assert second_client.backend_pid() != backend_pid
+            assert first_client.backend_pid() == backend_pid
+            first_client.query("COMMIT")
+            assert second_client.backend_pid() == backend_pid
+
+    assert fake_postgresql.connection_count == 2
+
+
+def test_transaction_pooling_with_extended_queries(fake_postgresql: FakePostgreSQL) -> None:
+    with pooled_proxy(fake_postgresql, PoolMode.TRANSACTION) as pg_proxy:
+        with closing(connect(pg_proxy)) as first_client, closing(connect(pg_proxy)) as second_client:
+            for client in [first_client, second_client]:
+                client.send(b"".join([
+                    encode_message(b"P", b"\x00SELECT pg_backend_pid()\x00\x00\x00"),
+                    encode_message(b"B", b"\x00\x00\x00\x00\x00\x00\x00\x00"),
+                    encode_message(b"E", b"\x00\x00\x00\x00\x00"),
+                ]))
+            for client in [first_client, second_client]:
+                client.send(encode_message(b"S"))
+
+            backend_pids = []
+            for client in [first_client, second_client]:
+                frames = client.read_until_ready()
+                assert [frame[0:1] for frame in frames] == [b"1", b"2", b"T", b"D", b"C"]
+                backend_pids.append(frames[3])
+            # The backend was held by the first client until its Sync
+            assert backend_pids[0] != backend_pids[1]
+
+
+def test_session_pooling(fake_postgresql: FakePostgreSQL) -> None:
+    with pooled_proxy(fake_postgresql, PoolMode.SESSION) as pg_proxy:
+        with closing(connect(pg_proxy)) as first_client, closing(connect(pg_proxy)) as second_client:
+            backend_pid = first_client.backend_pid()
+            assert second_client.backend_pid() != backend_pid
+            assert first_client.backend_pid() == backend_pid
+
+        with closing(connect(pg_proxy)) as client:
+            # The backend was reset before being handed to another client
+            assert client.backend_pid() in [backend_pid, backend_pid + 1]
+            assert (backend_pid, "DISCARD ALL") in fake_postgresql.queries
+
+    assert fake_postgresql.connection_count == 2
+
+
+def test_pooling_with_password() -> None:
+    with FakePostgreSQL(password="secret") as fake_postgresql:
+        # The client did not start TLS, so it is not asked for its password
+        with pooled_proxy(fake_postgresql, PoolMode.TRANSACTION) as pg_proxy, raises(ConnectionRefusedError, match="TLS"):
+            connect(pg_proxy, password="secret")
+
+    with FakePostgreSQL(password="secret") as fake_postgresql, pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, allow_cleartext_password=True) as pg_proxy:
+        with closing(connect(pg_proxy, password="secret")) as client:
+            backend_pid = client.backend_pid()
+
+        with raises(ConnectionRefusedError):
+            connect(pg_proxy, password="wrong")
+        with raises(ConnectionRefusedError):
+            connect(pg_proxy, password="wrông")
+
+        with closing(connect(pg_proxy, password="secret")) as client:
+            assert client.backend_pid() == backend_pid
+
+
+def prepared_query(statement: bytes) -> bytes:
+    return b"".join([
+        encode_message(b"B", b"\x00" + statement + b"\x00\x00\x00\x00\x00\x00\x00"),
+        encode_message(b"E", b"\x00\x00\x00\x00\x00"),
+        encode_message(b"S"),
+    ])
+
+
+def test_transaction_pooling_with_prepared_statements(fake_postgresql: FakePostgreSQL) -> None:
+    parse = lambda statement: encode_message(b"P", statement + b"\x00SELECT pg_backend_pid()\x00\x00\x00")
+
+    with pooled_proxy(fake_postgresql, PoolMode.TRANSACTION) as pg_proxy:
+        with closing(connect(pg_proxy)) as first_client, closing(connect(pg_proxy)) as second_client:
+            first_client.send(parse(b"s1") + encode_message(b"S"))
+            assert [frame[0:1] for frame in first_client.read_until_ready()] == [b"1"]
+            # The statement is already prepared on the backend, so the Parse of the second client is answered by the proxy
+            second_client.send(parse(b"s2") + encode_message(b"S"))
+            assert [frame[0:1] for frame in second_client.read_until_ready()] == [b"1"]
+            assert len(fake_postgresql.parsed_statements) == 1
+
+            # The first client holds the first backend, so the second one gets a new backend which lacks the statement
+            first_client.query("BEGIN")
+            second_client.send(prepared_query(b"s2"))
+            frames = second_client.read_until_ready()
+            assert [frame[0:1] for frame in frames] == [b"2", b"T", b"D", b"C"]
+            assert len(fake_postgresql.parsed_statements) == 2
+            assert fake_postgresql.connection_count == 2
+
+            first_client.send(prepared_query(b"s1"))
+            assert [frame[0:1] for frame in first_client.read_until_ready()] == [b"2", b"T", b"D", b"C"]
+            first_client.query("COMMIT")
+
+            # Closing the statement only forgets it for the client, and the other clients keep it
+            first_client.send(encode_message(b"C", b"Ss1\x00") + encode_message(b"S"))
+            assert [frame[0:1] for frame in first_client.read_until_ready()] == [b"3"]
+            first_client.send(prepared_query(b"s1"))
+            assert [frame[0:1] for frame in first_client.read_until_ready()] == [b"E"]
+            second_client.send(prepared_query(b"s2"))
+            assert [frame[0:1] for frame in second_client.read_until_ready()] == [b"2", b"T", b"D", b"C"]
+
+            # A name cannot be prepared twice, even if the backend never saw it
+            second_client.send(parse(b"s2") + encode_message(b"S"))
+            assert [frame[0:1] for frame in second_client.read_until_ready()] == [b"E"]
+
+
+def test_pooling_with_result_cache(fake_postgresql: FakePostgreSQL) -> None:
+    select = "SELECT * FROM users WHERE id = 42"
+    with pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, result_cache_size=1024 * 1024) as pg_proxy:
+        with closing(connect(pg_proxy)) as first_client, closing(connect(pg_proxy)) as second_client:
+            first_client.query(select)
+            second_client.query(select)
+            assert [query for _, query in fake_postgresql.queries].count(select) == 1
+
+            # Within a transaction, the backend is always asked
+            first_client.query("BEGIN")
+            first_client.query(select)
+            first_client.query("UPDATE users SET name = 'Alice' WHERE id = 42")
+            first_client.query("COMMIT")
+            assert [query for _, query in fake_postgresql.queries].count(select) == 2
+
+            # The write invalidated the cached result
+            second_client.query(select)
+            second_client.query(select)
+            assert [query for _, query in fake_postgresql.queries].count(select) == 3
+
+            # The results depend on the settings of the session, once it changed them
+            first_client.query("SET search_path TO other")
+            first_client.query(select)
+            first_client.query(select)
+            assert [query for _, query in fake_postgresql.queries].count(select) == 5
+
+    # The workers would each have their own cache, which a write through another one does not invalidate
+    with raises(ValueError):
+        pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, result_cache_size=1024 * 1024, worker_count=2)
+
+
+def test_transaction_pooling_with_replica(fake_postgresql: FakePostgreSQL) -> None:
+    select, update = "SELECT * FROM users", "UPDATE users SET name = 'Alice'"
+    queries = lambda fake_postgresql: [query for _, query in fake_postgresql.queries]
+
+    with FakePostgreSQL() as replica, pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, replicas=[(replica.host, replica.port)]) as pg_proxy:
+        with closing(connect(pg_proxy)) as client:
+            client.query(select)
+            client.query(update)
+            assert queries(replica) == [select]
+            assert queries(fake_postgresql) == [update]
+
+            # A transaction stays on the primary, as it may read what it wrote
+            for query in ["BEGIN", select, "COMMIT"]:
+                client.query(query)
+            assert queries(replica) == [select]
+
+            # Both queries are sent at once, and are answered in order by the replica and then the primary
+            client.send(encode_message(b"Q", f"{select}\x00".encode()) + encode_message(b"Q", f"{update}\x00".encode()))
+            assert [frame[0:1] for frame in client.read_until_ready()] == [b"C"]
+            assert [frame[0:1] for frame in client.read_until_ready()] == [b"C"]
+            assert queries(replica) == [select, select]
+            assert queries(fake_postgresql)[-1] == update
+
+            # A statement prepared for a read sends its executions to the replica too
+            client.send(encode_message(b"P", f"s1\x00{select}\x00\x00\x00".encode()) + encode_message(b"S"))
+            client.read_until_ready()
+            client.send(prepared_query(b"s1"))
+            assert [frame[0:1] for frame in client.read_until_ready()] == [b"2", b"C"]
+            assert queries(replica) == [select, select, select]
+
+        # A replica which refuses the clients is reported, and the reads go to the primary
+        with FakePostgreSQL(password="secret") as locked_replica, pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, replicas=[(locked_replica.host, locked_replica.port)]) as pg_proxy:
+            with closing(connect(pg_proxy)) as client:
+                client.query(select)
+            assert queries(fake_postgresql)[-1] == select
+            assert pg_proxy.metrics.replica_fallbacks.value == 1
+
+        # A session keeps its backend until it is over, so its queries cannot be routed
+        with raises(ValueError):
+            pooled_proxy(fake_postgresql, PoolMode.SESSION, replicas=[(replica.host, replica.port)])
+
+
+def test_transaction_pooling_with_health_check(fake_postgresql: FakePostgreSQL) -> None:
+    select = "SELECT * FROM users"
+
+    # Nothing listens on the replica, so the reads go to the primary
+    with pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, replicas=[("localhost", random_port())], health_check_interval=0.05) as pg_proxy:
+        with closing(connect(pg_proxy)) as client:
+            client.query(select)
+            client.query(select)
+            assert [query for _, query in fake_postgresql.queries] == [select, select]
+
+    # Once the health checks of the primary failed, the clients are refused without trying to connect
+    with pooled_proxy(FakePostgreSQL(), PoolMode.TRANSACTION, health_check_interval=0.05) as pg_proxy:
+        for _ in range(50):
+            with raises(ConnectionRefusedError) as error:
+                connect(pg_proxy)
+            if "unavailable" in str(error.value):
+                break
+            sleep(0.05)
+        assert "unavailable" in str(error.value)
+
+
+def test_pooling_with_admission_control(fake_postgresql: FakePostgreSQL) -> None:
+    with pooled_proxy(fake_postgresql, PoolMode.SESSION, max_upstream_connections=1, admission_timeout=0.5) as pg_proxy:
+        metrics = pg_proxy.metrics
+        with closing(connect(pg_proxy)) as client:
+            client.backend_pid()
+
+            # The only backend is held by the first client, so a client of another database waits for it in vain
+            with raises(ConnectionRefusedError):
+                connect(pg_proxy, database="other")
+            assert metrics.admission_timeouts.value == 1
+            assert metrics.admission_waiting_clients.value == 0
+
+        # Once idle, the backend of the first database is closed to make room for the other one
+        sleep(0.2)
+        with closing(connect(pg_proxy, database="other")) as client:
+            client.backend_pid()
+            assert metrics.upstream_connections.value == 1
+        assert metrics.admission_wait_duration.count == 2
+
+    with raises(ValueError):
+        pooled_proxy(fake_postgresql, None, max_upstream_connections_per_database=1)
+
+
+def test_pooling_without_memory_budget(fake_postgresql: FakePostgreSQL) -> None:
+    # The pooler reads the answers through asyncio streams, which only its watermarks bound
+    with raises(ValueError):
+        pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, memory_budget=1024 * 1024)
@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+from radium226.pg_proxy.wire import encode_message, encode_query, decode_frontend_message
+from radium226.pg_proxy.prepared_statements import PreparedStatementTracker
+
+
+def parse(statement: bytes, query: bytes) -> memoryview:
+    return memoryview(encode_message(b"P", statement + b"\x00" + query + b"\x00\x00\x00"))
+
+
+def bind(statement: bytes) -> memoryview:
+    return memoryview(encode_message(b"B", b"\x00" + statement + b"\x00\x00\x00\x00\x00\x00\x00"))
+
+
+SYNC = memoryview(encode_message(b"S"))
+
+
+def rewrite(tracker: PreparedStatementTracker, backend, *frames: memoryview) -> list[bytes]:
+    outgoing_frames = []
+    for frame in frames:
+        tracker.rewrite(frame, backend, outgoing_frames)
+    return [bytes(frame[0:1]) for frame in outgoing_frames]
+
+
+def test_prepared_statements_eviction() -> None:
+    backend = SimpleNamespace(prepared_statements={})
+    tracker = PreparedStatementTracker(max_prepared_statements=2)
+    assert rewrite(tracker, backend, parse(b"s1", b"SELECT 1"), parse(b"s2", b"SELECT 2"), SYNC) == [b"P", b"P", b"S"]
+
+    # The statements used since the last Sync are kept, even over the cap
+    assert rewrite(tracker, backend, bind(b"s1"), parse(b"s3", b"SELECT 3"), SYNC) == [b"B", b"C", b"P", b"S"]
+    assert len(backend.prepared_statements) == 2
+    assert rewrite(tracker, backend, bind(b"s1"), bind(b"s3"), parse(b"s4", b"SELECT 4"), SYNC) == [b"B", b"B", b"P", b"S"]
+    assert len(backend.prepared_statements) == 3
+
+    # The closed statement is prepared again once it is used again
+    assert rewrite(tracker, backend, bind(b"s2"), SYNC) == [b"C", b"C", b"P", b"B", b"S"]
+    assert len(backend.prepared_statements) == 2
+
+
+def test_prepared_statements_parsed_twice() -> None:
+    backend = SimpleNamespace(prepared_statements={})
+    tracker = PreparedStatementTracker()
+    rewrite(tracker, backend, parse(b"s1", b"SELECT 1"), SYNC)
+    tracker.route(memoryview(encode_message(b"1")), backend, [])
+    tracker.route(memoryview(encode_message(b"Z", b"I")), backend, [])
+
+    # Like PostgreSQL, the proxy refuses it, and skips what follows up to the Sync
+    assert rewrite(tracker, backend, parse(b"s1", b"SELECT 2"), bind(b"s1"), SYNC) == [b"S"]
+    assert [bytes(frame[0:1]) for frame in tracker.synthesized_responses()] == [b"E"]
+    assert rewrite(tracker, backend, bind(b"s1"), SYNC) == [b"B", b"S"]
+
+
+def test_prepared_statements_deallocated() -> None:
+    backend = SimpleNamespace(prepared_statements={})
+    tracker = PreparedStatementTracker()
+    rewrite(tracker, backend, parse(b"s1", b"SELECT 1"), parse(b"s2", b"SELECT 2"), SYNC)
+
+    # The backend knows the statement by another name
+    backend_names = set(backend.prepared_statements)
+    outgoing_frames = []
+    tracker.rewrite(memoryview(encode_query('DEALLOCATE "s1"')), backend, outgoing_frames)
+    [backend_name] = backend_names - set(backend.prepared_statements)
+    assert decode_frontend_message(memoryview(outgoing_frames[0])).query == f"DEALLOCATE {backend_name}"
+
+    # Which is prepared again first when it was closed
+    rewrite(tracker, backend, parse(b"s1", b"SELECT 1"), SYNC)
+    backend.prepared_statements.clear()
+    assert rewrite(tracker, backend, memoryview(encode_query("DEALLOCATE PREPARE s1;"))) == [b"P", b"Q"]
+    assert len(backend.prepared_statements) == 0
+
+    # The statements can be prepared again once they are all discarded
+    rewrite(tracker, backend, parse(b"s1", b"SELECT 1"), SYNC)
+    assert rewrite(tracker, backend, memoryview(encode_query("DISCARD ALL"))) == [b"Q"]
+    assert backend.prepared_statements == {}
+    assert rewrite(tracker, backend, parse(b"s1", b"SELECT 1"), parse(b"s2", b"SELECT 2"), SYNC) == [b"P", b"P", b"S"]
+    assert tracker.synthesized_responses() == []
+
+
+def test_prepared_statements_failed_before_simple_query() -> None:
+    backend = SimpleNamespace(prepared_statements={})
+    tracker = PreparedStatementTracker()
+    rewrite(tracker, backend, parse(b"s1", b"SELECT 1"), SYNC)
+
+    # The client waits for the ReadyForQuery of its simple query, even after a refused message
+    assert rewrite(tracker, backend, parse(b"s1", b"SELECT 2"), memoryview(encode_query("SELECT 1"))) == [b"Q"]
@@ -0,0 +1,41 @@
+from radium226.pg_proxy.query_analyzer import (
+    QueryAnalyzer,
+    QueryMetadata,
+    StatementKind,
+    fingerprint,
+)
+
+
+def test_fingerprint() -> None:
+    assert fingerprint("SELECT * FROM users WHERE id = 42 AND name = 'it''s'") == "SELECT * FROM users WHERE id = ? AND name = ?"
+    assert fingerprint("SELECT  *\nFROM users -- comment\nWHERE id IN (1, 2, 3)") == fingerprint("SELECT * FROM users WHERE id IN (4)")
+    assert fingerprint("SELECT $$a 'b' c$$, E'\\'', $1 FROM t1") == "SELECT ?, $1 FROM t1"
+    assert fingerprint('SELECT "42" FROM t') == 'SELECT "42" FROM t'
+
+
+def test_analyze() -> None:
+    query_analyzer = QueryAnalyzer()
+
+    assert query_analyzer.analyze("SELECT * FROM a.b JOIN c ON c.id = b.id") == QueryMetadata(("a.b", "c"), StatementKind.SELECT, True)
+    assert query_analyzer.analyze("INSERT INTO t VALUES (1)") == QueryMetadata(("t",), StatementKind.INSERT, False)
+    assert query_analyzer.analyze("WITH x AS (DELETE FROM t RETURNING *) SELECT * FROM x") == QueryMetadata(("t",), StatementKind.SELECT, False)
+    assert not query_analyzer.analyze("SELECT * FROM t FOR UPDATE").read_only
+    assert not query_analyzer.analyze("SELECT nextval('s')").read_only
+    assert query_analyzer.analyze("BEGIN").kind == StatementKind.TRANSACTION
+    assert query_analyzer.analyze("This is not SQL (((").kind == StatementKind.UNKNOWN
+
+
+def test_analyzer_cache() -> None:
+    query_analyzer = QueryAnalyzer(max_size=2)
+
+    for id in range(10):
+        query_analyzer.analyze(f"SELECT * FROM users WHERE id = {id}")
+    assert (query_analyzer.hit_count, query_analyzer.miss_count) == (9, 1)
+
+    query_analyzer.analyze("SELECT * FROM orders")
+    query_analyzer.analyze("SELECT * FROM users WHERE id = 0")
+    query_analyzer.analyze("SELECT * FROM products")
+    assert len(query_analyzer) == 2
+    # The least recently used statement shape was evicted
+    query_analyzer.analyze("SELECT * FROM orders")
+    assert (query_analyzer.hit_count, query_analyzer.miss_count) == (10, 4)
@@ -0,0 +1,47 @@
+from time import sleep
+
+from radium226.pg_proxy.result_cache import ResultCache
+
+
+def test_result_cache_eviction() -> None:
+    result_cache = ResultCache(max_size=64 * 16)
+
+    result_cache.put("a", ("users",), b"a" * 64, result_cache.generation)
+    result_cache.put("b", ("users",), b"b" * 64, result_cache.generation)
+    assert result_cache.get("a") == b"a" * 64
+    # Too big to be cached
+    result_cache.put("c", ("orders",), b"c" * 65, result_cache.generation)
+    assert result_cache.get("c") is None
+
+    for index in range(15):
+        result_cache.put(index, ("orders",), b"x" * 64, result_cache.generation)
+    # The least recently used entry was evicted to make room
+    assert result_cache.get("b") is None
+    assert result_cache.get("a") == b"a" * 64
+    assert result_cache.size == 64 * 16
+
+
+def test_result_cache_invalidation() -> None:
+    result_cache = ResultCache(max_size=1024)
+
+    result_cache.put("a", ("public.users",), b"a", result_cache.generation)
+    result_cache.put("b", ("orders",), b"b", result_cache.generation)
+    result_cache.invalidate({"Users"})
+    assert result_cache.get("a") is None
+    assert result_cache.get("b") == b"b"
+
+    # The answer was recorded before the invalidation, so it may be stale
+    generation = result_cache.generation
+    result_cache.invalidate({"users"})
+    result_cache.put("a", ("users",), b"a", generation)
+    assert result_cache.get("a") is None
+
+
+def test_result_cache_ttl() -> None:
+    result_cache = ResultCache(max_size=1024, ttl=0.1)
+
+    result_cache.put("a", ("users",), b"a", result_cache.generation)
+    assert result_cache.get("a") == b"a"
+    sleep(0.2)
+    assert result_cache.get("a") is None
+    assert len(result_cache) == 0
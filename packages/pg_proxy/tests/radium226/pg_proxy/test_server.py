@@ -1,7 +1,10 @@
+import socket
+from contextlib import closing
 from time import sleep
 from threading import Thread
 from pendulum import now
 
+from radium226.pg.random_port import random_port
 from radium226.pg_proxy.server import Server, Handler
 
 
@@ -28,4 +31,29 @@ def test_server():
 
     assert (end - begin).in_seconds() == TIMEOUT_IN_SECONDS
     
-    
\ No newline at end of file
+    
+
+def test_server_graceful_stop():
+    answer = bytes(range(256)) * 32 * 1024
+
+    class LargeAnswerHandler(Handler):
+
+        def handle(self, input_buffer, output_buffer):
+            output_buffer.write(answer)
+
+    port = random_port()
+    with Server("localhost", port, LargeAnswerHandler()) as server:
+        with closing(socket.create_connection(("localhost", port))) as client_socket:
+            client_socket.sendall(b"QUERY")
+            # The client does not read its answer yet, so it is still being written when the server is told to stop
+            sleep(0.2)
+            stop_thread = Thread(target=server.stop, kwargs={"grace_period": 10})
+            stop_thread.start()
+            sleep(0.2)
+            assert stop_thread.is_alive()
+
+            assert client_socket.recv(len(answer), socket.MSG_WAITALL) == answer
+
+        # The server stops as soon as every answer has been written
+        stop_thread.join(timeout=5)
+        assert not stop_thread.is_alive()
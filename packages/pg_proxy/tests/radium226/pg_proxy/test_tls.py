@@ -0,0 +1,73 @@
+import ssl
+from contextlib import closing
+from pathlib import Path
+
+from pytest import raises
+
+from radium226.pg_proxy import PoolMode, SSLMode
+from radium226.pg_proxy.tls import create_server_ssl_context
+
+from .conftest import FakePostgreSQL
+from .test_pooler import pooled_proxy, connect
+
+
+def client_ssl_context() -> ssl.SSLContext:
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
+def test_tls_termination(certificate_paths: tuple[Path, Path]) -> None:
+    certificate_path, key_path = certificate_paths
+    with FakePostgreSQL(ssl_context=create_server_ssl_context(certificate_path, key_path)) as fake_postgresql:
+        with pooled_proxy(
+            fake_postgresql,
+            PoolMode.SESSION,
+            ssl_certificate_path=certificate_path,
+            ssl_key_path=key_path,
+            upstream_ssl_mode=SSLMode.REQUIRE,
+        ) as pg_proxy:
+            # Both clients hold their backend, so two TLS connections are opened to PostgreSQL
+            with (
+                closing(connect(pg_proxy, ssl_context=client_ssl_context())) as first_client,
+                closing(connect(pg_proxy, ssl_context=client_ssl_context())) as second_client,
+            ):
+                assert first_client.backend_pid() != second_client.backend_pid()
+
+            # The proxy sees the queries of the clients, even though they are encrypted
+            with closing(connect(pg_proxy, ssl_context=client_ssl_context())) as client:
+                client.query("SELECT 1")
+
+        assert fake_postgresql.tls_connection_count == fake_postgresql.connection_count == 2
+        # The second backend resumed the TLS session of the first one
+        assert fake_postgresql.resumed_tls_session_count == 1
+
+
+def test_tls_termination_with_upstream_without_tls(fake_postgresql: FakePostgreSQL, certificate_paths: tuple[Path, Path]) -> None:
+    certificate_path, key_path = certificate_paths
+    with pooled_proxy(
+        fake_postgresql,
+        PoolMode.TRANSACTION,
+        ssl_certificate_path=certificate_path,
+        ssl_key_path=key_path,
+        upstream_ssl_mode=SSLMode.PREFER,
+    ) as pg_proxy:
+        with closing(connect(pg_proxy, ssl_context=client_ssl_context())) as client:
+            assert client.query("SELECT pg_backend_pid()")
+
+    with pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, upstream_ssl_mode=SSLMode.REQUIRE) as pg_proxy:
+        with raises(ConnectionRefusedError, match="TLS"):
+            connect(pg_proxy)
+
+
+def test_tls_termination_with_password(certificate_paths: tuple[Path, Path]) -> None:
+    certificate_path, key_path = certificate_paths
+    with FakePostgreSQL(password="secret") as fake_postgresql:
+        with pooled_proxy(fake_postgresql, PoolMode.TRANSACTION, ssl_certificate_path=certificate_path, ssl_key_path=key_path) as pg_proxy:
+            # The password goes in clear to the proxy, but inside the TLS connection
+            with closing(connect(pg_proxy, password="secret", ssl_context=client_ssl_context())) as client:
+                assert client.query("SELECT pg_backend_pid()")
+
+            with raises(ConnectionRefusedError, match="TLS"):
+                connect(pg_proxy, password="secret")
@@ -0,0 +1,59 @@
+import struct
+
+from radium226.pg_proxy.framing import SSL_REQUEST_CODE
+from radium226.pg_proxy.wire import (
+    decode_frontend_message,
+    decode_backend_message,
+    StartupMessage,
+    SSLRequest,
+    Query,
+    Parse,
+    Bind,
+    Execute,
+    Sync,
+    EncryptionResponse,
+    RowDescription,
+    DataRow,
+    CommandComplete,
+    ReadyForQuery,
+    ErrorResponse,
+    UnknownMessage,
+)
+
+
+def message(type: bytes, payload: bytes) -> memoryview:
+    return memoryview(type + struct.pack("!i", len(payload) + 4) + payload)
+
+
+def test_decode_frontend_messages() -> None:
+    payload = struct.pack("!i", 196608) + b"user\x00postgres\x00database\x00db\x00\x00"
+    startup_message = decode_frontend_message(memoryview(struct.pack("!i", len(payload) + 4) + payload))
+    assert startup_message == StartupMessage(196608, {"user": "postgres", "database": "db"})
+
+    assert decode_frontend_message(memoryview(struct.pack("!ii", 8, SSL_REQUEST_CODE))) == SSLRequest()
+    assert decode_frontend_message(message(b"Q", b"SELECT 1\x00")) == Query("SELECT 1")
+    assert decode_frontend_message(message(b"P", b"s1\x00SELECT $1\x00\x00\x01\x00\x00\x00\x17")) == Parse("s1", "SELECT $1", (23,))
+    assert decode_frontend_message(message(b"E", b"\x00\x00\x00\x00\x00")) == Execute("", 0)
+    assert decode_frontend_message(message(b"S", b"")) == Sync()
+
+    bind = decode_frontend_message(message(b"B", b"\x00s1\x00\x00\x00\x00\x02\x00\x00\x00\x0242\xff\xff\xff\xff\x00\x00"))
+    assert isinstance(bind, Bind)
+    assert (bind.portal, bind.statement) == ("", "s1")
+    assert [None if parameter is None else bytes(parameter) for parameter in bind.parameters] == [b"42", None]
+
+
+def test_decode_backend_messages() -> None:
+    assert decode_backend_message(memoryview(b"N")) == EncryptionResponse(False)
+
+    row_description = decode_backend_message(message(b"T", b"\x00\x01id\x00" + struct.pack("!ihihih", 0, 0, 23, 4, -1, 0)))
+    assert isinstance(row_description, RowDescription)
+    assert [(field.name, field.type_oid) for field in row_description.fields] == [("id", 23)]
+
+    data_row = decode_backend_message(message(b"D", b"\x00\x02\x00\x00\x00\x011\xff\xff\xff\xff"))
+    assert isinstance(data_row, DataRow)
+    assert [None if value is None else bytes(value) for value in data_row.values] == [b"1", None]
+
+    assert decode_backend_message(message(b"C", b"SELECT 1\x00")) == CommandComplete("SELECT 1")
+    assert decode_backend_message(message(b"Z", b"I")) == ReadyForQuery(b"I")
+    assert decode_backend_message(message(b"E", b"SERROR\x00Mboom\x00\x00")) == ErrorResponse({"S": "ERROR", "M": "boom"})
+    assert isinstance(decode_backend_message(message(b"?", b"")), UnknownMessage)
@@ -0,0 +1,163 @@
+import resource
+import socket
+import struct
+from contextlib import closing, contextmanager
+from enum import StrEnum, auto
+from multiprocessing import get_context
+from threading import Thread, Barrier
+from time import perf_counter
+from typing import Iterator
+
+from click import command, option, Choice
+
+from radium226.pg.random_port import random_port
+from radium226.socket_forwarder import SocketForwarder, StreamingEventHandler, Engine, HostAndPort
+from radium226.socket_forwarder.epoll_engine import EPOLL_SUPPORTED
+
+
+DURATION_IN_SECONDS = 5.0
+
+CLIENT_COUNT = 16
+
+# Like the queries and the ReadyForQuery of PostgreSQL, which are much smaller than a segment
+MESSAGE_SIZE = 64
+
+BULK_SIZE = 64 * 1024 * 1024
+
+
+class Workload(StrEnum):
+
+    # Each client sends a small message and waits for it back, so the cost of each event of the loop shows
+    PING_PONG = auto()
+    # Each client receives a large payload, so the cost of each chunk shows
+    BULK = auto()
+
+
+class _Handler(StreamingEventHandler):
+    """Makes every engine go through the same ring buffers, as the selectors one would splice the bytes otherwise."""
+
+    def on_chunk_sent(self, chunk: memoryview):
+        pass
+
+    def on_chunk_received(self, chunk: memoryview):
+        pass
+
+
+def _serve_upstream(server_socket: socket.socket):
+    def serve_connection(connection_socket: socket.socket):
+        with closing(connection_socket):
+            while header := connection_socket.recv(4, socket.MSG_WAITALL):
+                length, = struct.unpack("!i", header)
+                if length < 0:
+                    # The client asks for a bulk payload rather than for its message back
+                    connection_socket.sendall(bytes(-length))
+                    continue
+                connection_socket.sendall(header + connection_socket.recv(length, socket.MSG_WAITALL))
+
+    while True:
+        try:
+            connection_socket, _ = server_socket.accept()
+        except OSError:
+            break
+        Thread(target=serve_connection, args=(connection_socket,), daemon=True).start()
+
+
+def _forward(engine: Engine, inspect: bool, local_port: int, remote_port: int, ready, stop):
+    with SocketForwarder(
+        HostAndPort("localhost", local_port),
+        HostAndPort("localhost", remote_port),
+        _Handler() if inspect else None,
+        engine=engine,
+    ):
+        ready.set()
+        stop.wait()
+
+
+@contextmanager
+def forwarding(engine: Engine, inspect: bool, remote_port: int) -> Iterator[tuple[int, dict[str, float]]]:
+    """Forwards in its own process, whose resource usage is known once it is over."""
+
+    context = get_context("spawn")
+    ready, stop = context.Event(), context.Event()
+    local_port = random_port()
+    process = context.Process(target=_forward, args=(engine, inspect, local_port, remote_port, ready, stop))
+
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {}
+    process.start()
+    try:
+        ready.wait()
+        yield local_port, usage
+    finally:
+        stop.set()
+        process.join()
+        usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage["user_time"] = usage_after.ru_utime - usage_before.ru_utime
+        usage["system_time"] = usage_after.ru_stime - usage_before.ru_stime
+        usage["context_switch_count"] = (usage_after.ru_nvcsw - usage_before.ru_nvcsw) + (usage_after.ru_nivcsw - usage_before.ru_nivcsw)
+
+
+def run_clients(port: int, workload: Workload, client_count: int, duration: float) -> tuple[int, int, float]:
+    counts = [0] * client_count
+    barrier = Barrier(client_count + 1)
+
+    def run_client(index: int):
+        with closing(socket.create_connection(("localhost", port))) as client_socket:
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            barrier.wait()
+            end = perf_counter() + duration
+            while perf_counter() < end:
+                match workload:
+                    case Workload.PING_PONG:
+                        client_socket.sendall(struct.pack("!i", MESSAGE_SIZE) + bytes(MESSAGE_SIZE))
+                        client_socket.recv(4 + MESSAGE_SIZE, socket.MSG_WAITALL)
+                        counts[index] += 4 + MESSAGE_SIZE
+                    case Workload.BULK:
+                        client_socket.sendall(struct.pack("!i", -BULK_SIZE))
+                        received = 0
+                        while received < BULK_SIZE:
+                            received += len(client_socket.recv(1024 * 1024))
+                        counts[index] += BULK_SIZE
+
+    threads = [Thread(target=run_client, args=(index,)) for index in range(client_count)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    begin = perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - begin
+
+    byte_count = sum(counts)
+    message_count = byte_count // (4 + MESSAGE_SIZE) if workload == Workload.PING_PONG else byte_count // BULK_SIZE
+    return message_count, byte_count, elapsed
+
+
+@command()
+@option("--engine", "engines", type=Choice([engine.value for engine in Engine]), multiple=True, default=[Engine.SELECTORS.value, Engine.ASYNCIO.value, *([Engine.EPOLL.value] if EPOLL_SUPPORTED else [])], show_default=True)
+@option("--workload", "workloads", type=Choice([workload.value for workload in Workload]), multiple=True, default=[workload.value for workload in Workload], show_default=True)
+@option("--clients", "client_count", type=int, default=CLIENT_COUNT, show_default=True, help="Number of concurrent clients")
+@option("--duration", type=float, default=DURATION_IN_SECONDS, show_default=True, help="Duration in seconds of each run")
+@option("--inspect/--no-inspect", default=True, show_default=True, help="Whether an event handler sees the bytes (which keeps them in user space for every engine)")
+def main(engines: tuple[str, ...], workloads: tuple[str, ...], client_count: int, duration: float, inspect: bool):
+    with closing(socket.create_server(("localhost", 0))) as server_socket:
+        Thread(target=_serve_upstream, args=(server_socket,), daemon=True).start()
+        remote_port = server_socket.getsockname()[1]
+
+        for workload in map(Workload, workloads):
+            for engine in map(Engine, engines):
+                with forwarding(engine, inspect, remote_port) as (local_port, usage):
+                    message_count, byte_count, elapsed = run_clients(local_port, workload, client_count, duration)
+
+                # The system time is where the syscalls of the loop (like `epoll_ctl`) show
+                print(
+                    f"{workload} {engine}: {message_count / elapsed:,.0f} messages/s, "
+                    f"{byte_count / elapsed / 1024 / 1024:,.1f} MiB/s, "
+                    f"{usage['user_time'] / message_count * 1e6:,.1f} µs user "
+                    f"+ {usage['system_time'] / message_count * 1e6:,.1f} µs system per message, "
+                    f"{usage['context_switch_count'] / message_count:,.2f} context switches per message"
+                )
+
+
+if __name__ == "__main__":
+    main()
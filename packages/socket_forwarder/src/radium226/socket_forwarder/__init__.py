@@ -1,11 +1,37 @@
 from .app import app
-from .socket_forwarder import SocketForwarder, EventHandler
+from .socket_forwarder import SocketForwarder, Engine, run_socket_forwarder_worker
+from .event_handler import EventHandler, StreamingEventHandler
 from .host_and_port import HostAndPort
+from .supervisor import Supervisor
+from .dispatcher import DispatchingEventHandler, OverflowPolicy, Executor
+from .health import HealthCheck, HealthChecker, CircuitBreaker, CircuitState
+from .flow_control import Watermarks, MemoryBudget
+from .output_queue import OutputQueue
+from .wakeup import Wakeup
+from .admission import AdmissionControl, AsyncioAdmission, AdmissionTimeoutError
 
 
 __all__ = [
     "app",
     "SocketForwarder",
     "EventHandler",
+    "StreamingEventHandler",
+    "Engine",
     "HostAndPort",
+    "Supervisor",
+    "DispatchingEventHandler",
+    "OverflowPolicy",
+    "Executor",
+    "HealthCheck",
+    "HealthChecker",
+    "CircuitBreaker",
+    "CircuitState",
+    "Watermarks",
+    "MemoryBudget",
+    "OutputQueue",
+    "Wakeup",
+    "AdmissionControl",
+    "AsyncioAdmission",
+    "AdmissionTimeoutError",
+    "run_socket_forwarder_worker",
 ]
\ No newline at end of file
@@ -0,0 +1,233 @@
+import asyncio
+import socket
+from time import monotonic
+from typing import Callable, Hashable
+
+
+ADMISSION_TIMEOUT_IN_SECONDS = 30.0
+
+
+class AdmissionTimeoutError(TimeoutError):
+
+    pass
+
+
+class AdmissionControl():
+    """Caps the sessions open upstream: `limit` of them overall, and `key_limit` for each key (like a user and a
+    database).
+
+    The sessions over the cap wait for their turn in FIFO order, for at most `timeout` seconds. The control does not
+    wait by itself, so that each loop waits its own way: it queues its waiters (a connection, a future) with `admit`,
+    resumes the ones that `release` returns, and gives up on the ones that `expire` returns. It is only updated by its
+    loop, and read as is by the metrics.
+    """
+
+    limit: int | None
+    key_limit: int | None
+    timeout: float
+    # What the clients which waited for too long are sent before being disconnected (like an error of their protocol)
+    rejection: bytes
+    # Told how long (in seconds) each session waited before being admitted
+    on_admitted: Callable[[float], None] | None
+
+    active_count: int
+    _active_counts: dict[Hashable, int]
+    # The waiters, oldest first, with their key and since when they wait
+    _waiters: dict[Hashable, tuple[Hashable, float]]
+    # How many waiters were given up on
+    timeout_count: int
+
+    def __init__(self,
+        limit: int | None = None,
+        key_limit: int | None = None,
+        timeout: float = ADMISSION_TIMEOUT_IN_SECONDS,
+        rejection: bytes = b"",
+        on_admitted: Callable[[float], None] | None = None,
+    ):
+        for name, value in (("limit", limit), ("key_limit", key_limit)):
+            if value is not None and value < 1:
+                raise ValueError(f"The {name} must be at least 1 (or None for no limit), not {value}")
+
+        self.limit = limit
+        self.key_limit = key_limit
+        self.timeout = timeout
+        self.rejection = rejection
+        self.on_admitted = on_admitted
+
+        self.active_count = 0
+        self._active_counts = {}
+        self._waiters = {}
+        self.timeout_count = 0
+
+    @property
+    def waiting_count(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def next_deadline(self) -> float | None:
+        """When the oldest waiter is given up on (on the `monotonic` clock), if there is one."""
+
+        for _, since in self._waiters.values():
+            return since + self.timeout
+        return None
+
+    @property
+    def full(self) -> bool:
+        return self.limit is not None and self.active_count >= self.limit
+
+    def key_full(self, key: Hashable) -> bool:
+        return self.key_limit is not None and self._active_counts.get(key, 0) >= self.key_limit
+
+    def acquire(self, key: Hashable):
+        """Counts a session which is open already (like one handed off by the previous process), even over the cap."""
+
+        self.active_count += 1
+        self._active_counts[key] = self._active_counts.get(key, 0) + 1
+
+    def admit(self, key: Hashable, waiter: Hashable) -> bool:
+        """Admits a session for `key` right away, or queues its `waiter` and tells that it has to wait."""
+
+        if not self.full and not self.key_full(key):
+            self.acquire(key)
+            if on_admitted := self.on_admitted:
+                on_admitted(0.0)
+            return True
+
+        self._waiters[waiter] = (key, monotonic())
+        return False
+
+    def release(self, key: Hashable) -> list:
+        """Ends a session of `key`, and returns the waiters which are admitted in its place."""
+
+        self.active_count -= 1
+        if count := self._active_counts[key] - 1:
+            self._active_counts[key] = count
+        else:
+            del self._active_counts[key]
+
+        admitted = []
+        if not self._waiters:
+            return admitted
+
+        now = monotonic()
+        for waiter, (waiter_key, since) in list(self._waiters.items()):
+            if self.full:
+                break
+            # The waiters of a key at its limit are passed over, but keep their place
+            if self.key_full(waiter_key):
+                continue
+            del self._waiters[waiter]
+            self.acquire(waiter_key)
+            if on_admitted := self.on_admitted:
+                on_admitted(now - since)
+            admitted.append(waiter)
+        return admitted
+
+    def cancel(self, waiter: Hashable) -> bool:
+        """Forgets a waiter (like a client which left), and tells whether it was still waiting."""
+
+        return self._waiters.pop(waiter, None) is not None
+
+    def expire(self, now: float | None = None) -> list:
+        """Gives up on the waiters which waited for longer than the timeout, and returns them."""
+
+        now = monotonic() if now is None else now
+        expired = []
+        # They are queued in the order they started to wait, so the first one still in time ends the expired ones
+        for waiter, (_, since) in self._waiters.items():
+            if since + self.timeout > now:
+                break
+            expired.append(waiter)
+
+        for waiter in expired:
+            del self._waiters[waiter]
+        self.timeout_count += len(expired)
+        return expired
+
+    def clear(self) -> list:
+        """Forgets all the waiters (like when the loop stops), and returns them."""
+
+        waiters = list(self._waiters)
+        self._waiters.clear()
+        return waiters
+
+
+def reject(connection_socket: socket.socket, rejection: bytes):
+    """Sends its rejection to a client which waited for too long, before it is closed."""
+
+    if not rejection:
+        return
+    try:
+        # Closing a socket with unread data resets the connection, and the client could lose the rejection with it
+        while connection_socket.recv(64 * 1024):
+            pass
+    except OSError:
+        pass
+    try:
+        connection_socket.send(rejection)
+    except OSError:
+        pass
+
+
+class AsyncioAdmission():
+    """Waits for an `AdmissionControl` in an asyncio loop, whose timer gives up on the waiters."""
+
+    _admission_control: AdmissionControl
+    # Told when a session has to wait for `key`, so that it can make room for it (like by closing an idle backend)
+    _on_full: Callable[[Hashable], None] | None
+    _timer: asyncio.TimerHandle | None
+
+    def __init__(self, admission_control: AdmissionControl, on_full: Callable[[Hashable], None] | None = None):
+        self._admission_control = admission_control
+        self._on_full = on_full
+        self._timer = None
+
+    @property
+    def admission_control(self) -> AdmissionControl:
+        return self._admission_control
+
+    async def admit(self, key: Hashable):
+        """Waits until a session of `key` is admitted, or raises `AdmissionTimeoutError` once it waited for too long."""
+
+        # The future is hashed by identity, so the waiter is a new one even if the key is not
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, key)
+        if self._admission_control.admit(key, waiter):
+            return
+
+        self._schedule_expiry()
+        if on_full := self._on_full:
+            on_full(key)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The session may have been admitted in the meantime, and its place goes on to the next one then
+            if not self._admission_control.cancel(waiter) and future.done() and not future.cancelled() and future.exception() is None:
+                self.release(key)
+            raise
+
+    def release(self, key: Hashable):
+        for future, waiter_key in self._admission_control.release(key):
+            if future.done():
+                # It was cancelled while it waited, so its place goes on to the next one
+                self.release(waiter_key)
+            else:
+                future.set_result(None)
+
+    def _schedule_expiry(self):
+        if self._timer is not None or (deadline := self._admission_control.next_deadline) is None:
+            return
+        self._timer = asyncio.get_running_loop().call_later(max(deadline - monotonic(), 0), self._expire)
+
+    def _expire(self):
+        self._timer = None
+        timeout = self._admission_control.timeout
+        for future, _ in self._admission_control.expire():
+            if not future.done():
+                future.set_exception(AdmissionTimeoutError(f"No upstream connection was available within {timeout:g} seconds"))
+        self._schedule_expiry()
+
+    def close(self):
+        if timer := self._timer:
+            timer.cancel()
+            self._timer = None
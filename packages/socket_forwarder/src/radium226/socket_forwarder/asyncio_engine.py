@@ -0,0 +1,335 @@
+from abc import ABCMeta, abstractmethod
+import asyncio
+import logging
+import socket
+from typing import Callable
+from weakref import WeakSet
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from .host_and_port import HostAndPort
+from .ring_buffer import RING_BUFFER_CAPACITY
+from .flow_control import Watermarks
+from .event_handler import EventHandler, StreamingEventHandler, handler_for_connection, notify_connection_closed
+from .handoff import HandoffServer, hand_off, HANDOFF_GRACE_PERIOD_IN_SECONDS
+from .admission import AdmissionControl, AsyncioAdmission, AdmissionTimeoutError, reject
+from .health import CONNECT_TIMEOUT_IN_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+
+class ForwardingProtocol(asyncio.BufferedProtocol, metaclass=ABCMeta):
+    """One side of a forwarded connection: whatever it reads is written to its peer's transport."""
+
+    peer: "ForwardingProtocol | None"
+    transport: asyncio.Transport | None
+
+    def __init__(self, event_handler: EventHandler | StreamingEventHandler | None, watermarks: Watermarks | None = None):
+        # A streaming handler sees the chunks as they are read, so the writes need no watching
+        if isinstance(event_handler, StreamingEventHandler):
+            self._event_handler, self._streaming_event_handler = None, event_handler
+        else:
+            self._event_handler, self._streaming_event_handler = event_handler, None
+        # The limits of what is buffered for writing to our transport, above which the peer stops reading
+        self._watermarks = watermarks
+
+        self._buffer = memoryview(bytearray(RING_BUFFER_CAPACITY))
+        self._last_full_buffer = bytearray()
+
+        self.peer = None
+        self.transport = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        if self._event_handler:
+            # The handler must be notified as soon as the write buffer is drained, which `resume_writing` tells us
+            transport.set_write_buffer_limits(high=0)
+        elif watermarks := self._watermarks:
+            transport.set_write_buffer_limits(high=watermarks.high, low=watermarks.low)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._buffer
+
+    @property
+    def handler(self) -> EventHandler | StreamingEventHandler | None:
+        return self._event_handler or self._streaming_event_handler
+
+    def buffer_updated(self, nbytes: int):
+        if self._streaming_event_handler:
+            self._on_chunk_read(self._buffer[:nbytes])
+        self.peer.write(self._buffer[:nbytes])
+        if self.peer.transport.get_write_buffer_size() > 0:
+            # The transport keeps a reference to what it could not send right away, so we must not overwrite it
+            self._buffer = memoryview(bytearray(RING_BUFFER_CAPACITY))
+
+    def write(self, data: memoryview):
+        self.transport.write(data)
+        if self._event_handler:
+            self._last_full_buffer += data
+            if self.transport.get_write_buffer_size() == 0:
+                self._notify()
+
+    def _notify(self):
+        if len(self._last_full_buffer) > 0:
+            self._on_data_written(bytes(self._last_full_buffer))
+        self._last_full_buffer.clear()
+
+    @abstractmethod
+    def _on_data_written(self, buffer: bytes):
+        ...
+
+    @abstractmethod
+    def _on_chunk_read(self, chunk: memoryview):
+        ...
+
+    # Flow control: when our transport's write buffer is above its high watermark, the peer stops reading
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self._notify()
+        self.peer.transport.resume_reading()
+
+    def eof_received(self) -> bool:
+        self.peer.close()
+        return False
+
+    def connection_lost(self, exc: Exception | None):
+        if peer := self.peer:
+            peer.close()
+
+    def close(self):
+        if transport := self.transport:
+            self._notify()
+            # Buffered data is flushed before the transport is actually closed
+            transport.close()
+
+    def abort(self):
+        # Unlike `close`, what is buffered on both sides is dropped
+        for protocol in (self, self.peer):
+            if protocol and (transport := protocol.transport):
+                transport.abort()
+
+
+class UpstreamProtocol(ForwardingProtocol):
+
+    def connection_made(self, transport: asyncio.Transport):
+        super().connection_made(transport)
+        self.peer.transport.resume_reading()
+
+    def _on_data_written(self, buffer: bytes):
+        self._event_handler.on_data_sent(buffer)
+
+    def _on_chunk_read(self, chunk: memoryview):
+        self._streaming_event_handler.on_chunk_received(chunk)
+
+
+class DownstreamProtocol(ForwardingProtocol):
+
+    def __init__(self,
+        event_handler: EventHandler | StreamingEventHandler | None,
+        remote_host_and_ports: list[HostAndPort],
+        on_connection_failed: Callable[[HostAndPort], None] | None = None,
+        upstream_to_downstream_watermarks: Watermarks | None = None,
+        downstream_to_upstream_watermarks: Watermarks | None = None,
+        admission: AsyncioAdmission | None = None,
+        on_connection_succeeded: Callable[[HostAndPort], None] | None = None,
+        connect_timeout: float = CONNECT_TIMEOUT_IN_SECONDS,
+    ):
+        super().__init__(event_handler, upstream_to_downstream_watermarks)
+        self._remote_host_and_ports = remote_host_and_ports
+        self._on_connection_failed = on_connection_failed
+        self._on_connection_succeeded = on_connection_succeeded
+        self._connect_timeout = connect_timeout
+        self._downstream_to_upstream_watermarks = downstream_to_upstream_watermarks
+        self._admission = admission
+        self._admitted = False
+        self._connect_task = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        super().connection_made(transport)
+        # We do not read anything from downstream before being able to forward it
+        transport.pause_reading()
+        self._connect_task = asyncio.get_running_loop().create_task(self._connect_upstream())
+
+    async def _connect_upstream(self):
+        if admission := self._admission:
+            # Over the cap, the client waits for its turn before upstream is connected
+            try:
+                await admission.admit(None)
+            except AdmissionTimeoutError:
+                if rejection := admission.admission_control.rejection:
+                    # The transport does not give its socket away, but a duplicate of it reads and writes the same
+                    with self.transport.get_extra_info("socket").dup() as connection_socket:
+                        reject(connection_socket, rejection)
+                self.close()
+                return
+            self._admitted = True
+
+        # The upstreams are tried in order, until one of them accepts the connection
+        for remote_host_and_port in self._remote_host_and_ports:
+            upstream_protocol = UpstreamProtocol(self.handler, self._downstream_to_upstream_watermarks)
+            upstream_protocol.peer = self
+            self.peer = upstream_protocol
+            try:
+                # An upstream which does not answer in time is given up on, for the next one (`TimeoutError` is an
+                # `OSError` too)
+                await asyncio.wait_for(
+                    asyncio.get_running_loop().create_connection(
+                        lambda: upstream_protocol, 
+                        *remote_host_and_port.as_tuple(),
+                    ),
+                    self._connect_timeout,
+                )
+                if on_connection_succeeded := self._on_connection_succeeded:
+                    on_connection_succeeded(remote_host_and_port)
+                return
+            except OSError:
+                if on_connection_failed := self._on_connection_failed:
+                    on_connection_failed(remote_host_and_port)
+
+        self.peer = None
+        self.close()
+
+    def _on_data_written(self, buffer: bytes):
+        self._event_handler.on_data_received(buffer)
+
+    def _on_chunk_read(self, chunk: memoryview):
+        self._streaming_event_handler.on_chunk_sent(chunk)
+
+    def connection_lost(self, exc: Exception | None):
+        super().connection_lost(exc)
+        if handler := self.handler:
+            notify_connection_closed(handler)
+        if connect_task := self._connect_task:
+            # A client which leaves while it waits for its turn gives its place up, and one which leaves while upstream
+            # is being connected does not leave that connection behind
+            connect_task.cancel()
+        if self._admitted:
+            # Its place goes to the connections waiting for one
+            self._admitted = False
+            self._admission.release(None)
+
+
+class AsyncioEngine():
+
+    # The upstreams to try for a new connection, which change with their health
+    _remote_host_and_ports: Callable[[], list[HostAndPort]]
+    _event_handler: EventHandler | StreamingEventHandler | None
+    _on_connection_failed: Callable[[HostAndPort], None] | None
+    _on_connection_succeeded: Callable[[HostAndPort], None] | None
+    _connect_timeout: float
+    _upstream_to_downstream_watermarks: Watermarks | None
+    _downstream_to_upstream_watermarks: Watermarks | None
+    _admission: AsyncioAdmission | None
+
+    _loop: asyncio.AbstractEventLoop
+    # Forgotten once their connection is over, and cut when it is not over by the end of the grace period
+    _downstream_protocols: WeakSet
+
+    def __init__(self,
+        remote_host_and_ports: Callable[[], list[HostAndPort]],
+        event_handler: EventHandler | StreamingEventHandler | None,
+        use_uvloop: bool = False,
+        on_connection_failed: Callable[[HostAndPort], None] | None = None,
+        upstream_to_downstream_watermarks: Watermarks | None = None,
+        downstream_to_upstream_watermarks: Watermarks | None = None,
+        admission_control: AdmissionControl | None = None,
+        on_connection_succeeded: Callable[[HostAndPort], None] | None = None,
+        connect_timeout: float = CONNECT_TIMEOUT_IN_SECONDS,
+    ):
+        self._remote_host_and_ports = remote_host_and_ports
+        self._event_handler = event_handler
+        self._on_connection_failed = on_connection_failed
+        self._on_connection_succeeded = on_connection_succeeded
+        self._connect_timeout = connect_timeout
+        self._upstream_to_downstream_watermarks = upstream_to_downstream_watermarks
+        self._downstream_to_upstream_watermarks = downstream_to_upstream_watermarks
+        self._admission = AsyncioAdmission(admission_control) if admission_control else None
+
+        if use_uvloop:
+            if uvloop is None:
+                raise ValueError("The uvloop engine requires the uvloop package to be installed")
+            self._loop = uvloop.new_event_loop()
+        else:
+            self._loop = asyncio.new_event_loop()
+
+        self._stopped = self._loop.create_future()
+        self._downstream_protocols = WeakSet()
+
+    def _create_downstream_protocol(self) -> DownstreamProtocol:
+        downstream_protocol = DownstreamProtocol(
+            handler_for_connection(self._event_handler) if self._event_handler else None,
+            self._remote_host_and_ports(),
+            self._on_connection_failed,
+            self._upstream_to_downstream_watermarks,
+            self._downstream_to_upstream_watermarks,
+            self._admission,
+            self._on_connection_succeeded,
+            self._connect_timeout,
+        )
+        self._downstream_protocols.add(downstream_protocol)
+        return downstream_protocol
+
+    def _hand_off(self, downstream_server_socket: socket.socket, handoff_server: HandoffServer):
+        self._loop.remove_reader(handoff_server.fileno())
+        try:
+            handoff_socket, _ = handoff_server.accept()
+            # Only the listening socket is handed off, as the transports do not give their buffers away
+            hand_off(handoff_socket, downstream_server_socket, [])
+        except Exception:
+            logger.exception("The handoff failed")
+            if not handoff_server.accepted:
+                self._loop.add_reader(handoff_server.fileno(), self._hand_off, downstream_server_socket, handoff_server)
+            return
+
+        # The next process took over, and this one only serves its live connections until they are over
+        if not self._stopped.done():
+            self._stopped.set_result(HANDOFF_GRACE_PERIOD_IN_SECONDS)
+
+    async def _serve(self, downstream_server_socket: socket.socket, handoff_server: HandoffServer | None):
+        server = await self._loop.create_server(self._create_downstream_protocol, sock=downstream_server_socket)
+        if handoff_server:
+            self._loop.add_reader(handoff_server.fileno(), self._hand_off, downstream_server_socket, handoff_server)
+        try:
+            grace_period = await self._stopped
+        finally:
+            if handoff_server and not handoff_server.accepted:
+                self._loop.remove_reader(handoff_server.fileno())
+            server.close()
+        if grace_period is not None:
+            # The server waits for the connections it accepted to be over before it is closed
+            try:
+                await asyncio.wait_for(server.wait_closed(), grace_period)
+            except TimeoutError:
+                pass
+
+        # What is left once stopped (or once the grace period is over) is cut, and no waiter takes its place
+        if admission := self._admission:
+            admission.admission_control.clear()
+            admission.close()
+        for downstream_protocol in list(self._downstream_protocols):
+            downstream_protocol.abort()
+        # The transports are only closed by the next iteration of the loop
+        await asyncio.sleep(0)
+
+    def run(self, downstream_server_socket: socket.socket, handoff_server: HandoffServer | None = None):
+        try:
+            self._loop.run_until_complete(self._serve(downstream_server_socket, handoff_server))
+        finally:
+            self._loop.close()
+
+    def stop(self, grace_period: float | None = None):
+        def set_stopped():
+            if not self._stopped.done():
+                self._stopped.set_result(grace_period)
+
+        try:
+            self._loop.call_soon_threadsafe(set_stopped)
+        except RuntimeError:
+            # The loop is already closed
+            pass
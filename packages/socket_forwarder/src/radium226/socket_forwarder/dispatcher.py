@@ -0,0 +1,292 @@
+from collections import deque
+from enum import StrEnum, auto
+from itertools import count
+from multiprocessing import get_context
+from queue import Queue, Full
+from threading import Thread, Lock
+import traceback
+
+from .socket_forwarder import EventHandler
+from .event_handler import StreamingEventHandler, handler_for_connection, notify_connection_closed
+
+
+DISPATCH_QUEUE_SIZE = 1024
+
+SAMPLE_EVERY = 10
+
+
+class OverflowPolicy(StrEnum):
+
+    # The forwarding loop waits for the handler to catch up
+    BLOCK = auto()
+    # The event is dropped and counted, and so is the rest of its connection as the handler lost the stream
+    DROP = auto()
+    # Only one connection out of `sample_every` is dispatched, and the sampled ones are dropped on overflow
+    SAMPLE = auto()
+
+
+class Executor(StrEnum):
+
+    THREAD = auto()
+    # The handler runs on a copy of itself in each worker process, so whatever it records (like metrics) stays there
+    PROCESS = auto()
+
+
+class EventKind(StrEnum):
+
+    SENT = auto()
+    RECEIVED = auto()
+    CLOSED = auto()
+
+
+def _run_dispatch_worker(event_handler: EventHandler | StreamingEventHandler, event_queue):
+    connection_event_handlers: dict[int, EventHandler | StreamingEventHandler] = {}
+    # A streaming handler is given the chunks as they were read, which were copied to be dispatched
+    streaming = isinstance(event_handler, StreamingEventHandler)
+    while (event := event_queue.get()) is not None:
+        connection_id, kind, buffer = event
+        try:
+            match kind:
+                case EventKind.SENT:
+                    if not (connection_event_handler := connection_event_handlers.get(connection_id)):
+                        connection_event_handler = connection_event_handlers[connection_id] = handler_for_connection(event_handler)
+                    if streaming:
+                        connection_event_handler.on_chunk_sent(memoryview(buffer))
+                    else:
+                        connection_event_handler.on_data_sent(buffer)
+
+                case EventKind.RECEIVED:
+                    if not (connection_event_handler := connection_event_handlers.get(connection_id)):
+                        connection_event_handler = connection_event_handlers[connection_id] = handler_for_connection(event_handler)
+                    if streaming:
+                        connection_event_handler.on_chunk_received(memoryview(buffer))
+                    else:
+                        connection_event_handler.on_data_received(buffer)
+
+                case EventKind.CLOSED:
+                    if connection_event_handler := connection_event_handlers.pop(connection_id, None):
+                        notify_connection_closed(connection_event_handler)
+        except Exception:
+            # A failing handler must not stop the inspection of the other connections
+            traceback.print_exc()
+
+
+class DispatchingEventHandler(EventHandler):
+    """Moves the calls to an event handler off the forwarding loop, onto worker threads or processes.
+
+    Each connection is pinned to one worker, so its handler still sees its events in order. Each worker has a bounded
+    queue, and the `OverflowPolicy` decides what happens when it is full.
+
+    A `StreamingEventHandler` is wrapped as such: the connections then get streaming handlers, which copy each chunk to
+    dispatch it.
+
+    With the `PROCESS` executor, the handler is pickled to the workers: its own state (like the metrics it updates) is
+    not the one of the forwarding process, so it must export what it records by itself.
+    """
+
+    _event_handler: EventHandler | StreamingEventHandler
+    _worker_count: int
+    _queue_size: int
+    _overflow_policy: OverflowPolicy
+    _sample_every: int
+    _executor: Executor
+
+    _event_queues: list | None
+    # For each worker, the connections whose end did not fit in its queue, and which are told about later
+    _pending_closes: list[deque[int]]
+    _workers: list
+
+    dispatched_count: int
+    dropped_count: int
+
+    def __init__(self,
+        event_handler: EventHandler | StreamingEventHandler,
+        worker_count: int = 1,
+        queue_size: int = DISPATCH_QUEUE_SIZE,
+        overflow_policy: OverflowPolicy = OverflowPolicy.DROP,
+        sample_every: int = SAMPLE_EVERY,
+        executor: Executor = Executor.THREAD,
+    ):
+        self._event_handler = event_handler
+        self._worker_count = worker_count
+        self._queue_size = queue_size
+        self._overflow_policy = overflow_policy
+        self._sample_every = sample_every
+        self._executor = executor
+
+        self._init_runtime()
+
+        self.dispatched_count = 0
+        self.dropped_count = 0
+
+    def _init_runtime(self):
+        self._event_queues = None
+        self._pending_closes = []
+        self._workers = []
+        self._connection_ids = count()
+        self._start_lock = Lock()
+
+    # Only the configuration is pickled, so that each worker process of a `Supervisor` starts its own dispatchers
+    def __getstate__(self):
+        return {
+            "_event_handler": self._event_handler,
+            "_worker_count": self._worker_count,
+            "_queue_size": self._queue_size,
+            "_overflow_policy": self._overflow_policy,
+            "_sample_every": self._sample_every,
+            "_executor": self._executor,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+        self.dispatched_count = 0
+        self.dropped_count = 0
+
+    def _start(self):
+        with self._start_lock:
+            if self._event_queues is not None:
+                return
+
+            match self._executor:
+                case Executor.THREAD:
+                    event_queues = [Queue(self._queue_size) for _ in range(self._worker_count)]
+                    self._workers = [
+                        Thread(target=_run_dispatch_worker, args=(self._event_handler, event_queue), daemon=True)
+                        for event_queue in event_queues
+                    ]
+                case Executor.PROCESS:
+                    context = get_context("spawn")
+                    event_queues = [context.Queue(self._queue_size) for _ in range(self._worker_count)]
+                    self._workers = [
+                        context.Process(target=_run_dispatch_worker, args=(self._event_handler, event_queue), daemon=True)
+                        for event_queue in event_queues
+                    ]
+
+            for worker in self._workers:
+                worker.start()
+            self._pending_closes = [deque() for _ in event_queues]
+            self._event_queues = event_queues
+
+    @property
+    def streaming(self) -> bool:
+        return isinstance(self._event_handler, StreamingEventHandler)
+
+    def for_connection(self) -> EventHandler | StreamingEventHandler:
+        self._start()
+        connection_id = next(self._connection_ids)
+        if self._overflow_policy == OverflowPolicy.SAMPLE and connection_id % self._sample_every != 0:
+            return _IgnoringEventHandler()
+        if self.streaming:
+            return _StreamingConnectionDispatcher(self, connection_id % self._worker_count, connection_id)
+        return _ConnectionDispatcher(self, connection_id % self._worker_count, connection_id)
+
+    def _put(self, worker_index: int, event: tuple) -> bool:
+        event_queue = self._event_queues[worker_index]
+        if self._overflow_policy == OverflowPolicy.BLOCK:
+            event_queue.put(event)
+            return True
+
+        try:
+            # The ends which are still pending go first, as soon as there is room for them
+            pending_closes = self._pending_closes[worker_index]
+            while pending_closes:
+                event_queue.put_nowait((pending_closes[0], EventKind.CLOSED, None))
+                pending_closes.popleft()
+            event_queue.put_nowait(event)
+        except Full:
+            return False
+        return True
+
+    def _dispatch(self, worker_index: int, event: tuple) -> bool:
+        if not self._put(worker_index, event):
+            self.dropped_count += 1
+            return False
+
+        self.dispatched_count += 1
+        return True
+
+    def _dispatch_close(self, worker_index: int, connection_id: int):
+        # The end of a connection is never dropped (the worker would keep its handler forever), but it does not make
+        # the forwarding loop wait either: it is queued on the side until there is room for it
+        if not self._put(worker_index, (connection_id, EventKind.CLOSED, None)):
+            self._pending_closes[worker_index].append(connection_id)
+
+    def on_data_sent(self, buffer: bytes):
+        raise TypeError("The events are dispatched by the handlers returned by for_connection()")
+
+    def on_data_received(self, buffer: bytes):
+        raise TypeError("The events are dispatched by the handlers returned by for_connection()")
+
+    def close(self):
+        if self._event_queues is None:
+            return
+
+        for event_queue, pending_closes in zip(self._event_queues, self._pending_closes):
+            while pending_closes:
+                event_queue.put((pending_closes.popleft(), EventKind.CLOSED, None))
+            event_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._init_runtime()
+
+    def __enter__(self):
+        self._start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+
+class _IgnoringEventHandler(EventHandler):
+
+    def on_data_sent(self, buffer: bytes):
+        pass
+
+    def on_data_received(self, buffer: bytes):
+        pass
+
+    # It is a streaming handler too, so that the forwarding loops do not even track the writes for it
+    def on_chunk_sent(self, chunk: memoryview):
+        pass
+
+    def on_chunk_received(self, chunk: memoryview):
+        pass
+
+
+class _ConnectionDispatcher(EventHandler):
+
+    def __init__(self, dispatcher: DispatchingEventHandler, worker_index: int, connection_id: int):
+        self._dispatcher = dispatcher
+        self._worker_index = worker_index
+        self._connection_id = connection_id
+        self._desynchronized = False
+
+    def _dispatch(self, kind: EventKind, buffer: bytes | None):
+        if self._desynchronized:
+            self._dispatcher.dropped_count += 1
+            return
+
+        if not self._dispatcher._dispatch(self._worker_index, (self._connection_id, kind, buffer)):
+            self._desynchronized = True
+
+    def on_data_sent(self, buffer: bytes):
+        self._dispatch(EventKind.SENT, buffer)
+
+    def on_data_received(self, buffer: bytes):
+        self._dispatch(EventKind.RECEIVED, buffer)
+
+    def on_connection_closed(self):
+        self._dispatcher._dispatch_close(self._worker_index, self._connection_id)
+
+
+class _StreamingConnectionDispatcher(_ConnectionDispatcher):
+
+    # The chunks are only valid during the call, so they are copied before being queued
+    def on_chunk_sent(self, chunk: memoryview):
+        self._dispatch(EventKind.SENT, bytes(chunk))
+
+    def on_chunk_received(self, chunk: memoryview):
+        self._dispatch(EventKind.RECEIVED, bytes(chunk))
@@ -0,0 +1,584 @@
+import errno
+import logging
+import select
+import socket
+from collections import deque
+from queue import Queue, Empty
+from time import monotonic
+from typing import Callable
+from weakref import finalize
+
+from .host_and_port import HostAndPort
+from .ring_buffer import RingBuffer, RING_BUFFER_CAPACITY
+from .flow_control import Watermarks, MemoryBudget
+from .event_handler import EventHandler, StreamingEventHandler, handler_for_connection, notify_connection_closed
+from .wakeup import Wakeup
+from .admission import AdmissionControl, reject
+from .handoff import HandoffServer, HandedOffConnection, hand_off, HANDOFF_GRACE_PERIOD_IN_SECONDS
+from .health import CONNECT_TIMEOUT_IN_SECONDS
+
+
+EPOLL_SUPPORTED = hasattr(select, "epoll")
+
+# Each socket is registered once for everything, and is only told about again when it becomes readable or writable
+# again (so it must be read and written until EAGAIN every time)
+EPOLL_EVENTS = (select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP | select.EPOLLET) if EPOLL_SUPPORTED else 0
+
+# How many times the data of a connection is moved back and forth before the other connections get their turn
+MAX_ROUND_COUNT = 16
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Endpoint():
+    """One socket of a forwarded connection, with what epoll told about it since it was last read or written."""
+
+    connection: "_Connection"
+    connection_socket: socket.socket | None
+
+    readable: bool
+    writable: bool
+    # Whether it was read until its end, and whether it is not read anymore until its peer caught up
+    eof: bool
+    paused: bool
+
+    # What is waiting to be written to the socket, and what was written since the buffer was last drained (for the
+    # handlers which see whole buffers)
+    buffer: RingBuffer
+    watermarks: Watermarks
+    written: bytearray
+
+    def __init__(self, connection: "_Connection", watermarks: Watermarks | None):
+        self.connection = connection
+        self.connection_socket = None
+        self.readable = False
+        self.writable = False
+        self.eof = False
+        self.paused = False
+
+        self.buffer = RingBuffer(watermarks.high) if watermarks else RingBuffer()
+        self.watermarks = watermarks or Watermarks.for_capacity(RING_BUFFER_CAPACITY)
+        self.written = bytearray()
+
+
+class _Connection():
+
+    downstream: _Endpoint
+    upstream: _Endpoint
+
+    # The upstream being connected to, and the ones to try next if it fails
+    remote_host_and_port: HostAndPort | None
+    remaining_host_and_ports: list[HostAndPort]
+    upstream_connected: bool
+    # When the upstream being connected to is given up on, for the next one
+    connect_deadline: float | None
+    # Whether it holds a place of the admission control, rather than waiting for one
+    admitted: bool
+    closed: bool
+
+    event_handler: EventHandler | None
+    streaming_event_handler: StreamingEventHandler | None
+
+    def __init__(self,
+        downstream_connection_socket: socket.socket,
+        remaining_host_and_ports: list[HostAndPort],
+        event_handler: EventHandler | StreamingEventHandler | None,
+        upstream_to_downstream_watermarks: Watermarks | None,
+        downstream_to_upstream_watermarks: Watermarks | None,
+    ):
+        self.downstream = _Endpoint(self, upstream_to_downstream_watermarks)
+        self.downstream.connection_socket = downstream_connection_socket
+        self.upstream = _Endpoint(self, downstream_to_upstream_watermarks)
+
+        self.remote_host_and_port = None
+        self.remaining_host_and_ports = remaining_host_and_ports
+        self.upstream_connected = False
+        self.connect_deadline = None
+        self.admitted = False
+        self.closed = False
+
+        # A streaming handler sees the chunks as they are read, and is never told about the writes
+        if isinstance(event_handler, StreamingEventHandler):
+            self.event_handler, self.streaming_event_handler = None, event_handler
+        else:
+            self.event_handler, self.streaming_event_handler = event_handler, None
+
+
+class EpollEngine():
+    """Forwards the connections with an edge-triggered epoll loop (Linux only).
+
+    Unlike the selectors loop, which modifies the registration of a socket each time it goes from being read to being
+    written, each socket is registered once and its readiness is tracked on its endpoint: a chunk then costs its
+    `recv` and its `send`, and no `epoll_ctl`.
+    """
+
+    _remote_host_and_ports: Callable[[], list[HostAndPort]]
+    _event_handler: EventHandler | StreamingEventHandler | None
+    _on_connection_failed: Callable[[HostAndPort], None] | None
+    _on_connection_succeeded: Callable[[HostAndPort], None] | None
+    _connect_timeout: float
+    _upstream_to_downstream_watermarks: Watermarks | None
+    _downstream_to_upstream_watermarks: Watermarks | None
+    _memory_budget: MemoryBudget
+    _admission_control: AdmissionControl | None
+
+    _epoll: "select.epoll"
+    # Woken up by `stop`, as the loop is waiting in `epoll.poll`, with the grace periods to stop with (None to stop
+    # right away)
+    _wakeup: Wakeup
+    _stop_requests: Queue
+    _endpoints: dict[int, _Endpoint]
+    # The connections which still had data to move when their turn was over
+    _ready_connections: deque[_Connection]
+    # The connections to the upstreams, in the order they time out (those which are over since are skipped)
+    _connecting: deque[tuple[float, _Connection]]
+
+    def __init__(self,
+        remote_host_and_ports: Callable[[], list[HostAndPort]],
+        event_handler: EventHandler | StreamingEventHandler | None,
+        on_connection_failed: Callable[[HostAndPort], None] | None = None,
+        on_connection_succeeded: Callable[[HostAndPort], None] | None = None,
+        connect_timeout: float = CONNECT_TIMEOUT_IN_SECONDS,
+        upstream_to_downstream_watermarks: Watermarks | None = None,
+        downstream_to_upstream_watermarks: Watermarks | None = None,
+        memory_budget: MemoryBudget | None = None,
+        admission_control: AdmissionControl | None = None,
+    ):
+        if not EPOLL_SUPPORTED:
+            raise ValueError("The epoll engine is only available on Linux")
+
+        self._remote_host_and_ports = remote_host_and_ports
+        self._event_handler = event_handler
+        self._on_connection_failed = on_connection_failed
+        self._on_connection_succeeded = on_connection_succeeded
+        self._connect_timeout = connect_timeout
+        self._upstream_to_downstream_watermarks = upstream_to_downstream_watermarks
+        self._downstream_to_upstream_watermarks = downstream_to_upstream_watermarks
+        self._memory_budget = memory_budget or MemoryBudget()
+        self._admission_control = admission_control
+
+        self._epoll = select.epoll()
+        self._wakeup = Wakeup()
+        # Only closed with the engine, so that a late `stop` never writes to a file descriptor reused since
+        finalize(self, self._wakeup.close)
+        self._epoll.register(self._wakeup.fileno(), select.EPOLLIN)
+        self._stop_requests = Queue()
+        self._endpoints = {}
+        self._ready_connections = deque()
+        self._connecting = deque()
+
+    def _register(self, endpoint: _Endpoint):
+        self._endpoints[endpoint.connection_socket.fileno()] = endpoint
+        self._epoll.register(endpoint.connection_socket, EPOLL_EVENTS)
+
+    def _forget(self, endpoint: _Endpoint) -> socket.socket | None:
+        # The socket is not watched anymore, but is left open
+        connection_socket = endpoint.connection_socket
+        endpoint.connection_socket = None
+        if connection_socket is not None:
+            del self._endpoints[connection_socket.fileno()]
+            self._epoll.unregister(connection_socket)
+        return connection_socket
+
+    def _unregister(self, endpoint: _Endpoint):
+        if (connection_socket := self._forget(endpoint)) is None:
+            return
+
+        try:
+            connection_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection_socket.close()
+
+    def _accept_connections(self, downstream_server_socket: socket.socket):
+        while True:
+            try:
+                downstream_connection_socket, _ = downstream_server_socket.accept()
+            except BlockingIOError:
+                return
+
+            downstream_connection_socket.setblocking(False)
+            connection = _Connection(
+                downstream_connection_socket,
+                self._remote_host_and_ports(),
+                handler_for_connection(self._event_handler) if self._event_handler else None,
+                self._upstream_to_downstream_watermarks,
+                self._downstream_to_upstream_watermarks,
+            )
+            # Downstream is not read before upstream is connected, but its readiness is already tracked
+            self._register(connection.downstream)
+            # Over the cap, the client waits for its turn before upstream is connected
+            if (admission_control := self._admission_control) is None or admission_control.admit(None, connection):
+                connection.admitted = True
+                self._connect_upstream(connection)
+
+    def _adopt_connection(self, handed_off_connection: HandedOffConnection):
+        # It is forwarded without being inspected, as a new handler would not know where its messages start
+        connection = _Connection(
+            handed_off_connection.downstream_connection_socket,
+            [],
+            None,
+            self._upstream_to_downstream_watermarks,
+            self._downstream_to_upstream_watermarks,
+        )
+        connection.remote_host_and_port = handed_off_connection.remote_host_and_port
+        connection.upstream.connection_socket = handed_off_connection.upstream_connection_socket
+        connection.upstream_connected = True
+        connection.admitted = True
+        if admission_control := self._admission_control:
+            # It is already connected, so it is counted even over the cap
+            admission_control.acquire(None)
+
+        # The ring buffers take whatever the previous process had buffered, whatever its size
+        connection.downstream.buffer.extend(handed_off_connection.upstream_to_downstream_bytes)
+        connection.upstream.buffer.extend(handed_off_connection.downstream_to_upstream_bytes)
+        self._memory_budget.acquire(len(connection.downstream.buffer) + len(connection.upstream.buffer))
+
+        # Being registered, both sockets are told about right away if they are already readable or writable
+        for endpoint in (connection.downstream, connection.upstream):
+            endpoint.connection_socket.setblocking(False)
+            self._register(endpoint)
+
+    def _hand_off(self, downstream_server_socket: socket.socket, handoff_server: HandoffServer) -> bool:
+        # Tells whether the next process took over, after which this one only serves what it did not hand off
+        self._epoll.unregister(handoff_server.fileno())
+        try:
+            handoff_socket, with_connections = handoff_server.accept()
+        except Exception:
+            logger.exception("The next process could not be accepted")
+            self._epoll.register(handoff_server.fileno(), select.EPOLLIN)
+            return False
+
+        # The connections still connecting to their upstream, or half-closed, are not worth handing off
+        connections = [
+            connection
+            for connection in ({endpoint.connection for endpoint in self._endpoints.values()} if with_connections else [])
+            if connection.upstream_connected and not connection.downstream.eof and not connection.upstream.eof
+        ]
+        handed_off_connections = [
+            HandedOffConnection(
+                downstream_connection_socket=connection.downstream.connection_socket,
+                upstream_connection_socket=connection.upstream.connection_socket,
+                remote_host_and_port=connection.remote_host_and_port,
+                upstream_to_downstream_bytes=connection.downstream.buffer.take(),
+                downstream_to_upstream_bytes=connection.upstream.buffer.take(),
+            )
+            for connection in connections
+        ]
+
+        try:
+            hand_off(handoff_socket, downstream_server_socket, handed_off_connections)
+        except Exception:
+            # The next process did not take over, so this one keeps forwarding everything (though it cannot be handed
+            # off anymore, as the next process was given its handoff path)
+            logger.exception("The handoff failed")
+            for connection, handed_off_connection in zip(connections, handed_off_connections):
+                connection.downstream.buffer.extend(handed_off_connection.upstream_to_downstream_bytes)
+                connection.upstream.buffer.extend(handed_off_connection.downstream_to_upstream_bytes)
+            return False
+
+        for connection, handed_off_connection in zip(connections, handed_off_connections):
+            connection.closed = True
+            self._memory_budget.release(len(handed_off_connection.upstream_to_downstream_bytes) + len(handed_off_connection.downstream_to_upstream_bytes))
+            # The next process has its own duplicates of them, which must not be shut down
+            self._forget(connection.downstream).close()
+            self._forget(connection.upstream).close()
+            if event_handler := connection.event_handler or connection.streaming_event_handler:
+                notify_connection_closed(event_handler)
+            self._release_admission(connection)
+        return True
+
+    def _connect_upstream(self, connection: _Connection):
+        upstream = connection.upstream
+        while connection.remaining_host_and_ports:
+            remote_host_and_port = connection.remaining_host_and_ports.pop(0)
+            upstream_connection_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            upstream_connection_socket.setblocking(False)
+            if upstream_connection_socket.connect_ex(remote_host_and_port.as_tuple()) in (0, errno.EINPROGRESS):
+                connection.remote_host_and_port = remote_host_and_port
+                upstream.connection_socket = upstream_connection_socket
+                upstream.readable = upstream.writable = False
+                # The socket is writable once connected, or once the connection failed
+                self._register(upstream)
+                connection.connect_deadline = monotonic() + self._connect_timeout
+                self._connecting.append((connection.connect_deadline, connection))
+                return
+
+            upstream_connection_socket.close()
+            if on_connection_failed := self._on_connection_failed:
+                on_connection_failed(remote_host_and_port)
+
+        # No upstream is left, and the client knows it right away rather than after a timeout
+        self._close(connection)
+
+    def _fail_over(self, connection: _Connection):
+        # The upstream being connected to is given up on, and the next one is tried
+        connection.connect_deadline = None
+        self._unregister(connection.upstream)
+        if on_connection_failed := self._on_connection_failed:
+            on_connection_failed(connection.remote_host_and_port)
+        self._connect_upstream(connection)
+
+    def _expire_connects(self):
+        now = monotonic()
+        while self._connecting and self._connecting[0][0] <= now:
+            deadline, connection = self._connecting.popleft()
+            if connection.connect_deadline == deadline and not connection.closed:
+                self._fail_over(connection)
+
+    def _on_upstream_connected(self, connection: _Connection):
+        upstream = connection.upstream
+        if error := upstream.connection_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self._fail_over(connection)
+            return
+
+        connection.connect_deadline = None
+        connection.upstream_connected = True
+        if on_connection_succeeded := self._on_connection_succeeded:
+            on_connection_succeeded(connection.remote_host_and_port)
+        self._forward(connection)
+
+    def _room(self, endpoint: _Endpoint) -> int:
+        # What can still be read for the endpoint: up to its high watermark, or up to its low one under memory pressure
+        # (so that an empty connection can still make progress)
+        buffer, watermarks = endpoint.buffer, endpoint.watermarks
+        room = min(watermarks.high, buffer.capacity) - len(buffer)
+        if self._memory_budget.exhausted:
+            room = min(room, watermarks.low - len(buffer))
+        return room
+
+    def _read(self, source: _Endpoint, target: _Endpoint) -> bool:
+        connection = source.connection
+        buffer = target.buffer
+        if source.paused and len(buffer) <= target.watermarks.low and self._room(target) > 0:
+            source.paused = False
+
+        moved = False
+        while source.readable and not source.eof and not source.paused:
+            if (room := self._room(target)) <= 0:
+                if len(buffer) < target.watermarks.high:
+                    # It is the memory budget which stops the connection, before its high watermark
+                    self._memory_budget.pause_count += 1
+                source.paused = True
+                break
+
+            try:
+                chunk = buffer.recv_from(source.connection_socket, room)
+            except BlockingIOError:
+                source.readable = False
+                break
+            except ConnectionError:
+                source.eof = True
+                break
+
+            if not chunk:
+                source.eof = True
+                break
+
+            moved = True
+            self._memory_budget.acquire(len(chunk))
+            if streaming_event_handler := connection.streaming_event_handler:
+                if source is connection.downstream:
+                    streaming_event_handler.on_chunk_sent(chunk)
+                else:
+                    streaming_event_handler.on_chunk_received(chunk)
+        return moved
+
+    def _write(self, target: _Endpoint) -> bool:
+        connection = target.connection
+        buffer = target.buffer
+        moved = False
+        while target.writable and len(buffer) > 0:
+            length = len(buffer)
+            try:
+                if connection.event_handler:
+                    target.written += buffer.send_to(target.connection_socket)
+                else:
+                    buffer.gather_to(target.connection_socket)
+            except OSError:
+                # The socket is gone, and so is the connection
+                self._close(connection)
+                return False
+
+            if len(buffer) == length:
+                target.writable = False
+                break
+            moved = True
+            self._memory_budget.release(length - len(buffer))
+
+        if len(buffer) == 0 and target.written:
+            if target is connection.upstream:
+                connection.event_handler.on_data_sent(bytes(target.written))
+            else:
+                connection.event_handler.on_data_received(bytes(target.written))
+            target.written.clear()
+        return moved
+
+    def _forward(self, connection: _Connection):
+        if not connection.upstream_connected or connection.closed:
+            return
+
+        downstream, upstream = connection.downstream, connection.upstream
+        for _ in range(MAX_ROUND_COUNT):
+            moved = self._read(downstream, upstream) | self._write(upstream)
+            if connection.closed:
+                return
+            moved |= self._read(upstream, downstream) | self._write(downstream)
+            if connection.closed:
+                return
+
+            # One side is gone, and everything it sent has been forwarded
+            if (downstream.eof and len(upstream.buffer) == 0) or (upstream.eof and len(downstream.buffer) == 0):
+                self._close(connection)
+                return
+
+            if not moved:
+                return
+
+        # The connection could go on, but the others get their turn first
+        self._ready_connections.append(connection)
+
+    def _close(self, connection: _Connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        # What was not forwarded is dropped, and gives its memory back
+        self._memory_budget.release(len(connection.downstream.buffer) + len(connection.upstream.buffer))
+
+        self._unregister(connection.upstream)
+        self._unregister(connection.downstream)
+        if event_handler := connection.event_handler or connection.streaming_event_handler:
+            notify_connection_closed(event_handler)
+        self._release_admission(connection)
+
+    def _release_admission(self, connection: _Connection):
+        if (admission_control := self._admission_control) is None:
+            return
+        if not connection.admitted:
+            admission_control.cancel(connection)
+            return
+        connection.admitted = False
+        # Its place goes to the connections waiting for one
+        for admitted_connection in admission_control.release(None):
+            admitted_connection.admitted = True
+            self._connect_upstream(admitted_connection)
+
+    def _expire_admissions(self):
+        admission_control = self._admission_control
+        # The clients which waited for too long are turned away
+        for connection in admission_control.expire():
+            reject(connection.downstream.connection_socket, admission_control.rejection)
+            self._close(connection)
+
+    def _on_event(self, endpoint: _Endpoint, events: int):
+        connection = endpoint.connection
+        if events & (select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLHUP | select.EPOLLERR):
+            endpoint.readable = True
+        if events & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+            endpoint.writable = True
+
+        if not connection.admitted:
+            # A client which leaves while it waits for its turn gives its place up
+            if events & (select.EPOLLRDHUP | select.EPOLLHUP | select.EPOLLERR):
+                self._close(connection)
+            return
+
+        if endpoint is connection.upstream and not connection.upstream_connected:
+            if endpoint.writable:
+                self._on_upstream_connected(connection)
+            return
+
+        self._forward(connection)
+
+    def run(self,
+        downstream_server_socket: socket.socket,
+        handed_off_connections: list[HandedOffConnection] | None = None,
+        handoff_server: HandoffServer | None = None,
+    ):
+        downstream_server_socket.setblocking(False)
+        server_fd = downstream_server_socket.fileno()
+        wakeup_fd = self._wakeup.fileno()
+        handoff_fd = handoff_server.fileno() if handoff_server else None
+        self._epoll.register(server_fd, select.EPOLLIN | select.EPOLLET)
+        if handoff_server:
+            self._epoll.register(handoff_fd, select.EPOLLIN)
+        for handed_off_connection in handed_off_connections or []:
+            self._adopt_connection(handed_off_connection)
+
+        def stop_accepting():
+            self._epoll.unregister(server_fd)
+            # The connections still waiting in the backlog are refused, rather than left hanging
+            downstream_server_socket.close()
+            # Nothing is left to hand off either (unless it was just handed off)
+            if handoff_server and not handoff_server.accepted:
+                self._epoll.unregister(handoff_fd)
+
+        admission_control = self._admission_control
+        # Set once draining, after which the loop breaks as soon as no connection is left
+        drain_deadline: float | None = None
+        try:
+            while drain_deadline is None or (self._endpoints and monotonic() < drain_deadline):
+                deadline = min(
+                    [
+                        deadline
+                        for deadline in (
+                            drain_deadline,
+                            admission_control.next_deadline if admission_control is not None else None,
+                            self._connecting[0][0] if self._connecting else None,
+                        )
+                        if deadline is not None
+                    ],
+                    default=None,
+                )
+                if self._ready_connections:
+                    timeout = 0
+                else:
+                    timeout = -1 if deadline is None else max(deadline - monotonic(), 0)
+                events = self._epoll.poll(timeout)
+                if admission_control is not None:
+                    self._expire_admissions()
+
+                for fd, mask in events:
+                    if fd == wakeup_fd:
+                        # The stop requests are only looked at when `stop` woke the loop up
+                        self._wakeup.clear()
+                        while True:
+                            try:
+                                grace_period = self._stop_requests.get_nowait()
+                            except Empty:
+                                break
+                            if grace_period is None:
+                                return
+                            if drain_deadline is None:
+                                stop_accepting()
+                                drain_deadline = monotonic() + grace_period
+                    elif fd == server_fd:
+                        if drain_deadline is None:
+                            self._accept_connections(downstream_server_socket)
+                    elif fd == handoff_fd:
+                        if drain_deadline is None and self._hand_off(downstream_server_socket, handoff_server):
+                            stop_accepting()
+                            drain_deadline = monotonic() + HANDOFF_GRACE_PERIOD_IN_SECONDS
+                    # An earlier event of the batch may have closed the connection of this one
+                    elif endpoint := self._endpoints.get(fd):
+                        self._on_event(endpoint, mask)
+
+                for _ in range(len(self._ready_connections)):
+                    self._forward(self._ready_connections.popleft())
+                # The upstreams which did not answer in time are failed over (once the events of the batch are handled,
+                # as one of them may be the connection they were waiting for)
+                self._expire_connects()
+        finally:
+            if drain_deadline is None:
+                stop_accepting()
+            # What is left once stopped (or once the grace period is over) is cut, and no waiter takes its place
+            if admission_control is not None:
+                admission_control.clear()
+            for endpoint in list(self._endpoints.values()):
+                self._close(endpoint.connection)
+            self._epoll.close()
+
+    def stop(self, grace_period: float | None = None):
+        self._stop_requests.put(grace_period)
+        self._wakeup.wake()
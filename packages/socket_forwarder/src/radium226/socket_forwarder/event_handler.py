@@ -0,0 +1,59 @@
+from typing import Protocol, runtime_checkable
+
+
+class EventHandler(Protocol):
+
+    def for_connection(self) -> "EventHandler":
+        # Handlers keeping per-connection state (like a message framer) return a new instance here
+        return self
+
+    def on_data_sent(self, buffer: bytes):
+        ...
+
+    def on_data_received(self, buffer: bytes):
+        ...
+
+    def on_connection_closed(self):
+        pass
+
+
+@runtime_checkable
+class StreamingEventHandler(Protocol):
+    """Sees the bytes while they flow, rather than once a whole buffer is forwarded.
+
+    Each chunk is a memoryview of the forwarding buffer as it was just read: nothing is copied, but the chunk is only
+    valid during the call (so a handler keeping it must copy it).
+    """
+
+    def for_connection(self) -> "StreamingEventHandler":
+        return self
+
+    def on_chunk_sent(self, chunk: memoryview):
+        ...
+
+    def on_chunk_received(self, chunk: memoryview):
+        ...
+
+    def on_connection_closed(self):
+        pass
+
+
+def is_streaming(event_handler: EventHandler | StreamingEventHandler) -> bool:
+    """Tells whether the connections get streaming handlers from `for_connection`."""
+
+    # A wrapper (like a `DispatchingEventHandler`) tells it by itself, as its kind is the one of what it wraps
+    return getattr(event_handler, "streaming", isinstance(event_handler, StreamingEventHandler))
+
+
+def handler_for_connection(event_handler: EventHandler | StreamingEventHandler) -> EventHandler | StreamingEventHandler:
+    """The handler of a new connection, which is the handler itself when it does not define `for_connection`."""
+
+    # The handlers only need to match the protocols, and the ones which do not subclass them lack their defaults
+    if for_connection := getattr(event_handler, "for_connection", None):
+        return for_connection()
+    return event_handler
+
+
+def notify_connection_closed(event_handler: EventHandler | StreamingEventHandler):
+    if on_connection_closed := getattr(event_handler, "on_connection_closed", None):
+        on_connection_closed()
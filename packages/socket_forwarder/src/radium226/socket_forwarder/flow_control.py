@@ -0,0 +1,55 @@
+from dataclasses import dataclass
+
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+@dataclass(frozen=True, slots=True)
+class Watermarks():
+    """The producing socket of a direction stops being read once `high` bytes are buffered, and is read again at `low`."""
+
+    high: int
+    low: int
+
+    def __post_init__(self):
+        if not 0 <= self.low < self.high:
+            raise ValueError(f"The low watermark ({self.low}) must be below the high one ({self.high})")
+
+    @classmethod
+    def for_capacity(cls, capacity: int) -> "Watermarks":
+        return cls(high=capacity, low=capacity // 4)
+
+
+class MemoryBudget():
+    """The bytes buffered by all the connections of a process.
+
+    Once `limit` is reached, the connections are paused at their low watermark rather than at their high one. It is
+    only updated by the forwarding loop, and read as is by the metrics.
+    """
+
+    limit: int
+    used: int
+    # How many times a connection stopped being read because of the budget
+    pause_count: int
+
+    def __init__(self, limit: int = DEFAULT_MEMORY_BUDGET):
+        self.limit = limit
+        self.used = 0
+        self.pause_count = 0
+
+    def __getstate__(self):
+        # Each worker process gets a budget of its own
+        return {"limit": self.limit}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def exhausted(self) -> bool:
+        return self.used >= self.limit
+
+    def acquire(self, size: int):
+        self.used += size
+
+    def release(self, size: int):
+        self.used -= size
@@ -0,0 +1,190 @@
+import json
+import os
+import socket
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+
+from .host_and_port import HostAndPort
+
+
+HANDOFF_TIMEOUT_IN_SECONDS = 10.0
+
+# How long the previous process keeps serving the connections it could not hand off (the ones still connecting to
+# their upstream, or half-closed), before it cuts them
+HANDOFF_GRACE_PERIOD_IN_SECONDS = 30.0
+
+# Each message is a header (the lengths of its JSON and of its payload), which carries the file descriptors, then the
+# JSON and the payload themselves
+_HEADER = struct.Struct("!II")
+
+# What the next process asks for: the listening socket only, or the live connections too
+_REQUEST = struct.Struct("!?")
+
+
+class HandoffError(Exception):
+
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class HandedOffConnection():
+
+    downstream_connection_socket: socket.socket
+    upstream_connection_socket: socket.socket
+    remote_host_and_port: HostAndPort
+
+    # What was read from one side and not written to the other yet
+    upstream_to_downstream_bytes: bytes
+    downstream_to_upstream_bytes: bytes
+
+
+@dataclass(frozen=True, slots=True)
+class Handoff():
+    """What a process gets from the one it takes over from: its listening socket, and maybe its live connections."""
+
+    downstream_server_socket: socket.socket
+    connections: list[HandedOffConnection]
+
+
+def _send_message(handoff_socket: socket.socket, header: dict, payload: bytes = b"", fds: list[int] | None = None):
+    data = json.dumps(header).encode()
+    socket.send_fds(handoff_socket, [_HEADER.pack(len(data), len(payload))], fds or [])
+    handoff_socket.sendall(data + payload)
+
+
+def _receive_exactly(handoff_socket: socket.socket, length: int) -> bytes:
+    data = bytearray()
+    while len(data) < length:
+        chunk = handoff_socket.recv(length - len(data))
+        if not chunk:
+            raise HandoffError("The previous process went away during the handoff")
+        data += chunk
+    return bytes(data)
+
+
+def _socket_from_fd(fd: int) -> socket.socket:
+    received_socket = socket.socket(fileno=fd)
+    # The previous process may have made it non-blocking, which it would then be without Python knowing about it
+    received_socket.setblocking(True)
+    return received_socket
+
+
+def _receive_message(handoff_socket: socket.socket, fd_count: int) -> tuple[dict, bytes, list[int]]:
+    data, fds, flags, _ = socket.recv_fds(handoff_socket, _HEADER.size, fd_count, socket.MSG_WAITALL)
+    if flags & socket.MSG_CTRUNC or len(fds) != fd_count:
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError(f"{fd_count} file descriptors were expected, but {len(fds)} were received")
+    if len(data) != _HEADER.size:
+        raise HandoffError("The previous process went away during the handoff")
+
+    data_length, payload_length = _HEADER.unpack(data)
+    header = json.loads(_receive_exactly(handoff_socket, data_length))
+    return header, _receive_exactly(handoff_socket, payload_length), fds
+
+
+def request_handoff(
+    handoff_path: Path,
+    with_connections: bool,
+    timeout: float = HANDOFF_TIMEOUT_IN_SECONDS,
+) -> Handoff | None:
+    """Takes over from the process serving the handoff at `handoff_path`, if there is one."""
+
+    handoff_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    handoff_socket.settimeout(timeout)
+    with handoff_socket:
+        try:
+            handoff_socket.connect(str(handoff_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Nobody to take over from (or a stale path, left by a process which did not exit cleanly)
+            return None
+
+        handoff_socket.sendall(_REQUEST.pack(with_connections))
+
+        header, _, (server_fd,) = _receive_message(handoff_socket, 1)
+        downstream_server_socket = _socket_from_fd(server_fd)
+
+        connections = []
+        for _ in range(header["connection_count"]):
+            header, payload, (downstream_fd, upstream_fd) = _receive_message(handoff_socket, 2)
+            length = header["upstream_to_downstream_length"]
+            connections.append(
+                HandedOffConnection(
+                    downstream_connection_socket=_socket_from_fd(downstream_fd),
+                    upstream_connection_socket=_socket_from_fd(upstream_fd),
+                    remote_host_and_port=HostAndPort(header["host"], header["port"]),
+                    upstream_to_downstream_bytes=payload[:length],
+                    downstream_to_upstream_bytes=payload[length:],
+                )
+            )
+        return Handoff(downstream_server_socket, connections)
+
+
+class HandoffServer():
+    """Listens at `handoff_path` for the next process, which takes over by connecting to it."""
+
+    _handoff_path: Path
+    _server_socket: socket.socket
+    _accepted: bool
+
+    def __init__(self, handoff_path: Path):
+        self._handoff_path = handoff_path
+        # The previous process unlinked it before handing off, so whatever is left there is stale
+        handoff_path.unlink(missing_ok=True)
+        self._server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server_socket.bind(str(handoff_path))
+        self._server_socket.listen()
+        self._accepted = False
+
+    def fileno(self) -> int:
+        return self._server_socket.fileno()
+
+    @property
+    def accepted(self) -> bool:
+        return self._accepted
+
+    def accept(self, timeout: float = HANDOFF_TIMEOUT_IN_SECONDS) -> tuple[socket.socket, bool]:
+        """Accepts the next process, and tells whether it wants the live connections too."""
+
+        handoff_socket, _ = self._server_socket.accept()
+        handoff_socket.settimeout(timeout)
+        try:
+            with_connections, = _REQUEST.unpack(_receive_exactly(handoff_socket, _REQUEST.size))
+        except Exception:
+            handoff_socket.close()
+            raise
+
+        # The path is the next process's from now on, which listens at it for the one after
+        self._accepted = True
+        self._handoff_path.unlink(missing_ok=True)
+        self._server_socket.close()
+        return handoff_socket, with_connections
+
+    def close(self):
+        if not self._accepted:
+            self._handoff_path.unlink(missing_ok=True)
+        self._server_socket.close()
+
+
+def hand_off(
+    handoff_socket: socket.socket,
+    downstream_server_socket: socket.socket,
+    connections: list[HandedOffConnection],
+):
+    """Sends the listening socket and the live connections to the next process, which gets duplicates of them (so
+    they must then be closed, without being shut down)."""
+
+    with handoff_socket:
+        _send_message(handoff_socket, {"connection_count": len(connections)}, fds=[downstream_server_socket.fileno()])
+        for connection in connections:
+            _send_message(
+                handoff_socket,
+                {
+                    "host": connection.remote_host_and_port.host,
+                    "port": connection.remote_host_and_port.port,
+                    "upstream_to_downstream_length": len(connection.upstream_to_downstream_bytes),
+                },
+                connection.upstream_to_downstream_bytes + connection.downstream_to_upstream_bytes,
+                [connection.downstream_connection_socket.fileno(), connection.upstream_connection_socket.fileno()],
+            )
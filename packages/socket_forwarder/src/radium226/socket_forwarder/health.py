@@ -0,0 +1,213 @@
+from contextlib import ExitStack, closing
+from dataclasses import dataclass
+from enum import StrEnum, auto
+from threading import Thread, Event, Lock
+from time import monotonic
+from typing import Callable
+import errno
+import logging
+import os
+import select
+import socket
+
+from .host_and_port import HostAndPort
+
+
+PROBE_INTERVAL_IN_SECONDS = 1.0
+
+PROBE_TIMEOUT_IN_SECONDS = 0.5
+
+FAILURE_THRESHOLD = 3
+
+RESET_TIMEOUT_IN_SECONDS = 5.0
+
+# Without it, a connection to an unreachable upstream waits for the TCP timeouts of the OS (minutes) before failing over
+CONNECT_TIMEOUT_IN_SECONDS = 5.0
+
+
+logger = logging.getLogger(__name__)
+
+
+# Checks that the upstream speaks its protocol, by raising an OSError if it does not answer as expected
+Probe = Callable[[socket.socket], None]
+
+
+class CircuitState(StrEnum):
+
+    # The upstream gets the connections
+    CLOSED = auto()
+    # The upstream failed too many times in a row, and gets no connection until the reset timeout is over
+    OPEN = auto()
+    # The reset timeout is over, and the next connection (or probe) tells if the upstream is back
+    HALF_OPEN = auto()
+
+
+class CircuitBreaker():
+    """Stops sending connections to an upstream after `failure_threshold` consecutive failures.
+
+    It is shared by the forwarding loop and the health checker thread, hence the lock.
+    """
+
+    _failure_threshold: int
+    _reset_timeout: float
+
+    _lock: Lock
+    _state: CircuitState
+    _failure_count: int
+    _opened_at: float
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT_IN_SECONDS):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self._lock = Lock()
+        self._state = CircuitState.CLOSED
+        self._failure_count = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            if self._state == CircuitState.OPEN and monotonic() - self._opened_at >= self._reset_timeout:
+                self._state = CircuitState.HALF_OPEN
+            return self._state
+
+    def allows(self) -> bool:
+        return self.state != CircuitState.OPEN
+
+    def record_success(self):
+        with self._lock:
+            self._state = CircuitState.CLOSED
+            self._failure_count = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failure_count += 1
+            # A single failure is enough to open it again while we try the upstream back
+            if self._state == CircuitState.HALF_OPEN or self._failure_count >= self._failure_threshold:
+                self._state = CircuitState.OPEN
+                self._opened_at = monotonic()
+
+
+@dataclass(frozen=True, slots=True)
+class HealthCheck():
+    """How the upstreams are checked, which is sent to the worker processes (so the probe must be picklable)."""
+
+    probe: Probe | None = None
+    interval: float = PROBE_INTERVAL_IN_SECONDS
+    timeout: float = PROBE_TIMEOUT_IN_SECONDS
+    failure_threshold: int = FAILURE_THRESHOLD
+    reset_timeout: float = RESET_TIMEOUT_IN_SECONDS
+
+
+def connect(host_and_port: HostAndPort, timeout: float) -> socket.socket:
+    """Connects without waiting for longer than `timeout`, rather than for the TCP timeouts of the OS."""
+
+    connection_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connection_socket.setblocking(False)
+    try:
+        error = connection_socket.connect_ex(host_and_port.as_tuple())
+        if error == errno.EINPROGRESS:
+            # The socket is writable once the connection is made, or once it failed
+            _, writable, _ = select.select([], [connection_socket], [], timeout)
+            if not writable:
+                raise TimeoutError(f"Connecting to {host_and_port.host}:{host_and_port.port} timed out")
+            error = connection_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise OSError(error, os.strerror(error))
+    except BaseException:
+        connection_socket.close()
+        raise
+
+    connection_socket.settimeout(timeout)
+    return connection_socket
+
+
+class HealthChecker():
+    """Probes the upstreams in the background, and keeps a circuit breaker for each of them.
+
+    The breakers are also told about the connections which fail in between two probes, so that the next connections
+    skip a dead upstream right away.
+    """
+
+    _host_and_ports: list[HostAndPort]
+    _health_check: HealthCheck
+    # HostAndPort is not hashable, so the breakers are in the same order as the upstreams
+    _circuit_breakers: list[CircuitBreaker]
+    # The outcome of the last probe of each upstream, so that only the changes are reported
+    _healthy: list[bool]
+
+    _stopping: Event
+    _exit_stack: ExitStack
+
+    def __init__(self, host_and_ports: list[HostAndPort], health_check: HealthCheck):
+        self._host_and_ports = host_and_ports
+        self._health_check = health_check
+        self._circuit_breakers = [
+            CircuitBreaker(health_check.failure_threshold, health_check.reset_timeout)
+            for _ in host_and_ports
+        ]
+        self._healthy = [True for _ in host_and_ports]
+
+        self._stopping = Event()
+        self._exit_stack = ExitStack()
+
+    @property
+    def host_and_ports(self) -> list[HostAndPort]:
+        return self._host_and_ports
+
+    def circuit_breaker(self, host_and_port: HostAndPort) -> CircuitBreaker:
+        return self._circuit_breakers[self._host_and_ports.index(host_and_port)]
+
+    def available_host_and_ports(self) -> list[HostAndPort]:
+        """The upstreams whose circuit is not open, in the order they were given."""
+
+        return [
+            host_and_port
+            for host_and_port, circuit_breaker in zip(self._host_and_ports, self._circuit_breakers)
+            if circuit_breaker.allows()
+        ]
+
+    def record_failure(self, host_and_port: HostAndPort):
+        self.circuit_breaker(host_and_port).record_failure()
+
+    def record_success(self, host_and_port: HostAndPort):
+        self.circuit_breaker(host_and_port).record_success()
+
+    def check(self, host_and_port: HostAndPort) -> bool:
+        index = self._host_and_ports.index(host_and_port)
+        circuit_breaker = self._circuit_breakers[index]
+        try:
+            with closing(connect(host_and_port, self._health_check.timeout)) as connection_socket:
+                if probe := self._health_check.probe:
+                    probe(connection_socket)
+        except OSError as e:
+            if self._healthy[index]:
+                logger.warning("The upstream %s:%d failed its health check: %r", host_and_port.host, host_and_port.port, e)
+            self._healthy[index] = False
+            circuit_breaker.record_failure()
+            return False
+
+        if not self._healthy[index]:
+            logger.info("The upstream %s:%d passed its health check again", host_and_port.host, host_and_port.port)
+        self._healthy[index] = True
+        circuit_breaker.record_success()
+        return True
+
+    def _run(self):
+        while True:
+            for host_and_port in self._host_and_ports:
+                self.check(host_and_port)
+            if self._stopping.wait(self._health_check.interval):
+                break
+
+    def __enter__(self):
+        thread = Thread(target=self._run, daemon=True)
+        thread.start()
+        self._exit_stack.callback(thread.join)
+        self._exit_stack.callback(self._stopping.set)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._exit_stack.close()
+        return False
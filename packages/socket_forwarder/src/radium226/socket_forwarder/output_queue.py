@@ -0,0 +1,79 @@
+import os
+import socket
+from collections import deque
+from itertools import islice
+
+
+# The kernel does not take more buffers in a single `sendmsg`
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+TCP_CORK = getattr(socket, "TCP_CORK", None)
+
+
+class OutputQueue():
+    """The buffers waiting to be written to a socket, which are written together with `sendmsg` (scatter/gather).
+
+    Each message can then be queued as is, rather than being copied into a single buffer or sent with its own syscall.
+
+    With `cork`, the socket is corked from the moment the queue stops being empty to the moment it is drained, so that
+    the small messages written over several flushes (like a CommandComplete and a ReadyForQuery) leave in full
+    segments rather than one segment each. It is ignored where TCP_CORK does not exist (it is Linux only).
+    """
+
+    _connection_socket: socket.socket
+    _buffers: deque[memoryview]
+    _length: int
+
+    _cork: bool
+    _corked: bool
+
+    def __init__(self, connection_socket: socket.socket, cork: bool = False):
+        self._connection_socket = connection_socket
+        self._buffers = deque()
+        self._length = 0
+
+        self._cork = cork and TCP_CORK is not None and connection_socket.family in (socket.AF_INET, socket.AF_INET6)
+        self._corked = False
+
+    def __len__(self) -> int:
+        return self._length
+
+    def _set_corked(self, corked: bool):
+        # Uncorking sends whatever was held back right away
+        self._connection_socket.setsockopt(socket.IPPROTO_TCP, TCP_CORK, int(corked))
+        self._corked = corked
+
+    def append(self, buffer: bytes | bytearray | memoryview):
+        if len(buffer) == 0:
+            return
+        if self._cork and not self._corked:
+            self._set_corked(True)
+        self._buffers.append(memoryview(buffer))
+        self._length += len(buffer)
+
+    def flush(self) -> int:
+        """Writes as much as the socket takes with a single syscall, and tells how many bytes it took."""
+
+        if not self._buffers:
+            return 0
+
+        try:
+            n = self._connection_socket.sendmsg(list(islice(self._buffers, IOV_MAX)))
+        except BlockingIOError:
+            return 0
+
+        self._consume(n)
+        if not self._buffers and self._corked:
+            self._set_corked(False)
+        return n
+
+    def _consume(self, n: int):
+        self._length -= n
+        while n > 0:
+            buffer = self._buffers[0]
+            if len(buffer) > n:
+                # The rest of a partially written buffer is written by the next flush
+                self._buffers[0] = buffer[n:]
+                break
+            self._buffers.popleft()
+            n -= len(buffer)
@@ -0,0 +1,113 @@
+import socket
+
+
+RING_BUFFER_CAPACITY = 64 * 1024
+
+
+class RingBuffer():
+    """A preallocated circular byte buffer filled with `recv_into` and drained with `send` on memoryview slices."""
+
+    _buffer: bytearray
+    _view: memoryview
+
+    _start: int
+    _length: int
+
+    def __init__(self, capacity: int = RING_BUFFER_CAPACITY):
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def capacity(self) -> int:
+        return len(self._buffer)
+
+    def is_full(self) -> bool:
+        return self._length == self.capacity
+
+    def readable_view(self) -> memoryview:
+        end = min(self._start + self._length, self.capacity)
+        return self._view[self._start:end]
+
+    def readable_views(self) -> list[memoryview]:
+        # Once wrapped around, the content is in two parts: the end of the buffer and then its start
+        head = self.readable_view()
+        if len(head) == self._length:
+            return [head]
+        return [head, self._view[:self._length - len(head)]]
+
+    def writable_view(self) -> memoryview:
+        if self.is_full():
+            self._grow()
+
+        end = self._start + self._length
+        if end < self.capacity:
+            return self._view[end:]
+        else:
+            return self._view[end - self.capacity:self._start]
+
+    def commit(self, n: int) -> None:
+        self._length += n
+
+    def consume(self, n: int) -> None:
+        self._length -= n
+        if self._length == 0:
+            # Rewinding keeps the next `recv_into` as large and contiguous as possible
+            self._start = 0
+        else:
+            self._start = (self._start + n) % self.capacity
+
+    def extend(self, data: bytes) -> None:
+        while len(data) > self.capacity - self._length:
+            self._grow()
+        for view in (self.writable_view(), self.writable_view()):
+            n = min(len(view), len(data))
+            view[:n] = data[:n]
+            self.commit(n)
+            data = data[n:]
+
+    def take(self) -> bytes:
+        # Everything which is buffered, as when the connection is handed off to another process
+        data = b"".join(self.readable_views())
+        self.consume(self._length)
+        return data
+
+    def recv_from(self, connection_socket: socket.socket, size: int | None = None) -> memoryview:
+        view = self.writable_view()[:size]
+        n = connection_socket.recv_into(view)
+        self.commit(n)
+        return view[:n]
+
+    def send_to(self, connection_socket: socket.socket) -> memoryview:
+        view = self.readable_view()
+        try:
+            n = connection_socket.send(view)
+        except BlockingIOError:
+            return view[:0]
+        self.consume(n)
+        return view[:n]
+
+    def gather_to(self, connection_socket: socket.socket) -> int:
+        # Both parts of a wrapped content are written with a single syscall, when nobody needs to see what was sent
+        try:
+            n = connection_socket.sendmsg(self.readable_views())
+        except BlockingIOError:
+            # The socket is full again: the rest is sent once it is writable
+            return 0
+        self.consume(n)
+        return n
+
+    def _grow(self) -> None:
+        # Only happens when the producer outpaces the consumer: the content is linearized into a buffer twice as large
+        buffer = bytearray(self.capacity * 2)
+        head = self.readable_view()
+        buffer[:len(head)] = head
+        buffer[len(head):self._length] = self._view[:self._length - len(head)]
+
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._start = 0
@@ -2,16 +2,41 @@ from dataclasses import (
     dataclass, 
     field,
 )
+from collections import deque
 from contextlib import ExitStack
 from functools import partial
 from threading import Thread
 from enum import StrEnum, auto
+import errno
+import logging
 import selectors
 import socket
-from typing import Protocol
+from pathlib import Path
+from time import monotonic
+from typing import Callable
 from queue import Queue, Empty
 
 from .host_and_port import HostAndPort
+from .ring_buffer import RingBuffer, RING_BUFFER_CAPACITY
+from .splice_pipe import SplicePipe, SPLICE_SUPPORTED
+from .asyncio_engine import AsyncioEngine
+from .epoll_engine import EpollEngine
+from .health import HealthCheck, HealthChecker, CONNECT_TIMEOUT_IN_SECONDS
+from .flow_control import Watermarks, MemoryBudget
+from .event_handler import EventHandler, StreamingEventHandler, is_streaming, handler_for_connection, notify_connection_closed
+from .wakeup import Wakeup
+from .admission import AdmissionControl, reject
+from .handoff import (
+    Handoff,
+    HandoffServer,
+    HandedOffConnection,
+    request_handoff,
+    hand_off,
+    HANDOFF_GRACE_PERIOD_IN_SECONDS,
+)
+
+
+logger = logging.getLogger(__name__)
 
 
 class Side(StrEnum):
@@ -20,105 +45,589 @@ class Side(StrEnum):
     DOWNSTREAM = auto()
 
 
-class Command(StrEnum):
+class Engine(StrEnum):
 
-    BREAK_LOOP = auto()
-    CONTINUE_LOOP = auto()
+    SELECTORS = auto()
+    ASYNCIO = auto()
+    UVLOOP = auto()
+    EPOLL = auto()
 
 
-BUFFER_SIZE = 4096
+class Command(StrEnum):
+
+    BREAK_LOOP = auto()
+    # Stops accepting, and breaks the loop once the live connections are over
+    DRAIN_LOOP = auto()
 
 
-@dataclass
+# Hashed by identity, as each one is a connection of its own
+@dataclass(eq=False)
 class ForwardingContext():
 
-    upstream_connection_socket: socket.socket
     downstream_connection_socket: socket.socket
+    # None until a connection to one of the upstreams is attempted
+    upstream_connection_socket: socket.socket | None = field(default=None)
 
-    upstream_to_downstream_buffer: bytes = field(default=b"")
-    downstream_to_upstream_buffer: bytes = field(default=b"")
+    # The upstream being connected to, and the ones to try next if it fails
+    remote_host_and_port: HostAndPort | None = field(default=None)
+    remaining_host_and_ports: list[HostAndPort] = field(default_factory=list)
+    upstream_connected: bool = field(default=False)
+    # When the upstream being connected to is given up on, for the next one
+    connect_deadline: float | None = field(default=None)
 
-    last_full_upstream_to_downstream_buffer: bytes = field(default=b"")
-    last_full_downstream_to_upstream_buffer: bytes = field(default=b"")
+    upstream_to_downstream_buffer: RingBuffer | SplicePipe = field(default_factory=RingBuffer)
+    downstream_to_upstream_buffer: RingBuffer | SplicePipe = field(default_factory=RingBuffer)
 
+    upstream_to_downstream_watermarks: Watermarks = field(default_factory=lambda: Watermarks.for_capacity(RING_BUFFER_CAPACITY))
+    downstream_to_upstream_watermarks: Watermarks = field(default_factory=lambda: Watermarks.for_capacity(RING_BUFFER_CAPACITY))
 
-class EventHandler(Protocol):
+    last_full_upstream_to_downstream_buffer: bytearray = field(default_factory=bytearray)
+    last_full_downstream_to_upstream_buffer: bytearray = field(default_factory=bytearray)
 
-    def on_data_sent(self, buffer: bytes):
-        ...
+    upstream_paused: bool = field(default=False)
+    downstream_paused: bool = field(default=False)
+    # Whether one of the sides was read until its end
+    half_closed: bool = field(default=False)
+    # Whether it holds a place of the admission control, rather than waiting for one
+    admitted: bool = field(default=False)
+    closed: bool = field(default=False)
 
-    def on_data_received(self, buffer: bytes):
-        ...
+    event_handler: EventHandler | None = field(default=None)
+    streaming_event_handler: StreamingEventHandler | None = field(default=None)
 
 
 class SocketForwarder():
 
     _local_host_and_port: HostAndPort
     _remote_host_and_port: HostAndPort
+    # Tried in order when the upstreams before them cannot be connected to
+    _fallback_host_and_ports: list[HostAndPort]
+    _health_checker: HealthChecker | None
+    _connect_timeout: float
 
     _exit_stack: ExitStack
 
+    # Only looked at when the loop is woken up, which is the only thing `stop` does to the loop
     _command_queue: Queue
+    _wakeup: Wakeup | None
     _loop_thread: Thread | None
-    _event_handler: EventHandler | None
+    _event_handler: EventHandler | StreamingEventHandler | None
+
+    _engine: Engine
+    _asyncio_engine: AsyncioEngine | None
+    _epoll_engine: EpollEngine | None
+
+    # Each direction gets the capacity of its buffer as high watermark, unless told otherwise
+    _upstream_to_downstream_watermarks: Watermarks | None
+    _downstream_to_upstream_watermarks: Watermarks | None
+    _memory_budget: MemoryBudget
+
+    # Where the next process connects to take over from this one (and where this one took over from the previous one),
+    # and whether the live connections are handed off along with the listening socket
+    _handoff_path: Path | None
+    _handoff_connections: bool
+    _handoff: Handoff | None
+    _handoff_server: HandoffServer | None
+
+    # Caps the upstream connections, above which the clients wait for one to close
+    _admission_control: AdmissionControl | None
 
     def __init__(self, 
         local_host_and_port: HostAndPort, 
         remote_host_and_port: HostAndPort,
-        event_hander: EventHandler | None = None
-
+        event_hander: EventHandler | StreamingEventHandler | None = None,
+        reuse_port: bool = False,
+        engine: Engine = Engine.SELECTORS,
+        fallback_host_and_ports: list[HostAndPort] | None = None,
+        health_check: HealthCheck | None = None,
+        upstream_to_downstream_watermarks: Watermarks | None = None,
+        downstream_to_upstream_watermarks: Watermarks | None = None,
+        memory_budget: MemoryBudget | None = None,
+        handoff_path: Path | None = None,
+        handoff_connections: bool = False,
+        admission_control: AdmissionControl | None = None,
+        connect_timeout: float = CONNECT_TIMEOUT_IN_SECONDS,
     ):
+        if handoff_connections and handoff_path is None:
+            raise ValueError("Handing off the connections requires a handoff path")
+        # The transports of asyncio do not give their buffers away
+        if handoff_connections and engine in (Engine.ASYNCIO, Engine.UVLOOP):
+            raise ValueError(f"The {engine} engine can only hand off its listening socket")
+        # The transports of asyncio buffer on their own, so that they are only bound by their watermarks
+        if memory_budget is not None and engine in (Engine.ASYNCIO, Engine.UVLOOP):
+            raise ValueError(f"The {engine} engine does not support a memory budget")
+        # They can only tell the event handler when their write buffer is drained by having no watermarks
+        watermarks = upstream_to_downstream_watermarks is not None or downstream_to_upstream_watermarks is not None
+        if watermarks and event_hander is not None and not is_streaming(event_hander) and engine in (Engine.ASYNCIO, Engine.UVLOOP):
+            raise ValueError(f"The {engine} engine only supports the watermarks with a streaming event handler")
+
         self._local_host_and_port = local_host_and_port
         self._remote_host_and_port = remote_host_and_port
+        self._fallback_host_and_ports = fallback_host_and_ports or []
+        self._health_checker = HealthChecker(self.upstream_host_and_ports, health_check) if health_check else None
+        self._connect_timeout = connect_timeout
         self._event_handler = event_hander
+        self._reuse_port = reuse_port
+        self._engine = engine
+        self._asyncio_engine = None
+        self._epoll_engine = None
+
+        self._upstream_to_downstream_watermarks = upstream_to_downstream_watermarks
+        self._downstream_to_upstream_watermarks = downstream_to_upstream_watermarks
+        self._memory_budget = memory_budget or MemoryBudget()
+
+        self._handoff_path = handoff_path
+        self._handoff_connections = handoff_connections
+        self._handoff = None
+        self._handoff_server = None
+
+        self._admission_control = admission_control
 
         self._exit_stack = ExitStack()
         self._command_queue = Queue()
+        self._wakeup = None
 
 
-    def __enter__(self):
-        selector = self._exit_stack.enter_context(selectors.DefaultSelector())
+    @property
+    def upstream_host_and_ports(self) -> list[HostAndPort]:
+        return [self._remote_host_and_port, *self._fallback_host_and_ports]
+
+
+    @property
+    def health_checker(self) -> HealthChecker | None:
+        return self._health_checker
 
+
+    @property
+    def memory_budget(self) -> MemoryBudget:
+        return self._memory_budget
+
+
+    @property
+    def admission_control(self) -> AdmissionControl | None:
+        return self._admission_control
+
+
+    def _available_host_and_ports(self) -> list[HostAndPort]:
+        # Without health checks, every upstream is tried until one accepts the connection
+        if health_checker := self._health_checker:
+            return health_checker.available_host_and_ports()
+        return self.upstream_host_and_ports
+
+
+    def _on_connection_failed(self, remote_host_and_port: HostAndPort):
+        if health_checker := self._health_checker:
+            health_checker.record_failure(remote_host_and_port)
+
+
+    def _on_connection_succeeded(self, remote_host_and_port: HostAndPort):
+        # An upstream whose circuit is half-open is back, without waiting for its next probe
+        if health_checker := self._health_checker:
+            health_checker.record_success(remote_host_and_port)
+
+
+    def _bind(self) -> socket.socket:
         downstream_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         downstream_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self._reuse_port:
+            # Several processes can then bind the same address and the kernel balances the connections between them
+            downstream_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         downstream_server_socket.bind(self._local_host_and_port.as_tuple())
         downstream_server_socket.listen()
+        return downstream_server_socket
+
+
+    def _listen(self) -> socket.socket:
+        if handoff := self._handoff:
+            return handoff.downstream_server_socket
+        return self._bind()
+
+
+    def __enter__(self):
+        if health_checker := self._health_checker:
+            self._exit_stack.enter_context(health_checker)
+        if handoff_path := self._handoff_path:
+            # The process being replaced (if any) gives its listening socket away, so no connection is refused meanwhile
+            self._handoff = request_handoff(handoff_path, self._handoff_connections)
+            self._handoff_server = HandoffServer(handoff_path)
+            self._exit_stack.callback(self._handoff_server.close)
+        match self._engine:
+            case Engine.SELECTORS:
+                self._start_selectors_loop()
+            case Engine.ASYNCIO | Engine.UVLOOP:
+                self._start_asyncio_loop()
+            case Engine.EPOLL:
+                self._start_epoll_loop()
+        return self
+
+
+    def _start_asyncio_loop(self):
+        self._asyncio_engine = AsyncioEngine(
+            self._available_host_and_ports,
+            self._event_handler,
+            use_uvloop=self._engine == Engine.UVLOOP,
+            on_connection_failed=self._on_connection_failed,
+            on_connection_succeeded=self._on_connection_succeeded,
+            connect_timeout=self._connect_timeout,
+            upstream_to_downstream_watermarks=self._upstream_to_downstream_watermarks,
+            downstream_to_upstream_watermarks=self._downstream_to_upstream_watermarks,
+            admission_control=self._admission_control,
+        )
+
+        downstream_server_socket = self._listen()
+        self._exit_stack.callback(downstream_server_socket.close)
+
+        self._loop_thread = Thread(target=self._asyncio_engine.run, args=(downstream_server_socket, self._handoff_server))
+        self._loop_thread.start()
+        self._exit_stack.callback(self._loop_thread.join)
+
+
+    def _start_epoll_loop(self):
+        self._epoll_engine = EpollEngine(
+            self._available_host_and_ports,
+            self._event_handler,
+            on_connection_failed=self._on_connection_failed,
+            on_connection_succeeded=self._on_connection_succeeded,
+            connect_timeout=self._connect_timeout,
+            upstream_to_downstream_watermarks=self._upstream_to_downstream_watermarks,
+            downstream_to_upstream_watermarks=self._downstream_to_upstream_watermarks,
+            memory_budget=self._memory_budget,
+            admission_control=self._admission_control,
+        )
+
+        downstream_server_socket = self._listen()
+        self._exit_stack.callback(downstream_server_socket.close)
+
+        self._loop_thread = Thread(
+            target=self._epoll_engine.run,
+            args=(downstream_server_socket, self._handoff.connections if self._handoff else None, self._handoff_server),
+        )
+        self._loop_thread.start()
+        self._exit_stack.callback(self._loop_thread.join)
+
+
+    def _start_selectors_loop(self):
+        selector = self._exit_stack.enter_context(selectors.DefaultSelector())
+
+        memory_budget = self._memory_budget
+        admission_control = self._admission_control
+
+        downstream_server_socket = self._listen()
         selector.register(
             downstream_server_socket, 
             selectors.EVENT_READ | selectors.EVENT_WRITE, 
             data=None,
         )
 
+        wakeup = self._wakeup = self._exit_stack.enter_context(Wakeup())
+        selector.register(wakeup, selectors.EVENT_READ, data=None)
+
+        if handoff_server := self._handoff_server:
+            selector.register(handoff_server, selectors.EVENT_READ, data=None)
+
+        # The connections which are not closed yet, to wait for when draining
+        contexts: set[ForwardingContext] = set()
+        # The connections to the upstreams, in the order they time out (those which are over since are skipped)
+        connecting: deque[tuple[float, ForwardingContext]] = deque()
+
+        def create_buffer(buffer_type: type, watermarks: Watermarks | None) -> tuple[RingBuffer | SplicePipe, Watermarks]:
+            if watermarks is None:
+                buffer = buffer_type()
+                return buffer, Watermarks.for_capacity(buffer.capacity)
+            # The buffer never holds more than the high watermark, as its socket is not read anymore then
+            return buffer_type(watermarks.high), watermarks
+
         def accept_connection():
             #print("[accept_connection] We're going to accept a new connection from downstream... ")
             downstream_connection_socket, _ = downstream_server_socket.accept()
             downstream_connection_socket.setblocking(False)
             #print("[accept_connection] We've accepted a new connection from downstream! ")
 
-            #print("[accept_connection] We're going to connect to the upstream server... ")
-            upstream_connection_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            upstream_connection_socket.setblocking(False)
-            upstream_connection_socket.connect_ex(self._remote_host_and_port.as_tuple())
-            #print("[accept_connection] We've connected to the upstream server! ")
+            # Without an event handler the bytes never need to reach Python, so they are spliced through a pipe
+            buffer_type = SplicePipe if self._event_handler is None and SPLICE_SUPPORTED else RingBuffer
 
+            upstream_to_downstream_buffer, upstream_to_downstream_watermarks = create_buffer(buffer_type, self._upstream_to_downstream_watermarks)
+            downstream_to_upstream_buffer, downstream_to_upstream_watermarks = create_buffer(buffer_type, self._downstream_to_upstream_watermarks)
+            event_handler = handler_for_connection(self._event_handler) if self._event_handler else None
             context = ForwardingContext(
-                upstream_connection_socket=upstream_connection_socket,
                 downstream_connection_socket=downstream_connection_socket,
+                remaining_host_and_ports=self._available_host_and_ports(),
+                upstream_to_downstream_buffer=upstream_to_downstream_buffer,
+                downstream_to_upstream_buffer=downstream_to_upstream_buffer,
+                upstream_to_downstream_watermarks=upstream_to_downstream_watermarks,
+                downstream_to_upstream_watermarks=downstream_to_upstream_watermarks,
+                # A streaming handler sees the chunks as they are read, and is never told about the writes
+                streaming_event_handler=event_handler if isinstance(event_handler, StreamingEventHandler) else None,
+                event_handler=None if isinstance(event_handler, StreamingEventHandler) else event_handler,
             )
-
+            contexts.add(context)
+            # Over the cap, the client is not read from until it gets its turn
+            if admission_control is None or admission_control.admit(None, context):
+                context.admitted = True
+                connect_upstream(context)
+
+
+        def adopt_connection(connection: HandedOffConnection):
+            # The ring buffers take whatever the previous process had buffered, whatever its size
+            upstream_to_downstream_buffer, upstream_to_downstream_watermarks = create_buffer(RingBuffer, self._upstream_to_downstream_watermarks)
+            downstream_to_upstream_buffer, downstream_to_upstream_watermarks = create_buffer(RingBuffer, self._downstream_to_upstream_watermarks)
+            upstream_to_downstream_buffer.extend(connection.upstream_to_downstream_bytes)
+            downstream_to_upstream_buffer.extend(connection.downstream_to_upstream_bytes)
+            memory_budget.acquire(len(upstream_to_downstream_buffer) + len(downstream_to_upstream_buffer))
+
+            # It is forwarded without being inspected, as a new handler would not know where its messages start
+            context = ForwardingContext(
+                downstream_connection_socket=connection.downstream_connection_socket,
+                upstream_connection_socket=connection.upstream_connection_socket,
+                remote_host_and_port=connection.remote_host_and_port,
+                upstream_connected=True,
+                upstream_to_downstream_buffer=upstream_to_downstream_buffer,
+                downstream_to_upstream_buffer=downstream_to_upstream_buffer,
+                upstream_to_downstream_watermarks=upstream_to_downstream_watermarks,
+                downstream_to_upstream_watermarks=downstream_to_upstream_watermarks,
+                admitted=True,
+            )
+            contexts.add(context)
+            if admission_control is not None:
+                # It is already connected, so it is counted even over the cap
+                admission_control.acquire(None)
+
+            # Each side is written what is buffered for it first, and is read once it is drained
+            for side, connection_socket, buffer in (
+                (Side.DOWNSTREAM, context.downstream_connection_socket, upstream_to_downstream_buffer),
+                (Side.UPSTREAM, context.upstream_connection_socket, downstream_to_upstream_buffer),
+            ):
+                connection_socket.setblocking(False)
+                watch(
+                    connection_socket,
+                    selectors.EVENT_WRITE if len(buffer) > 0 else selectors.EVENT_READ,
+                    (side, context, False, False),
+                )
+
+
+        def hand_off_connections() -> bool:
+            # Tells whether the next process took over, after which this one only serves what it did not hand off
+            selector.unregister(handoff_server)
+            try:
+                handoff_socket, with_connections = handoff_server.accept()
+            except Exception:
+                logger.exception("The next process could not be accepted")
+                selector.register(handoff_server, selectors.EVENT_READ, data=None)
+                return False
+
+            # The connections still connecting to their upstream, or half-closed, are not worth handing off
+            handed_off_contexts = [context for context in contexts if context.upstream_connected and not context.half_closed] if with_connections else []
+            connections = [
+                HandedOffConnection(
+                    downstream_connection_socket=context.downstream_connection_socket,
+                    upstream_connection_socket=context.upstream_connection_socket,
+                    remote_host_and_port=context.remote_host_and_port,
+                    upstream_to_downstream_bytes=context.upstream_to_downstream_buffer.take(),
+                    downstream_to_upstream_bytes=context.downstream_to_upstream_buffer.take(),
+                )
+                for context in handed_off_contexts
+            ]
+
+            try:
+                hand_off(handoff_socket, downstream_server_socket, connections)
+            except Exception:
+                # The next process did not take over, so this one keeps forwarding everything (though it cannot be
+                # handed off anymore, as the next process was given its handoff path)
+                logger.exception("The handoff failed")
+                for context, connection in zip(handed_off_contexts, connections):
+                    context.upstream_to_downstream_buffer.extend(connection.upstream_to_downstream_bytes)
+                    context.downstream_to_upstream_buffer.extend(connection.downstream_to_upstream_bytes)
+                return False
+
+            for context, connection in zip(handed_off_contexts, connections):
+                context.closed = True
+                contexts.discard(context)
+                memory_budget.release(len(connection.upstream_to_downstream_bytes) + len(connection.downstream_to_upstream_bytes))
+                for connection_socket in (context.downstream_connection_socket, context.upstream_connection_socket):
+                    watch(connection_socket, 0, None)
+                    # The next process has its own duplicates of them, which must not be shut down
+                    connection_socket.close()
+                if event_handler := context.event_handler or context.streaming_event_handler:
+                    notify_connection_closed(event_handler)
+                release_admission(context)
+            return True
+
+
+        def connect_upstream(context: ForwardingContext):
+            while context.remaining_host_and_ports:
+                remote_host_and_port = context.remaining_host_and_ports.pop(0)
+                upstream_connection_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                upstream_connection_socket.setblocking(False)
+                if upstream_connection_socket.connect_ex(remote_host_and_port.as_tuple()) in (0, errno.EINPROGRESS):
+                    context.upstream_connection_socket = upstream_connection_socket
+                    context.remote_host_and_port = remote_host_and_port
+                    # The socket is writable once connected, or once the connection failed
+                    selector.register(
+                        upstream_connection_socket,
+                        selectors.EVENT_WRITE,
+                        data=(Side.UPSTREAM, context, None, None),
+                    )
+                    context.connect_deadline = monotonic() + self._connect_timeout
+                    connecting.append((context.connect_deadline, context))
+                    return
+
+                upstream_connection_socket.close()
+                self._on_connection_failed(remote_host_and_port)
+
+            # No upstream is left, and the client knows it right away rather than after a timeout
+            close_connection(context)
+
+
+        def fail_over(context: ForwardingContext):
+            # The upstream being connected to is given up on, and the next one is tried
+            context.connect_deadline = None
+            watch(context.upstream_connection_socket, 0, None)
+            context.upstream_connection_socket.close()
+            context.upstream_connection_socket = None
+            self._on_connection_failed(context.remote_host_and_port)
+            connect_upstream(context)
+
+
+        def expire_connects():
+            now = monotonic()
+            while connecting and connecting[0][0] <= now:
+                deadline, context = connecting.popleft()
+                if context.connect_deadline == deadline and not context.closed:
+                    fail_over(context)
+
+
+        def on_upstream_connected(context: ForwardingContext):
+            upstream_connection_socket = context.upstream_connection_socket
+            if error := upstream_connection_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                fail_over(context)
+                return
+
+            selector.unregister(upstream_connection_socket)
+            context.connect_deadline = None
+            context.upstream_connected = True
+            self._on_connection_succeeded(context.remote_host_and_port)
+            # We do not read anything from downstream before being able to forward it
             selector.register(
-                downstream_connection_socket, 
+                context.downstream_connection_socket,
                 selectors.EVENT_READ,
                 data=(Side.DOWNSTREAM, context, None, None),
             )
-
             selector.register(
-                upstream_connection_socket, 
+                upstream_connection_socket,
                 selectors.EVENT_READ,
                 data=(Side.UPSTREAM, context, None, None),
             )
 
 
+        def release_admission(context: ForwardingContext):
+            if admission_control is None:
+                return
+            if not context.admitted:
+                admission_control.cancel(context)
+                return
+            context.admitted = False
+            # Its place goes to the connections waiting for one
+            for admitted_context in admission_control.release(None):
+                admitted_context.admitted = True
+                connect_upstream(admitted_context)
+
+
+        def watch(connection_socket: socket.socket, events: int, data):
+            # Registers, modifies or unregisters the socket so that the selector watches exactly these events
+            if connection_socket in selector.get_map():
+                if events:
+                    selector.modify(connection_socket, events, data=data)
+                else:
+                    selector.unregister(connection_socket)
+            elif events:
+                selector.register(connection_socket, events, data=data)
+
+
+        def close_connection(context: ForwardingContext):
+            if context.closed:
+                return
+            context.closed = True
+            contexts.discard(context)
+            # What was not forwarded is dropped, and gives its memory back
+            memory_budget.release(len(context.upstream_to_downstream_buffer) + len(context.downstream_to_upstream_buffer))
+
+            for connection_socket in (context.upstream_connection_socket, context.downstream_connection_socket):
+                if connection_socket is not None and connection_socket.fileno() != -1:
+                    watch(connection_socket, 0, None)
+                    try:
+                        connection_socket.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    connection_socket.close()
+
+            if event_handler := context.event_handler or context.streaming_event_handler:
+                notify_connection_closed(event_handler)
+            release_admission(context)
+
+
+        def should_pause(buffer: RingBuffer | SplicePipe, watermarks: Watermarks) -> bool:
+            if buffer.is_full() or len(buffer) >= watermarks.high:
+                return True
+            if memory_budget.exhausted and len(buffer) > watermarks.low:
+                # Under memory pressure the connections keep no more than their low watermark, while an empty one can
+                # still make progress
+                memory_budget.pause_count += 1
+                return True
+            return False
+
+
+        def receive(buffer: RingBuffer | SplicePipe, connection_socket: socket.socket) -> memoryview | int | None:
+            # Returns what was read (which is empty once the socket is closed, and None when nothing could be read into
+            # a pipe), and accounts for it in the memory budget
+            length = len(buffer)
+            chunk = buffer.recv_from(connection_socket)
+            memory_budget.acquire(len(buffer) - length)
+            return chunk
+
+
+        def send(buffer: RingBuffer | SplicePipe, connection_socket: socket.socket, context: ForwardingContext):
+            length = len(buffer)
+            if isinstance(buffer, RingBuffer) and context.event_handler is None:
+                # What is sent is not kept for the event handler, so a wrapped buffer is sent as a whole
+                chunk = buffer.gather_to(connection_socket)
+            else:
+                chunk = buffer.send_to(connection_socket)
+            memory_budget.release(length - len(buffer))
+            return chunk
+
+
+        def pause_reading(side: Side, context: ForwardingContext):
+            match side:
+                case Side.UPSTREAM:
+                    watch(context.upstream_connection_socket, 0, None)
+                    context.upstream_paused = True
+                case Side.DOWNSTREAM:
+                    watch(context.downstream_connection_socket, 0, None)
+                    context.downstream_paused = True
+
+
+        def resume_reading(side: Side, context: ForwardingContext):
+            match side:
+                case Side.UPSTREAM:
+                    context.upstream_paused = False
+                    # If upstream is still being written to, it will be read again once drained
+                    if context.upstream_connection_socket not in selector.get_map():
+                        watch(
+                            context.upstream_connection_socket,
+                            selectors.EVENT_READ,
+                            (Side.UPSTREAM, context, None, None),
+                        )
+                case Side.DOWNSTREAM:
+                    context.downstream_paused = False
+                    # If downstream is still being written to, it will be read again once drained
+                    if context.downstream_connection_socket not in selector.get_map():
+                        watch(
+                            context.downstream_connection_socket,
+                            selectors.EVENT_READ,
+                            (Side.DOWNSTREAM, context, None, None),
+                        )
+
+
         def handle_connection(
             side: Side, 
             context: ForwardingContext, 
@@ -126,155 +635,222 @@ class SocketForwarder():
             close_downstream_connection_socket_after_write: bool | None,    
             mask
         ):
+            if side == Side.UPSTREAM and not context.upstream_connected:
+                on_upstream_connected(context)
+                return
+
             if mask & selectors.EVENT_READ:
                 match side:
                     case Side.UPSTREAM:
                         #print(f"[handle_connection/selectors.EVENT_READ/Side.UPSTREAM] Reading data from upstream... ")
-                        chunk = context.upstream_connection_socket.recv(BUFFER_SIZE)
-                        context.upstream_to_downstream_buffer += chunk
-                        close_downstream_connection_socket_after_write = len(chunk) == 0
+                        received = receive(context.upstream_to_downstream_buffer, context.upstream_connection_socket)
+                        if received and (streaming_event_handler := context.streaming_event_handler):
+                            streaming_event_handler.on_chunk_received(received)
+                        close_downstream_connection_socket_after_write = received is not None and not received
                         if close_downstream_connection_socket_after_write:
+                            context.half_closed = True
                             #print(f"[handle_connection/selectors.EVENT_READ/Side.DOWNSTREAM] Unregistering upstream connection socket... ")
                             selector.unregister(context.upstream_connection_socket)
+                        elif should_pause(context.upstream_to_downstream_buffer, context.upstream_to_downstream_watermarks):
+                            # We stop reading from upstream until downstream has caught up
+                            pause_reading(Side.UPSTREAM, context)
                         
-                        #print(f"[handle_connection/selectors.EVENT_READ/Side.UPSTREAM] chunk={chunk}")
+                        #print(f"[handle_connection/selectors.EVENT_READ/Side.UPSTREAM] received={received}")
                         #print(f"[handle_connection/selectors.EVENT_READ/Side.UPSTREAM] close_downstream_connection_socket_after_write={close_downstream_connection_socket_after_write}")
                         if len(context.upstream_to_downstream_buffer) > 0 or close_downstream_connection_socket_after_write:
-                            selector.modify(
+                            watch(
                                 context.downstream_connection_socket, 
                                 selectors.EVENT_WRITE,
-                                data=(Side.DOWNSTREAM, context, False, close_downstream_connection_socket_after_write),
+                                (Side.DOWNSTREAM, context, False, close_downstream_connection_socket_after_write),
                             )
 
                     case Side.DOWNSTREAM:
                         #print(f"[handle_connection/selectors.EVENT_READ/Side.DOWNSTREAM] Reading data from downstream... ")
-                        chunk = context.downstream_connection_socket.recv(BUFFER_SIZE)
-                        context.downstream_to_upstream_buffer += chunk
-                        close_upstream_connection_socket_after_write = len(chunk) == 0
+                        received = receive(context.downstream_to_upstream_buffer, context.downstream_connection_socket)
+                        if received and (streaming_event_handler := context.streaming_event_handler):
+                            streaming_event_handler.on_chunk_sent(received)
+                        close_upstream_connection_socket_after_write = received is not None and not received
                         if close_upstream_connection_socket_after_write:
+                            context.half_closed = True
                             #print(f"[handle_connection/selectors.EVENT_READ/Side.DOWNSTREAM] Unregistering downstream connection socket... ")
                             selector.unregister(context.downstream_connection_socket)
+                        elif should_pause(context.downstream_to_upstream_buffer, context.downstream_to_upstream_watermarks):
+                            # We stop reading from downstream until upstream has caught up
+                            pause_reading(Side.DOWNSTREAM, context)
 
-                        #print(f"[handle_connection/selectors.EVENT_READ/Side.DOWNSTREAM] chunk={chunk}")
+                        #print(f"[handle_connection/selectors.EVENT_READ/Side.DOWNSTREAM] received={received}")
                         #print(f"[handle_connection/selectors.EVENT_READ/Side.DOWNSTREAM] close_upstream_connection_socket_after_write={close_upstream_connection_socket_after_write}")
                         if len(context.downstream_to_upstream_buffer) > 0 or close_upstream_connection_socket_after_write:
-                            selector.modify(
+                            watch(
                                 context.upstream_connection_socket, 
                                 selectors.EVENT_WRITE,
-                                data=(Side.UPSTREAM, context, close_upstream_connection_socket_after_write, False),
+                                (Side.UPSTREAM, context, close_upstream_connection_socket_after_write, False),
                             )
 
             if mask & selectors.EVENT_WRITE:
                 match side:
                     case Side.UPSTREAM:
-                        if len(context.last_full_downstream_to_upstream_buffer) == 0:
-                            context.last_full_downstream_to_upstream_buffer = context.downstream_to_upstream_buffer
-
                         #print(f"[handle_connection/selectors.EVENT_WRITE/Side.UPSTREAM] Sending data from downstream to upstream... ")
                         try:
-                            n = context.upstream_connection_socket.send(context.downstream_to_upstream_buffer)
-                            context.downstream_to_upstream_buffer = context.downstream_to_upstream_buffer[n:]
+                            chunk = send(context.downstream_to_upstream_buffer, context.upstream_connection_socket, context)
+                            if context.event_handler:
+                                context.last_full_downstream_to_upstream_buffer += chunk
                         except BrokenPipeError:
-                            selector.unregister(context.downstream_connection_socket)
-                            context.downstream_connection_socket.shutdown(socket.SHUT_RDWR)
-                            context.downstream_connection_socket.close()
+                            close_connection(context)
                             return
 
                         if len(context.downstream_to_upstream_buffer) == 0:
-                            if event_handler := self._event_handler:
+                            if event_handler := context.event_handler:
                                 if len(context.last_full_downstream_to_upstream_buffer) > 0:
-                                    event_handler.on_data_sent(context.last_full_downstream_to_upstream_buffer)
-                            context.last_full_downstream_to_upstream_buffer = b""
+                                    event_handler.on_data_sent(bytes(context.last_full_downstream_to_upstream_buffer))
+                            context.last_full_downstream_to_upstream_buffer.clear()
 
                             if close_upstream_connection_socket_after_write:
-                                selector.unregister(context.upstream_connection_socket)
-                                context.upstream_connection_socket.shutdown(socket.SHUT_RDWR)
-                                context.upstream_connection_socket.close()
+                                # Downstream is gone and everything it sent has been forwarded
+                                close_connection(context)
+                                return
                             else:
-                                selector.modify(
+                                watch(
                                     context.upstream_connection_socket, 
-                                    selectors.EVENT_READ,
-                                    data=(Side.UPSTREAM, context, None, None),
+                                    0 if context.upstream_paused else selectors.EVENT_READ,
+                                    (Side.UPSTREAM, context, None, None),
                                 )
 
+                        if context.downstream_paused and len(context.downstream_to_upstream_buffer) <= context.downstream_to_upstream_watermarks.low:
+                            resume_reading(Side.DOWNSTREAM, context)
+
                     case Side.DOWNSTREAM:
-                        if len(context.last_full_upstream_to_downstream_buffer) == 0:
-                            context.last_full_upstream_to_downstream_buffer = context.upstream_to_downstream_buffer
                         #print(f"[handle_connection/selectors.EVENT_WRITE/Side.DOWNSTREAM] Sending data from upstream to downstream... ")
                         try:
-                            n = context.downstream_connection_socket.send(context.upstream_to_downstream_buffer)
-                            context.upstream_to_downstream_buffer = context.upstream_to_downstream_buffer[n:]
+                            chunk = send(context.upstream_to_downstream_buffer, context.downstream_connection_socket, context)
+                            if context.event_handler:
+                                context.last_full_upstream_to_downstream_buffer += chunk
                         except BrokenPipeError:
-                            selector.unregister(context.upstream_connection_socket)
-                            context.upstream_connection_socket.shutdown(socket.SHUT_RDWR)
-                            context.upstream_connection_socket.close()
+                            close_connection(context)
                             return
                         
                         if len(context.upstream_to_downstream_buffer) == 0:
-                            if event_handler := self._event_handler:
+                            if event_handler := context.event_handler:
                                 if len(context.last_full_upstream_to_downstream_buffer) > 0:
-                                    event_handler.on_data_received(context.last_full_upstream_to_downstream_buffer)
-                            context.last_full_upstream_to_downstream_buffer = b""
+                                    event_handler.on_data_received(bytes(context.last_full_upstream_to_downstream_buffer))
+                            context.last_full_upstream_to_downstream_buffer.clear()
                                 
                             if close_downstream_connection_socket_after_write:
-                                selector.unregister(context.downstream_connection_socket)
-                                context.downstream_connection_socket.shutdown(socket.SHUT_RDWR)
-                                context.downstream_connection_socket.close()
+                                # Upstream is gone and everything it sent has been forwarded
+                                close_connection(context)
+                                return
                             else:
-                                selector.modify(
+                                watch(
                                     context.downstream_connection_socket, 
-                                    selectors.EVENT_READ,
-                                    data=(Side.DOWNSTREAM, context, None, None),
+                                    0 if context.downstream_paused else selectors.EVENT_READ,
+                                    (Side.DOWNSTREAM, context, None, None),
                                 )
 
-        def loop(command_queue: Queue):
-            while True:
-                events = selector.select()
-                try:
-                    command = command_queue.get_nowait()
-                except Empty:
-                    command = Command.CONTINUE_LOOP
-
-                #print(f"[loop] command={command}")
-
-                if command == Command.BREAK_LOOP:
-                    break
-
-                for key, mask in events:
-                    if downstream_server_socket.fileno() == key.fileobj.fileno():
-                        accept_connection()
-                    else:
-                        side, context, close_upstream_connection_socket_after_write, close_downstream_connection_socket_after_write = key.data
-                        handle_connection(
-                            side, 
-                            context, 
-                            close_upstream_connection_socket_after_write, 
-                            close_downstream_connection_socket_after_write, 
-                            mask,
-                        )
+                        if context.upstream_paused and len(context.upstream_to_downstream_buffer) <= context.upstream_to_downstream_watermarks.low:
+                            resume_reading(Side.UPSTREAM, context)
 
-        self._command_queue = Queue()
+        def stop_accepting():
+            selector.unregister(downstream_server_socket)
+            # The connections still waiting in the backlog are refused, rather than left hanging
+            downstream_server_socket.close()
+            # Nothing is left to hand off either (unless it was just handed off)
+            if handoff_server is not None and not handoff_server.accepted:
+                selector.unregister(handoff_server)
+
+        def loop(command_queue: Queue):
+            # Set once draining, after which the loop breaks as soon as no connection is left
+            drain_deadline: float | None = None
+            if handoff := self._handoff:
+                for connection in handoff.connections:
+                    adopt_connection(connection)
+            try:
+                while drain_deadline is None or (contexts and monotonic() < drain_deadline):
+                    deadline = min(
+                        [
+                            deadline
+                            for deadline in (
+                                drain_deadline,
+                                admission_control.next_deadline if admission_control is not None else None,
+                                connecting[0][0] if connecting else None,
+                            )
+                            if deadline is not None
+                        ],
+                        default=None,
+                    )
+                    events = selector.select(None if deadline is None else max(deadline - monotonic(), 0))
+                    if admission_control is not None:
+                        # The clients which waited for too long are turned away
+                        for context in admission_control.expire():
+                            reject(context.downstream_connection_socket, admission_control.rejection)
+                            close_connection(context)
+                    for key, mask in events:
+                        if key.fileobj is wakeup:
+                            # The commands are only looked at when `stop` woke the loop up
+                            wakeup.clear()
+                            while True:
+                                try:
+                                    command, grace_period = command_queue.get_nowait()
+                                except Empty:
+                                    break
+                                if command == Command.BREAK_LOOP:
+                                    return
+                                if drain_deadline is None:
+                                    stop_accepting()
+                                    drain_deadline = monotonic() + grace_period
+                        elif key.fileobj is downstream_server_socket:
+                            # Once draining, the server socket is closed even if this event came with the wakeup
+                            if drain_deadline is None:
+                                accept_connection()
+                        elif key.fileobj is handoff_server:
+                            if drain_deadline is None and hand_off_connections():
+                                stop_accepting()
+                                drain_deadline = monotonic() + HANDOFF_GRACE_PERIOD_IN_SECONDS
+                        else:
+                            # An earlier event of the batch may have changed (or removed) the registration, whose data
+                            # is then the one to go with
+                            try:
+                                key = selector.get_key(key.fileobj)
+                            except (KeyError, ValueError):
+                                continue
+                            if not (mask := mask & key.events):
+                                continue
+                            side, context, close_upstream_connection_socket_after_write, close_downstream_connection_socket_after_write = key.data
+                            handle_connection(
+                                side, 
+                                context, 
+                                close_upstream_connection_socket_after_write, 
+                                close_downstream_connection_socket_after_write, 
+                                mask,
+                            )
+                    # The upstreams which did not answer in time are failed over (once the events of the batch are
+                    # handled, as one of them may be the connection they were waiting for)
+                    expire_connects()
+            finally:
+                # What is left once stopped (or once the grace period is over) is cut, and no waiter takes its place
+                if admission_control is not None:
+                    admission_control.clear()
+                for context in list(contexts):
+                    close_connection(context)
+                if drain_deadline is None:
+                    stop_accepting()
 
         self._loop_thread = Thread(target=loop, args=(self._command_queue,))
 
         self._loop_thread.start()
         self._exit_stack.callback(self._loop_thread.join)
-
-        return self
     
 
-    def _dummy_connect(self):
-        dummy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        dummy_socket.connect(self._local_host_and_port.as_tuple())
-        dummy_socket.shutdown(socket.SHUT_RDWR)
-        dummy_socket.close()
-
-    def stop(self, wait_for=True):
-        self._command_queue.put(Command.BREAK_LOOP)
-        try:
-            self._dummy_connect()
-        except Exception:
-            pass
+    def stop(self, wait_for=True, grace_period: float | None = None):
+        """Stops forwarding right away or, with a `grace_period` (in seconds), stops accepting and lets the live
+        connections end by themselves until then."""
+
+        if asyncio_engine := self._asyncio_engine:
+            asyncio_engine.stop(grace_period)
+        elif epoll_engine := self._epoll_engine:
+            epoll_engine.stop(grace_period)
+        elif wakeup := self._wakeup:
+            self._command_queue.put((Command.BREAK_LOOP, None) if grace_period is None else (Command.DRAIN_LOOP, grace_period))
+            wakeup.wake()
         if wait_for:
             self.wait_for()
 
@@ -284,4 +860,32 @@ class SocketForwarder():
         self._exit_stack.close()
 
     def wait_for(self):
-        self._loop_thread.join()
\ No newline at end of file
+        self._loop_thread.join()
+
+
+def run_socket_forwarder_worker(
+    local_host_and_port: HostAndPort,
+    remote_host_and_port: HostAndPort,
+    event_hander: EventHandler | StreamingEventHandler | None,
+    ready: Callable[[], None],
+    engine: Engine = Engine.SELECTORS,
+    fallback_host_and_ports: list[HostAndPort] | None = None,
+    health_check: HealthCheck | None = None,
+    upstream_to_downstream_watermarks: Watermarks | None = None,
+    downstream_to_upstream_watermarks: Watermarks | None = None,
+    memory_budget: MemoryBudget | None = None,
+):
+    with SocketForwarder(
+        local_host_and_port,
+        remote_host_and_port,
+        event_hander,
+        reuse_port=True,
+        engine=engine,
+        fallback_host_and_ports=fallback_host_and_ports,
+        health_check=health_check,
+        upstream_to_downstream_watermarks=upstream_to_downstream_watermarks,
+        downstream_to_upstream_watermarks=downstream_to_upstream_watermarks,
+        memory_budget=memory_budget,
+    ) as socket_forwarder:
+        ready()
+        socket_forwarder.wait_for()
@@ -0,0 +1,106 @@
+import fcntl
+import os
+import socket
+from weakref import finalize
+
+
+SPLICE_SUPPORTED = hasattr(os, "splice")
+
+SPLICE_PIPE_CAPACITY = 1024 * 1024
+
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+F_GETPIPE_SZ = getattr(fcntl, "F_GETPIPE_SZ", 1032)
+
+
+class SplicePipe():
+    """A kernel pipe used as a buffer: bytes are moved between sockets with `splice` and never reach Python."""
+
+    _read_fd: int
+    _write_fd: int
+
+    _capacity: int
+    _length: int
+    # The pipe holds its bytes in a fixed number of slots, and each spliced segment takes one of them: many small
+    # segments fill the pipe well before its capacity in bytes
+    _out_of_slots: bool
+
+    def __init__(self, capacity: int = SPLICE_PIPE_CAPACITY):
+        self._read_fd, self._write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        finalize(self, _close_pipe, self._read_fd, self._write_fd)
+
+        try:
+            self._capacity = fcntl.fcntl(self._write_fd, F_SETPIPE_SZ, capacity)
+        except OSError:
+            # The capacity is capped by /proc/sys/fs/pipe-max-size for unprivileged processes
+            self._capacity = fcntl.fcntl(self._write_fd, F_GETPIPE_SZ)
+
+        self._length = 0
+        self._out_of_slots = False
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def is_full(self) -> bool:
+        return self._out_of_slots or self._length >= self._capacity
+
+    def recv_from(self, connection_socket: socket.socket) -> int | None:
+        """Returns how many bytes were read (0 once the socket is closed), or None if none could be read."""
+
+        try:
+            n = os.splice(
+                connection_socket.fileno(),
+                self._write_fd,
+                self._capacity - self._length,
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+            )
+        except BlockingIOError:
+            # Either the socket has nothing to read, or the pipe is out of slots (which an empty one cannot be), and
+            # then the socket must not be read again before `send_to` frees some
+            self._out_of_slots = self._length > 0
+            return None
+        self._length += n
+        return n
+
+    def take(self) -> bytes:
+        # Everything which is buffered, as when the connection is handed off to another process
+        data = bytearray()
+        while len(data) < self._length:
+            data += os.read(self._read_fd, self._length - len(data))
+        self._length = 0
+        self._out_of_slots = False
+        return bytes(data)
+
+    def extend(self, data: bytes) -> None:
+        # What `take` returned, put back as when the handoff failed: the pipe it came from has room for it
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(self._write_fd, view):]
+        self._length += len(data)
+
+    def send_to(self, connection_socket: socket.socket) -> int:
+        if self._length == 0:
+            return 0
+
+        try:
+            n = os.splice(
+                self._read_fd,
+                connection_socket.fileno(),
+                self._length,
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+            )
+        except BlockingIOError:
+            # The socket is full: the rest is sent once it is writable
+            return 0
+        self._length -= n
+        if n > 0:
+            self._out_of_slots = False
+        return n
+
+
+def _close_pipe(read_fd: int, write_fd: int):
+    os.close(read_fd)
+    os.close(write_fd)
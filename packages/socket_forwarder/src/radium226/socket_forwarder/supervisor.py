@@ -0,0 +1,122 @@
+from contextlib import ExitStack
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from threading import Thread, Event
+from typing import Callable, Protocol
+import logging
+
+
+RESTART_DELAY_IN_SECONDS = 1.0
+
+READY_TIMEOUT_IN_SECONDS = 30.0
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerTarget(Protocol):
+
+    def __call__(self, ready: Callable[[], None]) -> None:
+        ...
+
+
+def _run_worker(target: WorkerTarget, ready_event) -> None:
+    target(ready_event.set)
+
+
+class Supervisor():
+    """Starts `worker_count` processes running the same target, restarts the ones which exit and stops them all on exit."""
+
+    _target: WorkerTarget
+    _worker_count: int
+
+    _exit_stack: ExitStack
+
+    _workers: list
+    _monitor_thread: Thread | None
+    _stopping: Event
+
+    def __init__(self,
+        target: WorkerTarget,
+        worker_count: int,
+        restart_delay: float = RESTART_DELAY_IN_SECONDS,
+        ready_timeout: float = READY_TIMEOUT_IN_SECONDS,
+    ):
+        self._target = target
+        self._worker_count = worker_count
+        self._restart_delay = restart_delay
+        self._ready_timeout = ready_timeout
+
+        # Workers are spawned rather than forked, so the target must be picklable
+        self._context = get_context("spawn")
+        self._exit_stack = ExitStack()
+        self._workers = []
+        self._monitor_thread = None
+        self._stopping = Event()
+
+    @property
+    def worker_count(self) -> int:
+        return self._worker_count
+
+    @property
+    def pids(self) -> list[int]:
+        return [worker.pid for worker in self._workers]
+
+    def _start_worker(self):
+        ready_event = self._context.Event()
+        worker = self._context.Process(target=_run_worker, args=(self._target, ready_event), daemon=True)
+        worker.start()
+        return worker, ready_event
+
+    def _monitor(self):
+        while not self._stopping.is_set():
+            sentinels = [worker.sentinel for worker in self._workers]
+            for sentinel in wait(sentinels, timeout=self._restart_delay):
+                if self._stopping.is_set():
+                    break
+
+                index = sentinels.index(sentinel)
+                dead_worker = self._workers[index]
+                dead_worker.join()
+                logger.warning("Worker %d exited with code %s, restarting it", dead_worker.pid, dead_worker.exitcode)
+                self._stopping.wait(self._restart_delay)
+                if not self._stopping.is_set():
+                    self._workers[index], _ = self._start_worker()
+
+    def __enter__(self):
+        started_workers = [self._start_worker() for _ in range(self._worker_count)]
+        self._workers = [worker for worker, _ in started_workers]
+        self._exit_stack.callback(self.stop)
+
+        try:
+            for worker, ready_event in started_workers:
+                if not ready_event.wait(self._ready_timeout):
+                    raise TimeoutError(f"Worker {worker.pid} did not become ready")
+        except BaseException:
+            # `__exit__` is not called when `__enter__` fails, so the workers would be left running
+            self.stop()
+            raise
+
+        self._monitor_thread = Thread(target=self._monitor, daemon=True)
+        self._monitor_thread.start()
+        return self
+
+    def wait_for(self):
+        if monitor_thread := self._monitor_thread:
+            monitor_thread.join()
+
+    def stop(self):
+        self._stopping.set()
+        if monitor_thread := self._monitor_thread:
+            monitor_thread.join()
+            self._monitor_thread = None
+
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __exit__(self, type, value, traceback):
+        self._exit_stack.close()
+        return False
@@ -0,0 +1,63 @@
+import os
+
+
+EVENTFD_SUPPORTED = hasattr(os, "eventfd")
+
+
+class Wakeup():
+    """A file descriptor to register in a selector (or in epoll), which becomes readable when another thread wakes it.
+
+    It is an eventfd where it exists, and the read end of a self-pipe elsewhere. The loop only looks at why it was
+    woken up when this file descriptor is among its events, so that serving the connections costs nothing more.
+    """
+
+    _read_fd: int
+    _write_fd: int
+
+    def __init__(self):
+        if EVENTFD_SUPPORTED:
+            self._read_fd = self._write_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._read_fd, self._write_fd = os.pipe()
+            for fd in (self._read_fd, self._write_fd):
+                os.set_blocking(fd, False)
+
+    def fileno(self) -> int:
+        return self._read_fd
+
+    def wake(self):
+        # Already closed with the loop
+        if self._write_fd == -1:
+            return
+        try:
+            if EVENTFD_SUPPORTED:
+                os.eventfd_write(self._write_fd, 1)
+            else:
+                os.write(self._write_fd, b"\x00")
+        except BlockingIOError:
+            # It does not matter how many times the loop is woken before it wakes up, so a full pipe is fine
+            pass
+
+    def clear(self):
+        try:
+            if EVENTFD_SUPPORTED:
+                os.eventfd_read(self._read_fd)
+            else:
+                while os.read(self._read_fd, 4096):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        read_fd, write_fd = self._read_fd, self._write_fd
+        # A late `wake` then fails on -1, rather than writing to a file descriptor reused since
+        self._read_fd = self._write_fd = -1
+        os.close(read_fd)
+        if write_fd != read_fd:
+            os.close(write_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,57 @@
+import asyncio
+
+from pytest import raises
+
+from radium226.socket_forwarder import AdmissionControl, AsyncioAdmission, AdmissionTimeoutError
+
+
+def test_admission_control() -> None:
+    admission_control = AdmissionControl(limit=2, key_limit=1)
+    assert admission_control.admit("alice", "first")
+    # Alice is at her limit, but Bob can still get the last place
+    assert not admission_control.admit("alice", "second")
+    assert not admission_control.admit("alice", "third")
+    assert admission_control.admit("bob", "fourth")
+    assert not admission_control.admit("bob", "fifth")
+    assert admission_control.waiting_count == 3
+
+    # The waiters are admitted in FIFO order, passing over the ones of a key at its limit
+    assert admission_control.release("bob") == ["fifth"]
+    assert admission_control.release("alice") == ["second"]
+    assert admission_control.cancel("third")
+    assert admission_control.release("alice") == []
+    assert admission_control.active_count == 1
+
+
+def test_admission_control_expire() -> None:
+    admission_control = AdmissionControl(limit=1, timeout=10)
+    assert admission_control.admit(None, "first")
+    assert not admission_control.admit(None, "second")
+    deadline = admission_control.next_deadline
+
+    assert admission_control.expire(deadline - 1) == []
+    assert admission_control.expire(deadline) == ["second"]
+    assert admission_control.timeout_count == 1
+    assert admission_control.next_deadline is None
+
+
+def test_asyncio_admission() -> None:
+    async def run():
+        admission = AsyncioAdmission(AdmissionControl(limit=1, timeout=0.2))
+        await admission.admit(None)
+        waiter = asyncio.create_task(admission.admit(None))
+        await asyncio.sleep(0)
+        admission.release(None)
+        await waiter
+
+        # The cancelled waiters give their place up, and the next ones time out
+        cancelled = asyncio.create_task(admission.admit(None))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with raises(AdmissionTimeoutError):
+            await admission.admit(None)
+        assert admission.admission_control.waiting_count == 0
+        admission.release(None)
+        assert admission.admission_control.active_count == 0
+
+    asyncio.run(run())
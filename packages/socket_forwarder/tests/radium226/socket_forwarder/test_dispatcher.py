@@ -0,0 +1,127 @@
+from itertools import count
+from threading import Event
+from typing import Iterator
+
+from radium226.socket_forwarder import (
+    DispatchingEventHandler, 
+    EventHandler,
+    StreamingEventHandler,
+    OverflowPolicy,
+)
+
+
+class RecordingEventHandler(EventHandler):
+
+    def __init__(self, records: list, unblocked: Event, connection_ids: Iterator[int] | None = None):
+        self._records = records
+        self._unblocked = unblocked
+        self._connection_ids = connection_ids or count()
+        self._connection_id = None
+
+    def for_connection(self) -> "RecordingEventHandler":
+        connection_event_handler = type(self)(self._records, self._unblocked, self._connection_ids)
+        connection_event_handler._connection_id = next(self._connection_ids)
+        return connection_event_handler
+
+    def on_data_sent(self, buffer: bytes):
+        self._unblocked.wait()
+        self._records.append((self._connection_id, buffer))
+
+    def on_data_received(self, buffer: bytes):
+        pass
+
+
+def test_dispatcher_keeps_the_order_of_each_connection() -> None:
+    records = []
+    unblocked = Event()
+    unblocked.set()
+    with DispatchingEventHandler(RecordingEventHandler(records, unblocked), worker_count=2, overflow_policy=OverflowPolicy.BLOCK) as dispatcher:
+        connection_event_handlers = [dispatcher.for_connection() for _ in range(3)]
+        for index in range(100):
+            for connection_event_handler in connection_event_handlers:
+                connection_event_handler.on_data_sent(index.to_bytes(1))
+        for connection_event_handler in connection_event_handlers:
+            connection_event_handler.on_connection_closed()
+
+    assert dispatcher.dropped_count == 0
+    buffers_by_connection = {}
+    for connection_id, buffer in records:
+        buffers_by_connection.setdefault(connection_id, []).append(buffer)
+    assert list(buffers_by_connection.values()) == [[index.to_bytes(1) for index in range(100)]] * 3
+
+
+def test_dispatcher_drops_events_when_full() -> None:
+    records = []
+    unblocked = Event()
+    with DispatchingEventHandler(RecordingEventHandler(records, unblocked), queue_size=1, overflow_policy=OverflowPolicy.DROP) as dispatcher:
+        connection_event_handler = dispatcher.for_connection()
+        for index in range(10):
+            connection_event_handler.on_data_sent(index.to_bytes(1))
+        unblocked.set()
+        connection_event_handler.on_connection_closed()
+
+    assert dispatcher.dropped_count >= 8
+    # Once an event is dropped, the handler would not make sense of the rest of the stream
+    assert [buffer for _, buffer in records] == [index.to_bytes(1) for index in range(10 - dispatcher.dropped_count)]
+
+
+def test_dispatcher_samples_connections() -> None:
+    records = []
+    unblocked = Event()
+    unblocked.set()
+    with DispatchingEventHandler(RecordingEventHandler(records, unblocked), overflow_policy=OverflowPolicy.SAMPLE, sample_every=4) as dispatcher:
+        for _ in range(8):
+            connection_event_handler = dispatcher.for_connection()
+            connection_event_handler.on_data_sent(b"SELECT 1")
+            connection_event_handler.on_connection_closed()
+
+    assert len(records) == 2
+
+
+class ClosingEventHandler(RecordingEventHandler):
+
+    def on_connection_closed(self):
+        self._records.append((self._connection_id, None))
+
+
+def test_dispatcher_delivers_the_ends_of_connections_when_full() -> None:
+    records = []
+    unblocked = Event()
+    with DispatchingEventHandler(ClosingEventHandler(records, unblocked), queue_size=1, overflow_policy=OverflowPolicy.DROP) as dispatcher:
+        connection_event_handlers = [dispatcher.for_connection() for _ in range(3)]
+        for connection_event_handler in connection_event_handlers:
+            connection_event_handler.on_data_sent(b"SELECT 1")
+        # The queue is full, but the forwarding loop does not wait for the handler to close the connections
+        for connection_event_handler in connection_event_handlers:
+            connection_event_handler.on_connection_closed()
+        unblocked.set()
+
+    closed_connection_ids = [connection_id for connection_id, buffer in records if buffer is None]
+    opened_connection_ids = [connection_id for connection_id, buffer in records if buffer is not None]
+    assert sorted(closed_connection_ids) == sorted(opened_connection_ids)
+
+
+class RecordingStreamingEventHandler(StreamingEventHandler):
+
+    def __init__(self, records: list):
+        self._records = records
+
+    def on_chunk_sent(self, chunk: memoryview):
+        self._records.append(bytes(chunk))
+
+    def on_chunk_received(self, chunk: memoryview):
+        pass
+
+
+def test_dispatcher_with_streaming_event_handler() -> None:
+    records = []
+    with DispatchingEventHandler(RecordingStreamingEventHandler(records), overflow_policy=OverflowPolicy.BLOCK) as dispatcher:
+        connection_event_handler = dispatcher.for_connection()
+        # The forwarding loops then see a streaming handler, whose chunks are copied as they are only valid during the call
+        assert dispatcher.streaming and isinstance(connection_event_handler, StreamingEventHandler)
+        chunk = bytearray(b"SELECT 1")
+        connection_event_handler.on_chunk_sent(memoryview(chunk))
+        chunk[:] = b"SELECT 2"
+        connection_event_handler.on_connection_closed()
+
+    assert records == [b"SELECT 1"]
@@ -0,0 +1,54 @@
+import socket
+from contextlib import closing
+from pathlib import Path
+from threading import Thread
+
+from radium226.socket_forwarder import HostAndPort
+from radium226.socket_forwarder.handoff import HandoffServer, HandedOffConnection, request_handoff, hand_off
+
+
+def test_handoff(tmp_path: Path) -> None:
+    handoff_path = tmp_path / "handoff.sock"
+    # Nobody to take over from yet
+    assert request_handoff(handoff_path, with_connections=True) is None
+
+    server_socket = socket.create_server(("localhost", 0))
+    (client_socket, downstream_socket), (upstream_socket, postgresql_socket) = socket.socketpair(), socket.socketpair()
+    connection = HandedOffConnection(
+        downstream_connection_socket=downstream_socket,
+        upstream_connection_socket=upstream_socket,
+        remote_host_and_port=HostAndPort("localhost", 5432),
+        upstream_to_downstream_bytes=b"Z\x00\x00\x00\x05I",
+        downstream_to_upstream_bytes=b"",
+    )
+
+    handoff_server = HandoffServer(handoff_path)
+
+    def serve_handoff():
+        handoff_socket, with_connections = handoff_server.accept()
+        hand_off(handoff_socket, server_socket, [connection] if with_connections else [])
+
+    thread = Thread(target=serve_handoff)
+    thread.start()
+    handoff = request_handoff(handoff_path, with_connections=True)
+    thread.join()
+    # The path is the next process's from now on
+    assert not handoff_path.exists()
+    handoff_server.close()
+
+    with closing(server_socket), closing(handoff.downstream_server_socket):
+        assert handoff.downstream_server_socket.getsockname() == server_socket.getsockname()
+
+    handed_off_connection, = handoff.connections
+    assert handed_off_connection.remote_host_and_port == connection.remote_host_and_port
+    assert handed_off_connection.upstream_to_downstream_bytes == connection.upstream_to_downstream_bytes
+    assert handed_off_connection.downstream_to_upstream_bytes == b""
+
+    # The received sockets are duplicates of the sent ones, which can be closed without cutting anything
+    for sent_socket in (downstream_socket, upstream_socket):
+        sent_socket.close()
+    with closing(client_socket), closing(postgresql_socket), closing(handed_off_connection.downstream_connection_socket), closing(handed_off_connection.upstream_connection_socket):
+        handed_off_connection.upstream_connection_socket.sendall(b"Q")
+        assert postgresql_socket.recv(1) == b"Q"
+        client_socket.sendall(b"X")
+        assert handed_off_connection.downstream_connection_socket.recv(1) == b"X"
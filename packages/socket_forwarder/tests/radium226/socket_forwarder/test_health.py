@@ -0,0 +1,76 @@
+import logging
+import socket
+from contextlib import closing
+from threading import Thread
+from time import sleep
+
+from radium226.pg.random_port import random_port
+from radium226.socket_forwarder import CircuitBreaker, CircuitState, HealthCheck, HealthChecker, HostAndPort
+
+
+def test_circuit_breaker() -> None:
+    circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == CircuitState.CLOSED
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == CircuitState.OPEN
+    assert not circuit_breaker.allows()
+
+    sleep(0.1)
+    assert circuit_breaker.state == CircuitState.HALF_OPEN
+    # The upstream is not back yet, so a single failure opens the circuit again
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == CircuitState.OPEN
+
+    sleep(0.1)
+    circuit_breaker.record_success()
+    assert circuit_breaker.state == CircuitState.CLOSED
+
+
+def test_health_checker() -> None:
+    def probe(connection_socket: socket.socket):
+        if connection_socket.recv(5) != b"hello":
+            raise ConnectionError("The upstream did not say hello")
+
+    def greet(server_socket: socket.socket):
+        while True:
+            try:
+                connection_socket, _ = server_socket.accept()
+            except OSError:
+                break
+            with closing(connection_socket):
+                connection_socket.sendall(b"hello")
+
+    # The healthy upstream greets each connection, while the silent one accepts them but says nothing
+    with closing(socket.create_server(("localhost", 0))) as healthy_server_socket, closing(socket.create_server(("localhost", 0))) as silent_server_socket:
+        Thread(target=greet, args=(healthy_server_socket,), daemon=True).start()
+        healthy_host_and_port = HostAndPort.from_tuple(healthy_server_socket.getsockname())
+        silent_host_and_port = HostAndPort.from_tuple(silent_server_socket.getsockname())
+        dead_host_and_port = HostAndPort("localhost", random_port())
+
+        health_checker = HealthChecker(
+            [dead_host_and_port, silent_host_and_port, healthy_host_and_port],
+            HealthCheck(probe=probe, timeout=0.1, failure_threshold=1),
+        )
+        assert not health_checker.check(dead_host_and_port)
+        assert not health_checker.check(silent_host_and_port)
+        assert health_checker.check(healthy_host_and_port)
+        assert health_checker.available_host_and_ports() == [healthy_host_and_port]
+
+
+def test_health_checker_reports_changes(caplog) -> None:
+    caplog.set_level(logging.INFO)
+    with closing(socket.create_server(("localhost", 0))) as server_socket:
+        host_and_port = HostAndPort.from_tuple(server_socket.getsockname())
+        health_checker = HealthChecker([host_and_port], HealthCheck(timeout=0.1))
+
+        assert health_checker.check(host_and_port)
+    # The upstream is reported once it fails, rather than at each of its probes
+    for _ in range(3):
+        assert not health_checker.check(host_and_port)
+    assert [record.levelname for record in caplog.records] == ["WARNING"]
+
+    with closing(socket.create_server(host_and_port.as_tuple())):
+        assert health_checker.check(host_and_port)
+        assert health_checker.check(host_and_port)
+    assert [record.levelname for record in caplog.records] == ["WARNING", "INFO"]
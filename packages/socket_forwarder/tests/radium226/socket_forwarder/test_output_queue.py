@@ -0,0 +1,44 @@
+import socket
+from contextlib import closing
+
+from pytest import mark
+
+from radium226.socket_forwarder import OutputQueue
+from radium226.socket_forwarder.output_queue import TCP_CORK
+
+
+def test_output_queue() -> None:
+    left_socket, right_socket = socket.socketpair()
+    with closing(left_socket), closing(right_socket):
+        left_socket.setblocking(False)
+        output_queue = OutputQueue(left_socket)
+
+        messages = [bytes([index]) * (index * 4096) for index in range(64)]
+        for message in messages:
+            output_queue.append(message)
+        assert len(output_queue) == sum(len(message) for message in messages)
+
+        # The socket takes only part of the messages at once, and the rest is written by the next flushes
+        received = bytearray()
+        while len(output_queue) > 0:
+            output_queue.flush()
+            received += right_socket.recv(1024 * 1024)
+        while len(received) < sum(len(message) for message in messages):
+            received += right_socket.recv(1024 * 1024)
+        assert bytes(received) == b"".join(messages)
+
+
+@mark.skipif(TCP_CORK is None, reason="TCP_CORK is only available on Linux")
+def test_output_queue_with_cork() -> None:
+    with closing(socket.create_server(("localhost", 0))) as server_socket:
+        with closing(socket.create_connection(server_socket.getsockname())) as client_socket:
+            connection_socket, _ = server_socket.accept()
+            with closing(connection_socket):
+                output_queue = OutputQueue(connection_socket, cork=True)
+                output_queue.append(b"C" * 13)
+                # The socket stays corked while the queue is not drained
+                assert connection_socket.getsockopt(socket.IPPROTO_TCP, TCP_CORK) == 1
+                output_queue.append(b"Z" * 6)
+                output_queue.flush()
+                assert connection_socket.getsockopt(socket.IPPROTO_TCP, TCP_CORK) == 0
+                assert client_socket.recv(13 + 6, socket.MSG_WAITALL) == b"C" * 13 + b"Z" * 6
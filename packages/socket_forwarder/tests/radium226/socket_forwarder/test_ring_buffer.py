@@ -0,0 +1,161 @@
+import socket
+from contextlib import closing
+
+from pytest import mark
+
+from radium226.socket_forwarder.ring_buffer import RingBuffer
+from radium226.socket_forwarder.splice_pipe import SplicePipe, SPLICE_SUPPORTED
+
+
+def test_ring_buffer_wraps_around() -> None:
+    ring_buffer = RingBuffer(capacity=8)
+
+    view = ring_buffer.writable_view()
+    view[:6] = b"abcdef"
+    ring_buffer.commit(6)
+    ring_buffer.consume(4)
+
+    view = ring_buffer.writable_view()
+    assert len(view) == 2
+    view[:2] = b"gh"
+    ring_buffer.commit(2)
+
+    view = ring_buffer.writable_view()
+    assert len(view) == 4
+    view[:3] = b"ijk"
+    ring_buffer.commit(3)
+
+    assert len(ring_buffer) == 7
+    assert bytes(ring_buffer.readable_view()) == b"efgh"
+    ring_buffer.consume(4)
+    assert bytes(ring_buffer.readable_view()) == b"ijk"
+
+
+def test_ring_buffer_grows_when_full() -> None:
+    ring_buffer = RingBuffer(capacity=4)
+
+    ring_buffer.writable_view()[:4] = b"abcd"
+    ring_buffer.commit(4)
+    ring_buffer.consume(2)
+    ring_buffer.writable_view()[:2] = b"ef"
+    ring_buffer.commit(2)
+    assert ring_buffer.is_full()
+
+    view = ring_buffer.writable_view()
+    assert ring_buffer.capacity == 8
+    view[:1] = b"g"
+    ring_buffer.commit(1)
+    assert bytes(ring_buffer.readable_view()) == b"cdefg"
+
+
+def test_ring_buffer_with_sockets() -> None:
+    left_socket, right_socket = socket.socketpair()
+    with closing(left_socket), closing(right_socket):
+        ring_buffer = RingBuffer(capacity=16)
+
+        left_socket.sendall(b"Hello, World!")
+        chunk = ring_buffer.recv_from(right_socket)
+        assert bytes(chunk) == b"Hello, World!"
+
+        chunk = ring_buffer.send_to(right_socket)
+        assert bytes(chunk) == b"Hello, World!"
+        assert len(ring_buffer) == 0
+        assert left_socket.recv(16) == b"Hello, World!"
+
+
+def test_ring_buffer_gathers_when_wrapped() -> None:
+    left_socket, right_socket = socket.socketpair()
+    with closing(left_socket), closing(right_socket):
+        ring_buffer = RingBuffer(capacity=8)
+        ring_buffer.writable_view()[:6] = b"abcdef"
+        ring_buffer.commit(6)
+        ring_buffer.consume(4)
+        ring_buffer.writable_view()[:2] = b"gh"
+        ring_buffer.commit(2)
+        ring_buffer.writable_view()[:3] = b"ijk"
+        ring_buffer.commit(3)
+
+        # Both the end and the start of the buffer are written at once
+        assert ring_buffer.gather_to(right_socket) == 7
+        assert len(ring_buffer) == 0
+        assert left_socket.recv(16) == b"efghijk"
+
+
+def test_ring_buffer_with_full_socket() -> None:
+    left_socket, right_socket = socket.socketpair()
+    with closing(left_socket), closing(right_socket):
+        right_socket.setblocking(False)
+        try:
+            while True:
+                right_socket.send(b"x" * 65536)
+        except BlockingIOError:
+            pass
+
+        ring_buffer = RingBuffer(capacity=8)
+        ring_buffer.writable_view()[:5] = b"hello"
+        ring_buffer.commit(5)
+        # Nothing is lost when the socket takes nothing, and it is sent again once the socket is writable
+        assert ring_buffer.gather_to(right_socket) == 0
+        assert len(ring_buffer.send_to(right_socket)) == 0
+        assert len(ring_buffer) == 5
+
+
+@mark.skipif(not SPLICE_SUPPORTED, reason="splice() is only available on Linux")
+def test_splice_pipe_with_sockets() -> None:
+    left_socket, right_socket = socket.socketpair()
+    with closing(left_socket), closing(right_socket):
+        splice_pipe = SplicePipe()
+
+        left_socket.sendall(b"Hello, World!")
+        assert splice_pipe.recv_from(right_socket) == 13
+        assert len(splice_pipe) == 13
+
+        assert splice_pipe.send_to(right_socket) == 13
+        assert len(splice_pipe) == 0
+        assert left_socket.recv(16) == b"Hello, World!"
+
+
+@mark.skipif(not SPLICE_SUPPORTED, reason="splice() is only available on Linux")
+def test_splice_pipe_with_small_segments() -> None:
+    left_socket, right_socket = socket.socketpair()
+    with closing(left_socket), closing(right_socket):
+        right_socket.setblocking(False)
+        # A single page, and so a single slot
+        splice_pipe = SplicePipe(4096)
+        for _ in range(64):
+            left_socket.send(b"x")
+
+        forwarded = 0
+        while forwarded < 64:
+            assert splice_pipe.recv_from(right_socket) > 0
+            # Each segment takes its own slot, so the pipe is full long before its capacity in bytes
+            if splice_pipe.recv_from(right_socket) is None:
+                assert splice_pipe.is_full()
+                assert len(splice_pipe) < splice_pipe.capacity
+            forwarded += splice_pipe.send_to(right_socket)
+            assert not splice_pipe.is_full()
+        assert left_socket.recv(64, socket.MSG_WAITALL) == b"x" * 64
+
+        # Without anything to read, the empty pipe is not full
+        assert splice_pipe.recv_from(right_socket) is None
+        assert not splice_pipe.is_full()
+
+
+@mark.skipif(not SPLICE_SUPPORTED, reason="splice() is only available on Linux")
+def test_splice_pipe_with_full_socket() -> None:
+    left_socket, right_socket = socket.socketpair()
+    with closing(left_socket), closing(right_socket):
+        splice_pipe = SplicePipe()
+        left_socket.sendall(b"Hello, World!")
+        assert splice_pipe.recv_from(right_socket) == 13
+
+        # Nobody reads on the other side, so the socket ends up full
+        right_socket.setblocking(False)
+        try:
+            while True:
+                right_socket.send(b"x" * 65536)
+        except BlockingIOError:
+            pass
+
+        assert splice_pipe.send_to(right_socket) == 0
+        assert len(splice_pipe) == 13
@@ -0,0 +1,503 @@
+import asyncio
+import os
+import signal
+import socket
+import struct
+from contextlib import closing
+from functools import partial
+from multiprocessing import active_children
+from pathlib import Path
+from threading import Thread
+from time import sleep, monotonic
+
+from pytest import fixture, mark, raises
+
+from radium226.pg.random_port import random_port
+from radium226.socket_forwarder import (
+    SocketForwarder, 
+    EventHandler, 
+    StreamingEventHandler,
+    Engine,
+    HostAndPort,
+    Supervisor,
+    HealthCheck,
+    Watermarks,
+    MemoryBudget,
+    AdmissionControl,
+    run_socket_forwarder_worker,
+)
+from radium226.socket_forwarder.epoll_engine import EPOLL_SUPPORTED
+from radium226.socket_forwarder.asyncio_engine import DownstreamProtocol
+
+
+PAYLOAD = bytes(range(256)) * 4096
+
+ENGINES = [Engine.SELECTORS, Engine.ASYNCIO, *([Engine.EPOLL] if EPOLL_SUPPORTED else [])]
+
+
+@fixture
+def echo_server() -> HostAndPort:
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(("localhost", 0))
+    server_socket.listen()
+
+    # Like PostgreSQL, the server reads a whole length-prefixed request before replying to it
+    def echo(connection_socket: socket.socket):
+        with closing(connection_socket):
+            while header := connection_socket.recv(8, socket.MSG_WAITALL):
+                length, = struct.unpack("!Q", header)
+                request = bytearray()
+                while len(request) < length:
+                    request += connection_socket.recv(length - len(request))
+                connection_socket.sendall(request)
+
+    def serve():
+        while True:
+            try:
+                connection_socket, _ = server_socket.accept()
+            except OSError:
+                break
+            Thread(target=echo, args=(connection_socket,), daemon=True).start()
+
+    Thread(target=serve, daemon=True).start()
+    yield HostAndPort.from_tuple(server_socket.getsockname())
+    server_socket.shutdown(socket.SHUT_RDWR)
+    server_socket.close()
+
+
+@fixture
+def firehose_server() -> HostAndPort:
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(("localhost", 0))
+    server_socket.listen()
+
+    # Like PostgreSQL streaming a large result, the server sends everything as fast as the proxy reads it
+    def send_payload(connection_socket: socket.socket):
+        with closing(connection_socket):
+            connection_socket.sendall(PAYLOAD * 8)
+
+    def serve():
+        while True:
+            try:
+                connection_socket, _ = server_socket.accept()
+            except OSError:
+                break
+            Thread(target=send_payload, args=(connection_socket,), daemon=True).start()
+
+    Thread(target=serve, daemon=True).start()
+    yield HostAndPort.from_tuple(server_socket.getsockname())
+    server_socket.shutdown(socket.SHUT_RDWR)
+    server_socket.close()
+
+
+class RecordingEventHandler(EventHandler):
+
+    def __init__(self):
+        self.sent = bytearray()
+        self.received = bytearray()
+
+    def on_data_sent(self, buffer: bytes):
+        self.sent += buffer
+
+    def on_data_received(self, buffer: bytes):
+        self.received += buffer
+
+
+class RecordingStreamingEventHandler(StreamingEventHandler):
+
+    def __init__(self):
+        self.sent = bytearray()
+        self.received = bytearray()
+        self.received_chunk_count = 0
+
+    def on_chunk_sent(self, chunk: memoryview):
+        self.sent += chunk
+
+    def on_chunk_received(self, chunk: memoryview):
+        self.received += chunk
+        self.received_chunk_count += 1
+
+
+def echo_through(host_and_port: HostAndPort, payload: bytes) -> bytes:
+    with closing(socket.create_connection(host_and_port.as_tuple())) as client_socket:
+        client_socket.sendall(struct.pack("!Q", len(payload)) + payload)
+        received = bytearray()
+        while len(received) < len(payload):
+            chunk = client_socket.recv(65536)
+            if not chunk:
+                break
+            received += chunk
+        return bytes(received)
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder(echo_server: HostAndPort, engine: Engine) -> None:
+    event_handler = RecordingEventHandler()
+    local_host_and_port = HostAndPort("localhost", random_port())
+    with SocketForwarder(local_host_and_port, echo_server, event_handler, engine=engine) as socket_forwarder:
+        assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+        socket_forwarder.stop()
+
+    assert bytes(event_handler.sent[8:]) == PAYLOAD
+    assert bytes(event_handler.received) == PAYLOAD
+
+
+# It only matches the protocol, so it has neither `for_connection` nor `on_connection_closed`
+class StructuralEventHandler():
+
+    def __init__(self):
+        self.sent = bytearray()
+
+    def on_data_sent(self, buffer: bytes):
+        self.sent += buffer
+
+    def on_data_received(self, buffer: bytes):
+        pass
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_with_structural_event_handler(echo_server: HostAndPort, engine: Engine) -> None:
+    event_handler = StructuralEventHandler()
+    local_host_and_port = HostAndPort("localhost", random_port())
+    with SocketForwarder(local_host_and_port, echo_server, event_handler, engine=engine) as socket_forwarder:
+        assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+        socket_forwarder.stop()
+
+    assert bytes(event_handler.sent[8:]) == PAYLOAD
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_with_streaming_event_handler(echo_server: HostAndPort, engine: Engine) -> None:
+    event_handler = RecordingStreamingEventHandler()
+    local_host_and_port = HostAndPort("localhost", random_port())
+    with SocketForwarder(local_host_and_port, echo_server, event_handler, engine=engine) as socket_forwarder:
+        assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+        socket_forwarder.stop()
+
+    assert bytes(event_handler.sent[8:]) == PAYLOAD
+    assert bytes(event_handler.received) == PAYLOAD
+    # The answer is seen while it flows, rather than once it has all been forwarded
+    assert event_handler.received_chunk_count > 1
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_without_event_handler(echo_server: HostAndPort, engine: Engine) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    with SocketForwarder(local_host_and_port, echo_server, engine=engine) as socket_forwarder:
+        assert echo_through(local_host_and_port, PAYLOAD * 4) == PAYLOAD * 4
+        socket_forwarder.stop()
+
+
+def test_socket_forwarder_workers(echo_server: HostAndPort) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    target = partial(run_socket_forwarder_worker, local_host_and_port, echo_server, None)
+    with Supervisor(target, worker_count=2, restart_delay=0.1) as supervisor:
+        for _ in range(8):
+            assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+
+        killed_pid, surviving_pid = supervisor.pids
+        os.kill(killed_pid, signal.SIGKILL)
+        for _ in range(50):
+            if killed_pid not in supervisor.pids:
+                break
+            sleep(0.1)
+
+        assert killed_pid not in supervisor.pids
+        assert surviving_pid in supervisor.pids
+        assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+
+
+def never_ready(ready) -> None:
+    sleep(60)
+
+
+def test_supervisor_stops_the_workers_which_are_not_ready() -> None:
+    supervisor = Supervisor(never_ready, worker_count=2, ready_timeout=0.5)
+    with raises(TimeoutError):
+        supervisor.__enter__()
+    assert supervisor.pids == []
+    assert active_children() == []
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_failover(echo_server: HostAndPort, engine: Engine) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    # Nothing listens on the first upstream, so the connections go to the next one
+    dead_host_and_port = HostAndPort("localhost", random_port())
+    health_check = HealthCheck(interval=0.05, failure_threshold=1, reset_timeout=60)
+    with SocketForwarder(
+        local_host_and_port,
+        dead_host_and_port,
+        engine=engine,
+        fallback_host_and_ports=[echo_server],
+        health_check=health_check,
+    ) as socket_forwarder:
+        assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+        # Once its circuit is open, the dead upstream is not even tried
+        assert socket_forwarder.health_checker.available_host_and_ports() == [echo_server]
+        assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+        socket_forwarder.stop()
+
+
+@fixture
+def unresponsive_server() -> HostAndPort:
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(("localhost", 0))
+    server_socket.listen(0)
+    # Like a host which went away, the server never accepts: once its backlog is full, the new connections hang
+    client_sockets = []
+    for _ in range(2):
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.setblocking(False)
+        client_socket.connect_ex(server_socket.getsockname())
+        client_sockets.append(client_socket)
+    yield HostAndPort.from_tuple(server_socket.getsockname())
+    for client_socket in client_sockets:
+        client_socket.close()
+    server_socket.close()
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_failover_on_connect_timeout(echo_server: HostAndPort, unresponsive_server: HostAndPort, engine: Engine) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    # The upstreams are probed once, at the start
+    health_check = HealthCheck(interval=60, timeout=0.1, failure_threshold=2, reset_timeout=60)
+    with SocketForwarder(
+        local_host_and_port,
+        unresponsive_server,
+        engine=engine,
+        fallback_host_and_ports=[echo_server],
+        health_check=health_check,
+        connect_timeout=0.2,
+    ) as socket_forwarder:
+        health_checker = socket_forwarder.health_checker
+        sleep(0.5)
+        health_checker.record_failure(echo_server)
+
+        start = monotonic()
+        assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+        assert monotonic() - start < 5
+        # The unresponsive upstream failed (after its health check did), while the connection to the next one made up
+        # for the failure recorded before
+        health_checker.record_failure(echo_server)
+        assert health_checker.available_host_and_ports() == [echo_server]
+        socket_forwarder.stop()
+
+
+def test_socket_forwarder_flow_control_with_asyncio(echo_server: HostAndPort) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    watermarks = Watermarks(high=64 * 1024, low=16 * 1024)
+    # The transports would be paused at their own watermarks, and the budget ignored
+    with raises(ValueError):
+        SocketForwarder(local_host_and_port, echo_server, None, engine=Engine.ASYNCIO, memory_budget=MemoryBudget())
+    with raises(ValueError):
+        SocketForwarder(local_host_and_port, echo_server, RecordingEventHandler(), engine=Engine.ASYNCIO, upstream_to_downstream_watermarks=watermarks)
+    SocketForwarder(local_host_and_port, echo_server, RecordingStreamingEventHandler(), engine=Engine.ASYNCIO, upstream_to_downstream_watermarks=watermarks)
+
+
+class PausedTransport():
+
+    def pause_reading(self):
+        pass
+
+
+def test_downstream_protocol_connection_lost_while_connecting(unresponsive_server: HostAndPort) -> None:
+    async def run():
+        downstream_protocol = DownstreamProtocol(None, [unresponsive_server])
+        downstream_protocol.connection_made(PausedTransport())
+        await asyncio.sleep(0.1)
+
+        # The client leaves while upstream does not answer yet
+        downstream_protocol.connection_lost(None)
+        await asyncio.sleep(0)
+        assert downstream_protocol._connect_task.cancelled()
+
+    asyncio.run(run())
+
+
+def receive_all(client_socket: socket.socket) -> bytes:
+    received = bytearray()
+    while chunk := client_socket.recv(65536):
+        received += chunk
+    return bytes(received)
+
+
+@mark.parametrize("engine", [Engine.SELECTORS, *([Engine.EPOLL] if EPOLL_SUPPORTED else [])])
+@mark.parametrize("event_handler", [None, RecordingEventHandler()])
+def test_socket_forwarder_flow_control(firehose_server: HostAndPort, event_handler: EventHandler | None, engine: Engine) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    watermarks = Watermarks(high=64 * 1024, low=16 * 1024)
+    memory_budget = MemoryBudget(limit=32 * 1024)
+    with SocketForwarder(
+        local_host_and_port,
+        firehose_server,
+        event_handler,
+        engine=engine,
+        upstream_to_downstream_watermarks=watermarks,
+        memory_budget=memory_budget,
+    ) as socket_forwarder:
+        client_sockets = [socket.create_connection(local_host_and_port.as_tuple()) for _ in range(4)]
+        # The clients do not read yet, so the proxy buffers as much as it is allowed to
+        sleep(0.2)
+        # No connection buffers more than its high watermark, and the ones over budget stopped at their low one
+        assert 0 < memory_budget.used <= len(client_sockets) * watermarks.high
+        assert memory_budget.pause_count > 0
+
+        for client_socket in client_sockets:
+            with closing(client_socket):
+                assert receive_all(client_socket) == PAYLOAD * 8
+
+        for _ in range(50):
+            if memory_budget.used == 0:
+                break
+            sleep(0.01)
+        assert memory_budget.used == 0
+        socket_forwarder.stop()
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_graceful_stop(echo_server: HostAndPort, engine: Engine) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    with SocketForwarder(local_host_and_port, echo_server, engine=engine) as socket_forwarder:
+        with closing(socket.create_connection(local_host_and_port.as_tuple())) as client_socket:
+            # The request is in flight when the forwarder is told to stop
+            client_socket.sendall(struct.pack("!Q", len(PAYLOAD)) + PAYLOAD[:1024])
+            sleep(0.1)
+            stop_thread = Thread(target=socket_forwarder.stop, kwargs={"grace_period": 10})
+            stop_thread.start()
+            sleep(0.1)
+
+            # No new connection is accepted meanwhile, but the live one is served until its end
+            try:
+                with closing(socket.create_connection(local_host_and_port.as_tuple(), timeout=1)) as refused_socket:
+                    assert refused_socket.recv(1) == b""
+            except ConnectionError:
+                pass
+            client_socket.sendall(PAYLOAD[1024:])
+            assert client_socket.recv(len(PAYLOAD), socket.MSG_WAITALL) == PAYLOAD
+            assert stop_thread.is_alive()
+
+        # The forwarder stops as soon as its last connection is over, rather than at the end of the grace period
+        stop_thread.join(timeout=5)
+        assert not stop_thread.is_alive()
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_graceful_stop_with_deadline(echo_server: HostAndPort, engine: Engine) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    with SocketForwarder(local_host_and_port, echo_server, engine=engine) as socket_forwarder:
+        with closing(socket.create_connection(local_host_and_port.as_tuple())) as client_socket:
+            sleep(0.1)
+            begin = monotonic()
+            socket_forwarder.stop(grace_period=0.5)
+            assert 0.5 <= monotonic() - begin < 5
+            # The connections which are not over by then are cut
+            client_socket.settimeout(1)
+            assert client_socket.recv(1) == b""
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_handoff(echo_server: HostAndPort, engine: Engine, tmp_path: Path) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    handoff_path = tmp_path / "handoff.sock"
+    # The transports of asyncio keep their buffers, so only the listening socket is handed off
+    handoff_connections = engine not in (Engine.ASYNCIO, Engine.UVLOOP)
+    with SocketForwarder(local_host_and_port, echo_server, engine=engine, handoff_path=handoff_path, handoff_connections=handoff_connections) as previous_socket_forwarder:
+        with closing(socket.create_connection(local_host_and_port.as_tuple())) as client_socket:
+            # The request is in flight when the next forwarder takes over
+            client_socket.sendall(struct.pack("!Q", len(PAYLOAD)) + PAYLOAD[:1024])
+            sleep(0.1)
+
+            with SocketForwarder(local_host_and_port, echo_server, engine=engine, handoff_path=handoff_path, handoff_connections=handoff_connections) as next_socket_forwarder:
+                if handoff_connections:
+                    # The previous forwarder had nothing left to serve, and is over
+                    previous_socket_forwarder.wait_for()
+
+                # The listening socket was never closed, and is now served by the next forwarder
+                assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+
+                # The live connection goes on, whichever process serves it
+                client_socket.sendall(PAYLOAD[1024:])
+                assert client_socket.recv(len(PAYLOAD), socket.MSG_WAITALL) == PAYLOAD
+                client_socket.close()
+
+                previous_socket_forwarder.wait_for()
+                # The next forwarder can hand off to the one after it
+                assert handoff_path.exists()
+                next_socket_forwarder.stop()
+
+    assert not handoff_path.exists()
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_failed_handoff(echo_server: HostAndPort, engine: Engine, tmp_path: Path, caplog) -> None:
+    local_host_and_port = HostAndPort("localhost", random_port())
+    handoff_path = tmp_path / "handoff.sock"
+    handoff_connections = engine not in (Engine.ASYNCIO, Engine.UVLOOP)
+    with SocketForwarder(local_host_and_port, echo_server, engine=engine, handoff_path=handoff_path, handoff_connections=handoff_connections) as socket_forwarder:
+        with closing(socket.create_connection(local_host_and_port.as_tuple())) as client_socket:
+            client_socket.sendall(struct.pack("!Q", len(PAYLOAD)) + PAYLOAD[:1024])
+            sleep(0.1)
+
+            # The next process asks for the connections, but goes away before it gets them
+            with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as handoff_socket:
+                handoff_socket.connect(str(handoff_path))
+                handoff_socket.sendall(struct.pack("!?", handoff_connections))
+            sleep(0.1)
+            assert "The handoff failed" in caplog.text
+
+            # The forwarder keeps serving its live connection, and the new ones
+            client_socket.sendall(PAYLOAD[1024:])
+            assert client_socket.recv(len(PAYLOAD), socket.MSG_WAITALL) == PAYLOAD
+            assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+        socket_forwarder.stop()
+
+
+@mark.parametrize("engine", ENGINES)
+def test_socket_forwarder_admission_control(echo_server: HostAndPort, engine: Engine) -> None:
+    wait_times = []
+    admission_control = AdmissionControl(limit=1, timeout=1, rejection=b"busy", on_admitted=wait_times.append)
+    local_host_and_port = HostAndPort("localhost", random_port())
+    with SocketForwarder(local_host_and_port, echo_server, engine=engine, admission_control=admission_control) as socket_forwarder:
+        first_socket = socket.create_connection(local_host_and_port.as_tuple())
+        with closing(first_socket), closing(socket.create_connection(local_host_and_port.as_tuple())) as second_socket:
+            first_socket.sendall(struct.pack("!Q", 5) + b"first")
+            assert first_socket.recv(5, socket.MSG_WAITALL) == b"first"
+
+            # The second client is over the cap, and is only answered once the first one is gone
+            second_socket.sendall(struct.pack("!Q", 6) + b"second")
+            sleep(0.2)
+            assert admission_control.waiting_count == 1
+            first_socket.close()
+            assert second_socket.recv(6, socket.MSG_WAITALL) == b"second"
+            assert admission_control.waiting_count == 0
+            assert wait_times[-1] >= 0.2
+
+            # The third one waits for the second one in vain, and is turned away
+            with closing(socket.create_connection(local_host_and_port.as_tuple())) as third_socket:
+                third_socket.sendall(struct.pack("!Q", 5) + b"third")
+                third_socket.settimeout(5)
+                assert receive_all(third_socket) == b"busy"
+                assert admission_control.timeout_count == 1
+
+        sleep(0.2)
+        assert admission_control.active_count == 0
+        socket_forwarder.stop()
+
+
+def test_socket_forwarder_with_small_segments(echo_server: HostAndPort) -> None:
+    # The pipes are a single page, which a single small segment fills, so they are often out of slots
+    watermarks = Watermarks(high=4096, low=1024)
+    local_host_and_port = HostAndPort("localhost", random_port())
+    with SocketForwarder(local_host_and_port, echo_server, upstream_to_downstream_watermarks=watermarks, downstream_to_upstream_watermarks=watermarks) as socket_forwarder:
+        with closing(socket.create_connection(local_host_and_port.as_tuple())) as client_socket:
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            payload = bytes(range(256)) * 4
+            client_socket.sendall(struct.pack("!Q", len(payload)))
+            for index in range(len(payload)):
+                client_socket.send(payload[index:index + 1])
+            assert client_socket.recv(len(payload), socket.MSG_WAITALL) == payload
+
+        assert echo_through(local_host_and_port, PAYLOAD) == PAYLOAD
+        socket_forwarder.stop()
@@ -0,0 +1,31 @@
+import selectors
+from threading import Thread
+
+from pytest import mark
+
+from radium226.socket_forwarder import Wakeup
+from radium226.socket_forwarder import wakeup as wakeup_module
+
+
+@mark.parametrize("eventfd_supported", [True, False] if wakeup_module.EVENTFD_SUPPORTED else [False])
+def test_wakeup(monkeypatch, eventfd_supported: bool) -> None:
+    # Without an eventfd, the self-pipe is used
+    monkeypatch.setattr(wakeup_module, "EVENTFD_SUPPORTED", eventfd_supported)
+    with Wakeup() as wakeup, selectors.DefaultSelector() as selector:
+        selector.register(wakeup, selectors.EVENT_READ)
+        assert selector.select(0) == []
+
+        # Waking several times before the loop wakes up wakes it once
+        threads = [Thread(target=wakeup.wake) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(selector.select(1)) == 1
+
+        wakeup.clear()
+        assert selector.select(0) == []
+        selector.unregister(wakeup)
+
+    # Once closed with the loop, waking it does nothing
+    wakeup.wake()